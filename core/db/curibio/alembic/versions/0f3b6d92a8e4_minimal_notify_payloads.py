@@ -0,0 +1,150 @@
+"""minimal notify payloads
+
+Revision ID: 0f3b6d92a8e4
+Revises: e7a4c19b5f20
+Create Date: 2026-10-17 20:26:53.718402
+
+"""
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "0f3b6d92a8e4"
+down_revision = "e7a4c19b5f20"
+branch_labels = None
+depends_on = None
+
+
+def _recipients(user_id, scope_type):
+    return f"""
+        'recipients', ARRAY(
+            SELECT DISTINCT CASE WHEN user_id IS NULL THEN customer_id ELSE user_id END
+            FROM account_scopes
+            WHERE customer_id=NEW.customer_id
+                AND (user_id={user_id} OR scope LIKE '%admin%' OR scope={scope_type})
+        ),
+    """
+
+
+UPLOAD_TYPE_RW_ALL_DATA = "(NEW.type::text || '\\:rw_all_data')"
+ADVANCED_ANALYSIS_RW_ALL_DATA = "'advanced_analysis\\:rw_all_data'"
+
+# the versions of the functions created in e7a4c19b5f20 and a316cdf0e2db, restored on downgrade
+PREV_FUNCTIONS = {
+    "uploads_notify_events": f"""
+        json_build_object(
+            'table', 'uploads',
+            'username', (SELECT users.name AS username FROM users WHERE id=NEW.user_id),
+            {_recipients("NEW.user_id", UPLOAD_TYPE_RW_ALL_DATA)}
+            'usage', coalesce((SELECT uploads FROM customer_usage WHERE customer_id=NEW.customer_id AND type=NEW.type), 0)
+        )::jsonb
+        || (row_to_json(NEW.*)::jsonb - 'meta')
+    """,
+    "jobs_result_notify_events": f"""
+        json_build_object(
+            'table', 'jobs_result',
+            'username', (SELECT users.name AS username FROM users JOIN uploads ON users.id=uploads.user_id WHERE uploads.id=NEW.upload_id),
+            'user_id', (SELECT users.id FROM users JOIN uploads ON users.id=uploads.user_id WHERE uploads.id=NEW.upload_id),
+            {_recipients("(SELECT user_id FROM uploads WHERE id=NEW.upload_id)", UPLOAD_TYPE_RW_ALL_DATA)}
+            'usage', coalesce((SELECT jobs FROM customer_usage WHERE customer_id=NEW.customer_id AND type=NEW.type), 0)
+        )::jsonb
+        || (row_to_json(NEW.*)::jsonb - 'meta')
+    """,
+    "advanced_analysis_result_notify_events": f"""
+        json_build_object(
+            'table', 'advanced_analysis_result',
+            'username', (SELECT users.name AS username FROM users WHERE users.id=NEW.user_id),
+            {_recipients("NEW.user_id", ADVANCED_ANALYSIS_RW_ALL_DATA)}
+            'usage', (SELECT COUNT(*) FROM advanced_analysis_result WHERE customer_id=NEW.customer_id)
+        )::jsonb
+        || (row_to_json(NEW.*)::jsonb - 'meta')
+    """,
+}
+
+# the event broker looks up everything else (the row itself, the username, the recipients, the usage) so that
+# writes to these tables don't pay for it. Multiple events are looked up together when they arrive close together
+NEW_FUNCTIONS = {
+    "uploads_notify_events": """
+        json_build_object(
+            'table', 'uploads', 'id', NEW.id, 'customer_id', NEW.customer_id, 'deleted', NEW.deleted
+        )
+    """,
+    "jobs_result_notify_events": """
+        json_build_object(
+            'table', 'jobs_result', 'job_id', NEW.job_id, 'customer_id', NEW.customer_id, 'status', NEW.status
+        )
+    """,
+    "advanced_analysis_result_notify_events": """
+        json_build_object(
+            'table', 'advanced_analysis_result', 'id', NEW.id, 'customer_id', NEW.customer_id, 'status', NEW.status
+        )
+    """,
+}
+
+
+def _create_notify_function(name, payload, condition="TRUE"):
+    op.execute(
+        f"""
+        CREATE OR REPLACE FUNCTION {name}()
+        RETURNS TRIGGER AS $$
+        BEGIN
+            IF {condition} THEN
+                PERFORM pg_notify('events', ({payload})::text);
+            END IF;
+        RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql;
+        """
+    )
+
+
+def upgrade():
+    for name, payload in NEW_FUNCTIONS.items():
+        # incomplete uploads are never shown, so there's no need to send events for them
+        condition = "NEW.multipart_upload_id IS NULL" if name == "uploads_notify_events" else "TRUE"
+        _create_notify_function(name, payload, condition)
+
+    # the event broker caches the scopes of each customer's accounts to determine who receives each event, so it
+    # needs to know when they change
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION account_scopes_notify_events()
+        RETURNS TRIGGER AS $$
+        BEGIN
+            PERFORM pg_notify(
+                'events',
+                json_build_object(
+                    'table', 'account_scopes',
+                    'customer_id', CASE WHEN TG_OP = 'DELETE' THEN OLD.customer_id ELSE NEW.customer_id END
+                )::text
+            );
+        RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """
+    )
+    op.execute(
+        """
+        CREATE TRIGGER trig_account_scopes_notify_events
+        AFTER INSERT OR UPDATE OR DELETE ON account_scopes
+        FOR EACH ROW
+        EXECUTE PROCEDURE account_scopes_notify_events();
+        """
+    )
+
+    for table in ("uploads", "account_scopes", "customer_usage"):
+        op.execute(f"GRANT SELECT ON TABLE {table} TO curibio_event_broker")
+    op.execute("GRANT SELECT (id, name) ON TABLE users TO curibio_event_broker")
+
+
+def downgrade():
+    op.execute("REVOKE SELECT (id, name) ON TABLE users FROM curibio_event_broker")
+    for table in ("customer_usage", "account_scopes", "uploads"):
+        op.execute(f"REVOKE ALL PRIVILEGES ON TABLE {table} FROM curibio_event_broker")
+
+    op.execute("DROP TRIGGER trig_account_scopes_notify_events ON account_scopes CASCADE")
+    op.execute("DROP FUNCTION account_scopes_notify_events CASCADE")
+
+    for name, payload in PREV_FUNCTIONS.items():
+        _create_notify_function(name, payload)
@@ -0,0 +1,109 @@
+"""uploads last_analyzed
+
+Revision ID: 3f6a0d8c2e71
+Revises: 7b3e5f0c9d18
+Create Date: 2026-10-17 16:18:45.120873
+
+"""
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "3f6a0d8c2e71"
+down_revision = "7b3e5f0c9d18"
+branch_labels = None
+depends_on = None
+
+UPLOAD_LISTING_CONDS = "deleted='f' AND multipart_upload_id IS NULL"
+
+
+def upgrade():
+    # creation time of the most recent non-deleted job of the upload, or creation time of the upload if there are none.
+    # Defaults to NOW() which is the same value created_at gets when an upload is inserted
+    op.execute(
+        "ALTER TABLE uploads ADD COLUMN last_analyzed TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT NOW()"
+    )
+
+    # used to find the latest job of an upload
+    op.execute(
+        "CREATE INDEX jobs_result_upload_id_created_at_idx ON jobs_result (upload_id, created_at) "
+        "WHERE status!='deleted'"
+    )
+
+    # SECURITY DEFINER since the roles that modify jobs_result do not all have UPDATE on uploads
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION refresh_upload_last_analyzed(upload_id_to_refresh uuid)
+        RETURNS VOID
+        SECURITY DEFINER
+        SET search_path = public
+        AS $$
+            -- only touch the upload if the value actually changes so job status updates do not cause upload events
+            UPDATE uploads SET last_analyzed=l.last_analyzed
+            FROM (
+                SELECT coalesce(
+                    (SELECT max(created_at) FROM jobs_result WHERE upload_id=upload_id_to_refresh AND status!='deleted'),
+                    (SELECT created_at FROM uploads WHERE id=upload_id_to_refresh)
+                ) AS last_analyzed
+            ) AS l
+            WHERE uploads.id=upload_id_to_refresh AND uploads.last_analyzed IS DISTINCT FROM l.last_analyzed;
+        $$ LANGUAGE sql;
+        """
+    )
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION update_upload_last_analyzed()
+        RETURNS TRIGGER AS $$
+        BEGIN
+            IF TG_OP != 'DELETE' THEN
+                PERFORM refresh_upload_last_analyzed(NEW.upload_id);
+            END IF;
+            IF TG_OP = 'DELETE' OR (TG_OP = 'UPDATE' AND OLD.upload_id IS DISTINCT FROM NEW.upload_id) THEN
+                PERFORM refresh_upload_last_analyzed(OLD.upload_id);
+            END IF;
+        RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """
+    )
+    op.execute(
+        """
+        CREATE TRIGGER trig_update_upload_last_analyzed
+        AFTER INSERT OR DELETE OR UPDATE OF upload_id, status, created_at ON jobs_result
+        FOR EACH ROW
+        EXECUTE PROCEDURE update_upload_last_analyzed();
+        """
+    )
+    # don't send an upload event for every row being backfilled
+    op.execute("ALTER TABLE uploads DISABLE TRIGGER trig_uploads_notify_events")
+    op.execute(
+        "UPDATE uploads SET last_analyzed=coalesce("
+        "(SELECT max(created_at) FROM jobs_result WHERE upload_id=uploads.id AND status!='deleted'), created_at"
+        ")"
+    )
+    op.execute("ALTER TABLE uploads ENABLE TRIGGER trig_uploads_notify_events")
+
+    # listing queries filter by customer (admin), customer and type (rw_all_data users), or user and type (base
+    # users), and sort/filter by last_analyzed
+    for name, cols in (
+        ("uploads_customer_id_last_analyzed_idx", "customer_id, last_analyzed"),
+        ("uploads_customer_id_type_last_analyzed_idx", "customer_id, type, last_analyzed"),
+        ("uploads_user_id_type_last_analyzed_idx", "user_id, type, last_analyzed"),
+    ):
+        op.execute(f"CREATE INDEX {name} ON uploads ({cols}) WHERE {UPLOAD_LISTING_CONDS}")
+
+
+def downgrade():
+    for name in (
+        "uploads_user_id_type_last_analyzed_idx",
+        "uploads_customer_id_type_last_analyzed_idx",
+        "uploads_customer_id_last_analyzed_idx",
+    ):
+        op.execute(f"DROP INDEX {name}")
+
+    op.execute("DROP TRIGGER trig_update_upload_last_analyzed ON jobs_result CASCADE")
+    op.execute("DROP FUNCTION update_upload_last_analyzed CASCADE")
+    op.execute("DROP FUNCTION refresh_upload_last_analyzed CASCADE")
+    op.execute("DROP INDEX jobs_result_upload_id_created_at_idx")
+    op.execute("ALTER TABLE uploads DROP COLUMN last_analyzed")
@@ -0,0 +1,58 @@
+"""ma compatibility notify
+
+Revision ID: 5c81e0d47a93
+Revises: 0f3b6d92a8e4
+Create Date: 2026-10-17 22:41:07.294816
+
+"""
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "5c81e0d47a93"
+down_revision = "0f3b6d92a8e4"
+branch_labels = None
+depends_on = None
+
+
+# the mantarray service keeps these tables in memory and reloads them when notified of a change
+COMPATIBILITY_TABLES = (
+    "ma_main_firmware",
+    "ma_channel_firmware",
+    "ma_controllers",
+    "sting_controllers",
+    "maunits",
+)
+
+
+def upgrade():
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION ma_compatibility_notify()
+        RETURNS TRIGGER AS $$
+        BEGIN
+            PERFORM pg_notify('ma_compatibility', TG_TABLE_NAME);
+        RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """
+    )
+
+    for table in COMPATIBILITY_TABLES:
+        # statement level since the whole table is reloaded no matter how many rows changed
+        op.execute(
+            f"""
+            CREATE TRIGGER trig_ma_compatibility_notify
+            AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table}
+            FOR EACH STATEMENT
+            EXECUTE PROCEDURE ma_compatibility_notify();
+            """
+        )
+
+
+def downgrade():
+    for table in COMPATIBILITY_TABLES:
+        op.execute(f"DROP TRIGGER trig_ma_compatibility_notify ON {table} CASCADE")
+
+    op.execute("DROP FUNCTION ma_compatibility_notify CASCADE")
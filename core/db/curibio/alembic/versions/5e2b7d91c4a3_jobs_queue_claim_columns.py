@@ -0,0 +1,27 @@
+"""jobs_queue claim columns
+
+Revision ID: 5e2b7d91c4a3
+Revises: 40088c3ef46c
+Create Date: 2026-10-17 09:12:41.203918
+
+"""
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "5e2b7d91c4a3"
+down_revision = "40088c3ef46c"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Workers now mark the rows they are processing instead of holding a transaction with the row deleted
+    op.execute("ALTER TABLE jobs_queue ADD COLUMN claimed_by VARCHAR(64)")
+    op.execute("ALTER TABLE jobs_queue ADD COLUMN claimed_at TIMESTAMP WITHOUT TIME ZONE")
+
+
+def downgrade():
+    op.execute("ALTER TABLE jobs_queue DROP COLUMN claimed_at")
+    op.execute("ALTER TABLE jobs_queue DROP COLUMN claimed_by")
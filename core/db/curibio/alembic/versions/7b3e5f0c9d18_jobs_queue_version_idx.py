@@ -0,0 +1,28 @@
+"""jobs_queue version idx
+
+Revision ID: 7b3e5f0c9d18
+Revises: e2d94b7a15f3
+Create Date: 2026-10-17 15:32:10.664390
+
+"""
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "7b3e5f0c9d18"
+down_revision = "e2d94b7a15f3"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # queue processors count items with `WHERE queue LIKE 'prefix%' GROUP BY meta->>'version'`.
+    # text_pattern_ops is needed for LIKE prefix matches to use the index
+    op.execute(
+        "CREATE INDEX jobs_queue_version_idx ON jobs_queue (queue text_pattern_ops, (meta->>'version'))"
+    )
+
+
+def downgrade():
+    op.execute("DROP INDEX jobs_queue_version_idx")
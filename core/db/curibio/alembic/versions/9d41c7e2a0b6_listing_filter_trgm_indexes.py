@@ -0,0 +1,41 @@
+"""listing filter trgm indexes
+
+Revision ID: 9d41c7e2a0b6
+Revises: 3f6a0d8c2e71
+Create Date: 2026-10-17 17:05:37.482916
+
+"""
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "9d41c7e2a0b6"
+down_revision = "3f6a0d8c2e71"
+branch_labels = None
+depends_on = None
+
+# the listing search filters match substrings with (I)LIKE '%x%', which a b-tree index can't be used for.
+# These expressions must match the ones used in the filters exactly for the indexes to be used
+TRGM_INDEXES = (
+    ("uploads_filename_trgm_idx", "uploads", "filename"),
+    ("uploads_id_trgm_idx", "uploads", "(id::text)"),
+    ("users_name_trgm_idx", "users", "name"),
+    ("jobs_result_filename_trgm_idx", "jobs_result", "(reverse(split_part(reverse(object_key), '/', 1)))"),
+    ("advanced_analysis_result_name_trgm_idx", "advanced_analysis_result", "name"),
+    ("advanced_analysis_result_id_trgm_idx", "advanced_analysis_result", "(id::text)"),
+)
+
+
+def upgrade():
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+
+    for name, table, expr in TRGM_INDEXES:
+        op.execute(f"CREATE INDEX {name} ON {table} USING gin ({expr} gin_trgm_ops)")
+
+
+def downgrade():
+    for name, *_ in reversed(TRGM_INDEXES):
+        op.execute(f"DROP INDEX {name}")
+
+    op.execute("DROP EXTENSION IF EXISTS pg_trgm")
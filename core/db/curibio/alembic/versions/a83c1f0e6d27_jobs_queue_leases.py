@@ -0,0 +1,32 @@
+"""jobs_queue leases
+
+Revision ID: a83c1f0e6d27
+Revises: 5e2b7d91c4a3
+Create Date: 2026-10-17 11:03:27.518604
+
+"""
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "a83c1f0e6d27"
+down_revision = "5e2b7d91c4a3"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute("ALTER TABLE jobs_queue ADD COLUMN lease_expires_at TIMESTAMP WITHOUT TIME ZONE")
+    op.execute("ALTER TABLE jobs_queue ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+    # only claimed items have a lease, so keep the index small
+    op.execute(
+        "CREATE INDEX jobs_queue_lease_expires_at_idx ON jobs_queue (queue, lease_expires_at) "
+        "WHERE claimed_by IS NOT NULL"
+    )
+
+
+def downgrade():
+    op.execute("DROP INDEX jobs_queue_lease_expires_at_idx")
+    op.execute("ALTER TABLE jobs_queue DROP COLUMN attempts")
+    op.execute("ALTER TABLE jobs_queue DROP COLUMN lease_expires_at")
@@ -0,0 +1,116 @@
+"""download bundles
+
+Revision ID: b52e8f1d7c34
+Revises: 9d41c7e2a0b6
+Create Date: 2026-10-17 18:12:04.538217
+
+"""
+
+import os
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "b52e8f1d7c34"
+down_revision = "9d41c7e2a0b6"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    qp_user_pass = os.getenv("DOWNLOAD_BUNDLES_QUEUE_PROCESSOR_RO_PASS")
+    if qp_user_pass is None:
+        raise Exception("Missing required value for DOWNLOAD_BUNDLES_QUEUE_PROCESSOR_RO_PASS")
+
+    # ZIPs of multiple files built by the download bundle workers. The id is the same as the id of the queue item
+    # that builds the bundle. bundle_hash identifies the contents of the bundle so that it can be reused by later
+    # requests for the same files. recipients are the accounts that requested the bundle and are notified when it
+    # is ready
+    op.execute(
+        """
+        CREATE TABLE download_bundles (
+            id          uuid PRIMARY KEY,
+            bundle_hash text NOT NULL,
+            user_id     uuid,
+            customer_id uuid NOT NULL,
+            recipients  uuid[] NOT NULL,
+            filename    text NOT NULL,
+            status      "JobStatus" NOT NULL,
+            meta        jsonb NOT NULL DEFAULT '{}'::jsonb,
+            created_at  TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT NOW(),
+            started_at  TIMESTAMP WITHOUT TIME ZONE,
+            finished_at TIMESTAMP WITHOUT TIME ZONE,
+            runtime     double precision,
+            object_key  text,
+            CONSTRAINT fk_download_bundles_customers FOREIGN KEY (customer_id) REFERENCES customers(id) ON DELETE CASCADE,
+            CONSTRAINT fk_download_bundles_users FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        )
+        """
+    )
+    # only one bundle of the same files should be built at a time, requests made while it is being built are added
+    # to its recipients instead
+    op.execute(
+        "CREATE UNIQUE INDEX download_bundles_in_progress_hash_idx ON download_bundles (bundle_hash) "
+        "WHERE status IN ('pending', 'running')"
+    )
+    op.execute(
+        "CREATE INDEX download_bundles_finished_hash_idx ON download_bundles (bundle_hash, finished_at) "
+        "WHERE status='finished'"
+    )
+    op.execute("CREATE INDEX download_bundles_finished_at_idx ON download_bundles (finished_at)")
+
+    op.execute("GRANT ALL PRIVILEGES ON TABLE download_bundles TO curibio_jobs")
+    op.execute("GRANT SELECT ON TABLE download_bundles TO curibio_event_broker")
+
+    op.execute(f"CREATE USER download_bundles_queue_processor_ro WITH PASSWORD '{qp_user_pass}'")
+    op.execute("GRANT SELECT ON TABLE jobs_queue TO download_bundles_queue_processor_ro")
+    op.execute(
+        "GRANT SELECT (status, runtime, finished_at, meta) ON TABLE download_bundles "
+        "TO download_bundles_queue_processor_ro"
+    )
+
+    # the event broker only needs to know when a bundle is done
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION download_bundles_notify_events()
+        RETURNS TRIGGER AS $$
+        BEGIN
+            IF NEW.status IN ('finished', 'error') AND OLD.status IS DISTINCT FROM NEW.status THEN
+                PERFORM pg_notify(
+                    'events',
+                    (
+                        json_build_object('table', 'download_bundles')::jsonb
+                        || (row_to_json(NEW.*)::jsonb - 'meta' - 'bundle_hash')
+                    )::text
+                );
+            END IF;
+        RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql;
+        """
+    )
+    op.execute(
+        """
+        CREATE TRIGGER trig_download_bundles_notify_events
+        AFTER UPDATE OF status ON download_bundles
+        FOR EACH ROW
+        EXECUTE PROCEDURE download_bundles_notify_events();
+        """
+    )
+
+
+def downgrade():
+    op.execute("DROP TRIGGER trig_download_bundles_notify_events ON download_bundles CASCADE")
+    op.execute("DROP FUNCTION download_bundles_notify_events CASCADE")
+
+    op.execute(
+        "REVOKE SELECT (status, runtime, finished_at, meta) ON TABLE download_bundles "
+        "FROM download_bundles_queue_processor_ro"
+    )
+    op.execute("REVOKE ALL PRIVILEGES ON TABLE jobs_queue FROM download_bundles_queue_processor_ro")
+    op.execute("DROP USER download_bundles_queue_processor_ro")
+
+    op.execute("REVOKE ALL PRIVILEGES ON TABLE download_bundles FROM curibio_event_broker")
+    op.execute("REVOKE ALL PRIVILEGES ON TABLE download_bundles FROM curibio_jobs")
+    op.execute("DROP TABLE download_bundles")
@@ -0,0 +1,43 @@
+"""queue processor result metrics
+
+Revision ID: c4f1e8a92b50
+Revises: a83c1f0e6d27
+Create Date: 2026-10-17 13:26:08.930152
+
+"""
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "c4f1e8a92b50"
+down_revision = "a83c1f0e6d27"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # queue processors report runtimes of recently finished jobs, so only need to read these columns
+    op.execute(
+        "GRANT SELECT (status, runtime, finished_at, meta) ON TABLE jobs_result TO pulse3d_queue_processor_ro"
+    )
+    op.execute(
+        "GRANT SELECT (status, runtime, finished_at, meta) ON TABLE advanced_analysis_result "
+        "TO advanced_analysis_queue_processor_ro"
+    )
+    op.execute("CREATE INDEX jobs_result_finished_at_idx ON jobs_result (finished_at)")
+    op.execute(
+        "CREATE INDEX advanced_analysis_result_finished_at_idx ON advanced_analysis_result (finished_at)"
+    )
+
+
+def downgrade():
+    op.execute("DROP INDEX advanced_analysis_result_finished_at_idx")
+    op.execute("DROP INDEX jobs_result_finished_at_idx")
+    op.execute(
+        "REVOKE SELECT (status, runtime, finished_at, meta) ON TABLE advanced_analysis_result "
+        "FROM advanced_analysis_queue_processor_ro"
+    )
+    op.execute(
+        "REVOKE SELECT (status, runtime, finished_at, meta) ON TABLE jobs_result FROM pulse3d_queue_processor_ro"
+    )
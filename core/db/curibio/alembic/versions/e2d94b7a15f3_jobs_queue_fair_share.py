@@ -0,0 +1,46 @@
+"""jobs_queue fair share
+
+Revision ID: e2d94b7a15f3
+Revises: c4f1e8a92b50
+Create Date: 2026-10-17 14:41:52.377201
+
+"""
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "e2d94b7a15f3"
+down_revision = "c4f1e8a92b50"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute("ALTER TABLE jobs_queue ADD COLUMN customer_id UUID")
+    op.execute(
+        "ALTER TABLE jobs_queue ADD COLUMN scheduled_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT NOW()"
+    )
+    # items already in the queue keep their current order
+    op.execute("UPDATE jobs_queue SET scheduled_at=created_at")
+    op.execute("UPDATE jobs_queue q SET customer_id=r.customer_id FROM jobs_result r WHERE q.id=r.job_id")
+    op.execute(
+        "UPDATE jobs_queue q SET customer_id=r.customer_id FROM advanced_analysis_result r WHERE q.id=r.id"
+    )
+
+    # claiming only looks at unclaimed items, in the order they will be claimed
+    op.execute(
+        "CREATE INDEX jobs_queue_claim_idx ON jobs_queue (queue, priority DESC, scheduled_at) "
+        "WHERE claimed_by IS NULL"
+    )
+    # used to find the last scheduled item of a customer when enqueuing
+    op.execute(
+        "CREATE INDEX jobs_queue_customer_scheduled_at_idx ON jobs_queue (queue, customer_id, scheduled_at)"
+    )
+
+
+def downgrade():
+    op.execute("DROP INDEX jobs_queue_customer_scheduled_at_idx")
+    op.execute("DROP INDEX jobs_queue_claim_idx")
+    op.execute("ALTER TABLE jobs_queue DROP COLUMN scheduled_at")
+    op.execute("ALTER TABLE jobs_queue DROP COLUMN customer_id")
@@ -0,0 +1,25 @@
+"""jobs_queue last error
+
+Revision ID: e3a9d4c7f218
+Revises: 5c81e0d47a93
+Create Date: 2026-10-17 23:12:48.603915
+
+"""
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "e3a9d4c7f218"
+down_revision = "5c81e0d47a93"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # the error an item was released with, so it is not reported as running out of time/memory if it is failed
+    op.execute("ALTER TABLE jobs_queue ADD COLUMN last_error TEXT")
+
+
+def downgrade():
+    op.execute("ALTER TABLE jobs_queue DROP COLUMN last_error")
@@ -0,0 +1,236 @@
+"""customer usage counters
+
+Revision ID: e7a4c19b5f20
+Revises: b52e8f1d7c34
+Create Date: 2026-10-17 19:41:27.603915
+
+"""
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "e7a4c19b5f20"
+down_revision = "b52e8f1d7c34"
+branch_labels = None
+depends_on = None
+
+
+# the notify functions as they were before the counters existed, restored on downgrade
+FROM_CURRENT_USAGE = """
+    FROM (
+        SELECT ( CASE WHEN (COUNT(*) <= 2 AND COUNT(*) > 0) THEN 1 ELSE GREATEST(COUNT(*) - 1, 0) END ) AS jobs_count
+        FROM jobs_result WHERE customer_id=NEW.customer_id and type=NEW.type GROUP BY upload_id
+    ) dt
+"""
+UPLOADS_USAGE = f"(SELECT COUNT(*) AS total_uploads {FROM_CURRENT_USAGE})"
+JOBS_USAGE = f"(SELECT SUM(jobs_count) AS total_jobs {FROM_CURRENT_USAGE})"
+
+
+def _create_notify_functions(uploads_usage, jobs_usage):
+    op.execute(
+        f"""
+        CREATE OR REPLACE FUNCTION uploads_notify_events()
+        RETURNS TRIGGER AS $$
+        BEGIN
+            PERFORM pg_notify(
+                'events',
+                (
+                    json_build_object(
+                        'table', 'uploads',
+                        'username', (SELECT users.name AS username FROM users WHERE id=NEW.user_id),
+                        'recipients', ARRAY(
+                            SELECT DISTINCT CASE WHEN user_id IS NULL THEN customer_id ELSE user_id END
+                            FROM account_scopes
+                            WHERE customer_id=NEW.customer_id
+                                AND (user_id=NEW.user_id OR scope LIKE '%admin%' OR scope=(NEW.type::text || '\\:rw_all_data'))
+                        ),
+                        'usage', {uploads_usage}
+                    )::jsonb
+                    || (row_to_json(NEW.*)::jsonb - 'meta')
+                )::text
+            );
+        RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql;
+        """
+    )
+
+    op.execute(
+        f"""
+        CREATE OR REPLACE FUNCTION jobs_result_notify_events()
+        RETURNS TRIGGER AS $$
+        BEGIN
+            PERFORM pg_notify(
+                'events',
+                (
+                    json_build_object(
+                        'table', 'jobs_result',
+                        'username', (SELECT users.name AS username FROM users JOIN uploads ON users.id=uploads.user_id WHERE uploads.id=NEW.upload_id),
+                        'user_id', (SELECT users.id FROM users JOIN uploads ON users.id=uploads.user_id WHERE uploads.id=NEW.upload_id),
+                        'recipients', ARRAY(
+                            SELECT DISTINCT CASE WHEN user_id IS NULL THEN customer_id ELSE user_id END
+                            FROM account_scopes
+                            WHERE customer_id=NEW.customer_id
+                                AND (user_id=(SELECT user_id FROM uploads WHERE id=NEW.upload_id) OR scope LIKE '%admin%' OR scope=(NEW.type::text || '\\:rw_all_data'))
+                        ),
+                        'usage', {jobs_usage}
+                    )::jsonb
+                    || (row_to_json(NEW.*)::jsonb - 'meta')
+                )::text
+            );
+        RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql;
+        """
+    )
+
+
+def upgrade():
+    # number of jobs of each type each upload has, any status. Only needed to know how many credits an upload
+    # uses when one of its jobs is added or removed. No foreign keys since rows are cleaned up by the trigger
+    # below when the jobs they count are deleted, which may happen in a cascade from the upload or customer
+    op.execute(
+        """
+        CREATE TABLE upload_job_counts (
+            upload_id   uuid NOT NULL,
+            customer_id uuid NOT NULL,
+            type        "UploadType" NOT NULL,
+            num_jobs    integer NOT NULL,
+            PRIMARY KEY (upload_id, customer_id, type)
+        )
+        """
+    )
+    # totals of upload_job_counts per customer and upload type, what the usage quota is checked against
+    op.execute(
+        """
+        CREATE TABLE customer_usage (
+            customer_id uuid NOT NULL,
+            type        "UploadType" NOT NULL,
+            uploads     integer NOT NULL DEFAULT 0,
+            jobs        integer NOT NULL DEFAULT 0,
+            PRIMARY KEY (customer_id, type)
+        )
+        """
+    )
+
+    # upload with 1 - 2 jobs = 1 credit, upload with 3+ jobs = 1 credit for each job after the first
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION upload_job_credits(num_jobs integer)
+        RETURNS integer
+        IMMUTABLE
+        AS $$
+            SELECT CASE WHEN num_jobs <= 0 THEN 0 WHEN num_jobs <= 2 THEN 1 ELSE num_jobs - 1 END;
+        $$ LANGUAGE sql;
+        """
+    )
+    # SECURITY DEFINER since the roles that modify jobs_result only have SELECT on the counter tables
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION change_customer_usage(
+            usage_customer_id uuid, usage_type "UploadType", usage_upload_id uuid, num_jobs_delta integer
+        )
+        RETURNS VOID
+        SECURITY DEFINER
+        SET search_path = public
+        AS $$
+        DECLARE
+            new_num_jobs integer;
+            old_num_jobs integer;
+        BEGIN
+            -- the upsert locks the upload's row, so changes to jobs of the same upload in concurrent transactions
+            -- are counted one after another
+            INSERT INTO upload_job_counts AS c (upload_id, customer_id, type, num_jobs)
+            VALUES (usage_upload_id, usage_customer_id, usage_type, num_jobs_delta)
+            ON CONFLICT (upload_id, customer_id, type) DO UPDATE SET num_jobs=c.num_jobs + num_jobs_delta
+            RETURNING c.num_jobs INTO new_num_jobs;
+            old_num_jobs := new_num_jobs - num_jobs_delta;
+
+            IF new_num_jobs <= 0 THEN
+                DELETE FROM upload_job_counts
+                WHERE upload_id=usage_upload_id AND customer_id=usage_customer_id AND type=usage_type;
+            END IF;
+
+            INSERT INTO customer_usage AS u (customer_id, type, uploads, jobs)
+            VALUES (
+                usage_customer_id,
+                usage_type,
+                (new_num_jobs > 0)::integer - (old_num_jobs > 0)::integer,
+                upload_job_credits(new_num_jobs) - upload_job_credits(old_num_jobs)
+            )
+            ON CONFLICT (customer_id, type) DO UPDATE
+            SET uploads=u.uploads + EXCLUDED.uploads, jobs=u.jobs + EXCLUDED.jobs;
+        END;
+        $$ LANGUAGE plpgsql;
+        """
+    )
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION update_customer_usage()
+        RETURNS TRIGGER AS $$
+        BEGIN
+            IF TG_OP = 'UPDATE'
+                AND (OLD.customer_id, OLD.type, OLD.upload_id) IS NOT DISTINCT FROM (NEW.customer_id, NEW.type, NEW.upload_id)
+            THEN
+                RETURN NULL;
+            END IF;
+            IF TG_OP != 'INSERT' THEN
+                PERFORM change_customer_usage(OLD.customer_id, OLD.type, OLD.upload_id, -1);
+            END IF;
+            IF TG_OP != 'DELETE' THEN
+                PERFORM change_customer_usage(NEW.customer_id, NEW.type, NEW.upload_id, 1);
+            END IF;
+        RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """
+    )
+    # row triggers for the same event fire in name order, so this has to sort before trig_jobs_result_notify_events
+    # for the usage in the event to include the new job
+    op.execute(
+        """
+        CREATE TRIGGER trig_jobs_result_customer_usage
+        AFTER INSERT OR DELETE OR UPDATE OF customer_id, type, upload_id ON jobs_result
+        FOR EACH ROW
+        EXECUTE PROCEDURE update_customer_usage();
+        """
+    )
+
+    # creating the trigger locks jobs_result against writes until this transaction commits, so no jobs can be
+    # added or removed between the backfill and the trigger taking over
+    op.execute(
+        """
+        INSERT INTO upload_job_counts (upload_id, customer_id, type, num_jobs)
+        SELECT upload_id, customer_id, type, COUNT(*) FROM jobs_result GROUP BY upload_id, customer_id, type
+        """
+    )
+    op.execute(
+        """
+        INSERT INTO customer_usage (customer_id, type, uploads, jobs)
+        SELECT customer_id, type, COUNT(*), SUM(upload_job_credits(num_jobs))
+        FROM upload_job_counts GROUP BY customer_id, type
+        """
+    )
+
+    for role in ("curibio_jobs", "curibio_jobs_ro", "curibio_users", "curibio_users_ro"):
+        op.execute(f"GRANT SELECT ON TABLE customer_usage TO {role}")
+
+    _create_notify_functions(
+        "coalesce((SELECT uploads FROM customer_usage WHERE customer_id=NEW.customer_id AND type=NEW.type), 0)",
+        "coalesce((SELECT jobs FROM customer_usage WHERE customer_id=NEW.customer_id AND type=NEW.type), 0)",
+    )
+
+
+def downgrade():
+    _create_notify_functions(UPLOADS_USAGE, JOBS_USAGE)
+
+    for role in ("curibio_users_ro", "curibio_users", "curibio_jobs_ro", "curibio_jobs"):
+        op.execute(f"REVOKE ALL PRIVILEGES ON TABLE customer_usage FROM {role}")
+
+    op.execute("DROP TRIGGER trig_jobs_result_customer_usage ON jobs_result CASCADE")
+    op.execute("DROP FUNCTION update_customer_usage CASCADE")
+    op.execute("DROP FUNCTION change_customer_usage CASCADE")
+    op.execute("DROP FUNCTION upload_job_credits CASCADE")
+    op.execute("DROP TABLE customer_usage")
+    op.execute("DROP TABLE upload_job_counts")
@@ -24,4 +24,5 @@ from .tokens import (
     AuthTokens,
     create_new_tokens,
     get_account_scopes,
+    ACCOUNT_SCOPES_CACHE,
 )
@@ -11,3 +11,7 @@ JWT_SECRET_KEY = config("JWT_SECRET_KEY", cast=Secret)
 JWT_ALGORITHM = config("JWT_ALGORITHM", cast=str, default="HS256")
 JWT_AUDIENCE = config("JWT_AUDIENCE", cast=str, default="curibio:auth")
 JWT_TOKEN_PREFIX = config("JWT_TOKEN_PREFIX", cast=str, default="Bearer")
+
+# max number of verified tokens cached by ProtectedAny. Access tokens expire after a few minutes, so this only needs to
+# cover the clients active within that time
+VERIFIED_TOKEN_CACHE_SIZE = config("VERIFIED_TOKEN_CACHE_SIZE", cast=int, default=10000)
@@ -1,5 +1,10 @@
+import asyncio
 from calendar import timegm
+from collections import OrderedDict
 from datetime import datetime, timezone, timedelta
+import json
+import time
+from typing import NamedTuple
 from uuid import UUID
 import logging
 
@@ -8,6 +13,7 @@ from pydantic import BaseModel
 from fastapi import HTTPException, Depends, status
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 import jwt
+from prometheus_client import Counter, Histogram
 
 from .models import AccountTypes, JWTMeta, JWTDetails, JWTPayload, LoginType, Token
 from .settings import (
@@ -17,6 +23,7 @@ from .settings import (
     ACCESS_TOKEN_EXPIRE_MINUTES,
     REFRESH_TOKEN_EXPIRE_MINUTES,
     EMAIL_VER_TOKEN_EXPIRE_MINUTES,
+    VERIFIED_TOKEN_CACHE_SIZE,
 )
 from .scopes import ScopeTags, Scopes, convert_scope_str
 
@@ -24,12 +31,66 @@ security = HTTPBearer()
 
 logger = logging.getLogger(__name__)
 
+TOKEN_DECODE_SECONDS = Histogram(
+    "auth_token_decode_seconds",
+    "Time spent decoding and validating a token that wasn't in the verified token cache",
+    buckets=(0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01),
+)
+TOKEN_CACHE_LOOKUPS = Counter(
+    "auth_verified_token_cache_lookups", "Lookups in the verified token cache", ["result"]
+)
+ACCOUNT_SCOPES_CACHE_LOOKUPS = Counter(
+    "auth_account_scopes_cache_lookups", "Lookups in the account scopes cache", ["result"]
+)
+
 
 class AuthTokens(BaseModel):
     access: Token
     refresh: Token
 
 
+class _VerifiedToken(NamedTuple):
+    payload: JWTPayload
+    scopes: frozenset[Scopes]
+
+
+class _VerifiedTokenCache:
+    """LRU cache of the payloads of tokens that have already been decoded and validated.
+
+    Clients reuse the same access token for many requests during its lifetime, so this skips verifying the
+    signature and building the payload model again for each one. Entries are only used until the token expires.
+    The cached payload is shared between requests, so it must not be modified.
+    """
+
+    def __init__(self, maxsize: int) -> None:
+        self._maxsize = maxsize
+        self._tokens: OrderedDict[str, _VerifiedToken] = OrderedDict()
+
+    def get(self, token: str) -> _VerifiedToken:
+        if (verified_token := self._tokens.get(token)) is not None:
+            if time.time() < verified_token.payload.exp:
+                self._tokens.move_to_end(token)
+                TOKEN_CACHE_LOOKUPS.labels("hit").inc()
+                return verified_token
+            del self._tokens[token]
+        TOKEN_CACHE_LOOKUPS.labels("miss").inc()
+
+        with TOKEN_DECODE_SECONDS.time():
+            payload = decode_token(token)
+        verified_token = _VerifiedToken(payload, frozenset(payload.scopes))
+
+        self._tokens[token] = verified_token
+        if len(self._tokens) > self._maxsize:
+            self._tokens.popitem(last=False)
+        return verified_token
+
+    def clear(self) -> None:
+        self._tokens.clear()
+
+
+VERIFIED_TOKEN_CACHE = _VerifiedTokenCache(VERIFIED_TOKEN_CACHE_SIZE)
+
+
 class ProtectedAny:
     def __init__(self, *, scopes: list[Scopes] | None = None, tag: ScopeTags | None = None):
         if scopes:
@@ -43,11 +104,10 @@ class ProtectedAny:
         token = credentials.credentials
 
         try:
-            payload = decode_token(token)
-            payload_scopes = set(payload.scopes)
+            payload, payload_scopes = VERIFIED_TOKEN_CACHE.get(token)
 
             # make sure that the access token has the required scope
-            if not self.scopes & payload_scopes:
+            if self.scopes.isdisjoint(payload_scopes):
                 # TODO raise a specific exeption here so that other errors result in a 500?
                 raise Exception("Required scope(s) not present")
 
@@ -147,24 +207,92 @@ def create_token(
 # TODO add testing for all this
 
 
-async def get_account_scopes(db_con, customer_id, user_id):
-    admin_scopes = await db_con.fetch(
-        "SELECT scope FROM account_scopes WHERE customer_id=$1 AND user_id IS NULL", customer_id
-    )
-    admin_scopes = [convert_scope_str(row["scope"]) for row in admin_scopes]
+class _AccountScopesCache:
+    """The resolved scopes of each account, including those inherited from its admin.
 
-    if user_id is None:
-        # if this is None, then we are retrieving the account scopes of the admin itself
-        return admin_scopes
+    Entries can only be trusted while something reports when they change, so the cache is only used while a
+    connection is listening for account_scopes change notifications (see listen). All of a customer's entries are
+    dropped when any of their accounts' scopes change.
+    """
+
+    def __init__(self) -> None:
+        self._scopes: dict[UUID, dict[UUID | None, tuple[Scopes, ...]]] = {}
+        # incremented whenever entries are dropped so that scopes queried before a change aren't cached after it
+        self.generation = 0
+        self._listening = False
+
+    def invalidate(self, customer_id: UUID | None = None) -> None:
+        self.generation += 1
+        if customer_id is None:
+            self._scopes.clear()
+        else:
+            self._scopes.pop(customer_id, None)
+
+    def get(self, customer_id: UUID, user_id: UUID | None) -> tuple[Scopes, ...] | None:
+        if not self._listening:
+            return None
+        scopes = self._scopes.get(customer_id, {}).get(user_id)
+        ACCOUNT_SCOPES_CACHE_LOOKUPS.labels("miss" if scopes is None else "hit").inc()
+        return scopes
+
+    def set(self, customer_id: UUID, user_id: UUID | None, scopes: list[Scopes], generation: int) -> None:
+        if self._listening and generation == self.generation:
+            self._scopes.setdefault(customer_id, {})[user_id] = tuple(scopes)
+
+    def _handle_notification(self, con, pid, channel, payload) -> None:
+        payload = json.loads(payload)
+        if payload.get("table") == "account_scopes":
+            self.invalidate(UUID(payload["customer_id"]))
+
+    async def listen(self, con) -> None:
+        """Use the cache while listening for changes on the given connection, until it closes."""
+        con_termination_event = asyncio.Event()
+        con.add_termination_listener(lambda _: con_termination_event.set())
+        await con.add_listener("events", self._handle_notification)
+
+        # scopes may have changed while not listening
+        self.invalidate()
+        self._listening = True
+        try:
+            await con_termination_event.wait()
+        finally:
+            self._listening = False
+            self.invalidate()
 
-    # assigned scopes
-    user_scopes = await db_con.fetch("SELECT scope FROM account_scopes WHERE user_id=$1", user_id)
-    user_scopes = [convert_scope_str(row["scope"]) for row in user_scopes]
-    # inherited scopes
-    for admin_scope in admin_scopes:
-        user_scopes += admin_scope.inheritable_scopes
 
-    return user_scopes
+ACCOUNT_SCOPES_CACHE = _AccountScopesCache()
+
+
+async def get_account_scopes(db_con, customer_id, user_id, *, use_cache=False):
+    """Get the scopes of the admin account (user_id=None) or of the user account and the ones it inherits.
+
+    The cache must not be used if the account's scopes may have been changed in the current transaction.
+    """
+    if use_cache and (cached_scopes := ACCOUNT_SCOPES_CACHE.get(customer_id, user_id)) is not None:
+        return list(cached_scopes)
+
+    generation = ACCOUNT_SCOPES_CACHE.generation
+    # if user_id is None, then this only returns the scopes of the admin itself
+    rows = await db_con.fetch(
+        "SELECT scope, user_id IS NULL AS is_admin_scope FROM account_scopes "
+        "WHERE customer_id=$1 AND (user_id IS NULL OR user_id=$2)",
+        customer_id,
+        user_id,
+    )
+    admin_scopes = [convert_scope_str(row["scope"]) for row in rows if row["is_admin_scope"]]
+
+    if user_id is None:
+        scopes = admin_scopes
+    else:
+        # assigned scopes
+        scopes = [convert_scope_str(row["scope"]) for row in rows if not row["is_admin_scope"]]
+        # inherited scopes
+        for admin_scope in admin_scopes:
+            scopes += admin_scope.inheritable_scopes
+
+    if use_cache:
+        ACCOUNT_SCOPES_CACHE.set(customer_id, user_id, scopes, generation)
+    return scopes
 
 
 # TODO make sure all calls to this use AccountTypes
@@ -11,5 +11,6 @@ setup(
         "fastapi==0.105.0",
         "pyjwt==2.3.0",
         "immutabledict==3.0.0",
+        "prometheus-client==0.19.0",
     ],
 )
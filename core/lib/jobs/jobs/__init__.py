@@ -1,5 +1,16 @@
 from .jobs import EmptyQueue
+from .jobs import DEFAULT_JOB_PRIORITY, INTERACTIVE_JOB_PRIORITY
+from .jobs import DOWNLOAD_BUNDLE_QUEUE, DOWNLOAD_BUNDLE_TTL_SECS
 from .jobs import get_item
+from .jobs import get_download_bundle_item
+from .jobs import claim_items
+from .jobs import release_items
+from .jobs import heartbeat
+from .jobs import reclaim_expired_items
+from .jobs import get_queue_stats
+from .jobs import listen_for_new_items
+from .jobs import InvalidCursor, get_next_cursor
+from .jobs import UPLOAD_SORT_FIELDS, JOB_SORT_FIELDS, ADVANCED_ANALYSIS_SORT_FIELDS
 from .jobs import create_job
 from .jobs import create_upload
 from .jobs import delete_jobs
@@ -34,11 +45,30 @@ from .jobs import (
     get_jobs_info_for_base_user,
     get_jobs_info_for_rw_all_data_user,
     get_jobs_info_for_admin,
+    get_download_bundle_hash,
+    create_download_bundle,
+    get_download_bundle,
 )
 
 __all__ = [
     "EmptyQueue",
+    "DEFAULT_JOB_PRIORITY",
+    "INTERACTIVE_JOB_PRIORITY",
+    "DOWNLOAD_BUNDLE_QUEUE",
+    "DOWNLOAD_BUNDLE_TTL_SECS",
     "get_item",
+    "get_download_bundle_item",
+    "claim_items",
+    "release_items",
+    "heartbeat",
+    "reclaim_expired_items",
+    "get_queue_stats",
+    "listen_for_new_items",
+    "InvalidCursor",
+    "get_next_cursor",
+    "UPLOAD_SORT_FIELDS",
+    "JOB_SORT_FIELDS",
+    "ADVANCED_ANALYSIS_SORT_FIELDS",
     "create_job",
     "create_upload",
     "delete_jobs",
@@ -72,4 +102,7 @@ __all__ = [
     "get_jobs_info_for_base_user",
     "get_jobs_info_for_rw_all_data_user",
     "get_jobs_info_for_admin",
+    "get_download_bundle_hash",
+    "create_download_bundle",
+    "get_download_bundle",
 ]
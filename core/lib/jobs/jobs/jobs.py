@@ -1,147 +1,530 @@
+import asyncio
+import base64
+from contextlib import asynccontextmanager
 from datetime import datetime
 from functools import wraps
+import hashlib
 import json
+import logging
 import os
 import time
 from typing import Any
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# how long a worker owns a claimed item without sending a heartbeat
+DEFAULT_LEASE_SECS = 15 * 60
+# how many times an item can be claimed before it is marked as failed
+DEFAULT_MAX_ATTEMPTS = 2
+
+DEFAULT_JOB_PRIORITY = 10
+# interactive analysis re-runs are small and have a user waiting on them, so they skip ahead of other jobs
+INTERACTIVE_JOB_PRIORITY = 20
+
+DOWNLOAD_BUNDLE_QUEUE = "download-bundles"
+# finished bundles are reused by later requests for the same files for this long. Bundle objects must not be removed
+# from S3 before this
+DOWNLOAD_BUNDLE_TTL_SECS = 7 * 24 * 60 * 60
+
+# Within a priority, items are claimed in order of scheduled_at. Each new item of a customer is scheduled this far
+# after the customer's last queued item, so a customer with a large backlog is interleaved with everyone else rather
+# than starving them. This is only used for ordering, items are never held back if there are idle workers
+FAIR_SHARE_STEP_SECS = 60
+_FAIR_SHARE_SCHEDULED_AT = (
+    "GREATEST(NOW(), (SELECT MAX(scheduled_at) FROM jobs_queue WHERE queue={queue} AND customer_id={customer_id}) "
+    "+ make_interval(secs => {step}))"
+)
+
+
+# Sortable fields of each listing, mapped to the expression sorted on, the type of that expression, and the value
+# the expression has for NULLs. Only the cursor's values need the type and NULL value, the expressions coalesce NULLs
+# themselves so they can be compared against a cursor
+_UPLOAD_SORT_EXPRS = {
+    "filename": ("uploads.filename", "text", None),
+    "id": ("uploads.id", "uuid", None),
+    "created_at": ("uploads.created_at", "timestamp", None),
+    "last_analyzed": ("uploads.last_analyzed", "timestamp", None),
+    "auto_upload": ("coalesce(uploads.auto_upload, false)", "boolean", False),
+    "username": ("users.name", "text", None),
+}
+_JOB_SORT_EXPRS = {
+    "id": ("j.job_id", "uuid", None),
+    "created_at": ("j.created_at", "timestamp", None),
+    "filename": ("coalesce(reverse(split_part(reverse(j.object_key), '/', 1)), '')", "text", ""),
+}
+_ADVANCED_ANALYSIS_SORT_EXPRS = {
+    "name": ("coalesce(name, '')", "text", ""),
+    "id": ("id", "uuid", None),
+    "created_at": ("created_at", "timestamp", None),
+    "type": ("type", '"AdvancedAnalysisType"', None),
+    "status": ("status", '"JobStatus"', None),
+}
+UPLOAD_SORT_FIELDS = tuple(_UPLOAD_SORT_EXPRS)
+JOB_SORT_FIELDS = tuple(_JOB_SORT_EXPRS)
+ADVANCED_ANALYSIS_SORT_FIELDS = tuple(_ADVANCED_ANALYSIS_SORT_EXPRS)
 
 
 class EmptyQueue(Exception):
     pass
 
 
-def get_item(*, queue):
+async def claim_items(
+    con,
+    *,
+    queue: str,
+    worker_id: str,
+    limit: int = 1,
+    lease_secs: int = DEFAULT_LEASE_SECS,
+    columns: str = "*",
+):
+    """Lease up to `limit` items in the given queue to this worker and return them.
+
+    The claim is committed immediately so that no transaction needs to be held open while the items are processed.
+    Items are removed from the queue once their result has been recorded. If the lease is not renewed with
+    `heartbeat` before it expires, the item will be returned to the queue by `reclaim_expired_items`.
+    """
     query = (
-        "DELETE FROM jobs_queue "
-        "WHERE id = (SELECT id FROM jobs_queue WHERE queue=$1 ORDER BY priority DESC, created_at ASC FOR UPDATE SKIP LOCKED LIMIT 1) "
-        "RETURNING id, upload_id, created_at, meta"
+        "UPDATE jobs_queue SET claimed_by=$2, claimed_at=NOW(), "
+        "lease_expires_at=NOW() + make_interval(secs => $4), attempts=attempts+1, last_error=NULL "
+        "WHERE id IN ("
+        "SELECT id FROM jobs_queue WHERE queue=$1 AND claimed_by IS NULL "
+        "ORDER BY priority DESC, scheduled_at ASC FOR UPDATE SKIP LOCKED LIMIT $3"
+        f") RETURNING {columns}"
     )
+    async with con.transaction():
+        return await con.fetch(query, queue, worker_id, limit, float(lease_secs))
 
-    def _outer(fn):
-        @wraps(fn)
-        async def _inner(*, con, con_to_update_job_result=None):
-            async with con.transaction():
-                item = await con.fetchrow(query, queue)
-                if not item:
-                    raise EmptyQueue(queue)
-
-                if con_to_update_job_result:
-                    # if already set to running, then assume that a different worker already tried processing the job and failed
-                    current_job_status = await con_to_update_job_result.fetchval(
-                        "SELECT status FROM jobs_result WHERE job_id=$1", item["id"]
-                    )
-                    if current_job_status == "running":
-                        await con_to_update_job_result.execute(
-                            "UPDATE jobs_result SET status='error', meta=meta||$1::jsonb, finished_at=NOW() WHERE job_id=$2",
-                            json.dumps({"error_msg": "Ran out of time/memory"}),
-                            item["id"],
-                        )
-                        return
-
-                    await con_to_update_job_result.execute(
-                        "UPDATE jobs_result SET status='running', started_at=$1 WHERE job_id=$2",
-                        datetime.now(),
+
+async def heartbeat(con, *, worker_id: str, item_ids: list, lease_secs: int = DEFAULT_LEASE_SECS):
+    """Extend the lease of items currently claimed by this worker."""
+    await con.execute(
+        "UPDATE jobs_queue SET lease_expires_at=NOW() + make_interval(secs => $3) "
+        "WHERE claimed_by=$1 AND id=ANY($2::uuid[])",
+        worker_id,
+        item_ids,
+        float(lease_secs),
+    )
+
+
+async def release_items(con, *, worker_id: str, item_ids: list, error: str | None = None):
+    """Return claimed items to the queue so that they can be picked up again.
+
+    If given, the error is recorded as the reason the item failed in case it has no attempts left.
+    """
+    await con.execute(
+        "UPDATE jobs_queue SET claimed_by=NULL, claimed_at=NULL, lease_expires_at=NULL, last_error=$3 "
+        "WHERE claimed_by=$1 AND id=ANY($2::uuid[])",
+        worker_id,
+        item_ids,
+        error,
+    )
+
+
+async def reclaim_expired_items(
+    con, *, queue: str, result_table: str, result_id_col: str, max_attempts: int = DEFAULT_MAX_ATTEMPTS
+):
+    """Return items with expired leases to the queue, and fail items that have used up all their attempts.
+
+    Items whose last attempt raised an error are failed with that error, the others are assumed to have been
+    killed, e.g. for running out of memory. Returns the IDs of the items that were failed.
+    """
+    async with con.transaction():
+        await con.execute(
+            "UPDATE jobs_queue SET claimed_by=NULL, claimed_at=NULL, lease_expires_at=NULL "
+            "WHERE queue=$1 AND claimed_by IS NOT NULL AND lease_expires_at < NOW()",
+            queue,
+        )
+        failed_items = await con.fetch(
+            "DELETE FROM jobs_queue WHERE queue=$1 AND claimed_by IS NULL AND attempts >= $2 "
+            "RETURNING id, last_error",
+            queue,
+            max_attempts,
+        )
+        if failed_items:
+            await con.executemany(
+                f"UPDATE {result_table} SET status='error', meta=meta||$1::jsonb, finished_at=NOW() "
+                f"WHERE {result_id_col}=$2",
+                [
+                    (
+                        json.dumps(
+                            {"error": item["last_error"]}
+                            if item["last_error"]
+                            else {"error_msg": "Ran out of time/memory"}
+                        ),
                         item["id"],
                     )
+                    for item in failed_items
+                ],
+            )
 
-                ts = time.time()
-                status, new_meta, object_key = await fn(con, item)
-                runtime = time.time() - ts
-
-                # update metadata
-                meta = json.loads(item["meta"])
-                meta.update(new_meta)
-
-                recording_length_s = meta.pop("recording_length_seconds", None)
-
-                data = {
-                    "status": status,
-                    "runtime": runtime,
-                    "finished_at": datetime.now(),
-                    "meta": json.dumps(meta),
-                    "object_key": object_key,
-                    "recording_length_seconds": recording_length_s,
-                }
-                set_clause = ", ".join(f"{key} = ${i}" for i, key in enumerate(data, 1))
-                await con.execute(
-                    f"UPDATE jobs_result SET {set_clause} WHERE job_id=${len(data) + 1}",
-                    *data.values(),
-                    item["id"],
-                )
-
-        return _inner
+    return [item["id"] for item in failed_items]
 
-    return _outer
 
+async def get_queue_stats(con, *, queue_prefix: str):
+    """Count the items in the queues starting with the given prefix, and how many of them are claimed, per version.
 
-def get_advanced_item(*, queue):
-    query = (
-        "DELETE FROM jobs_queue "
-        "WHERE id = (SELECT id FROM jobs_queue WHERE queue=$1 ORDER BY priority DESC, created_at ASC FOR UPDATE SKIP LOCKED LIMIT 1) "
-        "RETURNING id, sources, created_at, meta"
+    Also returns how long the oldest unclaimed item of each version has been waiting. Uses jobs_queue_version_idx.
+    """
+    return await con.fetch(
+        "SELECT meta->>'version' AS version, COUNT(*), "
+        "COUNT(*) FILTER (WHERE claimed_by IS NOT NULL) AS num_claimed, "
+        "EXTRACT(EPOCH FROM NOW() - MIN(created_at) FILTER (WHERE claimed_by IS NULL)) AS oldest_unclaimed_secs "
+        "FROM jobs_queue WHERE queue LIKE $1 GROUP BY version",
+        f"{queue_prefix}%",
     )
 
-    def _outer(fn):
-        @wraps(fn)
-        async def _inner(*, con, con_to_update_job_result=None):
-            async with con.transaction():
-                item = await con.fetchrow(query, queue)
-                if not item:
-                    raise EmptyQueue(queue)
-
-                if con_to_update_job_result:
-                    # if already set to running, then assume that a different worker already tried processing the job and failed
-                    current_job_status = await con_to_update_job_result.fetchval(
-                        "SELECT status FROM advanced_analysis_result WHERE id=$1", item["id"]
-                    )
-                    if current_job_status == "running":
-                        await con_to_update_job_result.execute(
-                            "UPDATE advanced_analysis_result SET status='error', meta=meta||$1::jsonb, finished_at=NOW() WHERE id=$2",
-                            json.dumps({"error_msg": "Ran out of time/memory"}),
-                            item["id"],
-                        )
-                        return
-
-                    await con_to_update_job_result.execute(
-                        "UPDATE advanced_analysis_result SET status='running', started_at=$1 WHERE id=$2",
-                        datetime.now(),
+
+@asynccontextmanager
+async def listen_for_new_items(pool):
+    """Listen for items being added to the queue on a dedicated connection.
+
+    Yields an event which is set whenever an item is added to any queue. Long-running workers should clear the event
+    before trying to claim items so that notifications received while they are processing are not missed.
+    """
+    new_items_event = asyncio.Event()
+
+    def _on_notification(connection, pid, channel, payload):
+        new_items_event.set()
+
+    async with pool.acquire() as con:
+        await con.add_listener("jobs_queue", _on_notification)
+        try:
+            yield new_items_event
+        finally:
+            await con.remove_listener("jobs_queue", _on_notification)
+
+
+def _queue_item_processor(
+    *, queue, batch_size, lease_secs, max_attempts, columns, result_table, result_id_col, update_result
+):
+    async def _mark_running(con, item):
+        await con.execute(
+            f"UPDATE {result_table} SET status='running', started_at=$1 WHERE {result_id_col}=$2",
+            datetime.now(),
+            item["id"],
+        )
+
+    async def _process(fn, pool, worker_id, item):
+        try:
+            async with pool.acquire() as con:
+                await _mark_running(con, item)
+
+            # no connection is held while the item is processed, fn acquires one from the pool when it needs to
+            ts = time.time()
+            status, new_meta, object_key = await fn(pool, item)
+            runtime = time.time() - ts
+
+            # update metadata
+            meta = json.loads(item["meta"])
+            meta.update(new_meta)
+
+            async with pool.acquire() as con:
+                async with con.transaction():
+                    # only record the result if this worker still owns the item
+                    if await con.fetchval(
+                        "DELETE FROM jobs_queue WHERE id=$1 AND claimed_by=$2 RETURNING id",
                         item["id"],
-                    )
+                        worker_id,
+                    ):
+                        await update_result(con, item, status, meta, object_key, runtime)
+        except Exception as e:
+            # put the item back so another worker can retry it
+            async with pool.acquire() as con:
+                await release_items(con, worker_id=worker_id, item_ids=[item["id"]], error=repr(e))
+            raise
+
+    async def _keep_leases_alive(pool, worker_id, item_ids):
+        while True:
+            await asyncio.sleep(lease_secs / 4)
+            if not item_ids:
+                continue
+            try:
+                async with pool.acquire() as con:
+                    await heartbeat(con, worker_id=worker_id, item_ids=list(item_ids), lease_secs=lease_secs)
+            except Exception:
+                # the lease is long enough to survive a few missed heartbeats, so keep trying
+                logger.exception(f"Failed to renew leases of items: {list(item_ids)}")
 
-                ts = time.time()
-                status, new_meta, object_key = await fn(con, item)
-                runtime = time.time() - ts
-
-                # update metadata
-                meta = json.loads(item["meta"])
-                meta.update(new_meta)
-
-                s3_prefix = None
-                name = None
-                if object_key is not None:
-                    s3_prefix = os.path.dirname(object_key)
-                    name = os.path.basename(object_key)
-
-                data = {
-                    "status": status,
-                    "runtime": runtime,
-                    "finished_at": datetime.now(),
-                    "meta": json.dumps(meta),
-                    "s3_prefix": s3_prefix,
-                    "name": name,
-                }
-                set_clause = ", ".join(f"{key} = ${i}" for i, key in enumerate(data, 1))
-                await con.execute(
-                    f"UPDATE advanced_analysis_result SET {set_clause} WHERE id=${len(data) + 1}",
-                    *data.values(),
-                    item["id"],
+    def _outer(fn):
+        @wraps(fn)
+        async def _inner(*, pool, worker_id):
+            async with pool.acquire() as con:
+                await reclaim_expired_items(
+                    con,
+                    queue=queue,
+                    result_table=result_table,
+                    result_id_col=result_id_col,
+                    max_attempts=max_attempts,
+                )
+                items = await claim_items(
+                    con,
+                    queue=queue,
+                    worker_id=worker_id,
+                    limit=batch_size,
+                    lease_secs=lease_secs,
+                    columns=columns,
                 )
+            if not items:
+                raise EmptyQueue(queue)
+
+            active_item_ids = {item["id"] for item in items}
+
+            async def _process_and_untrack(item):
+                try:
+                    await _process(fn, pool, worker_id, item)
+                finally:
+                    active_item_ids.discard(item["id"])
+
+            heartbeat_task = asyncio.create_task(_keep_leases_alive(pool, worker_id, active_item_ids))
+            try:
+                # the items are only processed in parallel while fn is awaiting, e.g. on work it runs in a thread
+                results = await asyncio.gather(
+                    *(_process_and_untrack(item) for item in items), return_exceptions=True
+                )
+            finally:
+                heartbeat_task.cancel()
+
+            if errors := [res for res in results if isinstance(res, BaseException)]:
+                raise errors[0]
 
         return _inner
 
     return _outer
 
 
+def get_item(*, queue, batch_size=1, lease_secs=DEFAULT_LEASE_SECS, max_attempts=DEFAULT_MAX_ATTEMPTS):
+    """Lease up to `batch_size` pulse3d jobs and process them concurrently with the decorated function.
+
+    The decorated function is called with the pool and a single queue item and must return a tuple of
+    (status, new_meta, object_key). It should only hold a connection while it is running queries. Leases are
+    renewed in the background while the items are processed, so blocking work in the decorated function must be
+    run in a thread (e.g. with `asyncio.to_thread`), otherwise the leases expire while the event loop is blocked
+    and the items are claimed again by another worker.
+    """
+
+    async def _update_result(con, item, status, meta, object_key, runtime):
+        recording_length_s = meta.pop("recording_length_seconds", None)
+
+        data = {
+            "status": status,
+            "runtime": runtime,
+            "finished_at": datetime.now(),
+            "meta": json.dumps(meta),
+            "object_key": object_key,
+            "recording_length_seconds": recording_length_s,
+        }
+        set_clause = ", ".join(f"{key} = ${i}" for i, key in enumerate(data, 1))
+        await con.execute(
+            f"UPDATE jobs_result SET {set_clause} WHERE job_id=${len(data) + 1}", *data.values(), item["id"]
+        )
+
+    return _queue_item_processor(
+        queue=queue,
+        batch_size=batch_size,
+        lease_secs=lease_secs,
+        max_attempts=max_attempts,
+        columns="id, upload_id, created_at, meta",
+        result_table="jobs_result",
+        result_id_col="job_id",
+        update_result=_update_result,
+    )
+
+
+def get_advanced_item(
+    *, queue, batch_size=1, lease_secs=DEFAULT_LEASE_SECS, max_attempts=DEFAULT_MAX_ATTEMPTS
+):
+    """Lease up to `batch_size` advanced analysis jobs and process them concurrently with the decorated function.
+
+    The decorated function is called with the pool and a single queue item and must return a tuple of
+    (status, new_meta, object_key). It should only hold a connection while it is running queries. Leases are
+    renewed in the background while the items are processed, so blocking work in the decorated function must be
+    run in a thread (e.g. with `asyncio.to_thread`), otherwise the leases expire while the event loop is blocked
+    and the items are claimed again by another worker.
+    """
+
+    async def _update_result(con, item, status, meta, object_key, runtime):
+        s3_prefix = None
+        name = None
+        if object_key is not None:
+            s3_prefix = os.path.dirname(object_key)
+            name = os.path.basename(object_key)
+
+        data = {
+            "status": status,
+            "runtime": runtime,
+            "finished_at": datetime.now(),
+            "meta": json.dumps(meta),
+            "s3_prefix": s3_prefix,
+            "name": name,
+        }
+        set_clause = ", ".join(f"{key} = ${i}" for i, key in enumerate(data, 1))
+        await con.execute(
+            f"UPDATE advanced_analysis_result SET {set_clause} WHERE id=${len(data) + 1}",
+            *data.values(),
+            item["id"],
+        )
+
+    return _queue_item_processor(
+        queue=queue,
+        batch_size=batch_size,
+        lease_secs=lease_secs,
+        max_attempts=max_attempts,
+        columns="id, sources, created_at, meta",
+        result_table="advanced_analysis_result",
+        result_id_col="id",
+        update_result=_update_result,
+    )
+
+
+def get_download_bundle_item(
+    *,
+    queue=DOWNLOAD_BUNDLE_QUEUE,
+    batch_size=1,
+    lease_secs=DEFAULT_LEASE_SECS,
+    max_attempts=DEFAULT_MAX_ATTEMPTS,
+):
+    """Lease up to `batch_size` download bundles and build them concurrently with the decorated function.
+
+    The decorated function is called with the pool and a single queue item and must return a tuple of
+    (status, new_meta, object_key). It should only hold a connection while it is running queries. Leases are
+    renewed in the background while the items are processed, so blocking work in the decorated function must be
+    run in a thread (e.g. with `asyncio.to_thread`), otherwise the leases expire while the event loop is blocked
+    and the items are claimed again by another worker.
+    """
+
+    async def _update_result(con, item, status, meta, object_key, runtime):
+        data = {
+            "status": status,
+            "runtime": runtime,
+            "finished_at": datetime.now(),
+            "meta": json.dumps(meta),
+            "object_key": object_key,
+        }
+        set_clause = ", ".join(f"{key} = ${i}" for i, key in enumerate(data, 1))
+        await con.execute(
+            f"UPDATE download_bundles SET {set_clause} WHERE id=${len(data) + 1}", *data.values(), item["id"]
+        )
+
+    return _queue_item_processor(
+        queue=queue,
+        batch_size=batch_size,
+        lease_secs=lease_secs,
+        max_attempts=max_attempts,
+        columns="id, sources, created_at, meta",
+        result_table="download_bundles",
+        result_id_col="id",
+        update_result=_update_result,
+    )
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+def _get_sort(sort_fields, sort_field, sort_direction):
+    if sort_field not in sort_fields:
+        sort_field = "created_at"
+    if sort_direction not in ("ASC", "DESC"):
+        sort_direction = "DESC"
+    return sort_field, sort_direction
+
+
+def _encode_cursor(sort_field, sort_direction, sort_value, id_):
+    if isinstance(sort_value, datetime):
+        sort_value = sort_value.isoformat()
+    elif sort_value is not None and not isinstance(sort_value, (str, bool, int, float)):
+        sort_value = str(sort_value)
+
+    cursor = json.dumps([sort_field, sort_direction, sort_value, str(id_)])
+    return base64.urlsafe_b64encode(cursor.encode()).decode()
+
+
+def _decode_cursor(cursor, sort_field, sort_direction, sort_exprs):
+    try:
+        cursor_sort_field, cursor_sort_direction, sort_value, id_ = json.loads(
+            base64.urlsafe_b64decode(cursor)
+        )
+    except Exception as e:
+        raise InvalidCursor("Malformed cursor") from e
+
+    # a cursor is only valid for the sorting of the request it came from
+    if (cursor_sort_field, cursor_sort_direction) != (sort_field, sort_direction):
+        raise InvalidCursor("Cursor does not match sort field and direction")
+
+    _, sort_type, null_value = sort_exprs[sort_field]
+    try:
+        id_ = str(uuid.UUID(id_))
+        if sort_value is None:
+            sort_value = null_value
+        elif sort_type == "timestamp":
+            sort_value = datetime.fromisoformat(sort_value)
+        elif sort_type == "boolean" and not isinstance(sort_value, bool):
+            raise TypeError()
+        elif sort_type != "boolean" and not isinstance(sort_value, str):
+            raise TypeError()
+    except (TypeError, ValueError, AttributeError) as e:
+        raise InvalidCursor("Malformed cursor") from e
+
+    return sort_value, id_
+
+
+def get_next_cursor(rows, *, sort_fields, sort_field, sort_direction, limit):
+    """Create the cursor of the page after the given rows.
+
+    Returns None if there are no more rows after the given ones. `sort_fields` should be the *_SORT_FIELDS
+    constant of the listing the rows came from.
+    """
+    if not rows or len(rows) < limit:
+        return None
+
+    sort_field, sort_direction = _get_sort(sort_fields, sort_field, sort_direction)
+    last_row = rows[-1]
+    return _encode_cursor(sort_field, sort_direction, last_row[sort_field], last_row["id"])
+
+
+def _add_sorting_and_pagination(
+    query, query_params, sort_exprs, sort_field, sort_direction, skip, limit, cursor
+):
+    """Sort by the given field, using the ID to break ties.
+
+    If a cursor is given, only rows after it are returned, otherwise `skip` rows are skipped. Using a cursor lets
+    the DB seek straight to the start of the page instead of scanning and discarding every row before it
+    """
+    query_params = query_params.copy()
+
+    sort_field, sort_direction = _get_sort(sort_exprs, sort_field, sort_direction)
+    sort_expr, sort_type, _ = sort_exprs[sort_field]
+    id_expr = sort_exprs["id"][0]
+
+    if cursor is not None:
+        sort_value, id_ = _decode_cursor(cursor, sort_field, sort_direction, sort_exprs)
+        comparison = "<" if sort_direction == "DESC" else ">"
+        if sort_field == "id":
+            query += f" AND {id_expr} {comparison} ${len(query_params) + 1}::uuid"
+            query_params.append(id_)
+        else:
+            query += (
+                f" AND ({sort_expr}, {id_expr}) {comparison} "
+                f"(${len(query_params) + 1}::{sort_type}, ${len(query_params) + 2}::uuid)"
+            )
+            query_params += [sort_value, id_]
+
+    if sort_field == "id":
+        query += f" ORDER BY {id_expr} {sort_direction}"
+    else:
+        query += f" ORDER BY {sort_expr} {sort_direction}, {id_expr} {sort_direction}"
+
+    if cursor is None:
+        query += f" LIMIT ${len(query_params) + 1} OFFSET ${len(query_params) + 2}"
+        query_params += [limit, skip]
+    else:
+        query += f" LIMIT ${len(query_params) + 1}"
+        query_params.append(limit)
+
+    return query, query_params
+
+
 async def get_uploads_info_for_admin(
     con,
     customer_id: str,
@@ -149,19 +532,19 @@ async def get_uploads_info_for_admin(
     sort_direction: str | None,
     skip: int,
     limit: int,
+    cursor: str | None = None,
     **filters,
 ):
     query = (
-        "SELECT users.name AS username, uploads.*, coalesce(j.last_analyzed, uploads.created_at) as last_analyzed "
+        "SELECT users.name AS username, uploads.* "
         "FROM uploads "
         "JOIN users ON uploads.user_id=users.id "
-        "LEFT JOIN (SELECT upload_id, max(created_at) AS last_analyzed FROM jobs_result WHERE status!='deleted' GROUP BY upload_id) AS j ON uploads.id=j.upload_id "
-        "WHERE users.customer_id=$1 AND uploads.deleted='f' AND uploads.multipart_upload_id IS NULL"
+        "WHERE uploads.customer_id=$1 AND uploads.deleted='f' AND uploads.multipart_upload_id IS NULL"
     )
     query_params = [customer_id]
 
     query, query_params = _add_upload_sorting_filtering_conds(
-        query, query_params, sort_field, sort_direction, skip, limit, **filters
+        query, query_params, sort_field, sort_direction, skip, limit, cursor, **filters
     )
 
     async with con.transaction():
@@ -178,19 +561,19 @@ async def get_uploads_info_for_rw_all_data_user(
     sort_direction: str | None,
     skip: int,
     limit: int,
+    cursor: str | None = None,
     **filters,
 ):
     query = (
-        "SELECT users.name AS username, uploads.*, coalesce(j.last_analyzed, uploads.created_at) as last_analyzed "
+        "SELECT users.name AS username, uploads.* "
         "FROM uploads "
         "JOIN users ON uploads.user_id=users.id "
-        "LEFT JOIN (SELECT upload_id, max(created_at) AS last_analyzed FROM jobs_result WHERE status!='deleted' GROUP BY upload_id) AS j ON uploads.id=j.upload_id "
-        "WHERE users.customer_id=$1 AND uploads.type=$2 AND uploads.deleted='f' AND uploads.multipart_upload_id IS NULL"
+        "WHERE uploads.customer_id=$1 AND uploads.type=$2 AND uploads.deleted='f' AND uploads.multipart_upload_id IS NULL"
     )
     query_params = [customer_id, upload_type]
 
     query, query_params = _add_upload_sorting_filtering_conds(
-        query, query_params, sort_field, sort_direction, skip, limit, **filters
+        query, query_params, sort_field, sort_direction, skip, limit, cursor, **filters
     )
 
     async with con.transaction():
@@ -207,18 +590,18 @@ async def get_uploads_info_for_base_user(
     sort_direction: str | None,
     skip: int,
     limit: int,
+    cursor: str | None = None,
     **filters,
 ):
     query = (
-        "SELECT uploads.*, coalesce(j.last_analyzed, uploads.created_at) as last_analyzed "
+        "SELECT uploads.* "
         "FROM uploads "
-        "LEFT JOIN (SELECT upload_id, max(created_at) AS last_analyzed FROM jobs_result WHERE status!='deleted' GROUP BY upload_id) AS j ON uploads.id=j.upload_id "
         "WHERE user_id=$1 AND uploads.type=$2 AND uploads.deleted='f' AND uploads.multipart_upload_id IS NULL"
     )
     query_params = [user_id, upload_type]
 
     query, query_params = _add_upload_sorting_filtering_conds(
-        query, query_params, sort_field, sort_direction, skip, limit, **filters
+        query, query_params, sort_field, sort_direction, skip, limit, cursor, **filters
     )
 
     async with con.transaction():
@@ -228,7 +611,7 @@ async def get_uploads_info_for_base_user(
 
 
 def _add_upload_sorting_filtering_conds(
-    query, query_params, sort_field, sort_direction, skip, limit, **filters
+    query, query_params, sort_field, sort_direction, skip, limit, cursor=None, **filters
 ):
     query_params = query_params.copy()
 
@@ -237,12 +620,13 @@ def _add_upload_sorting_filtering_conds(
     conds = ""
     for filter_name, filter_value in filters.items():
         placeholder = f"${next_placeholder_count}"
+        # the substring filters are backed by trigram indexes, so their expressions need to match the indexed ones
         match filter_name:
             case "username":
                 new_cond = f"users.name LIKE {placeholder}"
                 filter_value = f"%{filter_value}%"
             case "filename":
-                new_cond = f"LOWER(uploads.filename) LIKE LOWER({placeholder})"
+                new_cond = f"uploads.filename ILIKE {placeholder}"
                 filter_value = f"%{filter_value}%"
             case "id":
                 new_cond = f"uploads.id::text LIKE {placeholder}"
@@ -252,9 +636,13 @@ def _add_upload_sorting_filtering_conds(
             case "created_at_max":
                 new_cond = f"uploads.created_at <= to_timestamp({placeholder}, 'YYYY-MM-DD\"T\"HH:MI:SS.MSZ')"
             case "last_analyzed_min":
-                new_cond = f"coalesce(j.last_analyzed, uploads.created_at) >= to_timestamp({placeholder}, 'YYYY-MM-DD\"T\"HH:MI:SS.MSZ')"
+                new_cond = (
+                    f"uploads.last_analyzed >= to_timestamp({placeholder}, 'YYYY-MM-DD\"T\"HH:MI:SS.MSZ')"
+                )
             case "last_analyzed_max":
-                new_cond = f"coalesce(j.last_analyzed, uploads.created_at) <= to_timestamp({placeholder}, 'YYYY-MM-DD\"T\"HH:MI:SS.MSZ')"
+                new_cond = (
+                    f"uploads.last_analyzed <= to_timestamp({placeholder}, 'YYYY-MM-DD\"T\"HH:MI:SS.MSZ')"
+                )
             case _:
                 continue
 
@@ -264,22 +652,9 @@ def _add_upload_sorting_filtering_conds(
     if conds:
         query += conds
 
-    if sort_field in ("filename", "id", "created_at", "last_analyzed", "auto_upload", "username"):
-        if sort_field == "last_analyzed":
-            pass
-        elif sort_field == "username":
-            sort_field = "users.name"
-        else:
-            sort_field = f"uploads.{sort_field}"
-        if sort_direction not in ("ASC", "DESC"):
-            sort_direction = "DESC"
-        sort_direction = sort_direction.upper()
-        query += f" ORDER BY {sort_field} {sort_direction}"
-
-    query += f" LIMIT ${len(query_params) + 1} OFFSET ${len(query_params) + 2}"
-    query_params += [limit, skip]
-
-    return query, query_params
+    return _add_sorting_and_pagination(
+        query, query_params, _UPLOAD_SORT_EXPRS, sort_field, sort_direction, skip, limit, cursor
+    )
 
 
 async def get_uploads_download_info_for_admin(con, customer_id: str, upload_ids: list[str]):
@@ -424,6 +799,7 @@ async def get_jobs_info_for_admin(
     sort_direction: str | None,
     skip: int,
     limit: int,
+    cursor: str | None = None,
     **filters,
 ):
     query_params = [customer_id, upload_type]
@@ -437,7 +813,7 @@ async def get_jobs_info_for_admin(
     )
 
     query, query_params = _add_job_sorting_filtering_conds(
-        query, query_params, sort_field, sort_direction, skip, limit, **filters
+        query, query_params, sort_field, sort_direction, skip, limit, cursor, **filters
     )
 
     async with con.transaction():
@@ -454,6 +830,7 @@ async def get_jobs_info_for_rw_all_data_user(
     sort_direction: str | None,
     skip: int,
     limit: int,
+    cursor: str | None = None,
     **filters,
 ):
     query_params = [customer_id, upload_type]
@@ -467,7 +844,7 @@ async def get_jobs_info_for_rw_all_data_user(
     )
 
     query, query_params = _add_job_sorting_filtering_conds(
-        query, query_params, sort_field, sort_direction, skip, limit, **filters
+        query, query_params, sort_field, sort_direction, skip, limit, cursor, **filters
     )
 
     async with con.transaction():
@@ -484,6 +861,7 @@ async def get_jobs_info_for_base_user(
     sort_direction: str | None,
     skip: int,
     limit: int,
+    cursor: str | None = None,
     **filters,
 ):
     query_params = [user_id, upload_type]
@@ -495,7 +873,7 @@ async def get_jobs_info_for_base_user(
     )
 
     query, query_params = _add_job_sorting_filtering_conds(
-        query, query_params, sort_field, sort_direction, skip, limit, **filters
+        query, query_params, sort_field, sort_direction, skip, limit, cursor, **filters
     )
 
     async with con.transaction():
@@ -504,7 +882,9 @@ async def get_jobs_info_for_base_user(
     return jobs
 
 
-def _add_job_sorting_filtering_conds(query, query_params, sort_field, sort_direction, skip, limit, **filters):
+def _add_job_sorting_filtering_conds(
+    query, query_params, sort_field, sort_direction, skip, limit, cursor=None, **filters
+):
     query_params = query_params.copy()
 
     next_placeholder_count = len(query_params) + 1
@@ -518,9 +898,7 @@ def _add_job_sorting_filtering_conds(query, query_params, sort_field, sort_direc
             case "status":
                 new_cond = f"j.status={placeholder}"
             case "filename":
-                new_cond = (
-                    f"LOWER(reverse(split_part(reverse(j.object_key), '/', 1))) LIKE LOWER({placeholder})"
-                )
+                new_cond = f"reverse(split_part(reverse(j.object_key), '/', 1)) ILIKE {placeholder}"
                 filter_value = f"%{filter_value}%"
             case "include_prerelease_versions":
                 if filter_value:
@@ -541,18 +919,9 @@ def _add_job_sorting_filtering_conds(query, query_params, sort_field, sort_direc
     if conds:
         query += conds
 
-    if sort_field in ("id", "created_at", "filename"):
-        if sort_field == "created_at":
-            sort_field = f"j.{sort_field}"
-        if sort_direction not in ("ASC", "DESC"):
-            sort_direction = "DESC"
-        sort_direction = sort_direction.upper()
-        query += f" ORDER BY {sort_field} {sort_direction}"
-
-    query += f" LIMIT ${len(query_params) + 1} OFFSET ${len(query_params) + 2}"
-    query_params += [limit, skip]
-
-    return query, query_params
+    return _add_sorting_and_pagination(
+        query, query_params, _JOB_SORT_EXPRS, sort_field, sort_direction, skip, limit, cursor
+    )
 
 
 async def get_legacy_jobs_info_for_user(con, user_id: str, job_ids: list[str]):
@@ -648,16 +1017,32 @@ async def get_job_waveform_data_for_base_user(con, user_id: str, job_id: str, up
     return await con.fetchrow(query, *query_params)
 
 
-async def create_job(*, con, upload_id, queue, priority, meta, customer_id, job_type):
+async def create_job(*, con, upload_id, queue, priority, meta, customer_id, job_type, job_id=None):
+    """Add a job for the upload to the queue and return its ID.
+
+    `job_id` can be given if anything the job depends on needs to be stored under the ID before the job is created,
+    otherwise one is generated.
+    """
+    scheduled_at = _FAIR_SHARE_SCHEDULED_AT.format(queue="$2", customer_id="$5", step="$6")
     # the WITH clause in this query is necessary to make sure the given upload_id actually exists
     enqueue_job_query = (
         "WITH row AS (SELECT id FROM uploads WHERE id=$1) "
-        "INSERT INTO jobs_queue (upload_id, queue, priority, meta) SELECT id, $2, $3, $4 FROM row "
+        "INSERT INTO jobs_queue (id, upload_id, queue, priority, meta, customer_id, scheduled_at) "
+        f"SELECT COALESCE($7::uuid, gen_random_uuid()), id, $2, $3, $4, $5, {scheduled_at} FROM row "
         "RETURNING id"
     )
     async with con.transaction():
         # add job to queue
-        row = await con.fetchrow(enqueue_job_query, upload_id, queue, priority, json.dumps(meta))
+        row = await con.fetchrow(
+            enqueue_job_query,
+            upload_id,
+            queue,
+            priority,
+            json.dumps(meta),
+            customer_id,
+            float(FAIR_SHARE_STEP_SECS),
+            job_id,
+        )
         job_id = row["id"]
 
         data = {
@@ -726,29 +1111,20 @@ async def get_customer_pulse3d_usage(con, customer_id, upload_type) -> dict[str,
     Returns:
         - Dictionary with account limits and account usage
     """
-    # get upload-type specific usage restrictions for the admin account
-    # uploads limit, jobs limit, end date of plan
-    usage_limit_query = "SELECT usage_restrictions->$1 AS usage FROM customers WHERE id=$2"
-    # collects number of all jobs in admin account and return number of credits consumed
+    # upload-type specific usage restrictions (uploads limit, jobs limit, end date of plan) and the number of uploads
+    # and credits used, which are kept up to date by a trigger on jobs_result.
     # upload with 1 - 2 jobs  = 1 credit , upload with 3+ jobs = 1 credit for each upload with over 2 jobs
-    current_usage_query = (
-        "SELECT COUNT(*) AS total_uploads, SUM(jobs_count) AS total_jobs "
-        "FROM ( SELECT ( CASE WHEN (COUNT(*) <= 2 AND COUNT(*) > 0) THEN 1 ELSE GREATEST(COUNT(*) - 1, 0) END ) AS jobs_count FROM jobs_result WHERE customer_id=$1 and type=$2 GROUP BY upload_id) dt"
+    query = (
+        "SELECT c.usage_restrictions->$1 AS usage, "
+        "coalesce(u.uploads, 0) AS total_uploads, coalesce(u.jobs, 0) AS total_jobs "
+        "FROM customers AS c LEFT JOIN customer_usage AS u ON u.customer_id=c.id AND u.type::text=$1 "
+        "WHERE c.id=$2"
     )
 
-    usage_limit_json = await con.fetchrow(usage_limit_query, upload_type, customer_id)
-    current_usage_data = await con.fetchrow(current_usage_query, customer_id, upload_type)
-
-    usage_limit_dict = json.loads(usage_limit_json["usage"])
+    row = await con.fetchrow(query, upload_type, customer_id)
 
-    # usage query returns none if no jobs are found but 0 if no uploads are found
-    current_job_usage = current_usage_data.get("total_jobs", 0)
-    if current_job_usage is None:
-        current_job_usage = 0
-    current_usage_dict = {
-        "jobs": current_job_usage,
-        "uploads": int(current_usage_data.get("total_uploads", 0)),
-    }
+    usage_limit_dict = json.loads(row["usage"])
+    current_usage_dict = {"jobs": row["total_jobs"], "uploads": row["total_uploads"]}
 
     return {"limits": usage_limit_dict, "current": current_usage_dict}
 
@@ -827,6 +1203,7 @@ async def get_advanced_analyses_for_admin(
     sort_direction: str | None,
     skip: int,
     limit: int,
+    cursor: str | None = None,
     **filters,
 ):
     query = (
@@ -837,7 +1214,7 @@ async def get_advanced_analyses_for_admin(
     query_params = [customer_id]
 
     query, query_params = _add_advanced_analysis_sorting_filtering_conds(
-        query, query_params, sort_field, sort_direction, skip, limit, **filters
+        query, query_params, sort_field, sort_direction, skip, limit, cursor, **filters
     )
 
     async with con.transaction():
@@ -847,7 +1224,14 @@ async def get_advanced_analyses_for_admin(
 
 
 async def get_advanced_analyses_for_base_user(
-    con, user_id: str, sort_field: str | None, sort_direction: str | None, skip: int, limit: int, **filters
+    con,
+    user_id: str,
+    sort_field: str | None,
+    sort_direction: str | None,
+    skip: int,
+    limit: int,
+    cursor: str | None = None,
+    **filters,
 ):
     query = (
         "SELECT id, type, status, sources, (meta - 'error') AS meta, created_at, name "
@@ -857,7 +1241,7 @@ async def get_advanced_analyses_for_base_user(
     query_params = [user_id]
 
     query, query_params = _add_advanced_analysis_sorting_filtering_conds(
-        query, query_params, sort_field, sort_direction, skip, limit, **filters
+        query, query_params, sort_field, sort_direction, skip, limit, cursor, **filters
     )
 
     async with con.transaction():
@@ -867,7 +1251,7 @@ async def get_advanced_analyses_for_base_user(
 
 
 def _add_advanced_analysis_sorting_filtering_conds(
-    query, query_params, sort_field, sort_direction, skip, limit, **filters
+    query, query_params, sort_field, sort_direction, skip, limit, cursor=None, **filters
 ):
     query_params = query_params.copy()
 
@@ -878,7 +1262,7 @@ def _add_advanced_analysis_sorting_filtering_conds(
         placeholder = f"${next_placeholder_count}"
         match filter_name:
             case "name":
-                new_cond = f"LOWER(name) LIKE LOWER({placeholder})"
+                new_cond = f"name ILIKE {placeholder}"
                 filter_value = f"%{filter_value}%"
             case "id":
                 new_cond = f"id::text LIKE {placeholder}"
@@ -900,28 +1284,30 @@ def _add_advanced_analysis_sorting_filtering_conds(
     if conds:
         query += conds
 
-    if sort_field in ("name", "id", "created_at", "type", "status"):
-        if sort_direction not in ("ASC", "DESC"):
-            sort_direction = "DESC"
-        sort_direction = sort_direction.upper()
-        query += f" ORDER BY {sort_field} {sort_direction}"
-
-    query += f" LIMIT ${len(query_params) + 1} OFFSET ${len(query_params) + 2}"
-    query_params += [limit, skip]
-
-    return query, query_params
+    return _add_sorting_and_pagination(
+        query, query_params, _ADVANCED_ANALYSIS_SORT_EXPRS, sort_field, sort_direction, skip, limit, cursor
+    )
 
 
 async def create_advanced_analysis_job(
     *, con, sources, queue, priority, meta, user_id, customer_id, job_type
 ):
-    # the WITH clause in this query is necessary to make sure the given upload_id actually exists
+    scheduled_at = _FAIR_SHARE_SCHEDULED_AT.format(queue="$2", customer_id="$5", step="$6")
     enqueue_job_query = (
-        "INSERT INTO jobs_queue (sources, queue, priority, meta) VALUES ($1, $2, $3, $4) RETURNING id"
+        "INSERT INTO jobs_queue (sources, queue, priority, meta, customer_id, scheduled_at) "
+        f"VALUES ($1, $2, $3, $4, $5, {scheduled_at}) RETURNING id"
     )
     async with con.transaction():
         # add job to queue
-        job_id = await con.fetchval(enqueue_job_query, sources, queue, priority, json.dumps(meta))
+        job_id = await con.fetchval(
+            enqueue_job_query,
+            sources,
+            queue,
+            priority,
+            json.dumps(meta),
+            customer_id,
+            float(FAIR_SHARE_STEP_SECS),
+        )
 
         data = {
             "id": job_id,
@@ -972,3 +1358,82 @@ async def get_advanced_analyses_download_info_for_admin(*, con, customer_id, job
         jobs = [dict(row) async for row in con.cursor(query, customer_id, job_ids)]
 
     return jobs
+
+
+def get_download_bundle_hash(keys: list[str], filenames: list[str]) -> str:
+    """Identify the contents of a bundle. The order the files are given in does not matter."""
+    contents = sorted(zip(keys, filenames))
+    return hashlib.sha256(json.dumps(contents).encode()).hexdigest()
+
+
+async def create_download_bundle(
+    *, con, sources, keys, filenames, filename, account_id, user_id, customer_id, version
+) -> dict[str, Any]:
+    """Return a bundle of the given files, queueing a new one to be built if there is no usable existing bundle.
+
+    A finished bundle of the same files is reused if it is less than DOWNLOAD_BUNDLE_TTL_SECS old. If one is
+    already being built, the account is added to its recipients so it is notified when the bundle is ready along
+    with the account that requested it first. The account is also added to the recipients of a reused bundle so
+    that it can look the bundle up. The caller must make sure the account has access to all the files.
+    """
+    bundle_hash = get_download_bundle_hash(keys, filenames)
+    returning = "RETURNING id, status, object_key, filename"
+
+    async with con.transaction():
+        if existing_bundle := await con.fetchrow(
+            "UPDATE download_bundles "
+            "SET recipients=ARRAY(SELECT DISTINCT unnest(download_bundles.recipients || ARRAY[$3::uuid])) "
+            "WHERE id=("
+            "SELECT id FROM download_bundles "
+            "WHERE bundle_hash=$1 AND status='finished' AND finished_at > NOW() - make_interval(secs => $2) "
+            "ORDER BY finished_at DESC LIMIT 1"
+            f") {returning}",
+            bundle_hash,
+            float(DOWNLOAD_BUNDLE_TTL_SECS),
+            account_id,
+        ):
+            return dict(existing_bundle)
+
+        meta = {"version": version, "bundle_hash": bundle_hash, "keys": keys, "filenames": filenames}
+        bundle_id = uuid.uuid4()
+        bundle = await con.fetchrow(
+            "INSERT INTO download_bundles (id, bundle_hash, user_id, customer_id, recipients, filename, status, meta) "
+            "VALUES ($1, $2, $3, $4, ARRAY[$5::uuid], $6, 'pending', $7) "
+            "ON CONFLICT (bundle_hash) WHERE status IN ('pending', 'running') DO UPDATE "
+            "SET recipients=ARRAY(SELECT DISTINCT unnest(download_bundles.recipients || EXCLUDED.recipients)) "
+            f"{returning}",
+            bundle_id,
+            bundle_hash,
+            user_id,
+            customer_id,
+            account_id,
+            filename,
+            json.dumps(meta),
+        )
+
+        # only queue the bundle if it was just created
+        if bundle["id"] == bundle_id:
+            scheduled_at = _FAIR_SHARE_SCHEDULED_AT.format(queue="$3", customer_id="$6", step="$7")
+            await con.execute(
+                "INSERT INTO jobs_queue (id, sources, queue, priority, meta, customer_id, scheduled_at) "
+                f"VALUES ($1, $2, $3, $4, $5, $6, {scheduled_at})",
+                bundle_id,
+                sources,
+                DOWNLOAD_BUNDLE_QUEUE,
+                DEFAULT_JOB_PRIORITY,
+                json.dumps(meta),
+                customer_id,
+                float(FAIR_SHARE_STEP_SECS),
+            )
+
+    return dict(bundle)
+
+
+async def get_download_bundle(*, con, bundle_id, account_id) -> dict[str, Any] | None:
+    """Return the bundle if the account is one of its recipients."""
+    bundle = await con.fetchrow(
+        "SELECT id, status, object_key, filename FROM download_bundles WHERE id=$1 AND $2=ANY(recipients)",
+        bundle_id,
+        account_id,
+    )
+    return dict(bundle) if bundle else None
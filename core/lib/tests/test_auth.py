@@ -1,3 +1,9 @@
+import asyncio
+import json
+import uuid
+
+from auth import tokens
+from auth.models import AccountTypes
 from auth.scopes import (
     Scopes,
     check_prohibited_user_scopes,
@@ -6,7 +12,63 @@ from auth.scopes import (
     MissingScopeDependencyError,
     validate_scope_dependencies,
 )
+from fastapi import HTTPException
+from fastapi.security import HTTPAuthorizationCredentials
 import pytest
+import pytest_asyncio
+
+
+@pytest.fixture(scope="function", name="verified_token_cache", autouse=True)
+def fixture_verified_token_cache():
+    tokens.VERIFIED_TOKEN_CACHE.clear()
+    yield tokens.VERIFIED_TOKEN_CACHE
+    tokens.VERIFIED_TOKEN_CACHE.clear()
+
+
+@pytest.fixture(scope="function", name="account_scopes_cache")
+def fixture_account_scopes_cache():
+    cache = tokens._AccountScopesCache()
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(tokens, "ACCOUNT_SCOPES_CACHE", cache)
+        yield cache
+
+
+class ListenerConnection:
+    """Stand-in for the connection the account scopes cache listens on."""
+
+    def __init__(self):
+        self.listeners = {}
+        self.termination_listeners = []
+
+    def add_termination_listener(self, callback):
+        self.termination_listeners.append(callback)
+
+    async def add_listener(self, channel, callback):
+        self.listeners[channel] = callback
+
+    def notify(self, payload):
+        self.listeners["events"](self, 1, "events", json.dumps(payload))
+
+    def terminate(self):
+        for callback in self.termination_listeners:
+            callback(self)
+
+
+@pytest_asyncio.fixture(scope="function", name="listening_con")
+async def fixture_listening_con(account_scopes_cache):
+    con = ListenerConnection()
+    listen_task = asyncio.create_task(account_scopes_cache.listen(con))
+    await asyncio.sleep(0)
+    yield con
+    con.terminate()
+    await listen_task
+
+
+def _create_credentials(scopes=(Scopes.MANTARRAY__BASE,)):
+    token = tokens.create_token(
+        userid=uuid.uuid4(), customer_id=uuid.uuid4(), scopes=list(scopes), account_type=AccountTypes.USER
+    )
+    return HTTPAuthorizationCredentials(scheme="Bearer", credentials=token.token)
 
 
 def test_all_admin_scope_requirements_are_actually_admin_scopes():
@@ -123,3 +185,203 @@ def test_check_prohibited_admin_scopes__valid(admin_scope):
 def test_check_prohibited_admin_scopes__invalid(other_admin_scope, root_admin_scopes):
     with pytest.raises(ProhibitedScopeError):
         check_prohibited_user_scopes([other_admin_scope], root_admin_scopes)
+
+
+@pytest.mark.asyncio
+async def test_protected_any__only_decodes_token_once(mocker):
+    spied_decode = mocker.spy(tokens.jwt, "decode")
+    credentials = _create_credentials()
+    protected = tokens.ProtectedAny(scopes=[Scopes.MANTARRAY__BASE])
+
+    payloads = [await protected(credentials) for _ in range(3)]
+
+    assert spied_decode.call_count == 1
+    assert all(payload is payloads[0] for payload in payloads)
+
+
+@pytest.mark.asyncio
+async def test_protected_any__checks_scopes_of_cached_token():
+    credentials = _create_credentials()
+    await tokens.ProtectedAny(scopes=[Scopes.MANTARRAY__BASE])(credentials)
+
+    with pytest.raises(HTTPException) as exc_info:
+        await tokens.ProtectedAny(scopes=[Scopes.MANTARRAY__ADMIN])(credentials)
+    assert exc_info.value.status_code == 401
+
+
+@pytest.mark.asyncio
+async def test_protected_any__does_not_use_cached_token_after_it_expires(mocker):
+    credentials = _create_credentials()
+    protected = tokens.ProtectedAny(scopes=[Scopes.MANTARRAY__BASE])
+    payload = await protected(credentials)
+
+    mocker.patch.object(tokens.time, "time", return_value=payload.exp + 1)
+    spied_decode = mocker.spy(tokens, "decode_token")
+    mocker.patch.object(tokens.jwt, "decode", side_effect=tokens.jwt.ExpiredSignatureError())
+
+    with pytest.raises(HTTPException):
+        await protected(credentials)
+    spied_decode.assert_called_once()
+
+
+def test_verified_token_cache__evicts_least_recently_used_token(mocker):
+    cache = tokens._VerifiedTokenCache(maxsize=2)
+    spied_decode = mocker.spy(tokens, "decode_token")
+    token_1, token_2, token_3 = (_create_credentials().credentials for _ in range(3))
+
+    cache.get(token_1)
+    cache.get(token_2)
+    # token_1 is now the most recently used, so token_2 is evicted
+    cache.get(token_1)
+    cache.get(token_3)
+    assert spied_decode.call_count == 3
+
+    cache.get(token_1)
+    assert spied_decode.call_count == 3
+    cache.get(token_2)
+    assert spied_decode.call_count == 4
+
+
+def _scope_rows(admin_scopes=(), user_scopes=()):
+    return [{"scope": s.value, "is_admin_scope": True} for s in admin_scopes] + [
+        {"scope": s.value, "is_admin_scope": False} for s in user_scopes
+    ]
+
+
+@pytest.mark.asyncio
+async def test_get_account_scopes__returns_assigned_and_inherited_scopes_of_user(mocker):
+    mocked_con = mocker.AsyncMock()
+    mocked_con.fetch.return_value = _scope_rows(
+        admin_scopes=[Scopes.MANTARRAY__ADMIN, Scopes.MANTARRAY__NMJ_FEATURE],
+        user_scopes=[Scopes.MANTARRAY__BASE],
+    )
+    customer_id, user_id = uuid.uuid4(), uuid.uuid4()
+
+    assert await tokens.get_account_scopes(mocked_con, customer_id, user_id) == [
+        Scopes.MANTARRAY__BASE,
+        Scopes.MANTARRAY__NMJ,
+    ]
+    mocked_con.fetch.assert_called_once_with(
+        "SELECT scope, user_id IS NULL AS is_admin_scope FROM account_scopes "
+        "WHERE customer_id=$1 AND (user_id IS NULL OR user_id=$2)",
+        customer_id,
+        user_id,
+    )
+
+
+@pytest.mark.asyncio
+async def test_get_account_scopes__returns_scopes_of_admin(mocker):
+    mocked_con = mocker.AsyncMock()
+    mocked_con.fetch.return_value = _scope_rows(admin_scopes=[Scopes.MANTARRAY__ADMIN])
+
+    assert await tokens.get_account_scopes(mocked_con, uuid.uuid4(), None) == [Scopes.MANTARRAY__ADMIN]
+
+
+@pytest.mark.asyncio
+async def test_get_account_scopes__uses_cache_while_listening(listening_con, mocker):
+    mocked_con = mocker.AsyncMock()
+    mocked_con.fetch.return_value = _scope_rows(user_scopes=[Scopes.MANTARRAY__BASE])
+    customer_id, user_id = uuid.uuid4(), uuid.uuid4()
+
+    for _ in range(3):
+        scopes = await tokens.get_account_scopes(mocked_con, customer_id, user_id, use_cache=True)
+        assert scopes == [Scopes.MANTARRAY__BASE]
+    # the cache is not used unless requested
+    await tokens.get_account_scopes(mocked_con, customer_id, user_id)
+
+    assert mocked_con.fetch.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_get_account_scopes__does_not_use_cache_when_not_listening(account_scopes_cache, mocker):
+    mocked_con = mocker.AsyncMock()
+    mocked_con.fetch.return_value = _scope_rows(admin_scopes=[Scopes.MANTARRAY__ADMIN])
+    customer_id = uuid.uuid4()
+
+    for _ in range(2):
+        await tokens.get_account_scopes(mocked_con, customer_id, None, use_cache=True)
+
+    assert mocked_con.fetch.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_account_scopes_cache__drops_scopes_of_customer_when_they_change(listening_con, mocker):
+    mocked_con = mocker.AsyncMock()
+    mocked_con.fetch.return_value = _scope_rows(admin_scopes=[Scopes.MANTARRAY__ADMIN])
+    customer_id, other_customer_id = uuid.uuid4(), uuid.uuid4()
+    for c_id in (customer_id, other_customer_id):
+        await tokens.get_account_scopes(mocked_con, c_id, None, use_cache=True)
+
+    listening_con.notify({"table": "jobs_result", "customer_id": str(customer_id)})
+    listening_con.notify({"table": "account_scopes", "customer_id": str(customer_id)})
+    mocked_con.fetch.return_value = _scope_rows(
+        admin_scopes=[Scopes.MANTARRAY__ADMIN, Scopes.NAUTILAI__ADMIN]
+    )
+
+    assert await tokens.get_account_scopes(mocked_con, customer_id, None, use_cache=True) == [
+        Scopes.MANTARRAY__ADMIN,
+        Scopes.NAUTILAI__ADMIN,
+    ]
+    assert await tokens.get_account_scopes(mocked_con, other_customer_id, None, use_cache=True) == [
+        Scopes.MANTARRAY__ADMIN
+    ]
+    assert mocked_con.fetch.call_count == 3
+
+
+@pytest.mark.asyncio
+async def test_account_scopes_cache__does_not_cache_scopes_that_changed_while_being_queried(
+    listening_con, mocker
+):
+    customer_id = uuid.uuid4()
+
+    async def _fetch_se(*args):
+        # the change is committed after the scopes were read
+        listening_con.notify({"table": "account_scopes", "customer_id": str(customer_id)})
+        return _scope_rows(admin_scopes=[Scopes.MANTARRAY__ADMIN])
+
+    mocked_con = mocker.AsyncMock()
+    mocked_con.fetch.side_effect = _fetch_se
+
+    for _ in range(2):
+        await tokens.get_account_scopes(mocked_con, customer_id, None, use_cache=True)
+
+    assert mocked_con.fetch.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_account_scopes_cache__is_cleared_when_listening_stops(
+    listening_con, account_scopes_cache, mocker
+):
+    mocked_con = mocker.AsyncMock()
+    mocked_con.fetch.return_value = _scope_rows(admin_scopes=[Scopes.MANTARRAY__ADMIN])
+    customer_id = uuid.uuid4()
+    await tokens.get_account_scopes(mocked_con, customer_id, None, use_cache=True)
+
+    listening_con.terminate()
+    await asyncio.sleep(0)
+
+    assert account_scopes_cache.get(customer_id, None) is None
+    await tokens.get_account_scopes(mocked_con, customer_id, None, use_cache=True)
+    assert mocked_con.fetch.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_refresh__makes_fewer_queries_with_account_scopes_cache(listening_con, mocker):
+    mocked_con = mocker.AsyncMock()
+    mocked_con.fetch.return_value = _scope_rows(user_scopes=[Scopes.MANTARRAY__BASE])
+    customer_id, user_id = uuid.uuid4(), uuid.uuid4()
+
+    async def _num_queries(use_cache):
+        mocked_con.reset_mock()
+        for _ in range(3):
+            # what /refresh does after decoding the given refresh token
+            scopes = await tokens.get_account_scopes(mocked_con, customer_id, user_id, use_cache=use_cache)
+            await tokens.create_new_tokens(mocked_con, user_id, customer_id, scopes, AccountTypes.USER)
+        return mocked_con.fetch.call_count + mocked_con.execute.call_count
+
+    uncached_queries = await _num_queries(False)
+    cached_queries = await _num_queries(True)
+
+    assert uncached_queries == 6
+    # only the first refresh queries the scopes
+    assert cached_queries == 4
@@ -0,0 +1,149 @@
+import asyncio
+import os
+import statistics
+import time
+import uuid
+
+from auth import tokens
+from auth.models import AccountTypes
+from auth.scopes import Scopes, ScopeTags
+from fastapi.security import HTTPAuthorizationCredentials
+import pytest
+
+# these take a while and depend on the speed of the machine, so are only run when asked for
+run_benchmark = pytest.mark.skipif(
+    not os.getenv("RUN_BENCHMARKS"), reason="RUN_BENCHMARKS not set, skipping auth benchmarks"
+)
+
+NUM_REQUESTS = 1000
+# decoding verifies the signature and builds the payload model, a cache hit is a dict lookup
+MIN_SPEEDUP = 5
+
+NUM_REFRESHES = 100
+# a refresh makes 3 queries when the account's scopes aren't cached and 2 when they are
+MIN_REFRESH_SPEEDUP = 1.25
+
+
+def _run(coro):
+    # ProtectedAny never actually awaits anything, so it can be run without the overhead of an event loop
+    try:
+        coro.send(None)
+    except StopIteration as e:
+        return e.value
+    raise AssertionError("Coroutine did not complete")
+
+
+def _median_us(fn):
+    durations_us = []
+    for _ in range(NUM_REQUESTS):
+        start = time.perf_counter()
+        fn()
+        durations_us.append((time.perf_counter() - start) * 1e6)
+    return statistics.median(durations_us)
+
+
+@run_benchmark
+def test_protected_any__verified_token_cache_overhead():
+    token = tokens.create_token(
+        userid=uuid.uuid4(),
+        customer_id=uuid.uuid4(),
+        scopes=[Scopes.MANTARRAY__BASE],
+        account_type=AccountTypes.USER,
+    )
+    credentials = HTTPAuthorizationCredentials(scheme="Bearer", credentials=token.token)
+    protected = tokens.ProtectedAny(tag=ScopeTags.PULSE3D_READ)
+
+    def _uncached_request():
+        # how every request used to be handled
+        tokens.VERIFIED_TOKEN_CACHE.clear()
+        _run(protected(credentials))
+
+    def _cached_request():
+        _run(protected(credentials))
+
+    try:
+        uncached_median_us = _median_us(_uncached_request)
+        # the first request caches the token
+        _cached_request()
+        cached_median_us = _median_us(_cached_request)
+    finally:
+        tokens.VERIFIED_TOKEN_CACHE.clear()
+
+    print(  # allow-print
+        f"ProtectedAny: median auth overhead per request uncached={uncached_median_us:.1f}us "
+        f"cached={cached_median_us:.1f}us"
+    )
+
+    assert cached_median_us * MIN_SPEEDUP < uncached_median_us
+
+
+class SlowConnection:
+    """Connection where every query takes as long as a round trip to the DB."""
+
+    ROUND_TRIP_SECS = 0.002
+
+    def __init__(self, customer_id):
+        self.customer_id = customer_id
+        self.num_queries = 0
+
+    async def _query(self):
+        self.num_queries += 1
+        await asyncio.sleep(self.ROUND_TRIP_SECS)
+
+    async def fetchrow(self, *args):
+        await self._query()
+        return {"customer_id": self.customer_id}
+
+    async def fetch(self, *args):
+        await self._query()
+        return [
+            {"scope": Scopes.MANTARRAY__ADMIN.value, "is_admin_scope": True},
+            {"scope": Scopes.MANTARRAY__BASE.value, "is_admin_scope": False},
+        ]
+
+    async def execute(self, *args):
+        await self._query()
+
+    def add_termination_listener(self, callback):
+        pass
+
+    async def add_listener(self, channel, callback):
+        pass
+
+
+@run_benchmark
+@pytest.mark.asyncio
+async def test_refresh__account_scopes_cache_throughput(mocker):
+    customer_id, user_id = uuid.uuid4(), uuid.uuid4()
+    con = SlowConnection(customer_id)
+    cache = tokens._AccountScopesCache()
+    mocker.patch.object(tokens, "ACCOUNT_SCOPES_CACHE", cache)
+
+    async def _refresh(use_cache):
+        # what /refresh does after decoding the given refresh token
+        row = await con.fetchrow("SELECT refresh_token, customer_id FROM users WHERE id=$1", user_id)
+        scopes = await tokens.get_account_scopes(con, row["customer_id"], user_id, use_cache=use_cache)
+        await tokens.create_new_tokens(con, user_id, customer_id, scopes, AccountTypes.USER)
+
+    async def _refreshes_per_sec(use_cache):
+        con.num_queries = 0
+        start = time.perf_counter()
+        for _ in range(NUM_REFRESHES):
+            await _refresh(use_cache)
+        return NUM_REFRESHES / (time.perf_counter() - start), con.num_queries / NUM_REFRESHES
+
+    listen_task = asyncio.create_task(cache.listen(con))
+    await asyncio.sleep(0)
+    try:
+        uncached_rate, uncached_queries = await _refreshes_per_sec(False)
+        cached_rate, cached_queries = await _refreshes_per_sec(True)
+    finally:
+        listen_task.cancel()
+        await asyncio.gather(listen_task, return_exceptions=True)
+
+    print(  # allow-print
+        f"/refresh: refreshes/sec uncached={uncached_rate:.0f} ({uncached_queries:.2f} queries each) "
+        f"cached={cached_rate:.0f} ({cached_queries:.2f} queries each)"
+    )
+
+    assert cached_rate > uncached_rate * MIN_REFRESH_SPEEDUP
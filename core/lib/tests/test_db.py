@@ -0,0 +1,69 @@
+import pytest
+from utils import db
+
+
+TEST_POOL_NAME = "test-pool"
+
+
+@pytest.fixture(scope="function", name="mocked_pool")
+def fixture_mocked_pool(mocker):
+    mocked_pool = mocker.MagicMock()
+    mocked_pool.get_size.return_value = 5
+    mocked_pool.get_max_size.return_value = 10
+    mocked_pool.get_idle_size.return_value = 2
+    mocked_pool.acquire.return_value.__aenter__ = mocker.AsyncMock(return_value="test-con")
+    mocked_pool.acquire.return_value.__aexit__ = mocker.AsyncMock(return_value=False)
+    yield mocked_pool
+
+
+def _get_sample(metric, suffix=""):
+    for sample in metric.collect()[0].samples:
+        if sample.name == metric._name + suffix and sample.labels.get("pool") == TEST_POOL_NAME:
+            return sample.value
+
+
+@pytest.mark.asyncio
+async def test_asyncpg_pool_dep__creates_pool_once_with_configured_settings(mocked_pool, mocker):
+    # asyncpg.create_pool returns an awaitable pool rather than being a coroutine function, so can't be autospecced
+    mocked_create_pool = mocker.patch.object(
+        db.asyncpg, "create_pool", new=mocker.AsyncMock(return_value=mocked_pool)
+    )
+
+    pool_dep = db.AsyncpgPoolDep("test-dsn", min_size=2, max_size=4, name=TEST_POOL_NAME)
+    pool = await pool_dep()
+    assert await pool_dep() is pool
+
+    mocked_create_pool.assert_awaited_once_with(
+        "test-dsn",
+        min_size=2,
+        max_size=4,
+        statement_cache_size=db.DB_STATEMENT_CACHE_SIZE,
+        max_cached_statement_lifetime=db.DB_MAX_CACHED_STATEMENT_LIFETIME_SECS,
+    )
+
+
+@pytest.mark.asyncio
+async def test_instrumented_pool__records_acquire_time(mocked_pool):
+    pool = db.InstrumentedPool(mocked_pool, TEST_POOL_NAME)
+    num_acquires_before = _get_sample(db.POOL_ACQUIRE_SECONDS, "_count") or 0
+
+    async with pool.acquire() as con:
+        assert con == "test-con"
+
+    assert _get_sample(db.POOL_ACQUIRE_SECONDS, "_count") == num_acquires_before + 1
+    mocked_pool.acquire.return_value.__aexit__.assert_awaited_once()
+
+
+def test_instrumented_pool__reports_pool_usage(mocked_pool):
+    db.InstrumentedPool(mocked_pool, TEST_POOL_NAME)
+
+    assert _get_sample(db.POOL_SIZE) == 5
+    assert _get_sample(db.POOL_MAX_SIZE) == 10
+    assert _get_sample(db.POOL_IDLE) == 2
+    assert _get_sample(db.POOL_IN_USE) == 3
+
+
+def test_instrumented_pool__passes_through_other_attributes(mocked_pool):
+    pool = db.InstrumentedPool(mocked_pool, TEST_POOL_NAME)
+
+    assert pool.release is mocked_pool.release
@@ -0,0 +1,624 @@
+import asyncio
+from datetime import datetime
+import json
+import threading
+import uuid
+
+from jobs import (
+    JOB_SORT_FIELDS,
+    UPLOAD_SORT_FIELDS,
+    EmptyQueue,
+    InvalidCursor,
+    check_customer_pulse3d_usage,
+    create_advanced_analysis_job,
+    create_download_bundle,
+    create_job,
+    get_item,
+    get_advanced_item,
+    get_download_bundle_hash,
+    get_download_bundle_item,
+    get_jobs_info_for_admin,
+    get_next_cursor,
+    get_uploads_info_for_admin,
+    get_uploads_info_for_base_user,
+    get_uploads_info_for_rw_all_data_user,
+    listen_for_new_items,
+    reclaim_expired_items,
+)
+import pytest
+
+
+TEST_QUEUE = "test-queue"
+TEST_WORKER_ID = "test-worker"
+
+
+@pytest.fixture(scope="function", name="mocked_pool")
+def fixture_mocked_pool(mocker):
+    mocked_con = mocker.MagicMock()
+    mocked_con.claimable_items = []
+    mocked_con.failed_items = []
+
+    async def _fetch_se(query, *args):
+        if query.startswith("DELETE FROM jobs_queue"):
+            return mocked_con.failed_items
+        return mocked_con.claimable_items
+
+    mocked_con.fetch = mocker.AsyncMock(side_effect=_fetch_se)
+    # returned when removing a finished item from the queue
+    mocked_con.fetchval = mocker.AsyncMock(side_effect=lambda query, item_id, *args: item_id)
+    mocked_con.fetchrow = mocker.AsyncMock()
+    mocked_con.execute = mocker.AsyncMock()
+    mocked_con.executemany = mocker.AsyncMock()
+    mocked_con.add_listener = mocker.AsyncMock()
+    mocked_con.remove_listener = mocker.AsyncMock()
+    mocked_con.transaction.return_value.__aenter__ = mocker.AsyncMock()
+    mocked_con.transaction.return_value.__aexit__ = mocker.AsyncMock(return_value=False)
+
+    mocked_pool = mocker.MagicMock()
+    mocked_pool.acquire.return_value.__aenter__ = mocker.AsyncMock(return_value=mocked_con)
+    mocked_pool.acquire.return_value.__aexit__ = mocker.AsyncMock(return_value=False)
+
+    yield mocked_pool, mocked_con
+
+
+def _create_items(num_items):
+    return [{"id": uuid.uuid4(), "upload_id": uuid.uuid4(), "meta": json.dumps({})} for _ in range(num_items)]
+
+
+def _get_executed_queries(mocked_con):
+    return [c.args[0] for c in mocked_con.execute.call_args_list]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("decorator", [get_item, get_advanced_item, get_download_bundle_item])
+async def test_get_item__raises_empty_queue_if_no_items_claimed(decorator, mocked_pool, mocker):
+    pool, _ = mocked_pool
+
+    mocked_fn = mocker.AsyncMock()
+
+    with pytest.raises(EmptyQueue, match=TEST_QUEUE):
+        await decorator(queue=TEST_QUEUE)(mocked_fn)(pool=pool, worker_id=TEST_WORKER_ID)
+
+    mocked_fn.assert_not_called()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("batch_size", [1, 3])
+async def test_get_item__claims_batch_and_processes_each_item(batch_size, mocked_pool, mocker):
+    pool, con = mocked_pool
+
+    test_items = _create_items(batch_size)
+    con.claimable_items = test_items
+
+    mocked_fn = mocker.AsyncMock(return_value=("finished", {}, "test/key"))
+
+    await get_item(queue=TEST_QUEUE, batch_size=batch_size)(mocked_fn)(pool=pool, worker_id=TEST_WORKER_ID)
+
+    claim_query, *claim_args = con.fetch.call_args.args
+    assert "ORDER BY priority DESC, scheduled_at ASC FOR UPDATE SKIP LOCKED" in claim_query
+    assert claim_args[:3] == [TEST_QUEUE, TEST_WORKER_ID, batch_size]
+
+    assert [c.args[1] for c in mocked_fn.call_args_list] == test_items
+
+    delete_calls = [c for c in con.fetchval.call_args_list if c.args[0].startswith("DELETE FROM jobs_queue")]
+    assert [c.args[1:] for c in delete_calls] == [(item["id"], TEST_WORKER_ID) for item in test_items]
+
+    result_updates = [
+        q for q in _get_executed_queries(con) if q.startswith("UPDATE jobs_result SET status =")
+    ]
+    assert len(result_updates) == batch_size
+
+
+@pytest.mark.asyncio
+async def test_get_item__runs_blocking_work_of_items_in_batch_in_parallel(mocked_pool):
+    pool, con = mocked_pool
+
+    batch_size = 3
+    con.claimable_items = _create_items(batch_size)
+
+    # can only be passed once the blocking work of every item in the batch is running at the same time
+    barrier = threading.Barrier(batch_size, timeout=5)
+
+    async def _process_item(pool, item):
+        await asyncio.to_thread(barrier.wait)
+        return "finished", {}, "test/key"
+
+    await get_item(queue=TEST_QUEUE, batch_size=batch_size)(_process_item)(
+        pool=pool, worker_id=TEST_WORKER_ID
+    )
+
+    delete_calls = [c for c in con.fetchval.call_args_list if c.args[0].startswith("DELETE FROM jobs_queue")]
+    assert len(delete_calls) == batch_size
+
+
+@pytest.mark.asyncio
+async def test_get_item__releases_item_if_processing_raises(mocked_pool, mocker):
+    pool, con = mocked_pool
+
+    test_items = _create_items(2)
+    con.claimable_items = test_items
+
+    expected_error = Exception("test error")
+    mocked_fn = mocker.AsyncMock(side_effect=[expected_error, ("finished", {}, "test/key")])
+
+    with pytest.raises(Exception, match="test error"):
+        await get_item(queue=TEST_QUEUE, batch_size=2)(mocked_fn)(pool=pool, worker_id=TEST_WORKER_ID)
+
+    release_calls = [c for c in con.execute.call_args_list if "WHERE claimed_by=$1" in c.args[0]]
+    assert len(release_calls) == 1
+    # the error is recorded so the item isn't reported as running out of time/memory if it has no attempts left
+    assert release_calls[0].args[1:] == (TEST_WORKER_ID, [test_items[0]["id"]], repr(expected_error))
+    # the other item should still have been processed
+    assert any(c.args[0].startswith("DELETE FROM jobs_queue") for c in con.fetchval.call_args_list)
+
+
+@pytest.mark.asyncio
+async def test_get_item__does_not_hold_connection_while_processing_item(mocked_pool):
+    pool, con = mocked_pool
+
+    con.claimable_items = _create_items(1)
+    acquire_ctx = pool.acquire.return_value
+    num_cons_held_while_processing = []
+
+    async def _process_item(pool, item):
+        num_cons_held_while_processing.append(
+            acquire_ctx.__aenter__.await_count - acquire_ctx.__aexit__.await_count
+        )
+        return "finished", {}, "test/key"
+
+    await get_item(queue=TEST_QUEUE)(_process_item)(pool=pool, worker_id=TEST_WORKER_ID)
+
+    assert num_cons_held_while_processing == [0]
+    # the result is still recorded
+    assert [q for q in _get_executed_queries(con) if q.startswith("UPDATE jobs_result SET status =")]
+
+
+@pytest.mark.asyncio
+async def test_get_item__keeps_renewing_leases_after_heartbeat_fails(mocked_pool, mocker):
+    pool, con = mocked_pool
+
+    con.claimable_items = _create_items(1)
+    num_heartbeats = 0
+
+    async def _execute_se(query, *args):
+        nonlocal num_heartbeats
+        if query.startswith("UPDATE jobs_queue SET lease_expires_at"):
+            num_heartbeats += 1
+            if num_heartbeats == 1:
+                raise Exception("test heartbeat error")
+
+    con.execute.side_effect = _execute_se
+    mocked_log_exception = mocker.patch("jobs.jobs.logger.exception", autospec=True)
+
+    async def _process_item(pool, item):
+        while num_heartbeats < 2:
+            await asyncio.sleep(0.001)
+        return "finished", {}, "test/key"
+
+    await asyncio.wait_for(
+        get_item(queue=TEST_QUEUE, lease_secs=0.01)(_process_item)(pool=pool, worker_id=TEST_WORKER_ID),
+        timeout=5,
+    )
+
+    mocked_log_exception.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_get_item__does_not_record_result_if_lease_was_lost(mocked_pool, mocker):
+    pool, con = mocked_pool
+
+    con.claimable_items = _create_items(1)
+    # item no longer claimed by this worker
+    con.fetchval.side_effect = None
+    con.fetchval.return_value = None
+
+    mocked_fn = mocker.AsyncMock(return_value=("finished", {}, "test/key"))
+
+    await get_item(queue=TEST_QUEUE)(mocked_fn)(pool=pool, worker_id=TEST_WORKER_ID)
+
+    mocked_fn.assert_called_once()
+    assert not [q for q in _get_executed_queries(con) if q.startswith("UPDATE jobs_result SET status =")]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("num_failed", [0, 2])
+async def test_reclaim_expired_items__fails_items_out_of_attempts(num_failed, mocked_pool):
+    _, con = mocked_pool
+
+    con.failed_items = [{"id": uuid.uuid4(), "last_error": None} for _ in range(num_failed)]
+
+    failed_ids = await reclaim_expired_items(
+        con, queue=TEST_QUEUE, result_table="jobs_result", result_id_col="job_id", max_attempts=2
+    )
+    assert failed_ids == [item["id"] for item in con.failed_items]
+
+    executed_queries = _get_executed_queries(con)
+    assert len(executed_queries) == 1
+    assert "lease_expires_at < NOW()" in executed_queries[0]
+    if num_failed:
+        update_query, update_args = con.executemany.call_args.args
+        assert update_query.startswith("UPDATE jobs_result SET status='error'")
+        assert update_args == [
+            (json.dumps({"error_msg": "Ran out of time/memory"}), failed_id) for failed_id in failed_ids
+        ]
+    else:
+        con.executemany.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_reclaim_expired_items__fails_items_with_error_they_were_released_with(mocked_pool):
+    _, con = mocked_pool
+
+    con.failed_items = [
+        {"id": uuid.uuid4(), "last_error": "Exception('test error')"},
+        {"id": uuid.uuid4(), "last_error": None},
+    ]
+
+    await reclaim_expired_items(
+        con, queue=TEST_QUEUE, result_table="jobs_result", result_id_col="job_id", max_attempts=2
+    )
+
+    assert con.executemany.call_args.args[1] == [
+        (json.dumps({"error": "Exception('test error')"}), con.failed_items[0]["id"]),
+        (json.dumps({"error_msg": "Ran out of time/memory"}), con.failed_items[1]["id"]),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_listen_for_new_items__sets_event_on_notification(mocked_pool):
+    pool, con = mocked_pool
+
+    async with listen_for_new_items(pool) as new_items_event:
+        channel, callback = con.add_listener.call_args.args
+        assert channel == "jobs_queue"
+        assert not new_items_event.is_set()
+
+        callback(con, 1234, channel, "")
+        assert new_items_event.is_set()
+
+    con.remove_listener.assert_awaited_once_with(channel, callback)
+
+
+@pytest.mark.asyncio
+async def test_create_job__schedules_item_after_last_item_of_customer(mocked_pool):
+    _, con = mocked_pool
+
+    test_customer_id = uuid.uuid4()
+    con.fetchrow.return_value = {"id": uuid.uuid4()}
+
+    await create_job(
+        con=con,
+        upload_id=uuid.uuid4(),
+        queue=TEST_QUEUE,
+        priority=10,
+        meta={},
+        customer_id=test_customer_id,
+        job_type="mantarray",
+    )
+
+    enqueue_query, *enqueue_args = con.fetchrow.call_args.args
+    assert "SELECT MAX(scheduled_at) FROM jobs_queue WHERE queue=$2 AND customer_id=$5" in enqueue_query
+    assert enqueue_args[4] == test_customer_id
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("test_job_id", [None, uuid.uuid4()])
+async def test_create_job__uses_given_job_id(test_job_id, mocked_pool):
+    _, con = mocked_pool
+
+    con.fetchrow.return_value = {"id": test_job_id or uuid.uuid4()}
+
+    await create_job(
+        con=con,
+        upload_id=uuid.uuid4(),
+        queue=TEST_QUEUE,
+        priority=10,
+        meta={},
+        customer_id=uuid.uuid4(),
+        job_type="mantarray",
+        job_id=test_job_id,
+    )
+
+    enqueue_query, *enqueue_args = con.fetchrow.call_args.args
+    # the DB generates an ID if one isn't given
+    assert "COALESCE($7::uuid, gen_random_uuid())" in enqueue_query
+    assert enqueue_args[6] == test_job_id
+
+
+@pytest.mark.asyncio
+async def test_create_advanced_analysis_job__schedules_item_after_last_item_of_customer(mocked_pool):
+    _, con = mocked_pool
+
+    test_customer_id = uuid.uuid4()
+
+    await create_advanced_analysis_job(
+        con=con,
+        sources=[uuid.uuid4()],
+        queue=TEST_QUEUE,
+        priority=10,
+        meta={},
+        user_id=uuid.uuid4(),
+        customer_id=test_customer_id,
+        job_type="longitudinal",
+    )
+
+    enqueue_query, *enqueue_args = con.fetchval.call_args_list[0].args
+    assert "SELECT MAX(scheduled_at) FROM jobs_queue WHERE queue=$2 AND customer_id=$5" in enqueue_query
+    assert enqueue_args[4] == test_customer_id
+
+
+def _create_download_bundle_kwargs(con):
+    return dict(
+        con=con,
+        sources=[uuid.uuid4()],
+        keys=["prefix/a.zip", "prefix/b.zip"],
+        filenames=["a.zip", "b.zip"],
+        filename="recordings__2.zip",
+        account_id=uuid.uuid4(),
+        user_id=uuid.uuid4(),
+        customer_id=uuid.uuid4(),
+        version="0.1.0",
+    )
+
+
+def test_get_download_bundle_hash__does_not_depend_on_order_of_files():
+    assert get_download_bundle_hash(["k0", "k1"], ["f0", "f1"]) == get_download_bundle_hash(
+        ["k1", "k0"], ["f1", "f0"]
+    )
+    assert get_download_bundle_hash(["k0", "k1"], ["f0", "f1"]) != get_download_bundle_hash(
+        ["k0", "k1"], ["f1", "f0"]
+    )
+
+
+@pytest.mark.asyncio
+async def test_create_download_bundle__reuses_recently_finished_bundle(mocked_pool):
+    _, con = mocked_pool
+
+    finished_bundle = {
+        "id": uuid.uuid4(),
+        "status": "finished",
+        "object_key": "bundles/x.zip",
+        "filename": "f.zip",
+    }
+    con.fetchrow.return_value = finished_bundle
+    kwargs = _create_download_bundle_kwargs(con)
+
+    assert await create_download_bundle(**kwargs) == finished_bundle
+
+    con.fetchrow.assert_awaited_once()
+    # the account must be a recipient to be able to look up the bundle
+    reuse_query, *reuse_args = con.fetchrow.call_args.args
+    assert reuse_query.startswith("UPDATE download_bundles SET recipients=")
+    assert reuse_args[-1] == kwargs["account_id"]
+    con.execute.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+async def test_create_download_bundle__queues_new_bundle(mocked_pool):
+    _, con = mocked_pool
+
+    async def _fetchrow_se(query, *args):
+        if query.startswith("INSERT INTO download_bundles"):
+            return {"id": args[0], "status": "pending", "object_key": None, "filename": args[5]}
+        return None
+
+    con.fetchrow.side_effect = _fetchrow_se
+    kwargs = _create_download_bundle_kwargs(con)
+
+    bundle = await create_download_bundle(**kwargs)
+
+    assert bundle["status"] == "pending"
+    enqueue_query, *enqueue_args = con.execute.call_args.args
+    assert enqueue_query.startswith("INSERT INTO jobs_queue")
+    assert enqueue_args[0] == bundle["id"]
+    assert enqueue_args[1] == kwargs["sources"]
+    assert json.loads(enqueue_args[4])["keys"] == kwargs["keys"]
+
+
+@pytest.mark.asyncio
+async def test_create_download_bundle__does_not_queue_bundle_already_being_built(mocked_pool):
+    _, con = mocked_pool
+
+    in_progress_bundle = {"id": uuid.uuid4(), "status": "running", "object_key": None, "filename": "f.zip"}
+    con.fetchrow.side_effect = [None, in_progress_bundle]
+
+    assert await create_download_bundle(**_create_download_bundle_kwargs(con)) == in_progress_bundle
+
+    con.execute.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "get_uploads_fn,account_args",
+    [
+        (get_uploads_info_for_admin, ["customer_id"]),
+        (get_uploads_info_for_rw_all_data_user, ["customer_id", "mantarray"]),
+        (get_uploads_info_for_base_user, ["user_id", "mantarray"]),
+    ],
+)
+async def test_get_uploads_info__uses_last_analyzed_column(get_uploads_fn, account_args, mocked_pool):
+    _, con = mocked_pool
+    con.cursor.return_value.__aiter__.return_value = []
+
+    await get_uploads_fn(
+        con,
+        *account_args,
+        sort_field="last_analyzed",
+        sort_direction="ASC",
+        skip=0,
+        limit=10,
+        last_analyzed_min="2024-01-01T00:00:00.000Z",
+    )
+
+    query = con.cursor.call_args.args[0]
+    # should not need to aggregate all jobs of the uploads
+    assert "jobs_result" not in query
+    assert "uploads.last_analyzed >= " in query
+    assert "ORDER BY uploads.last_analyzed ASC" in query
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "get_uploads_fn,account_args",
+    [
+        (get_uploads_info_for_admin, ["customer_id"]),
+        (get_uploads_info_for_rw_all_data_user, ["customer_id", "mantarray"]),
+    ],
+)
+async def test_get_uploads_info__filters_customer_on_uploads_table(get_uploads_fn, account_args, mocked_pool):
+    _, con = mocked_pool
+    con.cursor.return_value.__aiter__.return_value = []
+
+    await get_uploads_fn(con, *account_args, sort_field=None, sort_direction=None, skip=0, limit=10)
+
+    query = con.cursor.call_args.args[0]
+    # so that uploads_customer_id_type_last_analyzed_idx can be used
+    assert "WHERE uploads.customer_id=$1" in query
+
+
+def test_get_next_cursor__returns_none_on_last_page():
+    rows = [{"id": uuid.uuid4(), "created_at": datetime.now()}]
+    assert (
+        get_next_cursor(rows, sort_fields=UPLOAD_SORT_FIELDS, sort_field=None, sort_direction=None, limit=2)
+        is None
+    )
+
+
+@pytest.mark.asyncio
+async def test_get_uploads_info__cursor_seeks_past_last_row_of_previous_page(mocked_pool):
+    _, con = mocked_pool
+    con.cursor.return_value.__aiter__.return_value = []
+
+    last_row = {"id": uuid.uuid4(), "last_analyzed": datetime(2024, 1, 2, 3, 4, 5, 678)}
+    cursor = get_next_cursor(
+        [last_row], sort_fields=UPLOAD_SORT_FIELDS, sort_field="last_analyzed", sort_direction="DESC", limit=1
+    )
+
+    await get_uploads_info_for_admin(
+        con,
+        "customer_id",
+        sort_field="last_analyzed",
+        sort_direction="DESC",
+        skip=100,
+        limit=10,
+        cursor=cursor,
+    )
+
+    query, *query_params = con.cursor.call_args.args
+    assert "(uploads.last_analyzed, uploads.id) < ($2::timestamp, $3::uuid)" in query
+    assert query.endswith("ORDER BY uploads.last_analyzed DESC, uploads.id DESC LIMIT $4")
+    # skip is not used when paginating with a cursor
+    assert "OFFSET" not in query
+    assert query_params == ["customer_id", last_row["last_analyzed"], str(last_row["id"]), 10]
+
+
+@pytest.mark.asyncio
+async def test_get_jobs_info__cursor_defaults_to_created_at_desc(mocked_pool):
+    _, con = mocked_pool
+    con.cursor.return_value.__aiter__.return_value = []
+
+    last_row = {"id": uuid.uuid4(), "created_at": datetime(2024, 1, 2)}
+    cursor = get_next_cursor(
+        [last_row], sort_fields=JOB_SORT_FIELDS, sort_field=None, sort_direction=None, limit=1
+    )
+
+    await get_jobs_info_for_admin(
+        con, "customer_id", "mantarray", sort_field=None, sort_direction=None, skip=0, limit=1, cursor=cursor
+    )
+
+    query = con.cursor.call_args.args[0]
+    assert "(j.created_at, j.job_id) < ($3::timestamp, $4::uuid)" in query
+    assert "ORDER BY j.created_at DESC, j.job_id DESC" in query
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("cursor", ["not-a-cursor", "WyJpZCIsICJERVNDIl0="])
+async def test_get_uploads_info__raises_error_for_invalid_cursor(cursor, mocked_pool):
+    _, con = mocked_pool
+
+    with pytest.raises(InvalidCursor):
+        await get_uploads_info_for_admin(
+            con, "customer_id", sort_field=None, sort_direction=None, skip=0, limit=10, cursor=cursor
+        )
+
+
+@pytest.mark.asyncio
+async def test_get_uploads_info__raises_error_if_cursor_sort_does_not_match(mocked_pool):
+    _, con = mocked_pool
+
+    cursor = get_next_cursor(
+        [{"id": uuid.uuid4(), "filename": "f"}],
+        sort_fields=UPLOAD_SORT_FIELDS,
+        sort_field="filename",
+        sort_direction="ASC",
+        limit=1,
+    )
+
+    with pytest.raises(InvalidCursor):
+        await get_uploads_info_for_admin(
+            con, "customer_id", sort_field="filename", sort_direction="DESC", skip=0, limit=10, cursor=cursor
+        )
+
+
+@pytest.mark.asyncio
+async def test_get_uploads_info__substring_filters_match_trgm_indexed_expressions(mocked_pool):
+    _, con = mocked_pool
+    con.cursor.return_value.__aiter__.return_value = []
+
+    await get_uploads_info_for_admin(
+        con,
+        "customer_id",
+        sort_field=None,
+        sort_direction=None,
+        skip=0,
+        limit=10,
+        filename="Rec",
+        id="abc",
+        username="user",
+    )
+
+    query, *query_params = con.cursor.call_args.args
+    assert "uploads.filename ILIKE $2" in query
+    assert "uploads.id::text LIKE $3" in query
+    assert "users.name LIKE $4" in query
+    assert query_params[1:4] == ["%Rec%", "%abc%", "%user%"]
+
+
+@pytest.mark.asyncio
+async def test_get_jobs_info__filename_filter_matches_trgm_indexed_expression(mocked_pool):
+    _, con = mocked_pool
+    con.cursor.return_value.__aiter__.return_value = []
+
+    await get_jobs_info_for_admin(
+        con,
+        "customer_id",
+        "mantarray",
+        sort_field=None,
+        sort_direction=None,
+        skip=0,
+        limit=10,
+        filename="Rec",
+    )
+
+    query = con.cursor.call_args.args[0]
+    assert "reverse(split_part(reverse(j.object_key), '/', 1)) ILIKE $3" in query
+
+
+@pytest.mark.asyncio
+async def test_check_customer_pulse3d_usage__reads_limits_and_counters_in_one_query(mocked_pool):
+    _, con = mocked_pool
+    con.fetchrow.return_value = {
+        "usage": json.dumps({"jobs": 10, "uploads": 5, "expiration_date": None}),
+        "total_uploads": 5,
+        "total_jobs": 7,
+    }
+
+    usage_quota = await check_customer_pulse3d_usage(con, "customer_id", "mantarray")
+
+    assert usage_quota["uploads_reached"] is True
+    assert usage_quota["jobs_reached"] is False
+    assert usage_quota["current"] == {"jobs": 7, "uploads": 5}
+    con.fetchrow.assert_awaited_once()
+    query = con.fetchrow.call_args.args[0]
+    assert "customer_usage" in query
+    assert "jobs_result" not in query
@@ -0,0 +1,236 @@
+import io
+import time
+
+from botocore.exceptions import ClientError
+from botocore.response import StreamingBody
+import pytest
+from utils import s3
+
+TEST_BUCKET = "test-bucket"
+TEST_KEY = "test/key.zip"
+
+
+@pytest.fixture(scope="function", name="mocked_s3_client")
+def fixture_mocked_s3_client(mocker):
+    s3._existing_objects.clear()
+    mocked_client = mocker.MagicMock()
+    mocked_client.generate_presigned_url.return_value = "test-url"
+    mocker.patch.object(s3, "get_s3_client", autospec=True, return_value=mocked_client)
+    yield mocked_client
+    s3._existing_objects.clear()
+
+
+def test_generate_presigned_url__only_checks_existence_once(mocked_s3_client):
+    assert s3.generate_presigned_url(TEST_BUCKET, TEST_KEY) == "test-url"
+    assert s3.generate_presigned_url(TEST_BUCKET, TEST_KEY) == "test-url"
+
+    mocked_s3_client.head_object.assert_called_once_with(Bucket=TEST_BUCKET, Key=TEST_KEY)
+
+
+def test_generate_presigned_url__does_not_remember_missing_objects(mocked_s3_client):
+    mocked_s3_client.head_object.side_effect = [Exception(), None]
+
+    with pytest.raises(ValueError):
+        s3.generate_presigned_url(TEST_BUCKET, TEST_KEY)
+    assert s3.generate_presigned_url(TEST_BUCKET, TEST_KEY) == "test-url"
+
+    assert mocked_s3_client.head_object.call_count == 2
+
+
+def test_generate_presigned_url__does_not_check_existence_if_verify_is_false(mocked_s3_client):
+    assert s3.generate_presigned_url(TEST_BUCKET, TEST_KEY, verify=False) == "test-url"
+
+    mocked_s3_client.head_object.assert_not_called()
+
+
+def test_complete_multipart_upload__marks_object_as_existing(mocked_s3_client):
+    s3.complete_multipart_upload(TEST_BUCKET, TEST_KEY, "test-upload-id", [])
+
+    assert s3.generate_presigned_url(TEST_BUCKET, TEST_KEY) == "test-url"
+
+    mocked_s3_client.head_object.assert_not_called()
+
+
+def test_upload_file_to_s3__marks_object_as_existing(mocked_s3_client, tmp_path):
+    test_file = tmp_path / "test.txt"
+    test_file.write_text("data")
+
+    s3.upload_file_to_s3(TEST_BUCKET, TEST_KEY, test_file)
+
+    assert (TEST_BUCKET, TEST_KEY) in s3._existing_objects
+
+
+def test_existence_cache__expires_entries(mocker):
+    mocked_monotonic = mocker.patch.object(s3.time, "monotonic", autospec=True, return_value=0)
+    cache = s3._ExistenceCache(ttl_secs=10, max_size=10)
+
+    cache.add(TEST_BUCKET, TEST_KEY)
+    mocked_monotonic.return_value = 9
+    assert (TEST_BUCKET, TEST_KEY) in cache
+    mocked_monotonic.return_value = 11
+    assert (TEST_BUCKET, TEST_KEY) not in cache
+
+
+def test_existence_cache__evicts_least_recently_used_entries():
+    cache = s3._ExistenceCache(ttl_secs=10, max_size=2)
+
+    cache.add(TEST_BUCKET, "key0")
+    cache.add(TEST_BUCKET, "key1")
+    # key0 is now the most recently used
+    assert (TEST_BUCKET, "key0") in cache
+    cache.add(TEST_BUCKET, "key2")
+
+    assert (TEST_BUCKET, "key0") in cache
+    assert (TEST_BUCKET, "key1") not in cache
+    assert (TEST_BUCKET, "key2") in cache
+
+
+def test_existence_cache__stores_nothing_if_max_size_is_zero():
+    cache = s3._ExistenceCache(ttl_secs=10, max_size=0)
+
+    cache.add(TEST_BUCKET, TEST_KEY)
+
+    assert (TEST_BUCKET, TEST_KEY) not in cache
+
+
+class _FakeS3Objects:
+    """Serves ranged get_object calls from a dict of objects"""
+
+    def __init__(self, objects: dict[str, bytes], latency_secs: float = 0):
+        self.objects = objects
+        self.latency_secs = latency_secs
+        self.calls = []
+
+    def get_object(self, Bucket, Key, Range, IfMatch=None):
+        self.calls.append({"Key": Key, "Range": Range, "IfMatch": IfMatch})
+        time.sleep(self.latency_secs)
+
+        data = self.objects[Key]
+        start, _, end = Range.removeprefix("bytes=").partition("-")
+        start = int(start)
+        if start >= len(data):
+            raise ClientError({"Error": {"Code": "InvalidRange"}}, "GetObject")
+        end = min(int(end), len(data) - 1) if end else len(data) - 1
+        stop = end + 1
+        body = data[start:stop]
+
+        return {
+            "Body": StreamingBody(io.BytesIO(body), len(body)),
+            "ContentRange": f"bytes {start}-{end}/{len(data)}",
+            "ETag": f"etag-{Key}",
+        }
+
+
+def _read_members(members):
+    return [(filename, b"".join(chunks)) for filename, _, _, _, chunks in members]
+
+
+@pytest.mark.parametrize("prefetch_count", [0, 1, 3, 10])
+def test_yield_s3_objects__yields_all_objects_in_order(prefetch_count, mocker):
+    objects = {f"key{i}": f"data{i}".encode() * (i + 1) for i in range(5)}
+    fake_s3 = _FakeS3Objects(objects)
+    mocker.patch.object(s3, "get_s3_client", autospec=True, return_value=fake_s3)
+
+    members = s3.yield_s3_objects(
+        TEST_BUCKET, list(objects), [f"file{i}" for i in range(5)], prefetch_count=prefetch_count
+    )
+
+    assert _read_members(members) == [(f"file{i}", data) for i, data in enumerate(objects.values())]
+
+
+def test_yield_s3_objects__streams_remainder_of_objects_larger_than_buffer(mocker):
+    objects = {"small": b"a" * 10, "large": b"b" * 25, "empty": b""}
+    fake_s3 = _FakeS3Objects(objects)
+    mocker.patch.object(s3, "get_s3_client", autospec=True, return_value=fake_s3)
+
+    members = s3.yield_s3_objects(TEST_BUCKET, list(objects), list(objects), prefetch_max_bytes=10)
+
+    assert _read_members(members) == list(objects.items())
+    assert {"Key": "large", "Range": "bytes=10-", "IfMatch": "etag-large"} in fake_s3.calls
+    assert len(fake_s3.calls) == 4
+
+
+def test_yield_s3_objects__prefetches_next_objects_while_current_one_is_streamed(mocker):
+    objects = {f"key{i}": b"data" for i in range(10)}
+    fake_s3 = _FakeS3Objects(objects)
+    mocker.patch.object(s3, "get_s3_client", autospec=True, return_value=fake_s3)
+
+    members = s3.yield_s3_objects(TEST_BUCKET, list(objects), list(objects), prefetch_count=3)
+    next(members)
+    # give the worker threads a chance to finish
+    time.sleep(0.1)
+
+    assert [call["Key"] for call in fake_s3.calls] == ["key0", "key1", "key2", "key3"]
+    members.close()
+
+
+def test_yield_s3_objects__raises_s3_error_if_object_cannot_be_fetched(mocker):
+    fake_s3 = _FakeS3Objects({"key0": b"data"})
+    mocker.patch.object(s3, "get_s3_client", autospec=True, return_value=fake_s3)
+
+    members = s3.yield_s3_objects(TEST_BUCKET, ["key0", "missing"], ["file0", "file1"])
+    next(members)
+
+    with pytest.raises(s3.S3Error, match=f"{TEST_BUCKET}/missing"):
+        next(members)
+
+
+def test_upload_chunks_to_s3__uploads_chunks_in_parts_of_at_least_part_size(mocked_s3_client):
+    mocked_s3_client.create_multipart_upload.return_value = {"UploadId": "test-upload-id"}
+    mocked_s3_client.upload_part.side_effect = lambda **kwargs: {"ETag": f"etag{kwargs['PartNumber']}"}
+
+    size = s3.upload_chunks_to_s3(TEST_BUCKET, TEST_KEY, (b"abc" for _ in range(5)), part_size=4)
+
+    assert size == 15
+    assert [c.kwargs["Body"] for c in mocked_s3_client.upload_part.call_args_list] == [
+        b"abcabc",
+        b"abcabc",
+        b"abc",
+    ]
+    mocked_s3_client.complete_multipart_upload.assert_called_once_with(
+        Bucket=TEST_BUCKET,
+        Key=TEST_KEY,
+        UploadId="test-upload-id",
+        MultipartUpload={"Parts": [{"ETag": f"etag{i}", "PartNumber": i} for i in range(1, 4)]},
+    )
+    assert (TEST_BUCKET, TEST_KEY) in s3._existing_objects
+
+
+def test_upload_chunks_to_s3__aborts_upload_if_chunks_cannot_be_read(mocked_s3_client):
+    mocked_s3_client.create_multipart_upload.return_value = {"UploadId": "test-upload-id"}
+
+    def _chunks():
+        yield b"abc"
+        raise Exception("source object missing")
+
+    with pytest.raises(s3.S3Error):
+        s3.upload_chunks_to_s3(TEST_BUCKET, TEST_KEY, _chunks(), part_size=4)
+
+    mocked_s3_client.abort_multipart_upload.assert_called_once_with(
+        Bucket=TEST_BUCKET, Key=TEST_KEY, UploadId="test-upload-id"
+    )
+    mocked_s3_client.complete_multipart_upload.assert_not_called()
+
+
+def test_generate_upload_part_urls__numbers_parts_from_first_part_num(mocked_s3_client):
+    urls = s3.generate_upload_part_urls(
+        TEST_BUCKET, TEST_KEY, "test-upload-id", ["md5a", "md5b"], first_part_num=21
+    )
+
+    assert urls == ["test-url", "test-url"]
+    assert [
+        c.kwargs["Params"]["PartNumber"] for c in mocked_s3_client.generate_presigned_url.call_args_list
+    ] == [
+        21,
+        22,
+    ]
+
+
+@pytest.mark.parametrize("first_part_num", [0, s3.MAX_MULTIPART_UPLOAD_PARTS])
+def test_generate_upload_part_urls__raises_error_for_invalid_part_numbers(first_part_num, mocked_s3_client):
+    with pytest.raises(s3.S3Error):
+        s3.generate_upload_part_urls(
+            TEST_BUCKET, TEST_KEY, "test-upload-id", ["md5a", "md5b"], first_part_num
+        )
+
+    mocked_s3_client.generate_presigned_url.assert_not_called()
@@ -0,0 +1,93 @@
+import os
+import statistics
+import time
+
+import boto3
+from botocore.client import Config
+import pytest
+from stream_zip import stream_zip
+from utils import s3
+
+# these take a while and depend on the speed of the machine, so are only run when asked for
+run_benchmark = pytest.mark.skipif(
+    not os.getenv("RUN_BENCHMARKS"), reason="RUN_BENCHMARKS not set, skipping S3 benchmarks"
+)
+
+NUM_CALLS = 50
+# creating a client costs milliseconds, presigning with an existing one costs well under one
+MIN_SPEEDUP = 5
+
+
+@pytest.fixture(scope="function", name="fake_aws_env")
+def fixture_fake_aws_env(monkeypatch):
+    # presigning is done locally, so no requests are made to AWS
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "test_key_id")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "test_secret_key")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    s3.get_s3_client.cache_clear()
+    yield
+    s3.get_s3_client.cache_clear()
+
+
+def _median_ms(fn):
+    durations_ms = []
+    for i in range(NUM_CALLS):
+        start = time.perf_counter()
+        fn(f"key{i}")
+        durations_ms.append((time.perf_counter() - start) * 1000)
+    return statistics.median(durations_ms)
+
+
+@run_benchmark
+def test_generate_presigned_post__shared_client_overhead(fake_aws_env):
+    def _with_new_client(key):
+        # how every call used to be made
+        s3_client = boto3.client("s3", config=Config(signature_version="s3v4"))
+        s3_client.generate_presigned_post("bucket", key, ExpiresIn=3600)
+
+    def _with_shared_client(key):
+        s3.generate_presigned_post("bucket", key, "md5")
+
+    # the first call creates the shared client
+    _with_shared_client("warmup")
+
+    new_client_median_ms = _median_ms(_with_new_client)
+    shared_client_median_ms = _median_ms(_with_shared_client)
+    print(  # allow-print
+        f"generate_presigned_post: median with new client={new_client_median_ms:.3f}ms "
+        f"with shared client={shared_client_median_ms:.3f}ms"
+    )
+
+    assert shared_client_median_ms * MIN_SPEEDUP < new_client_median_ms
+
+
+NUM_OBJECTS = 40
+# roughly the time to first byte of a GetObject from within the same region
+GET_OBJECT_LATENCY_SECS = 0.02
+MIN_PREFETCH_SPEEDUP = 4
+
+
+@run_benchmark
+def test_yield_s3_objects__prefetching_speedup(mocker):
+    def _get_object(Bucket, Key, Range, IfMatch=None):
+        time.sleep(GET_OBJECT_LATENCY_SECS)
+        return {"Body": mocker.MagicMock(read=lambda: b"data"), "ContentRange": "bytes 0-3/4"}
+
+    mocker.patch.object(s3, "get_s3_client", autospec=True).return_value.get_object = _get_object
+
+    keys = [f"key{i}" for i in range(NUM_OBJECTS)]
+
+    def _time_download(prefetch_count):
+        start = time.perf_counter()
+        for chunk in stream_zip(s3.yield_s3_objects("bucket", keys, keys, prefetch_count=prefetch_count)):
+            pass
+        return time.perf_counter() - start
+
+    sequential_secs = _time_download(0)
+    prefetching_secs = _time_download(s3.S3_PREFETCH_COUNT)
+    print(  # allow-print
+        f"yield_s3_objects: {NUM_OBJECTS} objects sequentially={sequential_secs:.3f}s "
+        f"with prefetching={prefetching_secs:.3f}s"
+    )
+
+    assert prefetching_secs * MIN_PREFETCH_SPEEDUP < sequential_secs
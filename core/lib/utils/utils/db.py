@@ -1,15 +1,93 @@
 import asyncio
+import os
+import time
 
 import asyncpg
+from prometheus_client import Gauge, Histogram
+
+
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", default=1))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", default=10))
+# asyncpg's defaults. The cache has to be disabled (size 0) if connections go through a proxy in transaction mode
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", default=100))
+DB_MAX_CACHED_STATEMENT_LIFETIME_SECS = int(os.getenv("DB_MAX_CACHED_STATEMENT_LIFETIME_SECS", default=300))
+
+POOL_SIZE = Gauge("db_pool_size", "Number of open connections in the pool", ["pool"])
+POOL_MAX_SIZE = Gauge("db_pool_max_size", "Max number of connections the pool will open", ["pool"])
+POOL_IDLE = Gauge("db_pool_idle", "Number of open connections not currently acquired", ["pool"])
+POOL_IN_USE = Gauge("db_pool_in_use", "Number of connections currently acquired", ["pool"])
+POOL_ACQUIRE_SECONDS = Histogram(
+    "db_pool_acquire_seconds",
+    "Time spent waiting to acquire a connection from the pool",
+    ["pool"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+
+
+class _TimedAcquireContext:
+    def __init__(self, acquire_ctx, acquire_seconds):
+        self._acquire_ctx = acquire_ctx
+        self._acquire_seconds = acquire_seconds
+
+    async def _acquire(self):
+        start = time.perf_counter()
+        try:
+            return await self._acquire_ctx
+        finally:
+            self._acquire_seconds.observe(time.perf_counter() - start)
+
+    def __await__(self):
+        return self._acquire().__await__()
+
+    async def __aenter__(self):
+        start = time.perf_counter()
+        try:
+            return await self._acquire_ctx.__aenter__()
+        finally:
+            self._acquire_seconds.observe(time.perf_counter() - start)
+
+    async def __aexit__(self, *exc_info):
+        return await self._acquire_ctx.__aexit__(*exc_info)
+
+
+class InstrumentedPool:
+    """Wraps an asyncpg pool to record how long acquiring a connection takes.
+
+    Everything other than acquire is passed through to the pool.
+    """
+
+    def __init__(self, pool: asyncpg.pool.Pool, name: str):
+        self._pool = pool
+        self._acquire_seconds = POOL_ACQUIRE_SECONDS.labels(name)
+
+        # these are read from the pool when the metrics are collected
+        POOL_SIZE.labels(name).set_function(pool.get_size)
+        POOL_MAX_SIZE.labels(name).set_function(pool.get_max_size)
+        POOL_IDLE.labels(name).set_function(pool.get_idle_size)
+        POOL_IN_USE.labels(name).set_function(lambda: pool.get_size() - pool.get_idle_size())
+
+    def acquire(self, *, timeout: float | None = None):
+        return _TimedAcquireContext(self._pool.acquire(timeout=timeout), self._acquire_seconds)
+
+    def __getattr__(self, attr):
+        return getattr(self._pool, attr)
 
 
 class AsyncpgPoolDep:
-    def __init__(self, dsn: str, min_size: int = 1, max_size: int = 10):
-        self._pool: asyncpg.pool.Pool | None = None
+    def __init__(
+        self,
+        dsn: str,
+        min_size: int = DB_POOL_MIN_SIZE,
+        max_size: int = DB_POOL_MAX_SIZE,
+        *,
+        name: str = "default",
+    ):
+        self._pool: InstrumentedPool | None = None
         self._lock = asyncio.Lock()
         self._dsn = dsn
         self._min = min_size
         self._max = max_size
+        self._name = name
 
     async def __call__(self):
         if self._pool is not None:
@@ -18,6 +96,13 @@ class AsyncpgPoolDep:
         async with self._lock:
             if self._pool is not None:
                 return self._pool
-            self._pool = await asyncpg.create_pool(self._dsn, min_size=self._min, max_size=self._max)
+            pool = await asyncpg.create_pool(
+                self._dsn,
+                min_size=self._min,
+                max_size=self._max,
+                statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+                max_cached_statement_lifetime=DB_MAX_CACHED_STATEMENT_LIFETIME_SECS,
+            )
+            self._pool = InstrumentedPool(pool, self._name)
 
         return self._pool
@@ -0,0 +1,15 @@
+import os
+
+from prometheus_client import start_http_server
+
+
+METRICS_PORT = os.getenv("METRICS_PORT")
+
+
+def start_metrics_server() -> None:
+    """Serve the prometheus metrics of this process on METRICS_PORT if it is set.
+
+    A separate port is used so that the metrics are not exposed through the ingress.
+    """
+    if METRICS_PORT:
+        start_http_server(int(METRICS_PORT))
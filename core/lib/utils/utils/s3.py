@@ -1,7 +1,13 @@
+import asyncio
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 import hashlib
 import base64
 from datetime import datetime
+from functools import cache, wraps
 import os
+import threading
+import time
 from typing import Any
 
 import boto3
@@ -9,21 +15,120 @@ from botocore.exceptions import ClientError
 from botocore.client import Config
 from stream_zip import ZIP_64
 
+# max number of connections the shared client keeps open. Should be at least the number of threads that can use the
+# client at once, otherwise connections get thrown away and recreated
+S3_MAX_POOL_CONNECTIONS = int(os.getenv("S3_MAX_POOL_CONNECTIONS", 50))
+# how long to remember that an object exists, and how many objects to remember. Setting the size to 0 disables the
+# cache so every check goes to S3
+S3_EXISTENCE_CACHE_TTL_SECS = float(os.getenv("S3_EXISTENCE_CACHE_TTL_SECS", 300))
+S3_EXISTENCE_CACHE_MAX_SIZE = int(os.getenv("S3_EXISTENCE_CACHE_MAX_SIZE", 10_000))
+# how many objects yield_s3_objects fetches ahead of the one being streamed, and how much of each object it buffers.
+# At most (S3_PREFETCH_COUNT + 1) * S3_PREFETCH_MAX_BYTES is held in memory per call
+S3_PREFETCH_COUNT = int(os.getenv("S3_PREFETCH_COUNT", 4))
+S3_PREFETCH_MAX_BYTES = int(os.getenv("S3_PREFETCH_MAX_BYTES", 8 * 1024**2))
+# max number of objects fetched at once by all calls to yield_s3_objects in the process
+S3_PREFETCH_MAX_WORKERS = int(os.getenv("S3_PREFETCH_MAX_WORKERS", 16))
+S3_STREAM_CHUNK_SIZE = 1024**2
+# size of the parts of objects uploaded by upload_chunks_to_s3. Must be at least 5 MiB
+S3_MULTIPART_PART_SIZE = int(os.getenv("S3_MULTIPART_PART_SIZE", 64 * 1024**2))
+
 
 class S3Error(Exception):
     """Raise instead of a ClientError"""
 
 
+@cache
+def get_s3_client():
+    """Return the S3 client shared by the whole process.
+
+    Creating a client is slow (loading service models, resolving credentials), and clients are thread safe, so there
+    is no reason to make a new one per call.
+    """
+    return boto3.client(
+        "s3",
+        config=Config(
+            signature_version="s3v4",
+            max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+            retries={"mode": "standard"},
+            tcp_keepalive=True,
+        ),
+    )
+
+
+class _ExistenceCache:
+    """TTL LRU set of (bucket, key) pairs known to exist in S3.
+
+    Only positive results are stored since a missing object may be uploaded at any time. Objects are rarely deleted,
+    and never without the DB being updated first, so a stale entry at worst produces a URL that 404s.
+    """
+
+    def __init__(self, ttl_secs: float, max_size: int):
+        self._ttl_secs = ttl_secs
+        self._max_size = max_size
+        self._expirations: OrderedDict[tuple[str, str], float] = OrderedDict()
+        # the sync helpers are run in worker threads by their async variants
+        self._lock = threading.Lock()
+
+    def add(self, bucket: str, key: str) -> None:
+        if self._max_size <= 0:
+            return
+        with self._lock:
+            self._expirations[(bucket, key)] = time.monotonic() + self._ttl_secs
+            self._expirations.move_to_end((bucket, key))
+            while len(self._expirations) > self._max_size:
+                self._expirations.popitem(last=False)
+
+    def __contains__(self, bucket_and_key: tuple[str, str]) -> bool:
+        with self._lock:
+            if (expiration := self._expirations.get(bucket_and_key)) is None:
+                return False
+            if expiration < time.monotonic():
+                del self._expirations[bucket_and_key]
+                return False
+            self._expirations.move_to_end(bucket_and_key)
+            return True
+
+    def clear(self) -> None:
+        with self._lock:
+            self._expirations.clear()
+
+
+_existing_objects = _ExistenceCache(S3_EXISTENCE_CACHE_TTL_SECS, S3_EXISTENCE_CACHE_MAX_SIZE)
+
+
+def _object_exists(bucket: str, key: str) -> bool:
+    if (bucket, key) in _existing_objects:
+        return True
+
+    try:
+        get_s3_client().head_object(Bucket=bucket, Key=key)
+    except Exception:
+        return False
+
+    _existing_objects.add(bucket, key)
+    return True
+
+
+def _list_keys(bucket: str, key_prefix: str) -> list[str]:
+    paginator = get_s3_client().get_paginator("list_objects_v2")
+    return [
+        obj["Key"]
+        for page in paginator.paginate(Bucket=bucket, Prefix=key_prefix)
+        for obj in page.get("Contents", [])
+    ]
+
+
 def generate_presigned_url(
-    bucket: str, key: str, filename_override: str | None = None, exp: int = 3600
+    bucket: str, key: str, filename_override: str | None = None, exp: int = 3600, verify: bool = True
 ) -> Any:
-    s3 = boto3.resource("s3")
-    s3_client = boto3.client("s3", config=Config(signature_version="s3v4"))
+    """Create a presigned download URL for the object.
 
-    # check if object exists
-    try:
-        s3.Object(bucket, key).load()
-    except:
+    If `verify` is True, a ValueError is raised if the object does not exist. Pass False when the object is already
+    known to exist, which makes this purely local work.
+    """
+    s3_client = get_s3_client()
+
+    if verify and not _object_exists(bucket, key):
         # there's probably a better error type that could be raised here
         raise ValueError(f"{key} not found in {bucket}")
 
@@ -42,21 +147,20 @@ def generate_presigned_url(
 
 def generate_presigned_urls_for_dir(bucket: str, key_prefix: str, objs_only: bool = False) -> list[str]:
     try:
-        s3 = boto3.resource("s3")
-        bucket = s3.Bucket(bucket)
-        objs = list(bucket.objects.filter(Prefix=key_prefix))
+        keys = _list_keys(bucket, key_prefix)
 
         if objs_only:
-            return [obj.key for obj in objs]
+            return keys
 
-        return [generate_presigned_url(bucket, obj.key) for obj in objs]
+        # these were just listed, so no need to check that they exist
+        return [generate_presigned_url(bucket, key, verify=False) for key in keys]
 
     except (ClientError, S3Error) as e:
         raise S3Error(f"Failed to generate presigned urls for {bucket}/{key_prefix}: {repr(e)}")
 
 
 def generate_presigned_post(bucket: str, key: str, md5s: str) -> dict[Any, Any]:
-    s3_client = boto3.client("s3", config=Config(signature_version="s3v4"))
+    s3_client = get_s3_client()
 
     try:
         fields = {"Content-MD5": md5s}
@@ -72,18 +176,37 @@ def generate_presigned_post(bucket: str, key: str, md5s: str) -> dict[Any, Any]:
 MULTIPART_UPLOAD_TIMEOUT_HRS = 24
 
 
-def generate_multipart_upload_urls(bucket: str, key: str, md5s_parts: list[str]) -> tuple[str, list[str]]:
-    s3_client = boto3.client("s3", config=Config(signature_version="s3v4"))
+# S3 does not allow more parts than this in a single multipart upload
+MAX_MULTIPART_UPLOAD_PARTS = 10_000
+
+
+def create_multipart_upload(bucket: str, key: str) -> str:
+    s3_client = get_s3_client()
 
     try:
         res = s3_client.create_multipart_upload(Bucket=bucket, Key=key)
     except ClientError as e:
         raise S3Error(f"Failed to generate create multipart upload for {bucket}/{key} with error: {repr(e)}")
 
-    upload_id = res["UploadId"]
+    return res["UploadId"]
+
+
+def generate_upload_part_urls(
+    bucket: str, key: str, multipart_upload_id: str, md5s_parts: list[str], first_part_num: int = 1
+) -> list[str]:
+    """Sign upload_part URLs for consecutive parts starting at `first_part_num`.
+
+    Signing is done locally, so no requests are made to S3.
+    """
+    if first_part_num < 1 or first_part_num + len(md5s_parts) - 1 > MAX_MULTIPART_UPLOAD_PARTS:
+        raise S3Error(
+            f"Invalid part numbers {first_part_num}-{first_part_num + len(md5s_parts) - 1} for {bucket}/{key}"
+        )
+
+    s3_client = get_s3_client()
 
     urls = []
-    for part_num, md5s in enumerate(md5s_parts, 1):
+    for part_num, md5s in enumerate(md5s_parts, first_part_num):
         try:
             url = s3_client.generate_presigned_url(
                 "upload_part",
@@ -91,7 +214,7 @@ def generate_multipart_upload_urls(bucket: str, key: str, md5s_parts: list[str])
                     "Bucket": bucket,
                     "Key": key,
                     "ContentMD5": md5s,
-                    "UploadId": upload_id,
+                    "UploadId": multipart_upload_id,
                     "PartNumber": part_num,
                 },
                 ExpiresIn=3600 * MULTIPART_UPLOAD_TIMEOUT_HRS,  # 1 day
@@ -103,11 +226,17 @@ def generate_multipart_upload_urls(bucket: str, key: str, md5s_parts: list[str])
 
         urls.append(url)
 
+    return urls
+
+
+def generate_multipart_upload_urls(bucket: str, key: str, md5s_parts: list[str]) -> tuple[str, list[str]]:
+    upload_id = create_multipart_upload(bucket, key)
+    urls = generate_upload_part_urls(bucket, key, upload_id, md5s_parts)
     return (upload_id, urls)
 
 
 def complete_multipart_upload(bucket: str, key: str, multipart_upload_id: str, part_infos: dict[str, Any]):
-    s3_client = boto3.client("s3", config=Config(signature_version="s3v4"))
+    s3_client = get_s3_client()
     try:
         s3_client.complete_multipart_upload(
             Bucket=bucket, Key=key, MultipartUpload={"Parts": part_infos}, UploadId=multipart_upload_id
@@ -115,9 +244,11 @@ def complete_multipart_upload(bucket: str, key: str, multipart_upload_id: str, p
     except ClientError as e:
         raise S3Error(f"Failed to complete multipart upload for {bucket}/{key} with error: {repr(e)}")
 
+    _existing_objects.add(bucket, key)
+
 
 def abort_multipart_upload(bucket: str, key: str, multipart_upload_id: str):
-    s3_client = boto3.client("s3", config=Config(signature_version="s3v4"))
+    s3_client = get_s3_client()
     try:
         s3_client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=multipart_upload_id)
     except ClientError as e:
@@ -126,42 +257,86 @@ def abort_multipart_upload(bucket: str, key: str, multipart_upload_id: str):
 
 def copy_s3_file(bucket: str, source_key: str, target_key: str) -> None:
     try:
-        s3 = boto3.resource("s3")
         copy_source = {"Bucket": bucket, "Key": source_key}
-        s3.meta.client.copy(copy_source, bucket, target_key)
+        get_s3_client().copy(copy_source, bucket, target_key)
 
     except ClientError as e:
         raise S3Error(f"Failed to copy {source_key} to {target_key} with error: {repr(e)}")
 
+    _existing_objects.add(bucket, target_key)
+
 
 def copy_s3_directory(bucket: str, key_prefix: str, target_prefix: str) -> None:
     try:
-        s3 = boto3.resource("s3")
-        bucket = s3.Bucket(bucket)
-        objs = list(bucket.objects.filter(Prefix=key_prefix))
-
-        for obj in objs:
+        for source_key in _list_keys(bucket, key_prefix):
             # get relative path to keep subdirectory structure
-            source_key = obj.key
             target_key = source_key.replace(key_prefix, target_prefix)
-            copy_s3_file(source_key, target_key)
+            copy_s3_file(bucket, source_key, target_key)
 
-    except ClientError as e:
-        raise S3Error(f"Failed to copy files from {source_key} to {target_key} with error: {repr(e)}")
+    except (ClientError, S3Error) as e:
+        raise S3Error(f"Failed to copy files from {key_prefix} to {target_prefix} with error: {repr(e)}")
 
 
 def upload_file_to_s3(bucket, key, file) -> None:
-    s3_client = boto3.client("s3")
-    try:
-        with open(f"{file}", "rb") as f:
-            contents = f.read()
-            md5 = hashlib.md5(contents).digest()
-            md5s = base64.b64encode(md5).decode()
-            s3_client.put_object(Body=f, Bucket=bucket, Key=key, ContentMD5=md5s)
+    with open(f"{file}", "rb") as f:
+        contents = f.read()
 
+    upload_bytes_to_s3(bucket, key, contents)
+
+
+def upload_bytes_to_s3(bucket: str, key: str, contents: bytes) -> None:
+    s3_client = get_s3_client()
+    try:
+        md5 = hashlib.md5(contents).digest()
+        md5s = base64.b64encode(md5).decode()
+        s3_client.put_object(Body=contents, Bucket=bucket, Key=key, ContentMD5=md5s)
     except ClientError as e:
         raise S3Error(f"Failed to upload file {bucket}/{key}: {repr(e)}")
 
+    _existing_objects.add(bucket, key)
+
+
+def upload_chunks_to_s3(bucket: str, key: str, chunks, part_size: int = S3_MULTIPART_PART_SIZE) -> int:
+    """Upload an iterable of bytes as a single object, returning the size of the object.
+
+    A multipart upload is used so that the whole object never needs to be held in memory or written to disk.
+    """
+    s3_client = get_s3_client()
+    upload_id = create_multipart_upload(bucket, key)
+
+    try:
+        part_infos = []
+        buffer = bytearray()
+        size = 0
+
+        def _upload_part():
+            part_num = len(part_infos) + 1
+            res = s3_client.upload_part(
+                Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=part_num, Body=bytes(buffer)
+            )
+            part_infos.append({"ETag": res["ETag"], "PartNumber": part_num})
+            buffer.clear()
+
+        for chunk in chunks:
+            buffer += chunk
+            size += len(chunk)
+            if len(buffer) >= part_size:
+                _upload_part()
+        # the last part can be smaller than the min part size, and there must be at least one part
+        if buffer or not part_infos:
+            _upload_part()
+
+        complete_multipart_upload(bucket, key, upload_id, part_infos)
+    except Exception as e:
+        try:
+            abort_multipart_upload(bucket, key, upload_id)
+        except S3Error:
+            # the original error is more useful
+            pass
+        raise S3Error(f"Failed to upload {bucket}/{key}: {repr(e)}") from e
+
+    return size
+
 
 def upload_directory_to_s3(bucket, key, dir) -> None:
     for root, _, files in os.walk(dir):
@@ -176,12 +351,11 @@ def upload_directory_to_s3(bucket, key, dir) -> None:
 
 def download_file_from_s3(bucket, key, file_path) -> None:
     try:
-        s3_client = boto3.client("s3")
-        s3 = boto3.resource("s3")
+        s3_client = get_s3_client()
 
         # check if object exists
         try:
-            s3.Object(bucket, key).load()
+            s3_client.head_object(Bucket=bucket, Key=key)
         except:
             raise Exception(f"Object at {key} was not found.")
 
@@ -193,30 +367,129 @@ def download_file_from_s3(bucket, key, file_path) -> None:
 
 def download_directory_from_s3(bucket, key, file_path) -> None:
     try:
-        s3_client = boto3.resource("s3")
-        bucket = s3_client.Bucket(bucket)
-        objs = list(bucket.objects.filter(Prefix=key))
-        for obj in objs:
+        s3_client = get_s3_client()
+        for obj_key in _list_keys(bucket, key):
             # get relative path to keep subdirectory structure
-            rel_path = os.path.relpath(obj.key, key)
+            rel_path = os.path.relpath(obj_key, key)
             target_dir = os.path.join(file_path, rel_path)
 
             # make subdirectories if they don't exist, remove filename from path
             os.makedirs(os.path.dirname(target_dir), exist_ok=True)
 
             # download to target directory with filename
-            bucket.download_file(obj.key, target_dir)
+            s3_client.download_file(Bucket=bucket, Key=obj_key, Filename=target_dir)
     except Exception as e:
         raise S3Error(f"Failed to download directory {bucket}/{key}: {repr(e)}")
 
 
-def yield_s3_objects(bucket: str, keys: list[str], filenames: list[str]):
+@cache
+def _get_prefetch_executor() -> ThreadPoolExecutor:
+    # shared by all downloads so that each one doesn't start its own threads
+    return ThreadPoolExecutor(max_workers=S3_PREFETCH_MAX_WORKERS, thread_name_prefix="s3-prefetch")
+
+
+def _prefetch_object(bucket: str, key: str, max_bytes: int) -> tuple[bytes, int, str | None]:
+    """Read up to the first `max_bytes` of the object.
+
+    Returns the bytes read, the total size of the object, and its ETag.
+    """
+    try:
+        res = get_s3_client().get_object(Bucket=bucket, Key=key, Range=f"bytes=0-{max_bytes - 1}")
+    except ClientError as e:
+        # a range can't be satisfied for an empty object
+        if e.response.get("Error", {}).get("Code") == "InvalidRange":
+            return b"", 0, None
+        raise
+
+    if content_range := res.get("ContentRange"):
+        size = int(content_range.rsplit("/", 1)[-1])
+    else:
+        size = res["ContentLength"]
+
+    return res["Body"].read(), size, res.get("ETag")
+
+
+def _iter_object_chunks(bucket: str, key: str, prefetched: bytes, size: int, etag: str | None):
+    try:
+        if prefetched:
+            yield prefetched
+
+        if len(prefetched) < size:
+            # stream the rest of an object too large to buffer, making sure it hasn't changed since it was prefetched
+            params = {"Bucket": bucket, "Key": key, "Range": f"bytes={len(prefetched)}-"}
+            if etag:
+                params["IfMatch"] = etag
+            body = get_s3_client().get_object(**params)["Body"]
+            yield from body.iter_chunks(chunk_size=S3_STREAM_CHUNK_SIZE)
+
+    except Exception as e:
+        raise S3Error(f"Failed to access {bucket}/{key}") from e
+
+
+def yield_s3_objects(
+    bucket: str,
+    keys: list[str],
+    filenames: list[str],
+    prefetch_count: int = S3_PREFETCH_COUNT,
+    prefetch_max_bytes: int = S3_PREFETCH_MAX_BYTES,
+):
+    """Yield the objects in the format expected by stream_zip, in the given order.
+
+    While an object is being streamed, the next `prefetch_count` objects are fetched in worker threads so that bulk
+    downloads aren't limited to the throughput of a single connection. Only the first `prefetch_max_bytes` of each
+    object are buffered, the rest of larger objects is streamed once they are reached. The worker threads are shared
+    by all downloads in the process, so at most S3_PREFETCH_MAX_WORKERS objects are fetched at once.
+    """
     key = None
+    executor = _get_prefetch_executor()
+    prefetching = deque()
+
+    def _prefetch(key):
+        return executor.submit(_prefetch_object, bucket, key, prefetch_max_bytes)
+
     try:
-        s3 = boto3.session.Session().resource("s3")
-        for idx, key in enumerate(keys):
-            obj = s3.Object(bucket_name=bucket, key=key)
-            yield filenames[idx], datetime.now(), 0o600, ZIP_64, obj.get()["Body"]
+        prefetching.extend(_prefetch(key) for key in keys[:prefetch_count])
+        for idx, (key, filename) in enumerate(zip(keys, filenames)):
+            # keep the next prefetch_count objects in flight while this one is streamed. stream_zip only asks for the
+            # next object once it has consumed the previous one
+            if idx + prefetch_count < len(keys):
+                prefetching.append(_prefetch(keys[idx + prefetch_count]))
+
+            prefetched, size, etag = prefetching.popleft().result()
+            chunks = _iter_object_chunks(bucket, key, prefetched, size, etag)
+            yield filename, datetime.now(), 0o600, ZIP_64, chunks
 
     except Exception as e:
         raise S3Error(f"Failed to access {bucket}/{key}") from e
+    finally:
+        # if the download is abandoned, don't bother fetching anything that hasn't started yet
+        for future in prefetching:
+            future.cancel()
+
+
+def _run_in_thread(fn):
+    """Create an async version of a blocking function that runs it in a worker thread.
+
+    These should be used instead of the sync versions inside of async request handlers so that S3 calls don't block
+    the event loop.
+    """
+
+    @wraps(fn)
+    async def _inner(*args, **kwargs):
+        return await asyncio.to_thread(fn, *args, **kwargs)
+
+    return _inner
+
+
+generate_presigned_url_async = _run_in_thread(generate_presigned_url)
+generate_presigned_urls_for_dir_async = _run_in_thread(generate_presigned_urls_for_dir)
+generate_presigned_post_async = _run_in_thread(generate_presigned_post)
+generate_multipart_upload_urls_async = _run_in_thread(generate_multipart_upload_urls)
+generate_upload_part_urls_async = _run_in_thread(generate_upload_part_urls)
+complete_multipart_upload_async = _run_in_thread(complete_multipart_upload)
+abort_multipart_upload_async = _run_in_thread(abort_multipart_upload)
+copy_s3_file_async = _run_in_thread(copy_s3_file)
+copy_s3_directory_async = _run_in_thread(copy_s3_directory)
+upload_file_to_s3_async = _run_in_thread(upload_file_to_s3)
+upload_bytes_to_s3_async = _run_in_thread(upload_bytes_to_s3)
+download_file_from_s3_async = _run_in_thread(download_file_from_s3)
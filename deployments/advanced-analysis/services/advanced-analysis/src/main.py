@@ -18,6 +18,9 @@ from uvicorn.protocols.utils import get_path_with_query_string
 
 from auth import ProtectedAny, ScopeTags, get_product_tags_of_user
 from jobs import (
+    ADVANCED_ANALYSIS_SORT_FIELDS,
+    DEFAULT_JOB_PRIORITY,
+    InvalidCursor,
     check_customer_advanced_analysis_usage,
     create_advanced_analysis_job,
     delete_advanced_analyses,
@@ -25,11 +28,13 @@ from jobs import (
     get_advanced_analyses_for_base_user,
     get_advanced_analyses_download_info_for_base_user,
     get_advanced_analyses_download_info_for_admin,
+    get_next_cursor,
 )
 from utils.db import AsyncpgPoolDep
+from utils.metrics import start_metrics_server
 from utils.email import FastMailClient
 from utils.logging import setup_logger, bind_context_to_logger
-from utils.s3 import yield_s3_objects, generate_presigned_url
+from utils.s3 import yield_s3_objects, generate_presigned_url_async
 from core.config import (
     CURIBIO_EMAIL,
     CURIBIO_EMAIL_PASSWORD,
@@ -48,7 +53,7 @@ from models.models import (
 setup_logger()
 logger = structlog.stdlib.get_logger("api.access")
 
-asyncpg_pool = AsyncpgPoolDep(dsn=DATABASE_URL)
+asyncpg_pool = AsyncpgPoolDep(dsn=DATABASE_URL, name="advanced-analysis")
 email_client = FastMailClient(
     mail_username=CURIBIO_EMAIL, mail_password=CURIBIO_EMAIL_PASSWORD, template_folder="./templates"
 )
@@ -56,6 +61,7 @@ email_client = FastMailClient(
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    start_metrics_server()
     await asyncpg_pool()
     yield
 
@@ -68,6 +74,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 
@@ -139,10 +146,12 @@ async def get_usage(request: Request, token=Depends(ProtectedAny(tag=ScopeTags.A
 @app.get("/advanced-analyses", response_model=GetAdvancedAnalysesResponse)
 async def get_advanced_analyses(
     request: Request,
+    response: Response,
     sort_field: str | None = Query(None),
     sort_direction: str | None = Query(None),
     skip: int = Query(0),
     limit: int = Query(300),
+    cursor: str | None = Query(None),
     token=Depends(ProtectedAny(tag=ScopeTags.ADVANCED_ANALYSIS_READ)),
 ):
     try:
@@ -155,15 +164,29 @@ async def get_advanced_analyses(
         }
 
         async with request.state.pgpool.acquire() as con:
-            return await _get_advanced_analyses_info(
+            advanced_analyses = await _get_advanced_analyses_info(
                 con,
                 token,
                 sort_field=sort_field,
                 sort_direction=sort_direction,
                 skip=skip,
                 limit=limit,
+                cursor=cursor,
                 **filters,
             )
+
+        if next_cursor := get_next_cursor(
+            advanced_analyses,
+            sort_fields=ADVANCED_ANALYSIS_SORT_FIELDS,
+            sort_field=sort_field,
+            sort_direction=sort_direction,
+            limit=limit,
+        ):
+            response.headers["X-Next-Cursor"] = next_cursor
+
+        return advanced_analyses
+    except InvalidCursor as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
     except Exception:
         logger.exception("Failed to get advanced analyses")
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -201,7 +224,7 @@ async def create_new_advanced_analysis(
         }
         queue = f"advanced-analysis-v{job_meta['version']}"
 
-        priority = 10  # TODO make this a constant and share with p3d svc?
+        priority = DEFAULT_JOB_PRIORITY
         async with request.state.pgpool.acquire() as con:
             usage = await check_customer_advanced_analysis_usage(con, customer_id)
             if usage["jobs_reached"]:
@@ -342,8 +365,9 @@ async def download_advanced_analysis(
         if len(jobs) == 1:
             # if only one file requested, return single presigned URL
             return {
-                "url": generate_presigned_url(
-                    PULSE3D_UPLOADS_BUCKET, keys[0], filename_override=filename_overrides[0]
+                # only finished analyses are returned, which are marked finished after their output is uploaded
+                "url": await generate_presigned_url_async(
+                    PULSE3D_UPLOADS_BUCKET, keys[0], filename_override=filename_overrides[0], verify=False
                 )
             }
         else:
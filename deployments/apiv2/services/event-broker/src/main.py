@@ -1,11 +1,14 @@
 import asyncio
 from calendar import timegm
+from collections import OrderedDict, defaultdict
+from collections.abc import Hashable
 from contextlib import asynccontextmanager
 from dataclasses import dataclass
 from datetime import datetime, timezone
 import itertools
 import json
 import time
+from typing import Any
 from uuid import UUID
 
 from fastapi import FastAPI, Request, Depends, status, HTTPException, Response
@@ -18,16 +21,19 @@ from uvicorn.protocols.utils import get_path_with_query_string
 
 from auth import ProtectedAny, Token, ScopeTags
 from utils.db import AsyncpgPoolDep
+from utils.metrics import start_metrics_server
 from utils.logging import setup_logger
 from core.config import DATABASE_URL, DASHBOARD_URL
 
 setup_logger()
 logger = structlog.stdlib.get_logger("api.access")
 
-asyncpg_pool = AsyncpgPoolDep(dsn=DATABASE_URL)
+asyncpg_pool = AsyncpgPoolDep(dsn=DATABASE_URL, name="event-broker")
 
 
 MESSAGE_RETRY_TIMEOUT = 15000
+# messages waiting to be sent to a single connection, if a client falls this far behind the oldest are dropped
+MAX_QUEUED_MESSAGES = 100
 
 
 # TODO split up this file into multiple files
@@ -37,71 +43,121 @@ class UserNotConnectedError(Exception):
     pass
 
 
-@dataclass
-class UserInfo:
+class MessageQueue:
+    """Bounded queue of messages waiting to be sent to a single connection.
+
+    A message with the same coalesce key as one already in the queue replaces it, since only the latest version
+    is needed. When the queue is full the oldest message is dropped.
+    """
+
+    def __init__(self, maxsize: int) -> None:
+        self._maxsize = maxsize
+        self._messages: OrderedDict[Any, dict[str, str]] = OrderedDict()
+        self._message_added = asyncio.Event()
+        self._keys = itertools.count()
+
+    def put(self, msg: dict[str, str], coalesce_key: Hashable | None = None) -> None:
+        key = next(self._keys) if coalesce_key is None else coalesce_key
+        if key in self._messages:
+            # move it to the end since it is now the newest message
+            del self._messages[key]
+        elif len(self._messages) >= self._maxsize:
+            _, dropped_msg = self._messages.popitem(last=False)
+            logger.warning(f"Message queue full, dropping {dropped_msg['event']} message")
+        self._messages[key] = msg
+        self._message_added.set()
+
+    async def get(self) -> dict[str, str]:
+        while not self._messages:
+            self._message_added.clear()
+            await self._message_added.wait()
+        return self._messages.popitem(last=False)[1]
+
+
+@dataclass(eq=False)
+class ConnectionInfo:
     token: Token
+    account_id: UUID
+    customer_id: UUID
     token_update_event: asyncio.Event
-    queue: asyncio.Queue
+    queue: MessageQueue
 
 
 class UserManager:
+    """Registry of open SSE connections, indexed by account and by customer.
+
+    An account can have multiple connections open, e.g. one per browser tab. All methods are synchronous so no
+    lock is needed, the indexes can't change while they are being iterated over.
+    """
+
     def __init__(self) -> None:
-        self._users: dict[UUID, UserInfo] = {}
-        self._lock = asyncio.Lock()
+        self._account_connections: dict[UUID, set[ConnectionInfo]] = defaultdict(set)
+        self._customer_connections: dict[UUID, set[ConnectionInfo]] = defaultdict(set)
+
+    def add(self, token: Token) -> ConnectionInfo:
+        con_info = ConnectionInfo(
+            token=token,
+            account_id=UUID(token.account_id),
+            customer_id=UUID(token.customer_id),
+            token_update_event=asyncio.Event(),
+            queue=MessageQueue(MAX_QUEUED_MESSAGES),
+        )
+        self._account_connections[con_info.account_id].add(con_info)
+        self._customer_connections[con_info.customer_id].add(con_info)
+        return con_info
+
+    def remove(self, con_info: ConnectionInfo) -> None:
+        for index, key in (
+            (self._account_connections, con_info.account_id),
+            (self._customer_connections, con_info.customer_id),
+        ):
+            if (connections := index.get(key)) is not None:
+                connections.discard(con_info)
+                if not connections:
+                    del index[key]
+
+    def update(self, token: Token) -> None:
+        account_id = UUID(token.account_id)
+        if not (connections := self._account_connections.get(account_id)):
+            logger.error(f"User {account_id} is not currently connected, cannot update token")
+            raise UserNotConnectedError()
 
-    async def add(self, token: Token) -> UserInfo:
-        # TODO how to handle multiple connections for the same user?
-        user_info = UserInfo(token=token, token_update_event=asyncio.Event(), queue=asyncio.Queue())
-        async with self._lock:
-            self._users[UUID(token.account_id)] = user_info
-        return user_info
+        # all connections of the account share the same cookies, so they all get the new token
+        for con_info in connections:
+            con_info.token = token
+            con_info.token_update_event.set()
 
-    async def remove(self, token: Token) -> None:
-        async with self._lock:
-            self._users.pop(UUID(token.account_id), None)
+    def send(self, account_id: UUID, msg: dict[str, str], coalesce_key: Hashable | None = None) -> None:
+        for con_info in self._account_connections.get(account_id, ()):
+            con_info.queue.put(msg, coalesce_key)
 
-    async def update(self, token: Token) -> None:
-        account_id = UUID(token.account_id)
-        async with self._lock:
-            try:
-                user_info = self._users[account_id]
-            except KeyError as e:
-                logger.error(f"User {account_id} is not currently connected, cannot update token")
-                raise UserNotConnectedError() from e
-            else:
-                user_info.token = token
-                user_info.token_update_event.set()
-
-    async def send(self, account_id: UUID, msg: dict[str, str]) -> None:
-        async with self._lock:
-            if user_info := self._users.get(account_id):
-                await user_info.queue.put(msg)
-
-    async def broadcast_to_customer(self, customer_id: UUID, msg: dict[str, str]):
-        async with self._lock:
-            for user_info in self._users.values():
-                if UUID(user_info.token.customer_id) == customer_id:
-                    await user_info.queue.put(msg)
-
-    async def broadcast_all(self, msg: str) -> None:
-        async with self._lock:
-            for user_info in self._users.values():
-                await user_info.queue.put(msg)
+    def broadcast_to_customer(
+        self, customer_id: UUID, msg: dict[str, str], coalesce_key: Hashable | None = None
+    ) -> None:
+        for con_info in self._customer_connections.get(customer_id, ()):
+            con_info.queue.put(msg, coalesce_key)
+
+    def broadcast_all(self, msg: dict[str, str]) -> None:
+        for connections in self._account_connections.values():
+            for con_info in connections:
+                con_info.queue.put(msg)
 
 
 USER_MANAGER = UserManager()
 
 
-async def event_generator(request, user_info):
-    account_id = UUID(user_info.token.account_id)
+async def event_generator(request, con_info):
+    account_id = con_info.account_id
 
     id_iter = itertools.count()
 
     try:
         while True:
-            msg = await user_info.queue.get()
+            msg = await con_info.queue.get()
             # TODO fix this, can't use decode_token
-            if timegm(datetime.now(tz=timezone.utc).utctimetuple()) > user_info.token.exp:
+            if timegm(datetime.now(tz=timezone.utc).utctimetuple()) > con_info.token.exp:
+                # cleared before prompting so that an update sent in response isn't missed
+                con_info.token_update_event.clear()
                 yield {
                     "event": "token_expired",
                     "id": next(id_iter),
@@ -109,7 +165,7 @@ async def event_generator(request, user_info):
                     "retry": MESSAGE_RETRY_TIMEOUT,
                 }
                 logger.info(f"User {account_id} token has expired, prompting update")
-                await asyncio.wait_for(user_info.token_update_event.wait(), timeout=60)
+                await asyncio.wait_for(con_info.token_update_event.wait(), timeout=60)
             yield msg | {"id": next(id_iter), "retry": MESSAGE_RETRY_TIMEOUT}
     except asyncio.CancelledError:
         logger.info(f"Event generator for user {account_id} cancelled")
@@ -118,59 +174,189 @@ async def event_generator(request, user_info):
     except Exception:
         logger.exception(f"ERROR - {account_id=}")
 
-    await USER_MANAGER.remove(user_info.token)
+    USER_MANAGER.remove(con_info)
+
+
+class ScopeCache:
+    """The scopes of each customer's accounts, used to determine which accounts receive each event.
+
+    A customer's scopes are loaded the first time one of their events is handled and dropped when they change.
+    """
+
+    def __init__(self) -> None:
+        self._scopes: dict[UUID, list[tuple[UUID | None, str]]] = {}
+
+    def invalidate(self, customer_id: UUID | None = None) -> None:
+        if customer_id is None:
+            self._scopes.clear()
+        else:
+            self._scopes.pop(customer_id, None)
 
+    async def load(self, con, customer_ids: set[UUID]) -> None:
+        if not (missing_customer_ids := [c for c in customer_ids if c not in self._scopes]):
+            return
 
-def create_notification_handler(con_pool):
+        rows = await con.fetch(
+            "SELECT customer_id, user_id, scope FROM account_scopes WHERE customer_id=ANY($1::uuid[])",
+            missing_customer_ids,
+        )
+        for customer_id in missing_customer_ids:
+            self._scopes[customer_id] = []
+        for row in rows:
+            self._scopes[row["customer_id"]].append((row["user_id"], row["scope"]))
+
+    def get_recipients(self, customer_id: UUID, owner_id: UUID | None, product: str) -> set[UUID]:
+        """Return the IDs of the owner of the data and any other account with access to all of it."""
+        rw_all_data_scope = f"{product}:rw_all_data"
+        return {
+            user_id or customer_id
+            for user_id, scope in self._scopes.get(customer_id, [])
+            if (owner_id is not None and user_id == owner_id)
+            or "admin" in scope
+            or scope == rw_all_data_scope
+        }
+
+
+SCOPE_CACHE = ScopeCache()
+
+# the DB only sends the ID of the row that changed, the row itself and the info needed to send it to the right
+# accounts are looked up here for all events in a batch at once
+DATA_UPDATE_QUERIES = {
+    "jobs_result": (
+        "SELECT j.*, up.user_id, users.name AS username, coalesce(cu.jobs, 0) AS usage "
+        "FROM jobs_result AS j JOIN uploads AS up ON j.upload_id=up.id "
+        "LEFT JOIN users ON up.user_id=users.id "
+        "LEFT JOIN customer_usage AS cu ON cu.customer_id=j.customer_id AND cu.type=j.type "
+        "WHERE j.job_id=ANY($1::uuid[])"
+    ),
+    "uploads": (
+        "SELECT up.*, users.name AS username, coalesce(cu.uploads, 0) AS usage "
+        "FROM uploads AS up LEFT JOIN users ON up.user_id=users.id "
+        "LEFT JOIN customer_usage AS cu ON cu.customer_id=up.customer_id AND cu.type=up.type "
+        "WHERE up.id=ANY($1::uuid[])"
+    ),
+    "advanced_analysis_result": (
+        "SELECT a.*, users.name AS username, "
+        "(SELECT COUNT(*) FROM advanced_analysis_result WHERE customer_id=a.customer_id) AS usage "
+        "FROM advanced_analysis_result AS a LEFT JOIN users ON a.user_id=users.id "
+        "WHERE a.id=ANY($1::uuid[])"
+    ),
+}
+DATA_UPDATE_ID_KEYS = {"jobs_result": "job_id", "uploads": "id", "advanced_analysis_result": "id"}
+
+MAX_NOTIFICATION_BATCH_SIZE = 100
+
+
+def _json_default(obj):
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    return str(obj)
+
+
+def _format_data_update(table, row) -> dict:
+    payload = dict(row)
+    match table:
+        case "jobs_result":
+            payload["product"] = payload.pop("type")
+            payload["usage_type"] = "jobs"
+            payload["id"] = payload.pop("job_id")
+        case "uploads":
+            del payload["meta"]
+            payload["product"] = payload.pop("type")
+            payload["usage_type"] = "uploads"
+        case "advanced_analysis_result":
+            payload["product"] = "advanced_analysis"
+            payload["usage_type"] = "advanced_analysis"
+    return payload
+
+
+async def send_data_updates(con_pool, data_update_ids: dict[tuple[str, UUID], None]) -> None:
+    ids_by_table = defaultdict(list)
+    for table, row_id in data_update_ids:
+        ids_by_table[table].append(row_id)
+
+    rows = {}
+    async with con_pool.acquire() as con:
+        for table, row_ids in ids_by_table.items():
+            for row in await con.fetch(DATA_UPDATE_QUERIES[table], row_ids):
+                rows[(table, row[DATA_UPDATE_ID_KEYS[table]])] = row
+        await SCOPE_CACHE.load(con, {row["customer_id"] for row in rows.values()})
+
+    # send in the order the notifications were received
+    for key in data_update_ids:
+        if (row := rows.get(key)) is None:
+            # the row was deleted before it could be looked up
+            continue
+        payload = _format_data_update(key[0], row)
+
+        # send update to anyone who has access to this upload/job
+        data_update_msg = {"event": "data_update", "data": json.dumps(payload, default=_json_default)}
+        for recipient_id in SCOPE_CACHE.get_recipients(
+            payload["customer_id"], payload["user_id"], payload["product"]
+        ):
+            USER_MANAGER.send(recipient_id, data_update_msg, coalesce_key=("data_update", key))
+
+        # send the new job or upload count to any connected user under this customer ID
+        usage_update_msg = {
+            "event": "usage_update",
+            "data": json.dumps({k: payload[k] for k in ("usage_type", "product", "usage")}),
+        }
+        USER_MANAGER.broadcast_to_customer(
+            payload["customer_id"],
+            usage_update_msg,
+            coalesce_key=("usage_update", payload["product"], payload["usage_type"]),
+        )
+
+
+async def handle_notifications(con_pool, notifications: list[dict]) -> None:
+    # multiple notifications for the same row only need to be sent once since the latest version of it is sent
+    data_update_ids = {}
+
+    for payload in notifications:
+        table = payload.pop("table")
+        match table:
+            case "account_scopes":
+                SCOPE_CACHE.invalidate(UUID(payload["customer_id"]))
+            case "notification_messages":
+                notifications_update_msg = {"event": "notifications_update", "data": json.dumps(payload)}
+                USER_MANAGER.send(UUID(payload.get("recipient_id")), notifications_update_msg)
+            case "download_bundles":
+                # the URL is presigned by pulse3d when the client requests it, so only the status is sent here
+                download_bundle_msg = {
+                    "event": "download_bundle_update",
+                    "data": json.dumps({k: payload[k] for k in ("id", "status", "filename")}),
+                }
+                for recipient_id in payload["recipients"]:
+                    USER_MANAGER.send(UUID(recipient_id), download_bundle_msg)
+            case _ if table in DATA_UPDATE_QUERIES:
+                data_update_ids[(table, UUID(payload[DATA_UPDATE_ID_KEYS[table]]))] = None
+            case invalid_table:
+                logger.error(f"Handling for {invalid_table} table notifications not supported")
+
+    if data_update_ids:
+        await send_data_updates(con_pool, data_update_ids)
+
+
+async def process_notifications(con_pool, notification_queue: asyncio.Queue) -> None:
+    while True:
+        # handle everything that arrived while the previous batch was being handled together
+        notifications = [await notification_queue.get()]
+        while len(notifications) < MAX_NOTIFICATION_BATCH_SIZE and not notification_queue.empty():
+            notifications.append(notification_queue.get_nowait())
+
+        try:
+            await handle_notifications(con_pool, notifications)
+        except Exception:
+            logger.exception("Error in handling notifications")
+
+
+def create_notification_handler(notification_queue):
     # Tanner (8/21/24): cannot use the connection attached to this notification as it will cause issues,
-    # need to grab a new connection from the pool instead.
-    async def handle_notification(connection, pid, channel, payload):
+    # so the notifications are handled in a separate task which grabs a new connection from the pool instead.
+    def handle_notification(connection, pid, channel, payload):
         try:
             logger.info(f"Notification received from DB: {payload}")
-
-            payload = json.loads(payload)
-            table = payload.pop("table")
-            match table:
-                case "notification_messages":
-                    notifications_update_msg = {"event": "notifications_update", "data": json.dumps(payload)}
-                    await USER_MANAGER.send(UUID(payload.get("recipient_id")), notifications_update_msg)
-                    return
-                case "jobs_result":
-                    payload["product"] = payload.pop("type")
-                    payload["usage_type"] = "jobs"
-                    payload["id"] = payload.pop("job_id")
-                    async with con_pool.acquire() as con:
-                        payload["meta"] = await con.fetchval(
-                            "SELECT meta FROM jobs_result WHERE job_id=$1", payload["id"]
-                        )
-                case "uploads":
-                    if payload["multipart_upload_id"] is not None:
-                        # don't want to show incomplete uploads
-                        return
-                    payload["product"] = payload.pop("type")
-                    payload["usage_type"] = "uploads"
-                case "advanced_analysis_result":
-                    payload["product"] = "advanced_analysis"
-                    payload["usage_type"] = "advanced_analysis"
-                    async with con_pool.acquire() as con:
-                        payload["meta"] = await con.fetchval(
-                            "SELECT meta FROM advanced_analysis_result WHERE id=$1", payload["id"]
-                        )
-                case invalid_table:
-                    logger.error(f"Handling for {invalid_table} table notifications not supported")
-                    return
-
-            # send update to anyone who has access to this upload/job
-            data_update_msg = {"event": "data_update", "data": json.dumps(payload)}
-            for recipient_id in payload.pop("recipients"):
-                await USER_MANAGER.send(UUID(recipient_id), data_update_msg)
-
-            # send the new job or upload count to any connected user under this customer ID
-            usage_update_msg = {
-                "event": "usage_update",
-                "data": json.dumps({k: payload[k] for k in ("usage_type", "product", "usage")}),
-            }
-            await USER_MANAGER.broadcast_to_customer(UUID(payload["customer_id"]), usage_update_msg)
+            notification_queue.put_nowait(json.loads(payload))
         except Exception:
             logger.exception("Error in handling notification")
 
@@ -179,7 +365,13 @@ def create_notification_handler(con_pool):
 
 async def listen_to_queue(con, con_pool):
     """Listen for notifications until the connection closes."""
-    await con.add_listener("events", create_notification_handler(con_pool))
+    # scopes may have changed while not listening
+    SCOPE_CACHE.invalidate()
+
+    notification_queue = asyncio.Queue()
+    processor_task = asyncio.create_task(process_notifications(con_pool, notification_queue))
+
+    await con.add_listener("events", create_notification_handler(notification_queue))
 
     db_con_termination_event = asyncio.Event()
 
@@ -190,7 +382,10 @@ async def listen_to_queue(con, con_pool):
 
     con.add_termination_listener(cancel_listen)
 
-    await db_con_termination_event.wait()
+    try:
+        await db_con_termination_event.wait()
+    finally:
+        processor_task.cancel()
 
 
 async def run_listener():
@@ -208,6 +403,7 @@ async def run_listener():
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    start_metrics_server()
     await asyncpg_pool()
 
     listener_task = asyncio.create_task(run_listener())
@@ -265,14 +461,14 @@ async def middleware(request: Request, call_next) -> Response:
 async def add_event_source(request: Request, token=Depends(ProtectedAny(tag=ScopeTags.PULSE3D_READ))):
     logger.info(f"User {UUID(token.account_id)} connected")
 
-    user_info = await USER_MANAGER.add(token)
+    con_info = USER_MANAGER.add(token)
 
-    return EventSourceResponse(event_generator(request, user_info), send_timeout=5)
+    return EventSourceResponse(event_generator(request, con_info), send_timeout=5)
 
 
 @app.post("/public/token")
 async def update_token(request: Request, token=Depends(ProtectedAny(tag=ScopeTags.PULSE3D_READ))):
     try:
-        await USER_MANAGER.update(token)
+        USER_MANAGER.update(token)
     except UserNotConnectedError:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN)
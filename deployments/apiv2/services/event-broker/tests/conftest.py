@@ -0,0 +1,20 @@
+import os
+import sys
+
+CLUSTER_NAME = "test"
+JWT_SECRET_KEY = "1234"
+POSTGRES_DB = "test_db"
+POSTGRES_USER = "test_pg_user"
+POSTGRES_PASSWORD = "test_pw"
+
+os.environ["CLUSTER_NAME"] = CLUSTER_NAME
+os.environ["JWT_SECRET_KEY"] = JWT_SECRET_KEY
+os.environ["POSTGRES_DB"] = POSTGRES_DB
+os.environ["POSTGRES_USER"] = POSTGRES_USER
+os.environ["POSTGRES_PASSWORD"] = POSTGRES_PASSWORD
+
+
+# import core and add to sys.modules so that main.py can find it, not sure why it can't otherwise
+from src import core
+
+sys.modules["core"] = core
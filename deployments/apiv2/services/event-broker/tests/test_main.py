@@ -0,0 +1,308 @@
+import asyncio
+from contextlib import asynccontextmanager
+import json
+import uuid
+
+from auth import AccountTypes, Scopes
+from auth.tokens import create_token, decode_token
+import pytest
+
+from src import main
+
+
+def _create_token(customer_id, user_id=None):
+    token = create_token(
+        userid=user_id,
+        customer_id=customer_id,
+        scopes=[Scopes.MANTARRAY__ADMIN if user_id is None else Scopes.MANTARRAY__BASE],
+        account_type=AccountTypes.USER if user_id else AccountTypes.ADMIN,
+    )
+    return decode_token(token.token)
+
+
+def _create_msg(event, data=""):
+    return {"event": event, "data": data}
+
+
+async def _get_all(queue):
+    msgs = []
+    while queue._messages:
+        msgs.append(await queue.get())
+    return msgs
+
+
+class Connection:
+    """Stand-in for both the pool and the connections acquired from it."""
+
+    def __init__(self, scope_rows=(), data_rows=()):
+        self.scope_rows = list(scope_rows)
+        # table -> rows
+        self.data_rows = dict(data_rows)
+        self.queries = []
+
+    async def fetch(self, query, ids):
+        self.queries.append((query, ids))
+        if query.startswith("SELECT customer_id, user_id, scope FROM account_scopes"):
+            return [row for row in self.scope_rows if row["customer_id"] in ids]
+
+        table = next(table for table, table_query in main.DATA_UPDATE_QUERIES.items() if query == table_query)
+        return [row for row in self.data_rows.get(table, []) if row[main.DATA_UPDATE_ID_KEYS[table]] in ids]
+
+    @asynccontextmanager
+    async def acquire(self):
+        yield self
+
+    def get_scope_queries(self):
+        return [ids for query, ids in self.queries if "FROM account_scopes" in query]
+
+
+def _scope_row(customer_id, user_id, scope):
+    return {"customer_id": customer_id, "user_id": user_id, "scope": scope}
+
+
+def _upload_row(customer_id, user_id):
+    return {
+        "id": uuid.uuid4(),
+        "customer_id": customer_id,
+        "user_id": user_id,
+        "type": "mantarray",
+        "meta": "{}",
+        "username": "test_user",
+        "usage": 1,
+    }
+
+
+def _upload_notification(row):
+    return {"table": "uploads", "id": str(row["id"])}
+
+
+@pytest.fixture(scope="function", name="user_manager")
+def fixture_user_manager():
+    user_manager = main.UserManager()
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(main, "USER_MANAGER", user_manager)
+        yield user_manager
+
+
+@pytest.fixture(scope="function", name="scope_cache")
+def fixture_scope_cache():
+    scope_cache = main.ScopeCache()
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(main, "SCOPE_CACHE", scope_cache)
+        yield scope_cache
+
+
+@pytest.mark.asyncio
+async def test_message_queue__coalesced_message_replaces_previous_one_and_moves_to_end():
+    queue = main.MessageQueue(maxsize=10)
+
+    queue.put(_create_msg("data_update", "old"), coalesce_key="key")
+    queue.put(_create_msg("notifications_update"))
+    queue.put(_create_msg("data_update", "new"), coalesce_key="key")
+
+    assert await _get_all(queue) == [_create_msg("notifications_update"), _create_msg("data_update", "new")]
+
+
+@pytest.mark.asyncio
+async def test_message_queue__does_not_coalesce_messages_without_key():
+    queue = main.MessageQueue(maxsize=10)
+
+    for _ in range(2):
+        queue.put(_create_msg("notifications_update"))
+
+    assert await _get_all(queue) == [_create_msg("notifications_update")] * 2
+
+
+@pytest.mark.asyncio
+async def test_message_queue__drops_oldest_message_when_full():
+    queue = main.MessageQueue(maxsize=2)
+
+    for i in range(3):
+        queue.put(_create_msg("data_update", str(i)))
+
+    assert await _get_all(queue) == [_create_msg("data_update", "1"), _create_msg("data_update", "2")]
+
+
+@pytest.mark.asyncio
+async def test_message_queue__get_waits_for_message():
+    queue = main.MessageQueue(maxsize=10)
+
+    get_task = asyncio.create_task(queue.get())
+    await asyncio.sleep(0)
+    assert not get_task.done()
+
+    queue.put(_create_msg("data_update"))
+
+    assert await asyncio.wait_for(get_task, timeout=1) == _create_msg("data_update")
+
+
+def test_user_manager__remove_only_removes_given_connection(user_manager):
+    customer_id, user_id = uuid.uuid4(), uuid.uuid4()
+    token = _create_token(customer_id, user_id)
+    con_info = user_manager.add(token)
+    other_con_info = user_manager.add(token)
+
+    user_manager.remove(con_info)
+
+    assert user_manager._account_connections == {user_id: {other_con_info}}
+    assert user_manager._customer_connections == {customer_id: {other_con_info}}
+
+
+def test_user_manager__remove_drops_empty_index_entries(user_manager):
+    customer_id = uuid.uuid4()
+    user_con_info = user_manager.add(_create_token(customer_id, uuid.uuid4()))
+    admin_con_info = user_manager.add(_create_token(customer_id))
+
+    user_manager.remove(user_con_info)
+    user_manager.remove(admin_con_info)
+
+    assert user_manager._account_connections == {}
+    assert user_manager._customer_connections == {}
+    # removing a connection more than once does nothing
+    user_manager.remove(user_con_info)
+
+
+def test_user_manager__update_sets_token_of_every_connection_of_account(user_manager):
+    customer_id, user_id = uuid.uuid4(), uuid.uuid4()
+    con_infos = [user_manager.add(_create_token(customer_id, user_id)) for _ in range(2)]
+    other_con_info = user_manager.add(_create_token(customer_id, uuid.uuid4()))
+
+    new_token = _create_token(customer_id, user_id)
+    user_manager.update(new_token)
+
+    for con_info in con_infos:
+        assert con_info.token is new_token
+        assert con_info.token_update_event.is_set()
+    assert other_con_info.token is not new_token
+    assert not other_con_info.token_update_event.is_set()
+
+
+def test_user_manager__update_raises_error_if_account_not_connected(user_manager):
+    with pytest.raises(main.UserNotConnectedError):
+        user_manager.update(_create_token(uuid.uuid4(), uuid.uuid4()))
+
+
+@pytest.mark.asyncio
+async def test_user_manager__send_reaches_every_connection_of_account(user_manager):
+    customer_id, user_id = uuid.uuid4(), uuid.uuid4()
+    con_infos = [user_manager.add(_create_token(customer_id, user_id)) for _ in range(2)]
+    other_con_info = user_manager.add(_create_token(customer_id, uuid.uuid4()))
+
+    user_manager.send(user_id, _create_msg("notifications_update"))
+
+    for con_info in con_infos:
+        assert await _get_all(con_info.queue) == [_create_msg("notifications_update")]
+    assert await _get_all(other_con_info.queue) == []
+
+
+@pytest.mark.asyncio
+async def test_user_manager__broadcast_to_customer_only_reaches_connections_of_customer(user_manager):
+    customer_id = uuid.uuid4()
+    con_infos = [
+        user_manager.add(_create_token(customer_id, uuid.uuid4())),
+        user_manager.add(_create_token(customer_id)),
+    ]
+    other_customer_con_info = user_manager.add(_create_token(uuid.uuid4(), uuid.uuid4()))
+
+    user_manager.broadcast_to_customer(customer_id, _create_msg("usage_update"))
+
+    for con_info in con_infos:
+        assert await _get_all(con_info.queue) == [_create_msg("usage_update")]
+    assert await _get_all(other_customer_con_info.queue) == []
+
+
+@pytest.mark.asyncio
+async def test_scope_cache__get_recipients__returns_owner_and_accounts_with_access_to_all_data(scope_cache):
+    customer_id, owner_id, rw_all_data_user_id = uuid.uuid4(), uuid.uuid4(), uuid.uuid4()
+    con = Connection(
+        scope_rows=[
+            _scope_row(customer_id, None, "mantarray:admin"),
+            _scope_row(customer_id, owner_id, "mantarray:base"),
+            _scope_row(customer_id, rw_all_data_user_id, "mantarray:rw_all_data"),
+            _scope_row(customer_id, uuid.uuid4(), "mantarray:base"),
+            _scope_row(customer_id, uuid.uuid4(), "nautilai:rw_all_data"),
+            _scope_row(uuid.uuid4(), None, "mantarray:admin"),
+        ]
+    )
+
+    await scope_cache.load(con, {customer_id})
+
+    # admin accounts are identified by the customer ID
+    assert scope_cache.get_recipients(customer_id, owner_id, "mantarray") == {
+        customer_id,
+        owner_id,
+        rw_all_data_user_id,
+    }
+    # data uploaded by an admin has no owning user
+    assert scope_cache.get_recipients(customer_id, None, "mantarray") == {customer_id, rw_all_data_user_id}
+
+
+@pytest.mark.asyncio
+async def test_scope_cache__load__only_queries_customers_not_already_loaded(scope_cache):
+    customer_id, other_customer_id = uuid.uuid4(), uuid.uuid4()
+    con = Connection(scope_rows=[_scope_row(customer_id, None, "mantarray:admin")])
+
+    await scope_cache.load(con, {customer_id})
+    await scope_cache.load(con, {customer_id, other_customer_id})
+    await scope_cache.load(con, {customer_id, other_customer_id})
+
+    assert con.get_scope_queries() == [[customer_id], [other_customer_id]]
+    # customers without any scopes are cached too
+    assert scope_cache.get_recipients(other_customer_id, None, "mantarray") == set()
+
+
+@pytest.mark.asyncio
+async def test_handle_notifications__account_scopes_change_invalidates_scopes_of_customer(scope_cache):
+    customer_id, other_customer_id = uuid.uuid4(), uuid.uuid4()
+    con = Connection(
+        scope_rows=[
+            _scope_row(customer_id, None, "mantarray:admin"),
+            _scope_row(other_customer_id, None, "mantarray:admin"),
+        ]
+    )
+    await scope_cache.load(con, {customer_id, other_customer_id})
+
+    await main.handle_notifications(con, [{"table": "account_scopes", "customer_id": str(customer_id)}])
+    user_id = uuid.uuid4()
+    con.scope_rows.append(_scope_row(customer_id, user_id, "mantarray:rw_all_data"))
+    await scope_cache.load(con, {customer_id, other_customer_id})
+
+    assert con.get_scope_queries()[-1] == [customer_id]
+    assert scope_cache.get_recipients(customer_id, None, "mantarray") == {customer_id, user_id}
+
+
+@pytest.mark.asyncio
+async def test_handle_notifications__sends_data_update_for_same_row_once(user_manager, scope_cache):
+    customer_id, owner_id = uuid.uuid4(), uuid.uuid4()
+    row = _upload_row(customer_id, owner_id)
+    con = Connection(
+        scope_rows=[_scope_row(customer_id, owner_id, "mantarray:base")], data_rows={"uploads": [row]}
+    )
+    con_info = user_manager.add(_create_token(customer_id, owner_id))
+
+    await main.handle_notifications(con, [_upload_notification(row), _upload_notification(row)])
+
+    assert con.queries[0] == (main.DATA_UPDATE_QUERIES["uploads"], [row["id"]])
+    msgs = await _get_all(con_info.queue)
+    assert [msg["event"] for msg in msgs] == ["data_update", "usage_update"]
+    data_update = json.loads(msgs[0]["data"])
+    assert data_update["id"] == str(row["id"])
+    assert data_update["product"] == "mantarray"
+    assert "meta" not in data_update
+
+
+@pytest.mark.asyncio
+async def test_handle_notifications__skips_rows_deleted_before_lookup(user_manager, scope_cache):
+    customer_id, owner_id = uuid.uuid4(), uuid.uuid4()
+    row, deleted_row = _upload_row(customer_id, owner_id), _upload_row(customer_id, owner_id)
+    con = Connection(
+        scope_rows=[_scope_row(customer_id, owner_id, "mantarray:base")], data_rows={"uploads": [row]}
+    )
+    con_info = user_manager.add(_create_token(customer_id, owner_id))
+
+    await main.handle_notifications(con, [_upload_notification(deleted_row), _upload_notification(row)])
+
+    data_updates = [
+        json.loads(msg["data"]) for msg in await _get_all(con_info.queue) if msg["event"] == "data_update"
+    ]
+    assert [data_update["id"] for data_update in data_updates] == [str(row["id"])]
@@ -0,0 +1,159 @@
+import asyncio
+from typing import Any, Callable
+
+import structlog
+
+logger = structlog.stdlib.get_logger("api.access")
+
+# channel that the triggers on the FW/SW version tables and maunits notify when they change
+NOTIFY_CHANNEL = "ma_compatibility"
+
+
+class CompatibilitySnapshot:
+    """The contents of the FW/SW version tables and maunits at one point in time.
+
+    Shared between requests, so the rows must not be modified. Anything derived from them can be memoized here
+    since it stays valid for as long as the snapshot is in use.
+    """
+
+    def __init__(
+        self,
+        main_fw_info: list[dict[str, Any]],
+        channel_fw_info: list[dict[str, Any]],
+        ma_sw_versions: list[dict[str, Any]],
+        sting_sw_versions: list[dict[str, Any]],
+        hw_versions: dict[str, str],
+    ) -> None:
+        self.main_fw_info = main_fw_info
+        self.channel_fw_info = channel_fw_info
+        self.ma_sw_versions = ma_sw_versions
+        self.sting_sw_versions = sting_sw_versions
+        # serial number -> HW version
+        self.hw_versions = hw_versions
+
+        self.main_fw_compatibility = [
+            {
+                "main_fw_version": row["version"],
+                "min_ma_controller_version": row["min_ma_controller_version"],
+                "min_sting_controller_version": row["min_sting_controller_version"],
+            }
+            for row in main_fw_info
+        ]
+        self._main_fw_by_version = {row["version"]: row for row in main_fw_info}
+        self._memo: dict[tuple, Any] = {}
+
+    @classmethod
+    async def load(cls, con) -> "CompatibilitySnapshot":
+        main_fw_info = await con.fetch("SELECT * FROM ma_main_firmware")
+        channel_fw_info = await con.fetch("SELECT * FROM ma_channel_firmware")
+        ma_sw_versions = await con.fetch("SELECT version, state FROM ma_controllers")
+        sting_sw_versions = await con.fetch("SELECT version, state FROM sting_controllers")
+        units = await con.fetch("SELECT serial_number, hw_version FROM maunits")
+
+        return cls(
+            [dict(row) for row in main_fw_info],
+            [dict(row) for row in channel_fw_info],
+            [dict(row) for row in ma_sw_versions],
+            [dict(row) for row in sting_sw_versions],
+            {row["serial_number"]: row["hw_version"] for row in units},
+        )
+
+    def get_compatible_versions(self, serial_number: str, prod: bool) -> list[dict[str, str]]:
+        """Get the versions compatible with the HW version of the MA instrument with the given serial number.
+
+        New dicts are returned on each call so they can be modified.
+        """
+        if (hw_version := self.hw_versions.get(serial_number)) is None:
+            return []
+
+        compatible_versions = []
+        for channel_fw in self.channel_fw_info:
+            if channel_fw["hw_version"] != hw_version or (prod and channel_fw["state"] != "external"):
+                continue
+            main_fw = self._main_fw_by_version[channel_fw["main_fw_version"]]
+            compatible_versions.append(
+                {
+                    "min_ma_controller_version": main_fw["min_ma_controller_version"],
+                    "min_sting_controller_version": main_fw["min_sting_controller_version"],
+                    "main_fw_version": main_fw["version"],
+                    "channel_fw_version": channel_fw["version"],
+                }
+            )
+        return compatible_versions
+
+    def memoize(self, key: tuple, fn: Callable[[], Any]) -> Any:
+        """Return the result of fn, only calling it the first time the key is used with this snapshot.
+
+        If fn raises an error, nothing is memoized.
+        """
+        try:
+            return self._memo[key]
+        except KeyError:
+            result = self._memo[key] = fn()
+            return result
+
+
+class CompatibilityIndex:
+    """Process-wide cache of the FW/SW version tables and maunits.
+
+    Every instrument requests its compatible versions when it starts up, so a fleet rebooting after a release
+    would otherwise read these tables many times over even though they only change when a release is made. The
+    tables are instead loaded once, by a single request even if many arrive at once, and reloaded after a
+    notification that one of them changed. Without a connection listening for those notifications there's no
+    way to tell when a snapshot is stale, so each request loads its own until listening resumes.
+    """
+
+    def __init__(self) -> None:
+        self._snapshot: CompatibilitySnapshot | None = None
+        # incremented whenever the snapshot is dropped so that one loaded before a change isn't kept after it
+        self._generation = 0
+        self._listening = False
+        self._lock = asyncio.Lock()
+
+    def invalidate(self) -> None:
+        self._generation += 1
+        self._snapshot = None
+
+    async def _load(self, pgpool) -> CompatibilitySnapshot:
+        async with pgpool.acquire() as con:
+            return await CompatibilitySnapshot.load(con)
+
+    async def get(self, pgpool) -> CompatibilitySnapshot:
+        if not self._listening:
+            return await self._load(pgpool)
+        if (snapshot := self._snapshot) is not None:
+            return snapshot
+
+        async with self._lock:
+            # the snapshot may have been loaded by another request while waiting for the lock
+            if (snapshot := self._snapshot) is not None:
+                return snapshot
+
+            generation = self._generation
+            snapshot = await self._load(pgpool)
+            if self._listening and generation == self._generation:
+                self._snapshot = snapshot
+                logger.info(f"Cached FW/SW versions for {len(snapshot.hw_versions)} MA units")
+            return snapshot
+
+    def _handle_notification(self, con, pid, channel, payload) -> None:
+        logger.info(f"{payload} changed, dropping FW/SW versions")
+        self.invalidate()
+
+    async def listen(self, con) -> None:
+        """Use the cache while listening for changes on the given connection, until it closes."""
+        con_termination_event = asyncio.Event()
+        con.add_termination_listener(lambda _: con_termination_event.set())
+        await con.add_listener(NOTIFY_CHANNEL, self._handle_notification)
+
+        # the tables may have changed while not listening
+        self.invalidate()
+        self._listening = True
+        try:
+            await con_termination_event.wait()
+        finally:
+            self._listening = False
+            self.invalidate()
+
+
+COMPATIBILITY_INDEX = CompatibilityIndex()
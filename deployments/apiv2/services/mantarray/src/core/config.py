@@ -5,6 +5,9 @@ config = Config(".env")
 # version used to tag the docker image
 VERSION = "0.10.6"
 
+# how long instruments may reuse the versions returned to them without checking if they changed
+VERSIONS_MAX_AGE_SECS = config("VERSIONS_MAX_AGE_SECS", cast=int, default=60)
+
 DASHBOARD_URL = config("DASHBOARD_URL", cast=str, default="https://dashboard.curibio-test.com")
 
 CLUSTER_NAME = config("CLUSTER_NAME", cast=str, default="test")
@@ -1,7 +1,7 @@
 import semver
 
 from .config import CLUSTER_NAME
-from utils.s3 import generate_presigned_url
+from utils.s3 import generate_presigned_url_async
 
 
 class NoPreviousVersionError(Exception):
@@ -12,10 +12,10 @@ class NoCompatibleVersionsError(Exception):
     pass
 
 
-def get_fw_download_url(version, firmware_type):
+async def get_fw_download_url(version, firmware_type):
     bucket = f"{CLUSTER_NAME}-{firmware_type}-firmware"
     file_name = f"{version}.bin"
-    url = generate_presigned_url(bucket=bucket, key=file_name)
+    url = await generate_presigned_url_async(bucket=bucket, key=file_name)
     return url
 
 
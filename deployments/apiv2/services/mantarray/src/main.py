@@ -1,8 +1,11 @@
+import asyncio
+import hashlib
 import time
 
 from contextlib import asynccontextmanager
 from asyncpg.exceptions import UniqueViolationError
 from fastapi import Depends, FastAPI, Path, Request, status, HTTPException, Response
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 import semver
@@ -12,7 +15,8 @@ from structlog.contextvars import bind_contextvars, clear_contextvars
 from uvicorn.protocols.utils import get_path_with_query_string
 
 from auth import ProtectedAny, Scopes
-from core.config import CLUSTER_NAME, DATABASE_URL, DASHBOARD_URL
+from core.compatibility import COMPATIBILITY_INDEX
+from core.config import CLUSTER_NAME, DATABASE_URL, DASHBOARD_URL, VERSIONS_MAX_AGE_SECS
 from core.versions import get_fw_download_url, get_required_sw_version_range, get_latest_compatible_versions
 from models.models import (
     ChannelFirmwareUpdateRequest,
@@ -25,20 +29,38 @@ from models.models import (
     LatestVersionsResponse,
 )
 from utils.db import AsyncpgPoolDep
+from utils.metrics import start_metrics_server
 from utils.logging import setup_logger, bind_context_to_logger
-from utils.s3 import generate_presigned_post
+from utils.s3 import generate_presigned_post_async
 
 setup_logger()
 logger = structlog.stdlib.get_logger("api.access")
 
 
-asyncpg_pool = AsyncpgPoolDep(dsn=DATABASE_URL)
+asyncpg_pool = AsyncpgPoolDep(dsn=DATABASE_URL, name="mantarray")
+
+
+async def listen_for_compatibility_changes():
+    """Keep the FW/SW version cache in use, which requires listening for changes to the tables."""
+    while True:
+        try:
+            pgpool = await asyncpg_pool()
+            async with pgpool.acquire() as con:
+                await COMPATIBILITY_INDEX.listen(con)
+        except Exception:
+            logger.exception("Error listening for FW/SW version changes")
+
+        # wait 1 minute before retrying connection
+        await asyncio.sleep(60)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    start_metrics_server()
     await asyncpg_pool()
+    compatibility_listener_task = asyncio.create_task(listen_for_compatibility_changes())
     yield
+    compatibility_listener_task.cancel()
 
 
 app = FastAPI(openapi_url=None, lifespan=lifespan)
@@ -89,6 +111,11 @@ SEMVER_REGEX = r"^\d+\.\d+\.\d+$"
 FW_TYPE_REGEX = "^(main|channel)$"
 SW_TYPE_REGEX = "^(mantarray|stingray)$"
 
+# instruments can reuse these for a short time, then only need to check that the ETag is still current
+VERSIONS_CACHE_CONTROL = f"public, max-age={VERSIONS_MAX_AGE_SECS}"
+# requires auth, so it must not be stored by shared caches
+FIRMWARE_INFO_CACHE_CONTROL = "private, no-cache"
+
 
 # TODO make request and response models for all of these?
 
@@ -167,18 +194,24 @@ async def get_software_for_main_fw(
 async def _get_software_range(request: Request, main_fw_version: str, prod: bool):
     """Get the max/min SW version compatible with the given main firmware version."""
     try:
-        async with request.state.pgpool.acquire() as con:
-            main_fw_compatibility = await con.fetch(
-                "SELECT version AS main_fw_version, min_ma_controller_version, min_sting_controller_version "
-                "FROM ma_main_firmware"
+        snapshot = await COMPATIBILITY_INDEX.get(request.state.pgpool)
+
+        def _get_max_min_version_dict():
+            return get_required_sw_version_range(
+                main_fw_version,
+                snapshot.main_fw_compatibility,
+                snapshot.ma_sw_versions,
+                snapshot.sting_sw_versions,
+                prod,
             )
-            ma_sw_versions = await con.fetch("SELECT version, state FROM ma_controllers")
-            sting_sw_versions = await con.fetch("SELECT version, state FROM sting_controllers")
 
-        max_min_version_dict = get_required_sw_version_range(
-            main_fw_version, main_fw_compatibility, ma_sw_versions, sting_sw_versions, prod
+        return _cached_json_response(
+            request,
+            snapshot,
+            ("software-range", main_fw_version, prod),
+            _get_max_min_version_dict,
+            VERSIONS_CACHE_CONTROL,
         )
-        return JSONResponse(max_min_version_dict)
     except Exception:
         err_msg = f"Error getting the required SW version for main FW v{main_fw_version}"
         logger.exception(err_msg)
@@ -188,88 +221,83 @@ async def _get_software_range(request: Request, main_fw_version: str, prod: bool
 # TODO Tanner (1/25/24): this is kept here to support backwards compatibility with older controller versions. It can be removed once all users upgrade to the controller versions released after the date of this note
 @app.get("/versions/{serial_number}")
 async def get_latest_prod_versions(request: Request, serial_number: str):
-    latest_versions = await _get_latest_versions(request, serial_number, True)
-    return JSONResponse(
-        {
+    def _format_latest_versions(latest_versions):
+        return {
             "latest_versions": {
                 "sw": latest_versions["min_ma_controller_version"],
                 "main-fw": latest_versions["main_fw_version"],
                 "channel-fw": latest_versions["channel_fw_version"],
             }
         }
-    )
+
+    return await _get_latest_versions(request, serial_number, True, "versions", _format_latest_versions)
 
 
 @app.get("/versions/{serial_number}/{prod}")
 async def get_latest_versions(request: Request, serial_number: str, prod: bool):
-    latest_versions = await _get_latest_versions(request, serial_number, prod)
-    return LatestVersionsResponse(
-        ma_sw=latest_versions["min_ma_controller_version"],
-        sting_sw=latest_versions["min_sting_controller_version"],
-        main_fw=latest_versions["main_fw_version"],
-        channel_fw=latest_versions["channel_fw_version"],
-    )
+    def _format_latest_versions(latest_versions):
+        return LatestVersionsResponse(
+            ma_sw=latest_versions["min_ma_controller_version"],
+            sting_sw=latest_versions["min_sting_controller_version"],
+            main_fw=latest_versions["main_fw_version"],
+            channel_fw=latest_versions["channel_fw_version"],
+        )
+
+    return await _get_latest_versions(request, serial_number, prod, "versions-v2", _format_latest_versions)
 
 
-async def _get_latest_versions(request: Request, serial_number: str, prod: bool):
+async def _get_latest_versions(
+    request: Request, serial_number: str, prod: bool, response_type: str, format_latest_versions
+):
     """Get the latest SW, main FW, and channel FW versions compatible with the MA instrument with the given serial number."""
     bind_context_to_logger({"serial_number": serial_number, "is_prod_controller": prod})
 
-    compat_query = (
-        "SELECT m.min_ma_controller_version, m.min_sting_controller_version, m.version AS main_fw_version, c.version AS channel_fw_version "
-        "FROM ma_channel_firmware AS c "
-        "JOIN ma_main_firmware AS m ON c.main_fw_version=m.version "
-        "JOIN maunits AS u ON c.hw_version=u.hw_version "
-        "WHERE u.serial_number=$1 "
-    )
-    if prod:
-        compat_query += "AND c.state='external'"
-
-    async with request.state.pgpool.acquire() as con:
-        try:
-            all_compatible_versions = await con.fetch(compat_query, serial_number)
-        except Exception:
-            logger.exception(f"Serial Number {serial_number} not found")
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST)
+    try:
+        snapshot = await COMPATIBILITY_INDEX.get(request.state.pgpool)
+    except Exception:
+        logger.exception("Error getting FW/SW versions")
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-        all_main_fw_versions = await con.fetch("SELECT version, state FROM ma_main_firmware")
+    if serial_number not in snapshot.hw_versions:
+        logger.error(f"Serial Number {serial_number} not found")
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST)
 
-    all_compatible_versions = [dict(row) for row in all_compatible_versions]
-    all_main_fw_versions = [dict(row) for row in all_main_fw_versions]
+    def _get_latest_versions_content():
+        all_compatible_versions = snapshot.get_compatible_versions(serial_number, prod)
+        latest_versions = get_latest_compatible_versions(all_compatible_versions, snapshot.main_fw_info, prod)
+        return format_latest_versions(latest_versions)
 
     try:
-        latest_versions = get_latest_compatible_versions(all_compatible_versions, all_main_fw_versions, prod)
+        return _cached_json_response(
+            request,
+            snapshot,
+            (response_type, serial_number, prod),
+            _get_latest_versions_content,
+            VERSIONS_CACHE_CONTROL,
+        )
     except Exception:
         err_msg = f"Error determining latest FW + SW versions for {serial_number}"
         logger.exception(err_msg)
         return JSONResponse(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, content={"message": err_msg})
 
-    return latest_versions
-
 
 @app.get("/firmware/info")
 async def get_all_fw_sw_compatibility(
     request: Request, token=Depends(ProtectedAny(scopes=[Scopes.MANTARRAY__FIRMWARE__LIST]))
 ):
     try:
-        async with request.state.pgpool.acquire() as con:
-            main_fw_info = await con.fetch("SELECT * FROM ma_main_firmware")
-            channel_fw_info = await con.fetch("SELECT * FROM ma_channel_firmware")
-            latest_ma_version = _get_min_compatible_sw_version(
-                await con.fetch("SELECT version, state FROM ma_controllers"), True
+        snapshot = await COMPATIBILITY_INDEX.get(request.state.pgpool)
+
+        def _get_firmware_info():
+            return FirmwareInfoResponse(
+                main_fw_info=snapshot.main_fw_info,
+                channel_fw_info=snapshot.channel_fw_info,
+                latest_ma_version=_get_min_compatible_sw_version(snapshot.ma_sw_versions, True),
+                latest_sting_version=_get_min_compatible_sw_version(snapshot.sting_sw_versions, True),
             )
-            latest_sting_version = _get_min_compatible_sw_version(
-                await con.fetch("SELECT version, state FROM sting_controllers"), True
-            )
-
-        main_fw_info = [dict(row) for row in main_fw_info]
-        channel_fw_info = [dict(row) for row in channel_fw_info]
 
-        return FirmwareInfoResponse(
-            main_fw_info=main_fw_info,
-            channel_fw_info=channel_fw_info,
-            latest_ma_version=latest_ma_version,
-            latest_sting_version=latest_sting_version,
+        return _cached_json_response(
+            request, snapshot, ("firmware-info",), _get_firmware_info, FIRMWARE_INFO_CACHE_CONTROL
         )
     except Exception:
         logger.exception("Error getting FW/SW compatibility")
@@ -285,7 +313,7 @@ async def get_firmware_download_url(
     try:
         bind_context_to_logger({"fw_type": fw_type, "fw_version": version})
 
-        url = get_fw_download_url(version, fw_type)
+        url = await get_fw_download_url(version, fw_type)
         return JSONResponse({"presigned_url": url})
     except Exception:
         err_msg = f"{fw_type.title()} Firmware v{version} not found"
@@ -330,7 +358,7 @@ async def upload_firmware_file(
 
         # create upload url before inserting FW version into DB so that if this step fails the DB insertion won't happen
         try:
-            upload_params = generate_presigned_post(
+            upload_params = await generate_presigned_post_async(
                 bucket=f"{CLUSTER_NAME}-{fw_type}-firmware", key=f"{version}.bin", md5s=details.md5s
             )
         except Exception:
@@ -407,6 +435,30 @@ async def add_software_version(
 # HELPERS
 
 
+def _render_json(content) -> tuple[bytes, str]:
+    body = JSONResponse(jsonable_encoder(content)).body
+    # based on the content rather than the snapshot so that every pod gives the same response the same ETag
+    return body, f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+
+
+def _cached_json_response(
+    request: Request, snapshot, key: tuple, get_content, cache_control: str
+) -> Response:
+    """Respond with the content returned by get_content, which is only rendered once per snapshot.
+
+    If the client already has the current version of the content, it isn't sent again.
+    """
+    body, etag = snapshot.memoize(key, lambda: _render_json(get_content()))
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+
+    if if_none_match := request.headers.get("If-None-Match"):
+        # weak comparison since proxies may weaken the ETag if they compress the response
+        if any(tag.strip().removeprefix("W/") in (etag, "*") for tag in if_none_match.split(",")):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    return Response(body, media_type="application/json", headers=headers)
+
+
 def _get_min_compatible_sw_version(sw_version_rows, is_compatible):
     max_sw_version_on_prod_channel = sorted(
         [semver.Version.parse(row["version"]) for row in sw_version_rows if row["state"] == "external"]
@@ -0,0 +1,149 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+import pytest
+import pytest_asyncio
+
+from src.core.compatibility import NOTIFY_CHANNEL, CompatibilityIndex
+
+TEST_ROWS = {
+    "SELECT * FROM ma_main_firmware": [
+        {
+            "version": "1.0.0",
+            "state": "external",
+            "min_ma_controller_version": "1.0.0",
+            "min_sting_controller_version": "1.0.0",
+        }
+    ],
+    "SELECT * FROM ma_channel_firmware": [
+        {"version": "1.0.0", "state": "external", "main_fw_version": "1.0.0", "hw_version": "2.2.0"}
+    ],
+    "SELECT version, state FROM ma_controllers": [{"version": "1.0.0", "state": "external"}],
+    "SELECT version, state FROM sting_controllers": [{"version": "1.0.0", "state": "external"}],
+    "SELECT serial_number, hw_version FROM maunits": [
+        {"serial_number": "MA2022001000", "hw_version": "2.2.0"}
+    ],
+}
+
+
+class Connection:
+    """Stand-in for both the connection the tables are loaded on and the one listening for changes to them."""
+
+    def __init__(self):
+        self.num_loads = 0
+        self.listeners = {}
+        self.termination_listeners = []
+        self.on_load = None
+
+    async def fetch(self, query):
+        if query == "SELECT * FROM ma_main_firmware":
+            self.num_loads += 1
+            if self.on_load:
+                self.on_load()
+        # give other requests a chance to run while loading
+        await asyncio.sleep(0)
+        return TEST_ROWS[query]
+
+    @asynccontextmanager
+    async def acquire(self):
+        yield self
+
+    def add_termination_listener(self, callback):
+        self.termination_listeners.append(callback)
+
+    async def add_listener(self, channel, callback):
+        self.listeners[channel] = callback
+
+    def notify(self, table):
+        self.listeners[NOTIFY_CHANNEL](self, 1, NOTIFY_CHANNEL, table)
+
+    def terminate(self):
+        for callback in self.termination_listeners:
+            callback(self)
+
+
+@pytest.fixture(scope="function", name="index")
+def fixture_index():
+    yield CompatibilityIndex()
+
+
+@pytest_asyncio.fixture(scope="function", name="con")
+async def fixture_con(index):
+    con = Connection()
+    listen_task = asyncio.create_task(index.listen(con))
+    await asyncio.sleep(0)
+    yield con
+    con.terminate()
+    await listen_task
+
+
+@pytest.mark.asyncio
+async def test_compatibility_index__loads_tables_once_for_concurrent_requests(index, con):
+    snapshots = await asyncio.gather(*[index.get(con) for _ in range(10)])
+
+    assert con.num_loads == 1
+    assert all(snapshot is snapshots[0] for snapshot in snapshots)
+    assert snapshots[0].hw_versions == {"MA2022001000": "2.2.0"}
+
+
+@pytest.mark.asyncio
+async def test_compatibility_index__reloads_tables_after_change(index, con):
+    snapshot = await index.get(con)
+
+    con.notify("ma_channel_firmware")
+
+    assert await index.get(con) is not snapshot
+    assert con.num_loads == 2
+
+
+@pytest.mark.asyncio
+async def test_compatibility_index__does_not_keep_tables_that_changed_while_loading(index, con):
+    con.on_load = lambda: con.notify("maunits")
+
+    for _ in range(2):
+        await index.get(con)
+
+    assert con.num_loads == 2
+
+
+@pytest.mark.asyncio
+async def test_compatibility_index__does_not_cache_tables_when_not_listening(index):
+    con = Connection()
+
+    for _ in range(2):
+        await index.get(con)
+
+    assert con.num_loads == 2
+
+
+@pytest.mark.asyncio
+async def test_compatibility_index__stops_caching_when_listening_stops(index, con):
+    await index.get(con)
+
+    con.terminate()
+    await asyncio.sleep(0)
+
+    for _ in range(2):
+        await index.get(con)
+    assert con.num_loads == 3
+
+
+@pytest.mark.asyncio
+async def test_compatibility_snapshot__memoizes_results(index, con):
+    snapshot = await index.get(con)
+    calls = []
+
+    def _fn():
+        calls.append(None)
+        return len(calls)
+
+    assert [snapshot.memoize(("key",), _fn) for _ in range(3)] == [1, 1, 1]
+    assert snapshot.get_compatible_versions("MA2022001000", True) == [
+        {
+            "min_ma_controller_version": "1.0.0",
+            "min_sting_controller_version": "1.0.0",
+            "main_fw_version": "1.0.0",
+            "channel_fw_version": "1.0.0",
+        }
+    ]
+    assert snapshot.get_compatible_versions("MA2022001001", True) == []
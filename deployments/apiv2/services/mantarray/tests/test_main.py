@@ -53,7 +53,8 @@ async def fixture_mocked_asyncpg_con(mocker):
 
     mocked_asyncpg_pool_coroutine = mocker.AsyncMock()
     mocked_asyncpg_pool_coroutine.return_value = mocker.MagicMock()
-    mocked_asyncpg_pool.return_value = mocked_asyncpg_pool_coroutine()
+    # a new coroutine for each request
+    mocked_asyncpg_pool.side_effect = lambda: mocked_asyncpg_pool_coroutine()
 
     mocked_asyncpg_con = await mocked_asyncpg_pool_coroutine.return_value.acquire().__aenter__()
     yield mocked_asyncpg_con
@@ -141,6 +142,57 @@ def test_software_range__get__success(is_prod, mocker):
     assert response.json() == expected_max_min
 
 
+def get_compatibility_fetch_se(
+    main_fw_info=(), channel_fw_info=(), ma_sw_versions=(), sting_sw_versions=(), units=()
+):
+    rows_for_query = {
+        "SELECT * FROM ma_main_firmware": main_fw_info,
+        "SELECT * FROM ma_channel_firmware": channel_fw_info,
+        "SELECT version, state FROM ma_controllers": ma_sw_versions,
+        "SELECT version, state FROM sting_controllers": sting_sw_versions,
+        "SELECT serial_number, hw_version FROM maunits": units,
+    }
+
+    def fetch_se(query):
+        return list(rows_for_query[query])
+
+    return fetch_se
+
+
+TEST_SERIAL_NUMBER = "MA2022001000"
+
+TEST_COMPATIBILITY_ROWS = {
+    "main_fw_info": [
+        {
+            "version": "3.0.0",
+            "state": "external",
+            "min_ma_controller_version": "1.0.0",
+            "min_sting_controller_version": "2.0.0",
+        },
+        {
+            "version": "3.1.0",
+            "state": "internal",
+            "min_ma_controller_version": "1.1.0",
+            "min_sting_controller_version": "2.1.0",
+        },
+    ],
+    "channel_fw_info": [
+        {"version": "4.0.0", "state": "external", "main_fw_version": "3.0.0", "hw_version": "2.2.0"},
+        {"version": "4.1.0", "state": "internal", "main_fw_version": "3.1.0", "hw_version": "2.2.0"},
+        {"version": "5.0.0", "state": "external", "main_fw_version": "3.1.0", "hw_version": "3.0.0"},
+    ],
+    "ma_sw_versions": [{"version": "1.0.0", "state": "external"}, {"version": "1.1.0", "state": "internal"}],
+    "sting_sw_versions": [
+        {"version": "2.0.0", "state": "external"},
+        {"version": "2.1.0", "state": "internal"},
+    ],
+    "units": [
+        {"serial_number": TEST_SERIAL_NUMBER, "hw_version": "2.2.0"},
+        {"serial_number": "MA2022001001", "hw_version": "3.0.0"},
+    ],
+}
+
+
 @pytest.mark.parametrize("is_prod", [True, False])
 def test_versions__get__success(is_prod, mocked_asyncpg_con, mocker):
     test_latest_versions = {
@@ -153,12 +205,9 @@ def test_versions__get__success(is_prod, mocked_asyncpg_con, mocker):
     mocked_get_latest = mocker.patch.object(
         main, "get_latest_compatible_versions", autospec=True, return_value=test_latest_versions
     )
+    mocked_asyncpg_con.fetch.side_effect = get_compatibility_fetch_se(**TEST_COMPATIBILITY_ROWS)
 
-    mocked_fetch_returns = [[{}, {}]] * 2
-    mocked_asyncpg_con.fetch.side_effect = mocked_fetch_returns
-
-    test_serial_number = "MA2022001000"
-    response = test_client.get(f"/versions/{test_serial_number}/{is_prod}")
+    response = test_client.get(f"/versions/{TEST_SERIAL_NUMBER}/{is_prod}")
     assert response.status_code == 200
     assert (
         response.json()
@@ -170,100 +219,123 @@ def test_versions__get__success(is_prod, mocked_asyncpg_con, mocker):
         ).model_dump()
     )
 
-    expected_query = (
-        "SELECT m.min_ma_controller_version, m.min_sting_controller_version, m.version AS main_fw_version, c.version AS channel_fw_version "
-        "FROM ma_channel_firmware AS c "
-        "JOIN ma_main_firmware AS m ON c.main_fw_version=m.version "
-        "JOIN maunits AS u ON c.hw_version=u.hw_version "
-        "WHERE u.serial_number=$1 "
+    expected_compatible_versions = [
+        {
+            "min_ma_controller_version": "1.0.0",
+            "min_sting_controller_version": "2.0.0",
+            "main_fw_version": "3.0.0",
+            "channel_fw_version": "4.0.0",
+        }
+    ]
+    if not is_prod:
+        expected_compatible_versions.append(
+            {
+                "min_ma_controller_version": "1.1.0",
+                "min_sting_controller_version": "2.1.0",
+                "main_fw_version": "3.1.0",
+                "channel_fw_version": "4.1.0",
+            }
+        )
+    mocked_get_latest.assert_called_once_with(
+        expected_compatible_versions, TEST_COMPATIBILITY_ROWS["main_fw_info"], is_prod
     )
-    if is_prod:
-        expected_query += "AND c.state='external'"
-
-    mocked_asyncpg_con.fetch.assert_any_call(expected_query, test_serial_number)
-    mocked_asyncpg_con.fetch.assert_any_call("SELECT version, state FROM ma_main_firmware")
-    mocked_get_latest.assert_called_once_with(*mocked_fetch_returns, is_prod)
 
 
 def test_versions__get__no_prod__success(mocked_asyncpg_con, mocker):
-    test_latest_versions = {
-        "min_ma_controller_version": "1.0.0",
-        "min_sting_controller_version": "2.0.0",
-        "main_fw_version": "3.0.0",
-        "channel_fw_version": "4.0.0",
-    }
-
-    mocked_get_latest = mocker.patch.object(
-        main, "get_latest_compatible_versions", autospec=True, return_value=test_latest_versions
-    )
+    mocked_asyncpg_con.fetch.side_effect = get_compatibility_fetch_se(**TEST_COMPATIBILITY_ROWS)
 
-    mocked_fetch_returns = [[{}, {}]] * 2
-    mocked_asyncpg_con.fetch.side_effect = mocked_fetch_returns
-
-    test_serial_number = "MA2022001000"
-    response = test_client.get(f"/versions/{test_serial_number}")
+    response = test_client.get(f"/versions/{TEST_SERIAL_NUMBER}")
     assert response.status_code == 200
-    assert response.json() == {
-        "latest_versions": {
-            "sw": test_latest_versions["min_ma_controller_version"],
-            "main-fw": test_latest_versions["main_fw_version"],
-            "channel-fw": test_latest_versions["channel_fw_version"],
-        }
-    }
-
-    expected_query = (
-        "SELECT m.min_ma_controller_version, m.min_sting_controller_version, m.version AS main_fw_version, c.version AS channel_fw_version "
-        "FROM ma_channel_firmware AS c "
-        "JOIN ma_main_firmware AS m ON c.main_fw_version=m.version "
-        "JOIN maunits AS u ON c.hw_version=u.hw_version "
-        "WHERE u.serial_number=$1 AND c.state='external'"
-    )
-    mocked_asyncpg_con.fetch.assert_any_call(expected_query, test_serial_number)
-    mocked_asyncpg_con.fetch.assert_any_call("SELECT version, state FROM ma_main_firmware")
-    mocked_get_latest.assert_called_once_with(*mocked_fetch_returns, True)
+    assert response.json() == {"latest_versions": {"sw": "1.0.0", "main-fw": "3.0.0", "channel-fw": "4.0.0"}}
 
 
 def test_versions__get__serial_number_not_found_in_db(mocked_asyncpg_con):
-    mocked_asyncpg_con.fetch.side_effect = Exception()
+    mocked_asyncpg_con.fetch.side_effect = get_compatibility_fetch_se(**TEST_COMPATIBILITY_ROWS)
 
     response = test_client.get("/versions/TEST-SERIAL-NUMBER")
     assert response.status_code == 400
 
 
+def test_versions__get__error_loading_versions(mocked_asyncpg_con):
+    mocked_asyncpg_con.fetch.side_effect = Exception()
+
+    response = test_client.get(f"/versions/{TEST_SERIAL_NUMBER}")
+    assert response.status_code == 500
+
+
+@pytest.mark.parametrize(
+    "test_route",
+    [
+        f"/versions/{TEST_SERIAL_NUMBER}/{True}",
+        f"/versions/{TEST_SERIAL_NUMBER}",
+        "/software-range/3.0.0/True",
+    ],
+)
+def test_versions__get__not_modified(test_route, mocked_asyncpg_con):
+    mocked_asyncpg_con.fetch.side_effect = get_compatibility_fetch_se(**TEST_COMPATIBILITY_ROWS)
+
+    response = test_client.get(test_route)
+    assert response.status_code == 200
+    assert response.headers["Cache-Control"] == main.VERSIONS_CACHE_CONTROL
+    etag = response.headers["ETag"]
+
+    for if_none_match in (etag, f"W/{etag}", f'"other", {etag}'):
+        response = test_client.get(test_route, headers={"If-None-Match": if_none_match})
+        assert response.status_code == 304
+        assert response.headers["ETag"] == etag
+        assert not response.content
+
+    response = test_client.get(test_route, headers={"If-None-Match": '"other"'})
+    assert response.status_code == 200
+
+
+def test_versions__get__etag_changes_with_versions(mocked_asyncpg_con):
+    mocked_asyncpg_con.fetch.side_effect = get_compatibility_fetch_se(**TEST_COMPATIBILITY_ROWS)
+    etag = test_client.get(f"/versions/{TEST_SERIAL_NUMBER}").headers["ETag"]
+
+    updated_rows = TEST_COMPATIBILITY_ROWS | {
+        "channel_fw_info": TEST_COMPATIBILITY_ROWS["channel_fw_info"]
+        + [{"version": "4.2.0", "state": "external", "main_fw_version": "3.0.0", "hw_version": "2.2.0"}]
+    }
+    mocked_asyncpg_con.fetch.side_effect = get_compatibility_fetch_se(**updated_rows)
+
+    response = test_client.get(f"/versions/{TEST_SERIAL_NUMBER}", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert response.json()["latest_versions"]["channel-fw"] == "4.2.0"
+
+
 def test_firmware_info__get__success(mocked_asyncpg_con):
     access_token = get_token(scopes=[Scopes.MANTARRAY__FIRMWARE__LIST])
 
-    expected_response = main.FirmwareInfoResponse(
-        main_fw_info=[{"main": "1.1.1"}],
-        channel_fw_info=[{"channel": "2.2.2"}],
-        latest_ma_version="4.4.4",
-        latest_sting_version="3.3.3",
-    )
-
-    def fetch_se(query):
-        if query == "SELECT * FROM ma_main_firmware":
-            return expected_response.main_fw_info
-        if query == "SELECT * FROM ma_channel_firmware":
-            return expected_response.channel_fw_info
-        if query == "SELECT version, state FROM ma_controllers":
-            return [
+    mocked_asyncpg_con.fetch.side_effect = get_compatibility_fetch_se(
+        **TEST_COMPATIBILITY_ROWS
+        | {
+            "ma_sw_versions": [
                 {"version": "1.1.1", "state": "external"},
                 {"version": "4.4.4", "state": "external"},
                 {"version": "5.5.5", "state": "internal"},
-            ]
-        if query == "SELECT version, state FROM sting_controllers":
-            return [
+            ],
+            "sting_sw_versions": [
                 {"version": "1.1.1", "state": "external"},
                 {"version": "3.3.3", "state": "external"},
                 {"version": "5.5.5", "state": "internal"},
-            ]
-        return None
-
-    mocked_asyncpg_con.fetch.side_effect = fetch_se
+            ],
+        }
+    )
 
     response = test_client.get("/firmware/info", headers={"Authorization": f"Bearer {access_token}"})
     assert response.status_code == 200
-    assert response.json() == expected_response.model_dump()
+    assert (
+        response.json()
+        == main.FirmwareInfoResponse(
+            main_fw_info=TEST_COMPATIBILITY_ROWS["main_fw_info"],
+            channel_fw_info=TEST_COMPATIBILITY_ROWS["channel_fw_info"],
+            latest_ma_version="4.4.4",
+            latest_sting_version="3.3.3",
+        ).model_dump()
+    )
+    assert response.headers["Cache-Control"] == main.FIRMWARE_INFO_CACHE_CONTROL
 
 
 def test_firmware__get__success(mocker):
@@ -329,7 +401,7 @@ def test_firmware__post__main_fw__success(
     mocked_asyncpg_con.fetch.side_effect = fetch_se
 
     mocked_presigned_post = mocker.patch.object(
-        main, "generate_presigned_post", autospec=True, return_value={"upload": "params"}
+        main, "generate_presigned_post_async", autospec=True, return_value={"upload": "params"}
     )
 
     response = test_client.post(
@@ -359,7 +431,7 @@ def test_firmware__post__channel_fw__success(mocker, mocked_asyncpg_con):
     test_fw_version = random_semver()
 
     mocked_presigned_post = mocker.patch.object(
-        main, "generate_presigned_post", autospec=True, return_value={"upload": "params"}
+        main, "generate_presigned_post_async", autospec=True, return_value={"upload": "params"}
     )
 
     test_main_fw_version = random_semver()
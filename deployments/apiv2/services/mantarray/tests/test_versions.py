@@ -84,13 +84,15 @@ def test_filter_and_sort_semvers__returns_correct_values(test_filter, expected_r
     versions._filter_and_sort_semvers(test_versions, test_filter) == expected_result
 
 
-def test_get_fw_download_url__generates_and_returns_presigned_using_the_params_given(mocker):
-    mocked_generate = mocker.patch.object(versions, "generate_presigned_url", autospec=True)
+async def test_get_fw_download_url__generates_and_returns_presigned_using_the_params_given(mocker):
+    mocked_generate = mocker.patch.object(versions, "generate_presigned_url_async", autospec=True)
 
     test_firmware_type = choice(["main", "channel"])
     test_version = choice(["1.11.111", "999.99.9"])
 
-    assert versions.get_fw_download_url(test_version, test_firmware_type) == mocked_generate.return_value
+    assert (
+        await versions.get_fw_download_url(test_version, test_firmware_type) == mocked_generate.return_value
+    )
 
     expected_bucket = f"{CLUSTER_NAME}-{test_firmware_type}-firmware"
     expected_key = f"{test_version}.bin"
@@ -16,6 +16,10 @@ CURIBIO_SUPPORT_EMAIL = config("CURIBIO_SUPPORT_EMAIL", cast=str)
 MICROSOFT_SSO_APP_ID = config("MICROSOFT_SSO_APP_ID", cast=str)
 MICROSOFT_SSO_KEYS_URI = config("MICROSOFT_SSO_KEYS_URI", cast=str)
 MICROSOFT_SSO_JWT_ALGORITHM = config("MICROSOFT_SSO_JWT_ALGORITHM", cast=str)
+# how long the fetched signing keys are used for before being fetched again
+MICROSOFT_SSO_KEYS_TTL_SECS = config("MICROSOFT_SSO_KEYS_TTL_SECS", cast=int, default=3600)
+# min time between fetches caused by a token signed with a key that isn't cached
+MICROSOFT_SSO_KEYS_MIN_REFETCH_SECS = config("MICROSOFT_SSO_KEYS_MIN_REFETCH_SECS", cast=int, default=60)
 
 POSTGRES_USER = config("POSTGRES_USER", cast=str)
 POSTGRES_PASSWORD = config("POSTGRES_PASSWORD", cast=Secret)
@@ -28,3 +32,13 @@ DATABASE_URL = config(
     cast=str,
     default=f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_SERVER}:{POSTGRES_PORT}/{POSTGRES_DB}",
 )
+
+# parameters for new password hashes, existing hashes are verified with the parameters they were created with.
+# Defaults are argon2-cffi's (the RFC 9106 low memory profile)
+ARGON2_TIME_COST = config("ARGON2_TIME_COST", cast=int, default=3)
+ARGON2_MEMORY_COST_KIB = config("ARGON2_MEMORY_COST_KIB", cast=int, default=65536)
+ARGON2_PARALLELISM = config("ARGON2_PARALLELISM", cast=int, default=4)
+# max number of passwords hashed or verified at once, each one uses ARGON2_MEMORY_COST_KIB of memory
+PASSWORD_HASHING_WORKERS = config("PASSWORD_HASHING_WORKERS", cast=int, default=2)
+# max number of hashes/verifications waiting for a worker, any more are rejected instead of queued
+PASSWORD_HASHING_MAX_PENDING = config("PASSWORD_HASHING_MAX_PENDING", cast=int, default=32)
@@ -0,0 +1,81 @@
+import asyncio
+import time
+
+import httpx
+from jwt import PyJWK, PyJWKSet, get_unverified_header
+from jwt.exceptions import PyJWKClientError
+import structlog
+
+logger = structlog.stdlib.get_logger("api.access")
+
+
+class JWKSCache:
+    """Process-wide cache of the signing keys in a JSON Web Key Set.
+
+    The key set is fetched when first needed and then kept fresh by refresh_periodically, so requests normally
+    don't wait on the key server at all. A token signed with a key that isn't cached causes one refetch in case
+    the keys were rotated, at most once every min_refetch_secs so that tokens with made up key IDs can't be used
+    to flood the key server. If a refresh fails, the keys already cached continue to be used.
+    """
+
+    def __init__(
+        self, uri: str, *, ttl_secs: float, min_refetch_secs: float, timeout_secs: float = 5
+    ) -> None:
+        self._uri = uri
+        self._ttl_secs = ttl_secs
+        self._min_refetch_secs = min_refetch_secs
+        self._timeout_secs = timeout_secs
+        self._keys: dict[str, PyJWK] = {}
+        # when the keys were last fetched, or last failed to be fetched while there were cached keys to fall back on
+        self._checked_at: float | None = None
+        self._lock = asyncio.Lock()
+
+    def _secs_since_check(self) -> float:
+        return float("inf") if self._checked_at is None else time.monotonic() - self._checked_at
+
+    async def _fetch(self) -> None:
+        async with httpx.AsyncClient(timeout=self._timeout_secs) as client:
+            response = await client.get(self._uri)
+        response.raise_for_status()
+
+        jwk_set = PyJWKSet.from_dict(response.json())
+        self._keys = {key.key_id: key for key in jwk_set.keys if key.public_key_use in ("sig", None)}
+        logger.info(f"Fetched {len(self._keys)} signing keys from {self._uri}")
+
+    async def refresh(self, max_age_secs: float) -> None:
+        """Fetch the key set unless it was checked less than max_age_secs ago."""
+        async with self._lock:
+            # the keys may have been fetched by another request while waiting for the lock
+            if self._secs_since_check() < max_age_secs:
+                return
+            try:
+                await self._fetch()
+            except Exception:
+                if not self._keys:
+                    raise
+                logger.exception(f"Failed to refresh signing keys from {self._uri}, using cached keys")
+            # when falling back on the cached keys, don't make every request wait on the key server again
+            self._checked_at = time.monotonic()
+
+    async def refresh_periodically(self) -> None:
+        while True:
+            try:
+                await self.refresh(0)
+            except Exception:
+                logger.exception(f"Failed to fetch signing keys from {self._uri}")
+            # refreshed well before the TTL is reached so that requests don't have to
+            await asyncio.sleep(self._ttl_secs / 2)
+
+    async def get_signing_key(self, kid: str) -> PyJWK:
+        await self.refresh(self._ttl_secs)
+        if kid not in self._keys:
+            # the keys may have been rotated since they were last fetched
+            await self.refresh(self._min_refetch_secs)
+
+        try:
+            return self._keys[kid]
+        except KeyError:
+            raise PyJWKClientError(f'Unable to find a signing key that matches: "{kid}"')
+
+    async def get_signing_key_from_jwt(self, token: str) -> PyJWK:
+        return await self.get_signing_key(get_unverified_header(token).get("kid"))
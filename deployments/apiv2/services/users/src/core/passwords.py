@@ -0,0 +1,100 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+from argon2 import PasswordHasher
+from argon2.exceptions import VerifyMismatchError
+from prometheus_client import Counter, Gauge, Histogram
+
+from models.errors import PasswordHashingBusyError
+from .config import (
+    ARGON2_MEMORY_COST_KIB,
+    ARGON2_PARALLELISM,
+    ARGON2_TIME_COST,
+    PASSWORD_HASHING_MAX_PENDING,
+    PASSWORD_HASHING_WORKERS,
+)
+
+HASHING_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+QUEUE_SECONDS = Histogram(
+    "password_hashing_queue_seconds",
+    "Time a password hash or verification waited for a worker",
+    ["operation"],
+    buckets=HASHING_BUCKETS,
+)
+RUN_SECONDS = Histogram(
+    "password_hashing_run_seconds",
+    "Time spent hashing or verifying a password",
+    ["operation"],
+    buckets=HASHING_BUCKETS,
+)
+PENDING = Gauge("password_hashing_pending", "Number of password hashes/verifications queued or running")
+REJECTED = Counter("password_hashing_rejected", "Number of password hashes/verifications rejected when busy")
+
+
+class PasswordHashingPool:
+    """Runs Argon2 hashing and verification in a bounded thread pool.
+
+    Argon2 is CPU and memory intensive by design, so running it on the event loop would stall every other request
+    handled by this process. argon2-cffi releases the GIL while hashing, so threads are enough to run it in
+    parallel. Requests are rejected with PasswordHashingBusyError instead of queued without limit when too many
+    are already waiting, e.g. during a burst of login attempts.
+    """
+
+    def __init__(self, max_workers: int, max_pending: int, password_hasher: PasswordHasher) -> None:
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="password-hashing")
+        self._max_pending = max_pending
+        self._num_pending = 0
+        self._password_hasher = password_hasher
+
+    async def _run(self, operation: str, fn, *args):
+        if self._num_pending >= self._max_pending:
+            REJECTED.inc()
+            raise PasswordHashingBusyError()
+
+        queued_at = time.perf_counter()
+
+        def _timed_fn():
+            started_at = time.perf_counter()
+            QUEUE_SECONDS.labels(operation).observe(started_at - queued_at)
+            try:
+                return fn(*args)
+            finally:
+                RUN_SECONDS.labels(operation).observe(time.perf_counter() - started_at)
+
+        self._num_pending += 1
+        PENDING.inc()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, _timed_fn)
+        finally:
+            self._num_pending -= 1
+            PENDING.dec()
+
+    async def hash(self, pw: str) -> str:
+        return await self._run("hash", self._password_hasher.hash, pw)
+
+    async def verify(self, phash: str, pw: str) -> None:
+        """Raises the same errors as PasswordHasher.verify if the password does not match the hash."""
+        await self._run("verify", self._password_hasher.verify, phash, pw)
+
+    async def matches_any(self, phashes: list[str], pw: str) -> bool:
+        async def _matches(phash):
+            try:
+                await self.verify(phash, pw)
+            except VerifyMismatchError:
+                return False
+            return True
+
+        # verified in parallel instead of one after another
+        return any(await asyncio.gather(*[_matches(phash) for phash in phashes]))
+
+
+PASSWORD_HASHING_POOL = PasswordHashingPool(
+    PASSWORD_HASHING_WORKERS,
+    PASSWORD_HASHING_MAX_PENDING,
+    # created once since the parameters are the same for every hash
+    PasswordHasher(
+        time_cost=ARGON2_TIME_COST, memory_cost=ARGON2_MEMORY_COST_KIB, parallelism=ARGON2_PARALLELISM
+    ),
+)
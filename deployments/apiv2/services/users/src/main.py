@@ -1,3 +1,4 @@
+import asyncio
 import json
 import time
 import uuid
@@ -5,12 +6,12 @@ from contextlib import asynccontextmanager
 from datetime import datetime, timedelta, timezone
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
-from argon2 import PasswordHasher
 from argon2.exceptions import VerifyMismatchError, InvalidHash
 from asyncpg.exceptions import UniqueViolationError
 from fastapi import FastAPI, Request, Depends, HTTPException, status, Response, Query
+from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
-from jwt import decode, PyJWKClient
+from jwt import decode
 from jwt.exceptions import InvalidTokenError
 from pydantic import EmailStr
 from starlette_context import context, request_cycle_context
@@ -36,6 +37,7 @@ from auth import (
     AuthTokens,
     get_account_scopes,
     create_new_tokens,
+    ACCOUNT_SCOPES_CACHE,
     AccountTypes,
     LoginType,
     get_product_tags_of_admin,
@@ -51,8 +53,18 @@ from core.config import (
     MICROSOFT_SSO_KEYS_URI,
     MICROSOFT_SSO_APP_ID,
     MICROSOFT_SSO_JWT_ALGORITHM,
+    MICROSOFT_SSO_KEYS_TTL_SECS,
+    MICROSOFT_SSO_KEYS_MIN_REFETCH_SECS,
+)
+from core.jwks import JWKSCache
+from core.passwords import PASSWORD_HASHING_POOL
+from models.errors import (
+    LoginError,
+    RegistrationError,
+    EmailRegistrationError,
+    UnableToUpdateAccountError,
+    PasswordHashingBusyError,
 )
-from models.errors import LoginError, RegistrationError, EmailRegistrationError, UnableToUpdateAccountError
 from models.users import (
     AdminLogin,
     UserLogin,
@@ -69,6 +81,7 @@ from models.users import (
     PreferencesUpdate,
 )
 from utils.db import AsyncpgPoolDep
+from utils.metrics import start_metrics_server
 from utils.email import FastMailClient
 from utils.logging import setup_logger, bind_context_to_logger
 from fastapi.templating import Jinja2Templates
@@ -76,14 +89,35 @@ from fastapi.templating import Jinja2Templates
 setup_logger()
 logger = structlog.stdlib.get_logger("api.access")
 
-asyncpg_pool = AsyncpgPoolDep(dsn=DATABASE_URL)
+MICROSOFT_SSO_JWKS = JWKSCache(
+    MICROSOFT_SSO_KEYS_URI,
+    ttl_secs=MICROSOFT_SSO_KEYS_TTL_SECS,
+    min_refetch_secs=MICROSOFT_SSO_KEYS_MIN_REFETCH_SECS,
+)
+
+asyncpg_pool = AsyncpgPoolDep(dsn=DATABASE_URL, name="users")
 email_client = FastMailClient(
     mail_username=CURIBIO_EMAIL, mail_password=CURIBIO_EMAIL_PASSWORD, template_folder="./templates"
 )
 
 
+async def listen_for_account_scopes_changes():
+    """Keep the account scopes cache in use, which requires listening for changes to them."""
+    while True:
+        try:
+            pgpool = await asyncpg_pool()
+            async with pgpool.acquire() as con:
+                await ACCOUNT_SCOPES_CACHE.listen(con)
+        except Exception:
+            logger.exception("Error listening for account scopes changes")
+
+        # wait 1 minute before retrying connection
+        await asyncio.sleep(60)
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    start_metrics_server()
     await asyncpg_pool()
     scheduler.add_job(
         daily_job,
@@ -92,7 +126,11 @@ async def lifespan(app: FastAPI):
         replace_existing=True,
     )
     scheduler.start()
+    jwks_refresh_task = asyncio.create_task(MICROSOFT_SSO_JWKS.refresh_periodically())
+    account_scopes_listener_task = asyncio.create_task(listen_for_account_scopes_changes())
     yield
+    account_scopes_listener_task.cancel()
+    jwks_refresh_task.cancel()
     scheduler.shutdown()
 
 
@@ -100,6 +138,8 @@ app = FastAPI(openapi_url=None, lifespan=lifespan)
 scheduler = AsyncIOScheduler()
 
 MAX_FAILED_LOGIN_ATTEMPTS = 10
+# how long clients are told to wait before retrying when too many passwords are being hashed
+PASSWORD_HASHING_RETRY_AFTER_SECS = 1
 TEMPLATES = Jinja2Templates(directory="templates")
 
 app.add_middleware(
@@ -111,6 +151,16 @@ app.add_middleware(
 )
 
 
+@app.exception_handler(PasswordHashingBusyError)
+async def password_hashing_busy_handler(request: Request, exc: PasswordHashingBusyError) -> JSONResponse:
+    logger.error(f"{request.method} {request.url.path}: Too many password hashes in progress")
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "Service Unavailable"},
+        headers={"Retry-After": str(PASSWORD_HASHING_RETRY_AFTER_SECS)},
+    )
+
+
 @app.middleware("http")
 async def db_session_middleware(request: Request, call_next) -> Response:
     request.state.pgpool = await asyncpg_pool()
@@ -387,7 +437,7 @@ async def sso_user(request: Request, details: SSOLogin):
                     raise LoginError("Bad user organization id state.")
 
             # get scopes from account_scopes table
-            scopes = await get_account_scopes(con, customer_id, user_id)
+            scopes = await get_account_scopes(con, customer_id, user_id, use_cache=True)
 
             tokens = await create_new_tokens(
                 con, user_id, customer_id, scopes, AccountTypes.USER, LoginType.SSO_MICROSOFT
@@ -428,21 +478,22 @@ async def login_admin(request: Request, details: AdminLogin):
                 LoginType.PASSWORD,
             )
 
-            # query will return None if customer email is not found
-            # or if login_type is not "password"
-            if select_query_result is None:
-                customer_id = None
-            else:
-                customer_id = select_query_result.get("id")
-                if select_query_result["password"] is None:
-                    raise LoginError("Account needs verification")
+        # query will return None if customer email is not found
+        # or if login_type is not "password"
+        if select_query_result is None:
+            customer_id = None
+        else:
+            customer_id = select_query_result.get("id")
+            if select_query_result["password"] is None:
+                raise LoginError("Account needs verification")
 
-            bind_context_to_logger({"customer_id": str(customer_id)})
+        bind_context_to_logger({"customer_id": str(customer_id)})
 
-            pw = details.password.get_secret_value()
-            # verify password, else raise LoginError
-            await _verify_password(con, account_type, pw, select_query_result)
+        pw = details.password.get_secret_value()
+        # verify password, else raise LoginError. No connection is held while waiting on the hashing pool
+        await _verify_password(request.state.pgpool, account_type, pw, select_query_result)
 
+        async with request.state.pgpool.acquire() as con:
             login_response = await _build_admin_login_or_sso_response(
                 con, customer_id, email, LoginType.PASSWORD
             )
@@ -450,6 +501,8 @@ async def login_admin(request: Request, details: AdminLogin):
 
     except LoginError as e:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail=str(e))
+    except PasswordHashingBusyError:
+        raise
     except Exception:
         logger.exception("POST /login/admin: Unexpected error")
         raise HTTPException(
@@ -504,24 +557,26 @@ async def login_user(request: Request, details: UserLogin):
                 select_query, username, str(details.customer_id), LoginType.PASSWORD
             )
 
-            # query will return None if username is not found
-            # or if login_type is not "password"
-            if select_query_result is not None:
-                user_id = select_query_result.get("id")
-                customer_id = select_query_result.get("customer_id")
-                # rebind customer id with uuid incase an alias was used above
-                bind_context_to_logger({"customer_id": str(customer_id), "user_id": str(user_id)})
+        # query will return None if username is not found
+        # or if login_type is not "password"
+        if select_query_result is not None:
+            user_id = select_query_result.get("id")
+            customer_id = select_query_result.get("customer_id")
+            # rebind customer id with uuid incase an alias was used above
+            bind_context_to_logger({"customer_id": str(customer_id), "user_id": str(user_id)})
 
-            pw = details.password.get_secret_value()
+        pw = details.password.get_secret_value()
 
-            # this will raise a LoginError if there are issues with the credentials or the user is suspended
-            await _verify_password(con, account_type, pw, select_query_result)
+        # this will raise a LoginError if there are issues with the credentials or the user is suspended.
+        # No connection is held while waiting on the hashing pool
+        await _verify_password(request.state.pgpool, account_type, pw, select_query_result)
 
-            if select_query_result["customer_suspended"]:
-                raise LoginError("The customer ID for this account has been deactivated.")
+        if select_query_result["customer_suspended"]:
+            raise LoginError("The customer ID for this account has been deactivated.")
 
+        async with request.state.pgpool.acquire() as con:
             # get scopes from account_scopes table
-            scopes = await get_account_scopes(con, customer_id, user_id)
+            scopes = await get_account_scopes(con, customer_id, user_id, use_cache=True)
 
             # users logging into the dashboard should not have usage returned because they need to select a product from the landing page first to be given correct limits
             # users logging into a specific instrument need the the usage returned right away and it is known what instrument they are using
@@ -549,6 +604,8 @@ async def login_user(request: Request, details: UserLogin):
 
     except LoginError as e:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail=str(e))
+    except PasswordHashingBusyError:
+        raise
     except Exception:
         logger.exception("POST /login: Unexpected error")
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -556,7 +613,7 @@ async def login_user(request: Request, details: UserLogin):
 
 async def _build_admin_login_or_sso_response(con, customer_id, email, login_type: LoginType):
     # get scopes from account_scopes table
-    scopes = await get_account_scopes(con, customer_id, None)
+    scopes = await get_account_scopes(con, customer_id, None, use_cache=True)
 
     # TODO split this part out into a new route
     # get list of scopes that the admin can assign to its users
@@ -588,17 +645,14 @@ async def _build_admin_login_or_sso_response(con, customer_id, email, login_type
 
 
 async def _decode_and_verify_jwt(token):
-    client = PyJWKClient(MICROSOFT_SSO_KEYS_URI)
-    signing_key = client.get_signing_key_from_jwt(token)
+    signing_key = await MICROSOFT_SSO_JWKS.get_signing_key_from_jwt(token)
     payload = decode(
         token, signing_key.key, algorithms=[MICROSOFT_SSO_JWT_ALGORITHM], audience=MICROSOFT_SSO_APP_ID
     )
     return payload
 
 
-async def _verify_password(con, account_type, pw, select_query_result) -> None:
-    ph = PasswordHasher()
-
+async def _verify_password(pgpool, account_type, pw, select_query_result) -> None:
     invalid_creds_msg = "Invalid credentials. Account will be locked after 10 failed attempts."
     account_locked_msg = "Account locked. Too many failed attempts."
     deactivated_msg = (
@@ -615,7 +669,7 @@ async def _verify_password(con, account_type, pw, select_query_result) -> None:
     try:
         # at this point, if no "password" key is present,
         # then there is an issue with the table in the database
-        ph.verify(select_query_result["password"], pw)
+        await PASSWORD_HASHING_POOL.verify(select_query_result["password"], pw)
     except VerifyMismatchError:
         # first check if account is already locked
         # should never be greater than maximum, but handling in case
@@ -627,9 +681,10 @@ async def _verify_password(con, account_type, pw, select_query_result) -> None:
         logger.info(
             f"Failed login attempt {updated_failed_attempts} for {account_type} id: {select_query_result['id']}"
         )
-        await _update_failed_login_attempts(
-            con, account_type, select_query_result["id"], updated_failed_attempts
-        )
+        async with pgpool.acquire() as con:
+            await _update_failed_login_attempts(
+                con, account_type, select_query_result["id"], updated_failed_attempts
+            )
         # update login error if this failed attempt hits limit
         raise LoginError(
             account_locked_msg if updated_failed_attempts == MAX_FAILED_LOGIN_ATTEMPTS else invalid_creds_msg
@@ -639,7 +694,7 @@ async def _verify_password(con, account_type, pw, select_query_result) -> None:
         The user or admin wasn't found but we don't want to leak info about valid users/admins
         through timing analysis so we still hash the supplied password before returning an error
         """
-        ph.hash(pw)
+        await PASSWORD_HASHING_POOL.hash(pw)
         raise LoginError(invalid_creds_msg)
     else:
         # only raise LoginError here when account is locked on successful creds after they have been checked to prevent giving away facts about successful login combinations
@@ -665,21 +720,19 @@ async def _update_failed_login_attempts(con, account_type: str, id: str, count:
     await con.execute(update_query, id)
 
 
-async def _update_password(con, pw, previous_passwords, update_query, query_params):
-    ph = PasswordHasher()
-    phash = ph.hash(pw)
+async def _update_password(pgpool, pw, previous_passwords, update_query, query_params):
+    """Hash the new password and store it.
+
+    The caller must not be holding a connection, the pool is only acquired from after hashing so that requests
+    waiting on the hashing pool don't use up the DB pool.
+    """
     # make sure new password does not match any previous passwords on file
-    for prev_pw in previous_passwords:
-        try:
-            ph.verify(prev_pw, pw)
-        except VerifyMismatchError:
-            # passwords don't match, nothing else to do
-            continue
-        else:
-            # passwords match, return msg indicating that this is the case
-            raise UnableToUpdateAccountError()
+    if await PASSWORD_HASHING_POOL.matches_any(previous_passwords, pw):
+        raise UnableToUpdateAccountError()
+    phash = await PASSWORD_HASHING_POOL.hash(pw)
 
-    await con.execute(update_query, phash, *query_params)
+    async with pgpool.acquire() as con:
+        await con.execute(update_query, phash, *query_params)
 
 
 @app.post("/refresh", response_model=AuthTokens, status_code=status.HTTP_201_CREATED)
@@ -726,7 +779,7 @@ async def refresh(request: Request, token=Depends(ProtectedAny(scopes=[Scopes.RE
 
             user_id = None if is_admin_account else account_id
             customer_id = account_id if is_admin_account else row["customer_id"]
-            scopes = await get_account_scopes(con, customer_id, user_id)
+            scopes = await get_account_scopes(con, customer_id, user_id, use_cache=True)
 
             # con is passed to this function, so it must be inside this async with block
             return await create_new_tokens(con, user_id, customer_id, scopes, account_type, login_type)
@@ -1090,62 +1143,59 @@ async def update_accounts(
 
         pw = details.password1.get_secret_value()
 
-        async with request.state.pgpool.acquire() as con:
-            async with con.transaction():
-                # ProtectedAny will return 401 already if token has expired, so no need to check again
+        # ProtectedAny will return 401 already if token has expired, so no need to check again
 
-                # get necessary info from DB before making any changes or validating any data
-                query = (
-                    "SELECT reset_token, previous_passwords FROM customers WHERE id=$1"
-                    if is_admin
-                    else "SELECT verified, reset_token, previous_passwords FROM users WHERE id=$1 AND customer_id=$2"
-                )
-                query_params = [account_id]
-                if is_user:
-                    query_params.append(customer_id)
-
-                row = await con.fetchrow(query, *query_params)
-
-                # if the token is being used to verify the user account and the account has already been verified, then return message to display to user
-                if is_user and details.verify and row["verified"]:
-                    msg = "Account has already been verified"
-                    logger.error(f"PUT /account: {msg}")
-                    return UnableToUpdateAccountResponse(message=msg)
-                # token in db gets replaced with NULL when it's been successfully used
-                if row["reset_token"] is None:
-                    msg = "Link has already been used"
-                    logger.error(f"PUT /account: {msg}")
-                    return UnableToUpdateAccountResponse(message=msg)
-
-                # if there is a token present in the DB but it does not match the one provided to this route, then presumably a new one has been created and thus the one being used should be considered expired
-                try:
-                    # decode and validate current reset token
-                    current_token = decode_token(row["reset_token"])
-                    # make sure the given token and the current token in the DB are the same
-                    assert token == current_token
-                except (InvalidTokenError, AssertionError):
-                    msg = "Link has expired"
-                    logger.error(f"PUT /account: {msg}")
-                    return UnableToUpdateAccountResponse(message=msg)
-
-                # Update the password of the account, and if it is a user also set the account as verified
-                update_query = (
-                    "UPDATE customers SET reset_token=NULL, password=$1, previous_passwords=array_prepend($1, previous_passwords[0:4]) WHERE id=$2"
-                    if is_admin
-                    else "UPDATE users SET verified='t', reset_token=NULL, password=$1, previous_passwords=array_prepend($1, previous_passwords[0:4]) WHERE id=$2 AND customer_id=$3"
-                )
-                query_params = [account_id]
+        # get necessary info from DB before making any changes or validating any data
+        query = (
+            "SELECT reset_token, previous_passwords FROM customers WHERE id=$1"
+            if is_admin
+            else "SELECT verified, reset_token, previous_passwords FROM users WHERE id=$1 AND customer_id=$2"
+        )
+        query_params = [account_id]
+        if is_user:
+            query_params.append(customer_id)
 
-                if is_user:
-                    query_params.append(customer_id)
+        async with request.state.pgpool.acquire() as con:
+            row = await con.fetchrow(query, *query_params)
+
+        # if the token is being used to verify the user account and the account has already been verified, then return message to display to user
+        if is_user and details.verify and row["verified"]:
+            msg = "Account has already been verified"
+            logger.error(f"PUT /account: {msg}")
+            return UnableToUpdateAccountResponse(message=msg)
+        # token in db gets replaced with NULL when it's been successfully used
+        if row["reset_token"] is None:
+            msg = "Link has already been used"
+            logger.error(f"PUT /account: {msg}")
+            return UnableToUpdateAccountResponse(message=msg)
+
+        # if there is a token present in the DB but it does not match the one provided to this route, then presumably a new one has been created and thus the one being used should be considered expired
+        try:
+            # decode and validate current reset token
+            current_token = decode_token(row["reset_token"])
+            # make sure the given token and the current token in the DB are the same
+            assert token == current_token
+        except (InvalidTokenError, AssertionError):
+            msg = "Link has expired"
+            logger.error(f"PUT /account: {msg}")
+            return UnableToUpdateAccountResponse(message=msg)
+
+        # Update the password of the account, and if it is a user also set the account as verified
+        update_query = (
+            "UPDATE customers SET reset_token=NULL, password=$1, previous_passwords=array_prepend($1, previous_passwords[0:4]) WHERE id=$2"
+            if is_admin
+            else "UPDATE users SET verified='t', reset_token=NULL, password=$1, previous_passwords=array_prepend($1, previous_passwords[0:4]) WHERE id=$2 AND customer_id=$3"
+        )
 
-                await _update_password(con, pw, row["previous_passwords"], update_query, query_params)
+        await _update_password(
+            request.state.pgpool, pw, row["previous_passwords"], update_query, query_params
+        )
 
     except UnableToUpdateAccountError:
         msg = "Cannot set password to any of the previous 5 passwords"
         logger.error(f"PUT /account: {msg}")
         return UnableToUpdateAccountResponse(message=msg)
-    except HTTPException:
+    except (HTTPException, PasswordHashingBusyError):
         raise
     except Exception:
         logger.exception("PUT /account: Unexpected error")
@@ -1592,17 +1642,16 @@ async def update_account(
                 elif action == "set_password":
                     pw = details.passwords.password1.get_secret_value()
 
+                    select_query = "SELECT previous_passwords FROM customers WHERE id=$1"
+                    update_query = "UPDATE customers SET password=$1, previous_passwords=array_prepend($1, previous_passwords[0:4]) WHERE id=$2"
+                    query_params = [account_id]
+                    # query for previous passwords
                     async with request.state.pgpool.acquire() as con:
-                        async with con.transaction():
-                            select_query = "SELECT previous_passwords FROM customers WHERE id=$1"
-                            update_query = "UPDATE customers SET password=$1, previous_passwords=array_prepend($1, previous_passwords[0:4]) WHERE id=$2"
-                            query_params = [account_id]
-                            # query for previous passwords
-                            row = await con.fetchrow(select_query, *query_params)
-                            # returning so last update does not get executed
-                            return await _update_password(
-                                con, pw, row["previous_passwords"], update_query, query_params
-                            )
+                        row = await con.fetchrow(select_query, *query_params)
+                    # returning so last update does not get executed
+                    return await _update_password(
+                        request.state.pgpool, pw, row["previous_passwords"], update_query, query_params
+                    )
                 else:
                     raise HTTPException(
                         status_code=status.HTTP_400_BAD_REQUEST,
@@ -1636,19 +1685,16 @@ async def update_account(
                     customer_id = uuid.UUID(hex=token.customer_id)
                     pw = details.passwords.password1.get_secret_value()
 
+                    select_query = "SELECT previous_passwords FROM users WHERE id=$1 AND customer_id=$2"
+                    update_query = "UPDATE users SET password=$1, previous_passwords=array_prepend($1, previous_passwords[0:4]) WHERE id=$2 AND customer_id=$3"
+                    query_params = [account_id, customer_id]
+                    # query for previous passwords
                     async with request.state.pgpool.acquire() as con:
-                        async with con.transaction():
-                            select_query = (
-                                "SELECT previous_passwords FROM users WHERE id=$1 AND customer_id=$2"
-                            )
-                            update_query = "UPDATE users SET password=$1, previous_passwords=array_prepend($1, previous_passwords[0:4]) WHERE id=$2 AND customer_id=$3"
-                            query_params = [account_id, customer_id]
-                            # query for previous passwords
-                            row = await con.fetchrow(select_query, *query_params)
-                            # returning so last update does not get executed
-                            return await _update_password(
-                                con, pw, row["previous_passwords"], update_query, query_params
-                            )
+                        row = await con.fetchrow(select_query, *query_params)
+                    # returning so last update does not get executed
+                    return await _update_password(
+                        request.state.pgpool, pw, row["previous_passwords"], update_query, query_params
+                    )
 
             else:
                 raise HTTPException(
@@ -1663,7 +1709,7 @@ async def update_account(
         msg = "Cannot set password to any of the previous 5 passwords"
         logger.exception(f"PUT /{account_id}: {msg}")
         return UnableToUpdateAccountResponse(message=msg)
-    except HTTPException:
+    except (HTTPException, PasswordHashingBusyError):
         raise
     except Exception:
         logger.exception(f"PUT /{account_id}: Unexpected error")
@@ -12,3 +12,7 @@ class EmailRegistrationError(Exception):
 
 class UnableToUpdateAccountError(Exception):
     pass
+
+
+class PasswordHashingBusyError(Exception):
+    pass
@@ -0,0 +1,148 @@
+import asyncio
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import uuid
+
+from cryptography.hazmat.primitives.asymmetric import rsa
+import httpx
+import jwt
+from jwt.algorithms import RSAAlgorithm
+from jwt.exceptions import PyJWKClientError
+import pytest
+
+from src import main
+from src.core.jwks import JWKSCache
+
+
+class KeyServer:
+    """Local stand-in for the Microsoft key set endpoint."""
+
+    def __init__(self):
+        self.private_keys = {}
+        self.jwks = {"keys": []}
+        self.num_requests = 0
+        self.available = True
+
+        key_server = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                key_server.num_requests += 1
+                if not key_server.available:
+                    self.send_response(503)
+                    self.end_headers()
+                    return
+                body = json.dumps(key_server.jwks).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self.uri = f"http://127.0.0.1:{self._server.server_address[1]}/keys"
+
+    def rotate_keys(self):
+        kid = uuid.uuid4().hex
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        self.private_keys = {kid: private_key}
+        jwk = json.loads(RSAAlgorithm.to_jwk(private_key.public_key())) | {"kid": kid, "use": "sig"}
+        self.jwks = {"keys": [jwk]}
+        return kid
+
+    def create_token(self, kid, **claims):
+        return jwt.encode(claims, self.private_keys[kid], algorithm="RS256", headers={"kid": kid})
+
+    def __enter__(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+@pytest.fixture(scope="function", name="key_server")
+def fixture_key_server():
+    with KeyServer() as key_server:
+        key_server.rotate_keys()
+        yield key_server
+
+
+def _get_kid(key_server):
+    return next(iter(key_server.private_keys))
+
+
+@pytest.mark.asyncio
+async def test_jwks_cache__fetches_keys_once_for_concurrent_requests(key_server):
+    cache = JWKSCache(key_server.uri, ttl_secs=3600, min_refetch_secs=60)
+    kid = _get_kid(key_server)
+    token = key_server.create_token(kid, email="test@email.com")
+
+    signing_keys = await asyncio.gather(*[cache.get_signing_key_from_jwt(token) for _ in range(10)])
+
+    assert key_server.num_requests == 1
+    assert jwt.decode(token, signing_keys[0].key, algorithms=["RS256"]) == {"email": "test@email.com"}
+
+
+@pytest.mark.asyncio
+async def test_jwks_cache__refetches_keys_for_unknown_kid(key_server):
+    cache = JWKSCache(key_server.uri, ttl_secs=3600, min_refetch_secs=0)
+    await cache.get_signing_key(_get_kid(key_server))
+
+    new_kid = key_server.rotate_keys()
+
+    assert (await cache.get_signing_key(new_kid)).key_id == new_kid
+    assert key_server.num_requests == 2
+
+
+@pytest.mark.asyncio
+async def test_jwks_cache__limits_refetches_for_unknown_kids(key_server):
+    cache = JWKSCache(key_server.uri, ttl_secs=3600, min_refetch_secs=60)
+    await cache.get_signing_key(_get_kid(key_server))
+
+    for _ in range(3):
+        with pytest.raises(PyJWKClientError):
+            await cache.get_signing_key("made-up-kid")
+
+    assert key_server.num_requests == 1
+
+
+@pytest.mark.asyncio
+async def test_jwks_cache__uses_cached_keys_if_key_server_is_unavailable(key_server):
+    cache = JWKSCache(key_server.uri, ttl_secs=0, min_refetch_secs=60)
+    kid = _get_kid(key_server)
+    await cache.get_signing_key(kid)
+
+    key_server.available = False
+
+    assert (await cache.get_signing_key(kid)).key_id == kid
+    assert key_server.num_requests == 2
+
+
+@pytest.mark.asyncio
+async def test_jwks_cache__raises_error_if_keys_were_never_fetched(key_server):
+    cache = JWKSCache(key_server.uri, ttl_secs=3600, min_refetch_secs=60)
+    key_server.available = False
+
+    with pytest.raises(httpx.HTTPStatusError):
+        await cache.get_signing_key(_get_kid(key_server))
+
+
+@pytest.mark.asyncio
+async def test_decode_and_verify_jwt__verifies_token_with_cached_key(key_server, mocker):
+    mocker.patch.object(
+        main, "MICROSOFT_SSO_JWKS", JWKSCache(key_server.uri, ttl_secs=3600, min_refetch_secs=60)
+    )
+    token = key_server.create_token(
+        _get_kid(key_server), email="test@email.com", aud=main.MICROSOFT_SSO_APP_ID
+    )
+
+    assert await main._decode_and_verify_jwt(token) == {
+        "email": "test@email.com",
+        "aud": main.MICROSOFT_SSO_APP_ID,
+    }
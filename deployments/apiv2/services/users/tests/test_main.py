@@ -4,6 +4,7 @@ from random import choice, randint
 import uuid
 
 from argon2 import PasswordHasher
+from argon2.exceptions import VerifyMismatchError
 from asyncpg.exceptions import UniqueViolationError
 from fastapi.testclient import TestClient
 from freezegun import freeze_time
@@ -38,6 +39,15 @@ TEST_PASSWORD = "Testpw123!"
 
 ACCOUNT_SCOPES = tuple(s for s in Scopes if ScopeTags.ACCOUNT in s.tags)
 
+ACCOUNT_SCOPES_QUERY = (
+    "SELECT scope, user_id IS NULL AS is_admin_scope FROM account_scopes "
+    "WHERE customer_id=$1 AND (user_id IS NULL OR user_id=$2)"
+)
+
+
+def get_store_refresh_token_call(mocker, table_name, account_id, token):
+    return mocker.call(f"UPDATE {table_name} SET refresh_token=$1 WHERE id=$2", token, account_id)
+
 
 def get_token(*, userid=None, customer_id=None, scopes=None, account_type=None, refresh=False):
     if not account_type:
@@ -59,15 +69,20 @@ def get_token(*, userid=None, customer_id=None, scopes=None, account_type=None,
     ).token
 
 
-@pytest.fixture(scope="function", name="mocked_asyncpg_con", autouse=True)
-async def fixture_mocked_asyncpg_con(mocker):
+@pytest.fixture(scope="function", name="mocked_asyncpg_pool", autouse=True)
+async def fixture_mocked_asyncpg_pool(mocker):
     mocked_asyncpg_pool = mocker.patch.object(main, "asyncpg_pool", autospec=True)
 
     mocked_asyncpg_pool_coroutine = mocker.AsyncMock()
     mocked_asyncpg_pool_coroutine.return_value = mocker.MagicMock()
     mocked_asyncpg_pool.return_value = mocked_asyncpg_pool_coroutine()
 
-    mocked_asyncpg_con = await mocked_asyncpg_pool_coroutine.return_value.acquire().__aenter__()
+    yield mocked_asyncpg_pool_coroutine.return_value
+
+
+@pytest.fixture(scope="function", name="mocked_asyncpg_con", autouse=True)
+async def fixture_mocked_asyncpg_con(mocked_asyncpg_pool, mocker):
+    mocked_asyncpg_con = await mocked_asyncpg_pool.acquire().__aenter__()
     mocked_asyncpg_con.transaction = mocker.MagicMock()
 
     yield mocked_asyncpg_con
@@ -75,7 +90,7 @@ async def fixture_mocked_asyncpg_con(mocker):
 
 @pytest.fixture(scope="function", name="spied_pw_hasher")
 def fixture_spied_pw_hasher(mocker):
-    spied_pw_hasher = mocker.spy(main.PasswordHasher, "hash")
+    spied_pw_hasher = mocker.spy(PasswordHasher, "hash")
     yield spied_pw_hasher
 
 
@@ -132,7 +147,7 @@ def test_login__user__success(send_client_type, use_alias, mocked_asyncpg_con, m
         "customer_id": test_customer_id,
         "customer_suspended": False,
     }
-    mocked_asyncpg_con.fetch.return_value = [{"scope": test_scope.value}]
+    mocked_asyncpg_con.fetch.return_value = [{"scope": test_scope.value, "is_admin_scope": False}]
     spied_create_token = mocker.spy(main, "create_new_tokens")
 
     expected_access_token = create_token(
@@ -176,16 +191,9 @@ def test_login__user__success(send_client_type, use_alias, mocked_asyncpg_con, m
     mocked_asyncpg_con.fetchrow.assert_called_once_with(
         expected_query, login_details["username"].lower(), login_details["customer_id"], "password"
     )
-    mocked_asyncpg_con.fetch.assert_has_calls(
-        [
-            mocker.call(
-                "SELECT scope FROM account_scopes WHERE customer_id=$1 AND user_id IS NULL", test_customer_id
-            ),
-            mocker.call("SELECT scope FROM account_scopes WHERE user_id=$1", test_user_id),
-        ]
-    )
-    mocked_asyncpg_con.execute.assert_called_with(
-        "UPDATE users SET refresh_token=$1 WHERE id=$2", expected_refresh_token.token, test_user_id
+    mocked_asyncpg_con.fetch.assert_called_once_with(ACCOUNT_SCOPES_QUERY, test_customer_id, test_user_id)
+    assert mocked_asyncpg_con.execute.call_args == get_store_refresh_token_call(
+        mocker, "users", test_user_id, expected_refresh_token.token
     )
 
     assert spied_create_token.call_count == 1
@@ -269,6 +277,85 @@ def test_login__user__returns_invalid_creds_if_account_is_suspended(mocked_async
     }
 
 
+@pytest.mark.parametrize("route", ["/login", "/login/admin"])
+def test_login__returns_503_if_too_many_passwords_are_being_hashed(route, mocked_asyncpg_con, mocker):
+    mocker.patch.object(
+        main.PASSWORD_HASHING_POOL, "verify", autospec=True, side_effect=main.PasswordHashingBusyError()
+    )
+    login_details = {"username": "test_USERNAME", "password": "test_password", "email": "test@email.com"}
+    if route == "/login":
+        login_details["customer_id"] = str(uuid.uuid4())
+
+    mocked_asyncpg_con.fetchrow.return_value = {
+        "password": "hash",
+        "id": uuid.uuid4(),
+        "failed_login_attempts": 0,
+        "suspended": False,
+    }
+
+    response = test_client.post(route, json=login_details)
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == str(main.PASSWORD_HASHING_RETRY_AFTER_SECS)
+    mocked_asyncpg_con.execute.assert_not_called()
+
+
+@pytest.mark.parametrize("route", ["/login", "/login/admin"])
+def test_login__does_not_hold_db_connection_while_verifying_password(
+    route, mocked_asyncpg_pool, mocked_asyncpg_con, mocker
+):
+    acquire_cm = mocked_asyncpg_pool.acquire.return_value
+    # the fixture enters the context once to get the connection
+    acquire_cm.__aenter__.reset_mock()
+    num_cons_held_while_verifying = []
+
+    async def _verify(*args):
+        num_cons_held_while_verifying.append(
+            acquire_cm.__aenter__.await_count - acquire_cm.__aexit__.await_count
+        )
+        raise VerifyMismatchError()
+
+    mocker.patch.object(main.PASSWORD_HASHING_POOL, "verify", autospec=True, side_effect=_verify)
+    login_details = {"username": "test_USERNAME", "password": "test_password", "email": "test@email.com"}
+    if route == "/login":
+        login_details["customer_id"] = str(uuid.uuid4())
+
+    mocked_asyncpg_con.fetchrow.return_value = {
+        "password": "hash",
+        "id": uuid.uuid4(),
+        "failed_login_attempts": 0,
+        "suspended": False,
+    }
+
+    response = test_client.post(route, json=login_details)
+    assert response.status_code == 401
+    assert num_cons_held_while_verifying == [0]
+    # the failed attempt is recorded on a connection acquired after verifying
+    mocked_asyncpg_con.execute.assert_called_once()
+    assert acquire_cm.__aenter__.await_count == acquire_cm.__aexit__.await_count == 2
+
+
+def test_account__put__returns_503_if_too_many_passwords_are_being_hashed(mocked_asyncpg_con, mocker):
+    mocker.patch.object(
+        main.PASSWORD_HASHING_POOL, "hash", autospec=True, side_effect=main.PasswordHashingBusyError()
+    )
+    access_token = get_token(scopes=[Scopes.MANTARRAY__ADMIN], account_type=AccountTypes.ADMIN)
+    account_id = main.decode_token(access_token).account_id
+
+    mocked_asyncpg_con.fetchrow.return_value = {"previous_passwords": []}
+
+    response = test_client.put(
+        f"/{uuid.UUID(account_id)}",
+        json={
+            "action_type": "set_password",
+            "passwords": {"password1": "Test_password1", "password2": "Test_password1"},
+        },
+        headers={"Authorization": f"Bearer {access_token}"},
+    )
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == str(main.PASSWORD_HASHING_RETRY_AFTER_SECS)
+    mocked_asyncpg_con.execute.assert_not_called()
+
+
 @freeze_time()
 @pytest.mark.parametrize("send_client_type", [True, False])
 def test_login__admin__success(send_client_type, mocked_asyncpg_con, mocker):
@@ -298,7 +385,7 @@ def test_login__admin__success(send_client_type, mocked_asyncpg_con, mocker):
         "failed_login_attempts": 0,
         "suspended": False,
     }
-    mocked_asyncpg_con.fetch.return_value = [{"scope": admin_scope.value}]
+    mocked_asyncpg_con.fetch.return_value = [{"scope": admin_scope.value, "is_admin_scope": True}]
     spied_create_token = mocker.spy(main, "create_new_tokens")
 
     expected_access_token = create_token(
@@ -333,11 +420,9 @@ def test_login__admin__success(send_client_type, mocked_asyncpg_con, mocker):
         login_details["email"].lower(),
         LoginType.PASSWORD,
     )
-    mocked_asyncpg_con.fetch.assert_called_once_with(
-        "SELECT scope FROM account_scopes WHERE customer_id=$1 AND user_id IS NULL", test_customer_id
-    )
-    mocked_asyncpg_con.execute.assert_called_with(
-        "UPDATE customers SET refresh_token=$1 WHERE id=$2", expected_refresh_token.token, test_customer_id
+    mocked_asyncpg_con.fetch.assert_called_once_with(ACCOUNT_SCOPES_QUERY, test_customer_id, None)
+    assert mocked_asyncpg_con.execute.call_args == get_store_refresh_token_call(
+        mocker, "customers", test_customer_id, expected_refresh_token.token
     )
 
     assert spied_create_token.call_count == 1
@@ -429,7 +514,7 @@ def test_sso__user__sign_in_success(send_client_type, mocked_asyncpg_con, mocker
         "verified": True,
         "sso_user_org_id": oid,
     }
-    mocked_asyncpg_con.fetch.return_value = [{"scope": test_scope.value}]
+    mocked_asyncpg_con.fetch.return_value = [{"scope": test_scope.value, "is_admin_scope": False}]
     spied_create_token = mocker.spy(main, "create_new_tokens")
 
     expected_access_token = create_token(
@@ -469,16 +554,9 @@ def test_sso__user__sign_in_success(send_client_type, mocked_asyncpg_con, mocker
     )
 
     mocked_asyncpg_con.fetchrow.assert_called_once_with(expected_query, email, LoginType.PASSWORD, tid)
-    mocked_asyncpg_con.fetch.assert_has_calls(
-        [
-            mocker.call(
-                "SELECT scope FROM account_scopes WHERE customer_id=$1 AND user_id IS NULL", test_customer_id
-            ),
-            mocker.call("SELECT scope FROM account_scopes WHERE user_id=$1", test_user_id),
-        ]
-    )
-    mocked_asyncpg_con.execute.assert_called_with(
-        "UPDATE users SET refresh_token=$1 WHERE id=$2", expected_refresh_token.token, test_user_id
+    mocked_asyncpg_con.fetch.assert_called_once_with(ACCOUNT_SCOPES_QUERY, test_customer_id, test_user_id)
+    assert mocked_asyncpg_con.execute.call_args == get_store_refresh_token_call(
+        mocker, "users", test_user_id, expected_refresh_token.token
     )
 
     assert spied_create_token.call_count == 1
@@ -526,7 +604,7 @@ def test_sso__user__sign_up_success(mocked_asyncpg_con, mocker):
         "verified": False,
         "sso_user_org_id": None,
     }
-    mocked_asyncpg_con.fetch.return_value = [{"scope": test_scope.value}]
+    mocked_asyncpg_con.fetch.return_value = [{"scope": test_scope.value, "is_admin_scope": False}]
     spied_create_token = mocker.spy(main, "create_new_tokens")
 
     expected_access_token = create_token(
@@ -566,16 +644,9 @@ def test_sso__user__sign_up_success(mocked_asyncpg_con, mocker):
     )
 
     mocked_asyncpg_con.fetchrow.assert_called_once_with(expected_query, email, LoginType.PASSWORD, tid)
-    mocked_asyncpg_con.fetch.assert_has_calls(
-        [
-            mocker.call(
-                "SELECT scope FROM account_scopes WHERE customer_id=$1 AND user_id IS NULL", test_customer_id
-            ),
-            mocker.call("SELECT scope FROM account_scopes WHERE user_id=$1", test_user_id),
-        ]
-    )
-    mocked_asyncpg_con.execute.assert_called_with(
-        "UPDATE users SET refresh_token=$1 WHERE id=$2", expected_refresh_token.token, test_user_id
+    mocked_asyncpg_con.fetch.assert_called_once_with(ACCOUNT_SCOPES_QUERY, test_customer_id, test_user_id)
+    assert mocked_asyncpg_con.execute.call_args == get_store_refresh_token_call(
+        mocker, "users", test_user_id, expected_refresh_token.token
     )
 
     assert spied_create_token.call_count == 1
@@ -673,7 +744,7 @@ def test_sso__admin__success(send_client_type, mocked_asyncpg_con, mocker):
     admin_scope = Scopes.MANTARRAY__ADMIN
 
     mocked_asyncpg_con.fetchrow.return_value = {"id": test_customer_id, "suspended": False}
-    mocked_asyncpg_con.fetch.return_value = [{"scope": admin_scope.value}]
+    mocked_asyncpg_con.fetch.return_value = [{"scope": admin_scope.value, "is_admin_scope": True}]
     spied_create_token = mocker.spy(main, "create_new_tokens")
 
     expected_access_token = create_token(
@@ -713,11 +784,9 @@ def test_sso__admin__success(send_client_type, mocked_asyncpg_con, mocker):
         tid,
         oid,
     )
-    mocked_asyncpg_con.fetch.assert_called_once_with(
-        "SELECT scope FROM account_scopes WHERE customer_id=$1 AND user_id IS NULL", test_customer_id
-    )
-    mocked_asyncpg_con.execute.assert_called_with(
-        "UPDATE customers SET refresh_token=$1 WHERE id=$2", expected_refresh_token.token, test_customer_id
+    mocked_asyncpg_con.fetch.assert_called_once_with(ACCOUNT_SCOPES_QUERY, test_customer_id, None)
+    assert mocked_asyncpg_con.execute.call_args == get_store_refresh_token_call(
+        mocker, "customers", test_customer_id, expected_refresh_token.token
     )
 
     assert spied_create_token.call_count == 1
@@ -1214,27 +1283,23 @@ def test_refresh__success(account_type, mocked_asyncpg_con, mocker):
     mocked_asyncpg_con.fetchrow.return_value = {"refresh_token": old_refresh_token}
     if not is_admin_account:
         mocked_asyncpg_con.fetchrow.return_value["customer_id"] = customer_id
-    mocked_asyncpg_con.fetch.return_value = [{"scope": test_scope_in_db.value}]
+    mocked_asyncpg_con.fetch.return_value = [
+        {"scope": test_scope_in_db.value, "is_admin_scope": is_admin_account}
+    ]
 
     response = test_client.post("/refresh", headers={"Authorization": f"Bearer {old_refresh_token}"})
     assert response.status_code == 201
     assert response.json() == AuthTokens(access=new_access_token, refresh=new_refresh_token).model_dump()
 
-    expected_fetch_calls = [
-        mocker.call("SELECT scope FROM account_scopes WHERE customer_id=$1 AND user_id IS NULL", customer_id)
-    ]
-    if not is_admin_account:
-        expected_fetch_calls.append(mocker.call("SELECT scope FROM account_scopes WHERE user_id=$1", userid))
-
     table_name = "customers" if is_admin_account else "users"
     account_id = customer_id if is_admin_account else userid
     mocked_asyncpg_con.fetchrow.assert_called_once_with(
         f"SELECT {select_clause} FROM {table_name} WHERE id=$1", account_id
     )
-    mocked_asyncpg_con.fetch.assert_has_calls(expected_fetch_calls)
-    mocked_asyncpg_con.execute.assert_called_once_with(
-        f"UPDATE {table_name} SET refresh_token=$1 WHERE id=$2", old_refresh_token, account_id
-    )
+    mocked_asyncpg_con.fetch.assert_called_once_with(ACCOUNT_SCOPES_QUERY, customer_id, userid)
+    assert mocked_asyncpg_con.execute.call_args_list == [
+        get_store_refresh_token_call(mocker, table_name, account_id, old_refresh_token)
+    ]
 
 
 def test_refresh__expired_refresh_token_in_db(mocked_asyncpg_con):
@@ -0,0 +1,178 @@
+import asyncio
+from contextlib import asynccontextmanager
+import os
+from types import SimpleNamespace
+import time
+import uuid
+
+from argon2 import PasswordHasher
+import pytest
+from starlette_context import request_cycle_context
+
+from src import main
+from src.core import passwords
+from src.models.users import UserLogin
+
+
+TEST_PASSWORD = "Testpw123!"
+
+# the login storm benchmark takes a while and depends on the speed of the machine, so is only run when asked for
+run_benchmark = pytest.mark.skipif(
+    not os.getenv("RUN_BENCHMARKS"), reason="RUN_BENCHMARKS not set, skipping password hashing benchmarks"
+)
+
+# roughly what a pod sees when many users try to log in at once
+NUM_LOGINS = 16
+# how often another request handled by the same process is simulated while the logins are happening
+TICK_INTERVAL_SECS = 0.005
+# each verification blocks the event loop for its whole duration when run on it, so the longest stall is at least
+# one order of magnitude longer than when they're all run in the pool
+MIN_STALL_REDUCTION = 10
+# the default size of the DB pool
+DB_POOL_SIZE = 10
+# how many logins of the storm against the DB pool are queued behind the hashing workers at once
+NUM_DB_POOL_LOGINS = 32
+
+
+@pytest.fixture(scope="function", name="pool")
+def fixture_pool():
+    yield passwords.PasswordHashingPool(
+        max_workers=2, max_pending=NUM_LOGINS, password_hasher=PasswordHasher()
+    )
+
+
+@pytest.mark.asyncio
+async def test_password_hashing_pool__hashes_and_verifies(pool):
+    phash = await pool.hash(TEST_PASSWORD)
+
+    await pool.verify(phash, TEST_PASSWORD)
+    assert await pool.matches_any([await pool.hash("other"), phash], TEST_PASSWORD) is True
+    assert await pool.matches_any([await pool.hash("other")], TEST_PASSWORD) is False
+
+
+@pytest.mark.asyncio
+async def test_password_hashing_pool__rejects_when_too_many_are_pending():
+    pool = passwords.PasswordHashingPool(max_workers=1, max_pending=1, password_hasher=PasswordHasher())
+
+    first_hash = asyncio.create_task(pool.hash(TEST_PASSWORD))
+    # let the first hash start
+    await asyncio.sleep(0)
+
+    with pytest.raises(passwords.PasswordHashingBusyError):
+        await pool.hash(TEST_PASSWORD)
+
+    await first_hash
+    # room is made once the first hash completes
+    await pool.hash(TEST_PASSWORD)
+
+
+async def _max_tick_delay_during(logins) -> float:
+    max_delay = 0
+    done = False
+
+    async def _ticker():
+        nonlocal max_delay
+        while not done:
+            start = time.perf_counter()
+            await asyncio.sleep(TICK_INTERVAL_SECS)
+            max_delay = max(max_delay, time.perf_counter() - start - TICK_INTERVAL_SECS)
+
+    ticker_task = asyncio.create_task(_ticker())
+    await asyncio.sleep(0)
+    try:
+        await logins()
+    finally:
+        done = True
+        await ticker_task
+
+    return max_delay
+
+
+@run_benchmark
+@pytest.mark.asyncio
+async def test_password_hashing_pool__login_storm_does_not_stall_event_loop(pool):
+    phash = PasswordHasher().hash(TEST_PASSWORD)
+
+    async def _logins_on_loop():
+        # how every login used to be handled
+        async def _login():
+            PasswordHasher().verify(phash, TEST_PASSWORD)
+
+        await asyncio.gather(*[_login() for _ in range(NUM_LOGINS)])
+
+    async def _logins_in_pool():
+        await asyncio.gather(*[pool.verify(phash, TEST_PASSWORD) for _ in range(NUM_LOGINS)])
+
+    on_loop_max_delay = await _max_tick_delay_during(_logins_on_loop)
+    in_pool_max_delay = await _max_tick_delay_during(_logins_in_pool)
+    print(  # allow-print
+        f"{NUM_LOGINS} logins: max event loop stall on loop={on_loop_max_delay * 1000:.1f}ms "
+        f"in pool={in_pool_max_delay * 1000:.1f}ms"
+    )
+
+    assert in_pool_max_delay * MIN_STALL_REDUCTION < on_loop_max_delay
+
+
+class _DBPool:
+    """Stand-in for an asyncpg pool with a limited number of connections whose queries return immediately."""
+
+    def __init__(self, size, row):
+        self._semaphore = asyncio.Semaphore(size)
+        self._row = row
+        self.max_acquire_wait = 0
+
+    @asynccontextmanager
+    async def acquire(self):
+        start = time.perf_counter()
+        async with self._semaphore:
+            self.max_acquire_wait = max(self.max_acquire_wait, time.perf_counter() - start)
+            yield self
+
+    async def fetchrow(self, *args):
+        return self._row
+
+    async def fetch(self, *args):
+        return [{"scope": "mantarray:base", "is_admin_scope": False}]
+
+    async def execute(self, *args):
+        pass
+
+
+@run_benchmark
+@pytest.mark.asyncio
+async def test_login_storm__does_not_exhaust_db_pool(mocker):
+    phash = PasswordHasher().hash(TEST_PASSWORD)
+    pool = passwords.PasswordHashingPool(
+        max_workers=2, max_pending=NUM_DB_POOL_LOGINS, password_hasher=PasswordHasher()
+    )
+    mocker.patch.object(main, "PASSWORD_HASHING_POOL", pool)
+
+    start = time.perf_counter()
+    await pool.verify(phash, TEST_PASSWORD)
+    verify_secs = time.perf_counter() - start
+
+    customer_id = uuid.uuid4()
+    db_pool = _DBPool(
+        DB_POOL_SIZE,
+        {
+            "password": phash,
+            "id": uuid.uuid4(),
+            "failed_login_attempts": 0,
+            "suspended": False,
+            "customer_id": customer_id,
+            "customer_suspended": False,
+        },
+    )
+    request = SimpleNamespace(state=SimpleNamespace(pgpool=db_pool))
+    details = UserLogin(customer_id=customer_id, username="test_user", password=TEST_PASSWORD)
+
+    # every login but the first few waits on the hashing pool, none of them should make other requests wait
+    # for a connection while they do
+    with request_cycle_context({}):
+        await asyncio.gather(*[main.login_user(request, details) for _ in range(NUM_DB_POOL_LOGINS)])
+    print(  # allow-print
+        f"{NUM_DB_POOL_LOGINS} logins with {DB_POOL_SIZE} DB connections: "
+        f"max acquire wait={db_pool.max_acquire_wait * 1000:.1f}ms, single verify={verify_secs * 1000:.1f}ms"
+    )
+
+    assert db_pool.max_acquire_wait < verify_secs
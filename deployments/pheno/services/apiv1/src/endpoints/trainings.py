@@ -14,13 +14,13 @@ from lib.models import *
 from lib.utils import format_name
 from lib.utils import RouteErrorHandler
 
-from utils.s3 import generate_presigned_url
-from utils.s3 import generate_presigned_post
-from utils.s3 import copy_s3_file
-from utils.s3 import copy_s3_directory
-from utils.s3 import generate_presigned_urls_for_dir
-from utils.s3 import download_file_from_s3
-from utils.s3 import upload_file_to_s3
+from utils.s3 import generate_presigned_url_async
+from utils.s3 import generate_presigned_post_async
+from utils.s3 import copy_s3_file_async
+from utils.s3 import copy_s3_directory_async
+from utils.s3 import generate_presigned_urls_for_dir_async
+from utils.s3 import download_file_from_s3_async
+from utils.s3 import upload_file_to_s3_async
 
 
 logging.basicConfig(format="%(asctime)s %(message)s", level=logging.INFO, datefmt="%Y-%m-%d %H:%M:%S")
@@ -43,7 +43,7 @@ async def get_all_trainings(selected_user_id: int, cur=Depends(get_cur)) -> List
     for training in trainings:
         try:
             key = f"trainings/{selected_user_id}/{training['study']}/{training['name']}/sample.jpg"
-            url = generate_presigned_url(bucket=PHENO_BUCKET, key=key, exp=5 * 60e3)
+            url = await generate_presigned_url_async(bucket=PHENO_BUCKET, key=key, exp=5 * 60e3)
             training.update({"sample_url": url})
         except Exception as e:
             logger.error(f"There was an error generating presigned url for {training}: {e}")
@@ -75,7 +75,7 @@ async def get_training_log(id: int, cur=Depends(get_cur)) -> Any:
     training = await cur.fetchrow("SELECT name, study, user_id FROM trainings WHERE id=$1", id)
     key = f"trainings/{training['user_id']}/{training['study']}/{training['name']}/{training['name']}.log"
 
-    return generate_presigned_url(bucket=PHENO_BUCKET, key=key, exp=5 * 60e3)
+    return await generate_presigned_url_async(bucket=PHENO_BUCKET, key=key, exp=5 * 60e3)
 
 
 @router.get(
@@ -86,7 +86,7 @@ async def get_training_results(id: int, cur=Depends(get_cur)) -> str:
     training = await cur.fetchrow("SELECT name, study, user_id FROM trainings WHERE id=$1", id)
     key = f"trainings/{training['user_id']}/{training['study']}/{training['name']}_out/"
 
-    return generate_presigned_urls_for_dir(bucket=PHENO_BUCKET, key_prefix=key)
+    return await generate_presigned_urls_for_dir_async(bucket=PHENO_BUCKET, key_prefix=key)
 
 
 @router.post("/updateParam/{id}", description="Updates value in training table")
@@ -157,7 +157,9 @@ async def upload_new_train_images(
 
         if idx == 0:  # upload an image as the sample image
             sample_img_key = f"trainings/{user_id}/{details.study_name}/{details.name}/sample.jpg"
-            upload_params = generate_presigned_post(PHENO_BUCKET, sample_img_key, details.md5s[idx])
+            upload_params = await generate_presigned_post_async(
+                PHENO_BUCKET, sample_img_key, details.md5s[idx]
+            )
             presigned_urls.append(upload_params)
 
         # upload class images
@@ -167,7 +169,7 @@ async def upload_new_train_images(
             else f"trainings/{user_id}/{details.study_name}/{details.name}/{details.name}/{details.val_or_train}/{details.class_name}/{img_name}"
         )
 
-        upload_params = generate_presigned_post(PHENO_BUCKET, key, details.md5s[idx])
+        upload_params = await generate_presigned_post_async(PHENO_BUCKET, key, details.md5s[idx])
         presigned_urls.append(upload_params)
 
     return presigned_urls
@@ -319,14 +321,14 @@ async def retrain_submit(
 
     source_key = f'trainings/{training["user_id"]}/{training["study"]}/{training["name"]}/sample.jpg'
     target_key = f'trainings/{details.user_id}/{training["study"]}/{retraining_name}/sample.jpg'
-    copy_s3_file(PHENO_BUCKET, source_key, target_key)
+    await copy_s3_file_async(PHENO_BUCKET, source_key, target_key)
 
     # copy original images over to new dir in s3
     source_prefix = (
         f'trainings/{training["user_id"]}/{training["study"]}/{training["name"]}/{training["name"]}/'
     )
     target_prefix = f'trainings/{details.user_id}/{training["study"]}/{retraining_name}/{retraining_name}/'
-    copy_s3_directory(PHENO_BUCKET, source_prefix, target_prefix)
+    await copy_s3_directory_async(PHENO_BUCKET, source_prefix, target_prefix)
 
     # TODO update job queue with new entry
 
@@ -349,7 +351,7 @@ async def plot_log(id: int, cur=Depends(get_cur)):
     with tempfile.TemporaryDirectory() as tmp_dir:
         key = f'trainings/{training["user_id"]}/{training["study"]}/{training["name"]}/{training["name"]}_out/progress.txt'
         file_path = os.path.join(tmp_dir, "progress.txt")
-        response = download_file_from_s3(PHENO_BUCKET, key, file_path)
+        response = await download_file_from_s3_async(PHENO_BUCKET, key, file_path)
 
         if response != 404:
             with open(file_path, "r") as progress_file:
@@ -392,7 +394,7 @@ async def generate_patch_examples(id: int, cur=Depends(get_cur)) -> List[str]:
     training = await cur.fetchrow("SELECT name, study, user_id, classnames FROM trainings WHERE id=$1", id)
 
     key_prefix = f'trainings/{training["user_id"]}/{training["study"]}/{training["name"]}/{training["name"]}_patches/Val/'
-    presigned_urls = generate_presigned_urls_for_dir(PHENO_BUCKET, key_prefix)
+    presigned_urls = await generate_presigned_urls_for_dir_async(PHENO_BUCKET, key_prefix)
 
     return presigned_urls  # reminder that this will return an empty array if no patch images are found
 
@@ -412,7 +414,7 @@ async def start_blind_score(id: int, cur=Depends(get_cur)):
 
     with tempfile.TemporaryDirectory() as tmp_dir:
         file_path = os.path.join(tmp_dir, f"{training['name']}.csv")
-        response = download_file_from_s3(PHENO_BUCKET, key, file_path)
+        response = await download_file_from_s3_async(PHENO_BUCKET, key, file_path)
 
         if response != 404:
             df = pd.read_csv(file_path, delimiter=",")
@@ -440,7 +442,7 @@ async def generate_images_to_score(id: int, cur=Depends(get_cur)):
     with tempfile.TemporaryDirectory() as tmp_dir:
         file_path = os.path.join(tmp_dir, f"{training['name']}.csv")
         key = f'trainings/{training["user_id"]}/{training["study"]}/{training["name"]}/{training["name"]}_out/{training["name"]}.csv'
-        response = download_file_from_s3(PHENO_BUCKET, key, file_path)
+        response = await download_file_from_s3_async(PHENO_BUCKET, key, file_path)
 
         if response != 404:
             df = pd.read_csv(file_path, delimiter=",")
@@ -455,7 +457,7 @@ async def generate_images_to_score(id: int, cur=Depends(get_cur)):
 
     # get val images from s3 and check against filenames
     key = f'trainings/{training["user_id"]}/{training["study"]}/{training["name"]}/{training["name"]}/'
-    obj_keys = generate_presigned_urls_for_dir(PHENO_BUCKET, key, True)
+    obj_keys = await generate_presigned_urls_for_dir_async(PHENO_BUCKET, key, True)
 
     # get only val images that match filenames list
     obj_keys = [key for key in obj_keys if os.path.basename(key) in filenames]
@@ -463,7 +465,7 @@ async def generate_images_to_score(id: int, cur=Depends(get_cur)):
     # randomize keys
     shuffle(obj_keys)
     # get presigned urls
-    urls = [generate_presigned_url(PHENO_BUCKET, key) for key in obj_keys]
+    urls = [await generate_presigned_url_async(PHENO_BUCKET, key) for key in obj_keys]
     # this check is in the original route, just in case
     if len(urls) == 0:
         return JSONResponse(
@@ -493,7 +495,7 @@ async def process_blind_score_results(id: int, cur=Depends(get_cur)):
     training = await cur.fetchrow("SELECT name, classnames, user_id, study FROM trainings WHERE id=$1", id)
 
     key = f'trainings/{training["user_id"]}/{training["study"]}/{training["name"]}/{training["study"]}_out/{training["study"]}_blindscore.csv'
-    presigned_url = generate_presigned_url(PHENO_BUCKET, key)
+    presigned_url = await generate_presigned_url_async(PHENO_BUCKET, key)
 
     return presigned_url
 
@@ -518,7 +520,7 @@ async def process_blind_score_results(id: int, details: Blindscore_request_model
 
         file_path = os.path.join(tmp_dir, f'{training["name"]}.csv')
         key = f'trainings/{training["user_id"]}/{training["study"]}/{training["name"]}/{training["name"]}_out/{training["name"]}.csv'
-        response = download_file_from_s3(PHENO_BUCKET, key, file_path)
+        response = await download_file_from_s3_async(PHENO_BUCKET, key, file_path)
 
         if response != 404:
             df = pd.read_csv(file_path, delimiter=",")
@@ -569,7 +571,7 @@ async def process_blind_score_results(id: int, details: Blindscore_request_model
         # upload csv file to s3
         logger.info(f"Uploading {csv_filename}: {response}")
         key = f"trainings/{training['user_id']}/{training['study']}/{training['name']}/{training['name']}_out/{training['name']}_blindscore.csv"
-        upload_file_to_s3(PHENO_BUCKET, key, csv_filepath)
+        await upload_file_to_s3_async(PHENO_BUCKET, key, csv_filepath)
 
     return Blindscore_response_model(
         net_score=net_score,
@@ -8,10 +8,13 @@ from asynctest import CoroutineMock
 
 ROOT_DIR = os.path.dirname(os.path.abspath("src"))
 sys.path.insert(0, os.path.join(ROOT_DIR, "src"))
+# S3 is mocked per test, so objects found to exist in one test shouldn't be remembered in others
+os.environ["S3_EXISTENCE_CACHE_MAX_SIZE"] = "0"
 
 from main import app
 from lib.db import Database
 from lib.db import get_cur
+from utils.s3 import get_s3_client
 
 
 @pytest.fixture
@@ -26,12 +29,10 @@ def mock_cursor():
 
 @pytest.fixture
 def mock_s3_client(mocker):
-    return mocker.patch.object(boto3, "client", autospec=True)
-
-
-@pytest.fixture
-def mock_s3_resource(mocker):
-    return mocker.patch.object(boto3, "resource", autospec=True)
+    # the S3 client is cached, so make sure the mocked client is the one that gets used, and isn't used by other tests
+    get_s3_client.cache_clear()
+    yield mocker.patch.object(boto3, "client", autospec=True)
+    get_s3_client.cache_clear()
 
 
 @pytest.fixture
@@ -1,9 +1,7 @@
 from copy import deepcopy
 import pytest
-import boto3
 import json
 from freezegun import freeze_time
-from unittest.mock import MagicMock
 
 from src.endpoints import trainings
 from src.lib import *
@@ -140,11 +138,11 @@ def test_get_filtered_trainings__(client, mock_cursor):
 
 
 #  download log
-def test_download_log__returns_presigned_url(client, mock_s3_client, mock_s3_resource, mock_cursor):
+def test_download_log__returns_presigned_url(client, mock_s3_client, mock_cursor):
     test_url = "www.test_url.com"
 
     mock_cursor.fetchrow.return_value = MOCK_TRAINING_DB_RETURN_DICT
-    mock_s3_resource.return_value.Object.return_value.load.return_value = True
+    mock_s3_client.return_value.head_object.return_value = {}
     mock_s3_client.return_value.generate_presigned_url.return_value = test_url
 
     # make request
@@ -155,17 +153,14 @@ def test_download_log__returns_presigned_url(client, mock_s3_client, mock_s3_res
 
 
 # download results
-def test_download_results__returns_presigned_url_for_directory(
-    client, mock_s3_client, mock_cursor, mock_s3_resource
-):
-    test_obj = MagicMock()
-    test_obj.key = "test"
-
+def test_download_results__returns_presigned_url_for_directory(client, mock_s3_client, mock_cursor):
     test_url = "www.test_url.com"
     mock_cursor.fetchrow.return_value = MOCK_TRAINING_DB_RETURN_DICT
 
-    mock_s3_resource.return_value.Object.return_value.load.return_value = True
-    mock_s3_resource.return_value.Bucket.return_value.objects.filter.return_value = [test_obj] * 10
+    mock_s3_client.return_value.head_object.return_value = {}
+    mock_s3_client.return_value.get_paginator.return_value.paginate.return_value = [
+        {"Contents": [{"Key": "test"}] * 10}
+    ]
 
     mock_s3_client.return_value.generate_presigned_url.return_value = test_url
 
@@ -498,10 +493,8 @@ def test_retrain_submit__skips_review_based_on_user_type(
     whichuser,
     mocker,
     mock_cursor,
+    mock_s3_client,
 ):
-    # mock s3 copy
-    mocker.patch.object(boto3, "resource", autospec=True)
-
     copy_retrain_params = deepcopy(test_retrain_params)
     copy_retrain_params["whichuser"] = whichuser
 
@@ -515,11 +508,7 @@ def test_retrain_submit__skips_review_based_on_user_type(
 
 
 @freeze_time("2022-01-01")
-def test_retrain_submit__assert_files_get_copied_correctly_in_s3(
-    client, mocker, mock_cursor, mock_s3_resource
-):
-    # mock s3 copy
-    spied_copy = mocker.spy(mock_s3_resource.return_value.meta.client, "copy")
+def test_retrain_submit__assert_files_get_copied_correctly_in_s3(client, mock_cursor, mock_s3_client):
 
     mock_cursor.fetchrow.return_value = MOCK_TRAINING_DB_RETURN_DICT
 
@@ -534,7 +523,7 @@ def test_retrain_submit__assert_files_get_copied_correctly_in_s3(
     }
     target = f"trainings/10/study_name/RE-10-2022-01-01-000000/sample.jpg"
 
-    spied_copy.assert_called_with(sample_src, "phenolearn", target)
+    mock_s3_client.return_value.copy.assert_called_with(sample_src, "phenolearn", target)
 
 
 def test_retrain_submit__returns_500_error_to_catch_all_other_exceptions(client, mock_cursor):
@@ -548,7 +537,7 @@ def test_retrain_submit__returns_500_error_to_catch_all_other_exceptions(client,
 
 # test plot log
 def test_plot_log__returns_dict_of_parsed_vals_from_file_downloaded_from_s3(
-    client, mocker, mock_cursor, mock_s3_resource, mock_s3_client
+    client, mocker, mock_cursor, mock_s3_client
 ):
     mock_cursor.fetchrow.return_value = MOCK_TRAINING_DB_RETURN_DICT
 
@@ -556,7 +545,7 @@ def test_plot_log__returns_dict_of_parsed_vals_from_file_downloaded_from_s3(
     mocked_tf = mocker.patch.object(trainings.tempfile, "TemporaryDirectory", autospec=True)
     mocked_tf.return_value.__enter__.return_value = "tests/trainings/training_test_files"
 
-    mock_s3_resource.return_value.Object.return_value.load.return_value = True
+    mock_s3_client.return_value.head_object.return_value = {}
     mock_s3_client.return_value.download_file.return_value = None
 
     response = client.get("/train/plotLog/1")
@@ -630,19 +619,16 @@ def test_plot_log__returns_not_found_error_if_progress_file_does_not_exist(clien
 
 
 # generate patch examples
-def test_generate_patch_ex__returns_list_of_presigned_urls(
-    client, mock_cursor, mock_s3_resource, mock_s3_client
-):
-    test_obj = MagicMock()
-    test_obj.key = "test"
-
+def test_generate_patch_ex__returns_list_of_presigned_urls(client, mock_cursor, mock_s3_client):
     test_url = "www.test_url.com"
     test_urls = [test_url] * 10
     mock_cursor.fetchrow.return_value = MOCK_TRAINING_DB_RETURN_DICT
 
     # mock s3 return values to generate presigned urls
-    mock_s3_resource.return_value.Object.return_value.load.return_value = True
-    mock_s3_resource.return_value.Bucket.return_value.objects.filter.return_value = [test_obj] * 10
+    mock_s3_client.return_value.head_object.return_value = {}
+    mock_s3_client.return_value.get_paginator.return_value.paginate.return_value = [
+        {"Contents": [{"Key": "test"}] * 10}
+    ]
     mock_s3_client.return_value.generate_presigned_url.return_value = test_url
 
     response = client.get("/train/generatePatchExamples/1")
@@ -652,14 +638,14 @@ def test_generate_patch_ex__returns_list_of_presigned_urls(
 
 # start blind score
 def test_start_blind_score__returns_number_of_val_images_from_csv_file(
-    client, mock_cursor, mocker, mock_s3_resource, mock_s3_client
+    client, mock_cursor, mocker, mock_s3_client
 ):
     copied_return_dict = deepcopy(MOCK_TRAINING_DB_RETURN_DICT)
     copied_return_dict["name"] = "TR-1-2022-01-01-120000"
     mock_cursor.fetchrow.return_value = copied_return_dict
 
     # mock to return test s3 file to use for testing
-    mock_s3_resource.return_value.Object.return_value.load.return_value = True
+    mock_s3_client.return_value.head_object.return_value = {}
     mock_s3_client.return_value.download_file.return_value = None
     mocked_tf = mocker.patch.object(trainings.tempfile, "TemporaryDirectory", autospec=True)
     mocked_tf.return_value.__enter__.return_value = "tests/trainings/training_test_files"
@@ -671,14 +657,14 @@ def test_start_blind_score__returns_number_of_val_images_from_csv_file(
 
 @pytest.mark.parametrize("route", ["/train/startBlindScore/1", "/train/generateImagesToScore/1"])
 def test_csv_routes__returns_404_not_found_if_no_csv_file_is_found(
-    client, mock_cursor, mocker, mock_s3_resource, route
+    client, mock_cursor, mocker, mock_s3_client, route
 ):
     copied_return_dict = deepcopy(MOCK_TRAINING_DB_RETURN_DICT)
     copied_return_dict["name"] = "TR-1-2022-01-01-120000"
     mock_cursor.fetchrow.return_value = copied_return_dict
 
     # mock to return test s3 file to use for testing
-    mock_s3_resource.return_value.Object.return_value.load.side_effect = Exception()
+    mock_s3_client.return_value.head_object.side_effect = Exception()
     mocked_tf = mocker.patch.object(trainings.tempfile, "TemporaryDirectory", autospec=True)
     mocked_tf.return_value.__enter__.return_value = "tests/trainings/training_test_files"
 
@@ -690,7 +676,7 @@ def test_csv_routes__returns_404_not_found_if_no_csv_file_is_found(
 
 # generate images to score
 def test_generate_images_to_score__returns_number_of_val_images_from_csv_file(
-    client, mock_cursor, mocker, mock_s3_resource, mock_s3_client
+    client, mock_cursor, mocker, mock_s3_client
 ):
     copied_return_dict = deepcopy(MOCK_TRAINING_DB_RETURN_DICT)
     copied_return_dict["name"] = "TR-1-2022-01-01-120000"
@@ -709,13 +695,11 @@ def test_generate_images_to_score__returns_number_of_val_images_from_csv_file(
         "Train/12mon_train_1001_c5e7e7e2_f7d39346.png",
     ]
 
-    test_objs = [MagicMock() for _ in range(8)]
-    for idx, obj in enumerate(test_objs):
-        obj.key = expected_s3_objs[idx]
+    test_objs = [{"Key": key} for key in expected_s3_objs]
 
     # mock s3 return values to generate presigned urls
-    mock_s3_resource.return_value.Object.return_value.load.return_value = True
-    mock_s3_resource.return_value.Bucket.return_value.objects.filter.return_value = test_objs
+    mock_s3_client.return_value.head_object.return_value = {}
+    mock_s3_client.return_value.get_paginator.return_value.paginate.return_value = [{"Contents": test_objs}]
     mock_s3_client.return_value.generate_presigned_url.return_value = test_url
 
     # redirect to test csc file
@@ -733,20 +717,18 @@ def test_generate_images_to_score__returns_number_of_val_images_from_csv_file(
 
 
 def test_generate_images_to_score__returns_404_if_no_presigned_urls_are_returned(
-    client, mock_cursor, mocker, mock_s3_resource, mock_s3_client
+    client, mock_cursor, mocker, mock_s3_client
 ):
     copied_return_dict = deepcopy(MOCK_TRAINING_DB_RETURN_DICT)
     copied_return_dict["name"] = "TR-1-2022-01-01-120000"
     copied_return_dict["classnames"] = "6_mon,12_mon"
     mock_cursor.fetchrow.return_value = copied_return_dict
 
-    test_objs = [MagicMock() for _ in range(8)]
-    for obj in test_objs:
-        obj.key = ""
+    test_objs = [{"Key": ""} for _ in range(8)]
 
     # mock s3 return values to generate presigned urls
-    mock_s3_resource.return_value.Object.return_value.load.return_value = True
-    mock_s3_resource.return_value.Bucket.return_value.objects.filter.return_value = test_objs
+    mock_s3_client.return_value.head_object.return_value = {}
+    mock_s3_client.return_value.get_paginator.return_value.paginate.return_value = [{"Contents": test_objs}]
     mock_s3_client.return_value.generate_presigned_url.return_value = None
 
     # redirect to test csc file
@@ -761,11 +743,11 @@ def test_generate_images_to_score__returns_404_if_no_presigned_urls_are_returned
 
 # get blind score results
 def test_get_blind_score_results__returns_presigned_url_for_blindscore_csv(
-    client, mock_cursor, mock_s3_resource, mock_s3_client
+    client, mock_cursor, mock_s3_client
 ):
     test_url = "www.test_url.com"
     mock_cursor.fetchrow.return_value = MOCK_TRAINING_DB_RETURN_DICT
-    mock_s3_resource.return_value.Object.return_value.load.return_value = True
+    mock_s3_client.return_value.head_object.return_value = {}
     mock_s3_client.return_value.generate_presigned_url.return_value = test_url
 
     response = client.get("/train/getBlindScoreResults/1")
@@ -774,7 +756,7 @@ def test_get_blind_score_results__returns_presigned_url_for_blindscore_csv(
 
 
 def test_process_blind_score_results__uploads_new_csv_to_s3_and_returns_net_scores(
-    mocker, client, mock_cursor, mock_s3_resource, mock_s3_client
+    mocker, client, mock_cursor, mock_s3_client
 ):
     copied_return_dict = deepcopy(MOCK_TRAINING_DB_RETURN_DICT)
     copied_return_dict["name"] = "TR-1-2022-01-01-120000"
@@ -782,7 +764,7 @@ def test_process_blind_score_results__uploads_new_csv_to_s3_and_returns_net_scor
     mock_cursor.fetchrow.return_value = copied_return_dict
 
     # mock open in download_file_from_s3 util to return with no error
-    mock_s3_resource.return_value.Object.return_value.load.return_value = True
+    mock_s3_client.return_value.head_object.return_value = {}
     mock_s3_client.return_value.download_file.return_value = None
 
     # redirect to test csc file
@@ -814,10 +796,10 @@ def test_process_blind_score_results__uploads_new_csv_to_s3_and_returns_net_scor
 
 
 def test_process_blind_score_results__returns_404_not_found_if_no_csv_file_is_found(
-    client, mock_cursor, mock_s3_resource
+    client, mock_cursor, mock_s3_client
 ):
     # mock to return test s3 file to use for testing
-    mock_s3_resource.return_value.Object.return_value.load.side_effect = Exception()
+    mock_s3_client.return_value.head_object.side_effect = Exception()
     mock_cursor.fetchrow.return_value = MOCK_TRAINING_DB_RETURN_DICT
 
     details = {
@@ -26,6 +26,11 @@ PULSE3D_UPLOADS_BUCKET = config("UPLOADS_BUCKET_ENV", cast=str, default="test-pu
 MANTARRAY_LOGS_BUCKET = config("MANTARRAY_LOGS_BUCKET_ENV", cast=str, default="test-mantarray-logs")
 PRIVATE_DOWNLOADS_BUCKET = config("PRIVATE_DOWNLOADS_BUCKET_ENV", cast=str)
 
+# version of the worker that builds download bundles, the queue processor starts workers with this image tag
+DOWNLOAD_BUNDLE_WORKER_VERSION = config("DOWNLOAD_BUNDLE_WORKER_VERSION", cast=str, default="0.1.0")
+# the download-bundles namespace needs the queue processor and worker creds sealed before this can be turned on
+DOWNLOAD_BUNDLES_ENABLED = config("DOWNLOAD_BUNDLES_ENABLED", cast=bool, default=False)
+
 DATABASE_URL = config(
     "DATABASE_URL",
     cast=str,
@@ -1,9 +1,11 @@
+import asyncio
+import base64
 from contextlib import asynccontextmanager
 from collections import defaultdict
 from datetime import datetime, timezone
+import io
 import json
 import os
-import tempfile
 import time
 from typing import Any
 import uuid
@@ -25,8 +27,14 @@ from fastapi import Depends, FastAPI, HTTPException, Query, Request, Response, s
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
 from jobs import (
+    DEFAULT_JOB_PRIORITY,
+    INTERACTIVE_JOB_PRIORITY,
+    JOB_SORT_FIELDS,
+    UPLOAD_SORT_FIELDS,
+    InvalidCursor,
     check_customer_pulse3d_usage,
     create_analysis_preset,
+    create_download_bundle,
     create_job,
     create_upload,
     delete_jobs,
@@ -50,6 +58,8 @@ from jobs import (
     get_jobs_info_for_base_user,
     get_jobs_info_for_rw_all_data_user,
     get_jobs_info_for_admin,
+    get_next_cursor,
+    get_download_bundle,
 )
 from curibio_analysis_lib import DataTypes, TwitchMetrics, get_metric_display_title
 from pulse3D.peak_finding.constants import (
@@ -63,17 +73,19 @@ from stream_zip import stream_zip
 from starlette_context import context, request_cycle_context
 from structlog.contextvars import bind_contextvars, clear_contextvars
 from utils.db import AsyncpgPoolDep
+from utils.metrics import start_metrics_server
 from utils.email import FastMailClient
 from utils.logging import setup_logger, bind_context_to_logger
 from utils.s3 import (
     S3Error,
-    generate_presigned_post,
-    generate_multipart_upload_urls,
-    complete_multipart_upload,
-    abort_multipart_upload,
+    generate_presigned_post_async,
+    generate_multipart_upload_urls_async,
+    generate_upload_part_urls_async,
+    complete_multipart_upload_async,
+    abort_multipart_upload_async,
     MULTIPART_UPLOAD_TIMEOUT_HRS,
-    generate_presigned_url,
-    upload_file_to_s3,
+    generate_presigned_url_async,
+    upload_bytes_to_s3_async,
     yield_s3_objects,
 )
 from uvicorn.protocols.utils import get_path_with_query_string
@@ -84,11 +96,14 @@ from core.config import (
     CURIBIO_SUPPORT_EMAIL,
     DASHBOARD_URL,
     DATABASE_URL,
+    DOWNLOAD_BUNDLE_WORKER_VERSION,
+    DOWNLOAD_BUNDLES_ENABLED,
     MANTARRAY_LOGS_BUCKET,
     PULSE3D_UPLOADS_BUCKET,
     PRIVATE_DOWNLOADS_BUCKET,
 )
 from models.models import (
+    DownloadBundleResponse,
     GenericErrorResponse,
     JobDownloadRequest,
     JobRequest,
@@ -103,6 +118,8 @@ from models.models import (
     UploadDownloadRequest,
     UploadRequest,
     UploadResponse,
+    MultipartUploadPartsRequest,
+    MultipartUploadPartsResponse,
     MultipartUploadRequest,
     MultipartUploadResponse,
     CompleteMultipartUploadRequest,
@@ -113,7 +130,7 @@ from models.models import (
     WaveformDataResponse,
     GetJobsRequest,
 )
-from models.types import TupleParam
+from models.types import Number, TupleParam
 from repository.notification_repository import NotificationRepository
 from service.notification_service import NotificationService
 
@@ -121,7 +138,7 @@ setup_logger()
 logger = structlog.stdlib.get_logger("api.access")
 
 
-asyncpg_pool = AsyncpgPoolDep(dsn=DATABASE_URL)
+asyncpg_pool = AsyncpgPoolDep(dsn=DATABASE_URL, name="pulse3d")
 email_client = FastMailClient(
     mail_username=CURIBIO_EMAIL, mail_password=CURIBIO_EMAIL_PASSWORD, template_folder="./templates"
 )
@@ -130,6 +147,7 @@ notification_service: NotificationService
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    start_metrics_server()
     global notification_service
     notification_service = NotificationService(NotificationRepository(await asyncpg_pool()))
     scheduler.add_job(
@@ -152,6 +170,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 
@@ -206,7 +225,9 @@ async def handle_expired_multipart_uploads():
                 upload_id = row["id"]
                 try:
                     s3_key = f"{row['prefix']}/{row['filename']}"
-                    abort_multipart_upload(PULSE3D_UPLOADS_BUCKET, s3_key, row["multipart_upload_id"])
+                    await abort_multipart_upload_async(
+                        PULSE3D_UPLOADS_BUCKET, s3_key, row["multipart_upload_id"]
+                    )
                 except Exception:
                     logger.exception(f"Failed to abort multipart upload for upload ID: {upload_id}")
                 else:
@@ -227,11 +248,13 @@ async def handle_expired_multipart_uploads():
 @app.get("/uploads")
 async def get_uploads_info(
     request: Request,
+    response: Response,
     upload_type: str | None = Query(None),
     sort_field: str | None = Query(None),
     sort_direction: str | None = Query(None),
     skip: int = Query(0),
     limit: int = Query(300),
+    cursor: str | None = Query(None),
     token=Depends(ProtectedAny(tag=ScopeTags.PULSE3D_READ)),
 ):
     if token.account_type == "user" and upload_type not in get_product_tags_of_user(token.scopes):
@@ -255,7 +278,7 @@ async def get_uploads_info(
         bind_context_to_logger({"user_id": token.userid, "customer_id": token.customer_id})
 
         async with request.state.pgpool.acquire() as con:
-            return await _get_uploads(
+            uploads = await _get_uploads(
                 con=con,
                 token=token,
                 upload_type=upload_type,
@@ -263,9 +286,22 @@ async def get_uploads_info(
                 sort_direction=sort_direction,
                 skip=skip,
                 limit=limit,
+                cursor=cursor,
                 **filters,
             )
 
+        if next_cursor := get_next_cursor(
+            uploads,
+            sort_fields=UPLOAD_SORT_FIELDS,
+            sort_field=sort_field,
+            sort_direction=sort_direction,
+            limit=limit,
+        ):
+            response.headers["X-Next-Cursor"] = next_cursor
+
+        return uploads
+    except InvalidCursor as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
     except Exception:
         logger.exception("Failed to get uploads")
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -316,7 +352,7 @@ async def create_recording_upload(
             # then the new upload row won't be committed
             async with con.transaction():
                 upload_id = await create_upload(con=con, upload_params=upload_params)
-                params = _generate_presigned_post(details, PULSE3D_UPLOADS_BUCKET, s3_key)
+                params = await _generate_presigned_post(details, PULSE3D_UPLOADS_BUCKET, s3_key)
                 return UploadResponse(id=upload_id, params=params)
     except ProhibitedProductError:
         logger.exception(f"User does not have permission to upload {upload_type} recordings")
@@ -370,7 +406,7 @@ async def create_recording_upload_multipart(
             if usage_quota["uploads_reached"]:
                 return GenericErrorResponse(message=usage_quota, error="UsageError")
 
-            (multipart_upload_id, urls) = _generate_multipart_upload_urls(
+            (multipart_upload_id, urls) = await _generate_multipart_upload_urls(
                 details, PULSE3D_UPLOADS_BUCKET, s3_prefix
             )
             upload_params["multipart_upload_id"] = multipart_upload_id
@@ -388,6 +424,46 @@ async def create_recording_upload_multipart(
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+@app.post("/uploads/multipart/parts", response_model=MultipartUploadPartsResponse)
+async def get_recording_upload_multipart_part_urls(
+    request: Request,
+    details: MultipartUploadPartsRequest,
+    token=Depends(ProtectedAny(tag=ScopeTags.PULSE3D_WRITE)),
+):
+    """Sign upload URLs for the next window of parts of an in-progress multipart upload."""
+    try:
+        user_id = str(uuid.UUID(token.userid))
+
+        bind_context_to_logger({"user_id": user_id, "upload_id": str(details.id)})
+
+        async with request.state.pgpool.acquire() as con:
+            row = await con.fetchrow(
+                "SELECT prefix, filename, multipart_upload_id FROM uploads "
+                "WHERE user_id=$1 AND id=$2 AND multipart_upload_id IS NOT NULL",
+                user_id,
+                details.id,
+            )
+        if not row:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+
+        urls = await generate_upload_part_urls_async(
+            PULSE3D_UPLOADS_BUCKET,
+            f"{row['prefix']}/{row['filename']}",
+            row["multipart_upload_id"],
+            details.md5s_parts,
+            first_part_num=details.first_part_num,
+        )
+        return MultipartUploadPartsResponse(urls=urls)
+    except HTTPException:
+        raise
+    except S3Error:
+        logger.exception("Error generating multipart upload part urls")
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST)
+    except Exception:
+        logger.exception("Error generating multipart upload part urls")
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
 @app.put("/uploads/multipart/complete", status_code=status.HTTP_204_NO_CONTENT)
 async def complete_recording_upload_multipart(
     request: Request,
@@ -411,7 +487,7 @@ async def complete_recording_upload_multipart(
                     user_id,
                     details.id,
                 )
-                complete_multipart_upload(
+                await complete_multipart_upload_async(
                     PULSE3D_UPLOADS_BUCKET, s3_key, row["multipart_upload_id"], details.parts
                 )
     except S3Error:
@@ -440,7 +516,9 @@ async def abort_recording_upload_multipart(
                     details.id,
                 )
                 s3_key = f"{rows[0]['prefix']}/{rows[0]['filename']}"
-                abort_multipart_upload(PULSE3D_UPLOADS_BUCKET, s3_key, rows[0]["multipart_upload_id"])
+                await abort_multipart_upload_async(
+                    PULSE3D_UPLOADS_BUCKET, s3_key, rows[0]["multipart_upload_id"]
+                )
     except S3Error:
         logger.exception("Error aborting multipart upload")
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST)
@@ -515,7 +593,10 @@ async def download_uploads(
 
         if len(upload_ids) == 1:
             # if only one file requested, return single presigned URL
-            return {"filename": filenames[0], "url": generate_presigned_url(PULSE3D_UPLOADS_BUCKET, keys[0])}
+            return {
+                "filename": filenames[0],
+                "url": await generate_presigned_url_async(PULSE3D_UPLOADS_BUCKET, keys[0]),
+            }
         else:
             # Grab ZIP file from in-memory, make response with correct MIME-type
             return StreamingResponse(
@@ -542,7 +623,7 @@ async def create_log_upload(
 
         bind_context_to_logger({"customer_id": customer_id, "user_id": user_id})
 
-        params = _generate_presigned_post(details, MANTARRAY_LOGS_BUCKET, s3_key)
+        params = await _generate_presigned_post(details, MANTARRAY_LOGS_BUCKET, s3_key)
         return UploadResponse(params=params)
     except S3Error:
         logger.exception("Error creating log upload")
@@ -580,6 +661,7 @@ async def get_jobs_info(
 @app.get("/jobs")
 async def get_info_of_jobs(
     request: Request,
+    response: Response,
     model: GetJobsRequest = Depends(),
     token=Depends(ProtectedAny(tag=ScopeTags.PULSE3D_READ)),
 ):
@@ -593,9 +675,22 @@ async def get_info_of_jobs(
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid product type")
 
         async with request.state.pgpool.acquire() as con:
-            return await _get_jobs_info(con, token, **model.model_dump(exclude_none=True))
+            jobs = await _get_jobs_info(con, token, **model.model_dump(exclude_none=True))
+
+        if next_cursor := get_next_cursor(
+            jobs,
+            sort_fields=JOB_SORT_FIELDS,
+            sort_field=model.sort_field,
+            sort_direction=model.sort_direction,
+            limit=model.limit,
+        ):
+            response.headers["X-Next-Cursor"] = next_cursor
+
+        return jobs
     except HTTPException:
         raise
+    except InvalidCursor as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
     except Exception:
         logger.exception("Failed to get jobs")
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -635,7 +730,9 @@ async def _legacy_get_info_of_jobs(request: Request, job_ids: list[uuid.UUID] |
                 if obj_key:
                     logger.info(f"Generating presigned download url for {obj_key}")
                     try:
-                        job_info["url"] = generate_presigned_url(PULSE3D_UPLOADS_BUCKET, obj_key)
+                        job_info["url"] = await generate_presigned_url_async(
+                            PULSE3D_UPLOADS_BUCKET, obj_key, verify=False
+                        )
                     except Exception:
                         logger.exception(f"Error generating presigned url for {obj_key}")
                         job_info["url"] = "Error creating download link"
@@ -772,7 +869,9 @@ async def create_new_job(
 
         logger.info(f"Using v{details.version} with params: {analysis_params}")
 
-        priority = 10
+        # interactive analysis re-runs go in the fast lane
+        priority = INTERACTIVE_JOB_PRIORITY if details.peaks_valleys else DEFAULT_JOB_PRIORITY
+
         async with request.state.pgpool.acquire() as con:
             # first check user_id of upload matches user_id in token
             # Luci (12/14/2022) checking separately here because the only other time it's checked is in the pulse3d-worker, we want to catch it here first if it's unauthorized and not checking in create_job to make it universal to all services, not just pulse3d
@@ -822,7 +921,24 @@ async def create_new_job(
             if details.name_override and pulse3d_semver >= "0.32.2":
                 job_meta["name_override"] = details.name_override
 
-            # finally create job
+        pv_parquet = None
+        if details.peaks_valleys:
+            # only added during interactive analysis. Built once the request has been checked, and without holding a
+            # DB connection, since this can take a while for long recordings
+            pv_parquet = await asyncio.to_thread(
+                _create_peaks_valleys_parquet, details, pulse3d_semver, peak_valley_diff
+            )
+
+        # the job ID is generated here so that the peaks and valleys can be uploaded before the job is created. This way
+        # the job is never visible to workers without them, and no DB connection is held during the upload
+        job_id = uuid.uuid4()
+        if pv_parquet is not None:
+            key = f"uploads/{customer_id}/{original_upload_user}/{upload_id}/{job_id}/peaks_valleys.parquet"
+            logger.info(f"Peaks and valleys found in job request, uploading to s3: {key}")
+            # upload to s3 under upload id and job id for pulse3d-worker to use
+            await upload_bytes_to_s3_async(bucket=PULSE3D_UPLOADS_BUCKET, key=key, contents=pv_parquet)
+
+        async with request.state.pgpool.acquire() as con:
             job_id = await create_job(
                 con=con,
                 upload_id=upload_id,
@@ -831,6 +947,7 @@ async def create_new_job(
                 meta=job_meta,
                 customer_id=customer_id,
                 job_type=upload_type,
+                job_id=job_id,
             )
 
             bind_context_to_logger({"job_id": str(job_id)})
@@ -854,28 +971,6 @@ async def create_new_job(
                     else customer_row["expiration_date"].strftime("%B %-d, %Y")
                 )
 
-            # Luci (12/1/22): this happens after the job is already created to have access to the job id, hopefully this doesn't cause any issues with the job starting before the file is uploaded to s3
-            if details.peaks_valleys:
-                key = (
-                    f"uploads/{customer_id}/{original_upload_user}/{upload_id}/{job_id}/peaks_valleys.parquet"
-                )
-                logger.info(f"Peaks and valleys found in job request, uploading to s3: {key}")
-
-                # only added during interactive analysis
-                with tempfile.TemporaryDirectory() as tmpdir:
-                    pv_parquet_path = os.path.join(tmpdir, "peaks_valleys.parquet")
-
-                    if pulse3d_semver >= "1.0.0":
-                        features_df = _create_features_df(
-                            details.timepoints, details.peaks_valleys, peak_valley_diff
-                        )
-                    else:
-                        features_df = _create_legacy_features_df(details.peaks_valleys, peak_valley_diff)
-                    # write peaks and valleys to parquet file in temporary directory
-                    features_df.write_parquet(pv_parquet_path)
-                    # upload to s3 under upload id and job id for pulse3d-worker to use
-                    upload_file_to_s3(bucket=PULSE3D_UPLOADS_BUCKET, key=key, file=pv_parquet_path)
-
         if email_content:
             await _send_account_email(
                 emails=[email_content["email"], CURIBIO_SUPPORT_EMAIL],
@@ -952,43 +1047,16 @@ async def download_analyses(
         async with request.state.pgpool.acquire() as con:
             jobs = await _get_jobs_download(con, token, upload_type=details.upload_type, job_ids=job_ids)
 
-        num_times_repeated = defaultdict(lambda: 0)
-
-        filename_overrides = list()
-        keys = list()
-
-        for job in jobs:
-            obj_key = job["object_key"]
-            keys.append(obj_key)
-
-            filename = os.path.basename(obj_key)
-
-            filename_override = filename
-            if details.timezone:
-                try:
-                    timestamp = job["created_at"]
-                    timestamp = timestamp.astimezone(ZoneInfo(details.timezone)).strftime("%Y-%m-%d_%H-%M-%S")
-                    filename_override = _add_timestamp_to_filename(obj_key.split("/")[-1], timestamp)
-                except Exception:
-                    logger.exception(
-                        f"Error appending local timestamp download name: {filename=}, timezone={details.timezone} utc_timestamp={job.get('created_at')}"
-                    )
-
-            if filename_override in filename_overrides:
-                num_times_repeated[filename_override] += 1
-                duplicate_num = num_times_repeated[filename_override]
-                # add duplicate num to differentiate duplicate filenames
-                root, ext = os.path.splitext(filename_override)
-                filename_override = f"{root}_({duplicate_num}){ext}"
-
-            filename_overrides.append(filename_override)
+        keys = [job["object_key"] for job in jobs]
+        filename_overrides = _get_job_download_filenames(jobs, details.timezone)
 
         if len(jobs) == 1:
             # if only one file requested, return single presigned URL
             return {
                 "id": jobs[0]["id"],
-                "url": generate_presigned_url(
-                    PULSE3D_UPLOADS_BUCKET, keys[0], filename_override=filename_overrides[0]
+                # object_key is only set once the worker has uploaded the output, so no need to check that it exists
+                "url": await generate_presigned_url_async(
+                    PULSE3D_UPLOADS_BUCKET, keys[0], filename_override=filename_overrides[0], verify=False
                 ),
             }
         else:
@@ -1005,6 +1073,162 @@ async def download_analyses(
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+@app.post("/uploads/download/bundle", response_model=DownloadBundleResponse)
+async def create_uploads_download_bundle(
+    request: Request, details: UploadDownloadRequest, token=Depends(ProtectedAny(tag=ScopeTags.PULSE3D_READ))
+):
+    """Queue a ZIP of the given recordings to be built by a worker rather than streaming one from here.
+
+    The URL of the bundle is sent over the event broker once it is ready, or returned immediately if the same files
+    were bundled recently.
+    """
+    _check_download_bundles_enabled()
+
+    if token.account_type == "user" and details.upload_type not in get_product_tags_of_user(token.scopes):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST)
+
+    if not details.upload_ids:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No upload IDs given")
+
+    # need to convert UUIDs to str to avoid issues with DB
+    upload_ids = [str(id) for id in details.upload_ids]
+
+    bind_context_to_logger(
+        {"user_id": token.userid, "customer_id": token.customer_id, "upload_type": details.upload_type}
+    )
+
+    try:
+        async with request.state.pgpool.acquire() as con:
+            uploads = await _get_uploads_download(
+                con=con, token=token, upload_ids=upload_ids, upload_type=details.upload_type
+            )
+            if not uploads:
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No uploads found")
+
+            return await _create_download_bundle(
+                con,
+                token,
+                sources=upload_ids,
+                keys=[f"{upload['prefix']}/{upload['filename']}" for upload in uploads],
+                filenames=[upload["filename"] for upload in uploads],
+                filename=_get_download_bundle_filename("recordings", details.upload_type, len(uploads)),
+            )
+    except HTTPException:
+        raise
+    except Exception:
+        logger.exception("Failed to create recordings download bundle")
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@app.post("/jobs/download/bundle", response_model=DownloadBundleResponse)
+async def create_analyses_download_bundle(
+    request: Request, details: JobDownloadRequest, token=Depends(ProtectedAny(tag=ScopeTags.PULSE3D_READ))
+):
+    """Queue a ZIP of the given analyses to be built by a worker rather than streaming one from here.
+
+    The URL of the bundle is sent over the event broker once it is ready, or returned immediately if the same files
+    were bundled recently.
+    """
+    _check_download_bundles_enabled()
+
+    if token.account_type == "user" and details.upload_type not in get_product_tags_of_user(token.scopes):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST)
+
+    if not details.job_ids:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No job IDs given")
+
+    # need to convert UUIDs to str to avoid issues with DB
+    job_ids = [str(job_id) for job_id in details.job_ids]
+
+    bind_context_to_logger({"user_id": token.userid, "customer_id": token.customer_id})
+
+    try:
+        async with request.state.pgpool.acquire() as con:
+            jobs = await _get_jobs_download(con, token, upload_type=details.upload_type, job_ids=job_ids)
+            # jobs that haven't finished have no output to include yet
+            jobs = [job for job in jobs if job["object_key"]]
+            if not jobs:
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No finished jobs found")
+
+            return await _create_download_bundle(
+                con,
+                token,
+                sources=job_ids,
+                keys=[job["object_key"] for job in jobs],
+                filenames=_get_job_download_filenames(jobs, details.timezone),
+                filename=_get_download_bundle_filename("analyses", details.upload_type, len(jobs)),
+            )
+    except HTTPException:
+        raise
+    except Exception:
+        logger.exception("Failed to create analyses download bundle")
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@app.get("/download-bundles/{bundle_id}", response_model=DownloadBundleResponse)
+async def get_download_bundle_info(
+    request: Request, bundle_id: uuid.UUID, token=Depends(ProtectedAny(tag=ScopeTags.PULSE3D_READ))
+):
+    """Get the status of a download bundle, and its URL if it is finished.
+
+    Only needed by clients that missed the event sent when the bundle finished.
+    """
+    _check_download_bundles_enabled()
+
+    try:
+        async with request.state.pgpool.acquire() as con:
+            bundle = await get_download_bundle(
+                con=con, bundle_id=bundle_id, account_id=str(uuid.UUID(token.account_id))
+            )
+        if not bundle:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+
+        return await _format_download_bundle(bundle)
+    except HTTPException:
+        raise
+    except Exception:
+        logger.exception("Failed to get download bundle")
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+def _check_download_bundles_enabled():
+    if not DOWNLOAD_BUNDLES_ENABLED:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Download bundles are not enabled")
+
+
+def _get_job_download_filenames(jobs: list[dict[str, Any]], timezone: str | None) -> list[str]:
+    num_times_repeated = defaultdict(lambda: 0)
+
+    filename_overrides = list()
+
+    for job in jobs:
+        obj_key = job["object_key"]
+
+        filename = os.path.basename(obj_key)
+
+        filename_override = filename
+        if timezone:
+            try:
+                timestamp = job["created_at"]
+                timestamp = timestamp.astimezone(ZoneInfo(timezone)).strftime("%Y-%m-%d_%H-%M-%S")
+                filename_override = _add_timestamp_to_filename(obj_key.split("/")[-1], timestamp)
+            except Exception:
+                logger.exception(
+                    f"Error appending local timestamp download name: {filename=}, timezone={timezone} utc_timestamp={job.get('created_at')}"
+                )
+
+        if filename_override in filename_overrides:
+            num_times_repeated[filename_override] += 1
+            duplicate_num = num_times_repeated[filename_override]
+            # add duplicate num to differentiate duplicate filenames
+            root, ext = os.path.splitext(filename_override)
+            filename_override = f"{root}_({duplicate_num}){ext}"
+
+        filename_overrides.append(filename_override)
+
+    return filename_overrides
+
+
 def _add_timestamp_to_filename(filename: str, timestamp: str) -> str:
     name, ext = os.path.splitext(filename)
     return f"{name}__{timestamp}{ext}"
@@ -1052,23 +1276,25 @@ async def get_job_waveform_data(
         else:
             pre_analysis_s3_key = f"{selected_job['prefix']}/{job_id}/pre-analysis.zip"
 
-        logger.info(f"Generating presigned URL for {pre_analysis_s3_key}")
-        try:
-            time_force_url = generate_presigned_url(PULSE3D_UPLOADS_BUCKET, pre_analysis_s3_key)
-        except ValueError:
-            message = f"Pre-analysis file was not found in S3 under key {pre_analysis_s3_key}"
-            logger.exception(message)
-            return GenericErrorResponse(error="MissingDataError", message=message)
-
         # Get presigned url for peaks and valleys
-        logger.info("Generating presigned URL for peaks and valleys")
         pv_parquet_key = f"{selected_job['prefix']}/{job_id}/peaks_valleys.parquet"
-        try:
-            peaks_valleys_url = generate_presigned_url(PULSE3D_UPLOADS_BUCKET, pv_parquet_key)
-        except ValueError:
-            message = f"Peaks/Valleys Parquet file was not found in S3 under key {pv_parquet_key}"
-            logger.exception(message)
-            return GenericErrorResponse(error="MissingDataError", message=message)
+
+        # checking that each file exists requires a request to S3 unless it was checked recently, so do both at once
+        logger.info(f"Generating presigned URLs for {pre_analysis_s3_key} and {pv_parquet_key}")
+        time_force_url, peaks_valleys_url = await asyncio.gather(
+            generate_presigned_url_async(PULSE3D_UPLOADS_BUCKET, pre_analysis_s3_key),
+            generate_presigned_url_async(PULSE3D_UPLOADS_BUCKET, pv_parquet_key),
+            return_exceptions=True,
+        )
+        for url_or_exc, message in (
+            (time_force_url, f"Pre-analysis file was not found in S3 under key {pre_analysis_s3_key}"),
+            (peaks_valleys_url, f"Peaks/Valleys Parquet file was not found in S3 under key {pv_parquet_key}"),
+        ):
+            if isinstance(url_or_exc, ValueError):
+                logger.error(message)
+                return GenericErrorResponse(error="MissingDataError", message=message)
+            if isinstance(url_or_exc, Exception):
+                raise url_or_exc
 
         data_type_str: str | None = parsed_meta.get("data_type")
         if data_type_str:
@@ -1253,7 +1479,7 @@ async def get_object_download(key: str, token=Depends(ProtectedAny(tag=ScopeTags
     try:
         return PresignedDownloadUrlResponse(
             filename=key.split("/")[-1],
-            url=generate_presigned_url(PRIVATE_DOWNLOADS_BUCKET, f"pulse3d/{key}"),
+            url=await generate_presigned_url_async(PRIVATE_DOWNLOADS_BUCKET, f"pulse3d/{key}"),
         )
     except Exception:
         logger.exception(f"Failed to get presigned download url for object 'pulse3d/{key}'")
@@ -1408,22 +1634,77 @@ async def _get_job_waveform_data(con, token, job_id: str, upload_type: str) -> d
             )
 
 
-def _generate_presigned_post(details, bucket, s3_prefix):
+def _get_download_bundle_filename(download_type: str, upload_type: str | None, num_files: int) -> str:
+    filename = f"{download_type}__{num_files}.zip"
+    if upload_type:
+        filename = f"{upload_type}-{filename}"
+    return filename
+
+
+async def _create_download_bundle(con, token, **bundle_info) -> DownloadBundleResponse:
+    bundle = await create_download_bundle(
+        con=con,
+        account_id=str(uuid.UUID(token.account_id)),
+        user_id=str(uuid.UUID(token.userid)) if token.account_type == "user" else None,
+        customer_id=str(uuid.UUID(token.customer_id)),
+        version=DOWNLOAD_BUNDLE_WORKER_VERSION,
+        **bundle_info,
+    )
+    logger.info(f"Download bundle {bundle['id']} is {bundle['status']}")
+
+    return await _format_download_bundle(bundle)
+
+
+async def _format_download_bundle(bundle) -> DownloadBundleResponse:
+    url = None
+    if bundle["status"] == "finished":
+        # object_key is only set once the worker has uploaded the bundle, so no need to check that it exists
+        url = await generate_presigned_url_async(
+            PULSE3D_UPLOADS_BUCKET, bundle["object_key"], filename_override=bundle["filename"], verify=False
+        )
+
+    return DownloadBundleResponse(id=bundle["id"], status=bundle["status"], url=url)
+
+
+async def _generate_presigned_post(details, bucket, s3_prefix):
     s3_key = f"{s3_prefix}/{details.filename}"
     logger.info(f"Generating presigned upload url for {bucket}/{s3_key}")
-    params = generate_presigned_post(bucket=bucket, key=s3_key, md5s=details.md5s)
+    params = await generate_presigned_post_async(bucket=bucket, key=s3_key, md5s=details.md5s)
     return params
 
 
-def _generate_multipart_upload_urls(details, bucket, s3_prefix):
+async def _generate_multipart_upload_urls(details, bucket, s3_prefix):
     s3_key = f"{s3_prefix}/{details.filename}"
     logger.info(f"Generating multipart presigned upload urls for {bucket}/{s3_key}")
-    (upload_id, urls) = generate_multipart_upload_urls(
-        bucket=bucket, key=s3_key, md5s_parts=details.md5s_parts
+    # signing a URL for every part of a large recording takes a while, so the client can ask for only the first few
+    (upload_id, urls) = await generate_multipart_upload_urls_async(
+        bucket=bucket, key=s3_key, md5s_parts=details.md5s_parts[: details.num_urls]
     )
     return (upload_id, urls)
 
 
+def _create_peaks_valleys_parquet(
+    details: JobRequest, pulse3d_semver: VersionInfo, peak_valley_diff: int
+) -> bytes:
+    if pulse3d_semver >= "1.0.0":
+        features_df = _create_features_df(_get_timepoints(details), details.peaks_valleys, peak_valley_diff)
+    else:
+        features_df = _create_legacy_features_df(details.peaks_valleys, peak_valley_diff)
+
+    pv_parquet = io.BytesIO()
+    features_df.write_parquet(pv_parquet)
+    return pv_parquet.getvalue()
+
+
+def _get_timepoints(details: JobRequest) -> pl.Series | list[Number] | None:
+    if details.timepoints_ipc is None:
+        return details.timepoints
+
+    # much smaller than a JSON array for long recordings, and doesn't need to be parsed number by number
+    timepoints_df = pl.read_ipc_stream(io.BytesIO(base64.b64decode(details.timepoints_ipc)))
+    return timepoints_df.to_series(0)
+
+
 def _create_features_df(timepoints, features, peak_valley_diff):
     ia_features = _create_legacy_features_df(features, peak_valley_diff)
 
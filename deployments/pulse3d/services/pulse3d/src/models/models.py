@@ -84,6 +84,8 @@ class GetJobsRequest(BaseModel):
     sort_direction: str | None = None
     skip: int = 0
     limit: int = 300
+    # if given, skip is ignored and the page after the cursor is returned
+    cursor: str | None = None
 
 
 class UsageQuota(BaseModel):
@@ -104,6 +106,8 @@ class MultipartUploadRequest(BaseModel):
     md5s_parts: list[str]
     upload_type: str
     auto_upload: bool
+    # only sign URLs for this many parts up front, the rest are requested from /uploads/multipart/parts as needed
+    num_urls: int | None = Field(default=None, ge=1)
 
 
 class MultipartUploadResponse(BaseModel):
@@ -111,6 +115,16 @@ class MultipartUploadResponse(BaseModel):
     urls: list[str]
 
 
+class MultipartUploadPartsRequest(BaseModel):
+    id: uuid.UUID
+    first_part_num: int = Field(ge=1)
+    md5s_parts: list[str] = Field(min_length=1, max_length=1000)
+
+
+class MultipartUploadPartsResponse(BaseModel):
+    urls: list[str]
+
+
 class CompleteMultipartUploadRequest(BaseModel):
     id: uuid.UUID
     parts: list[dict[str, Any]]
@@ -156,6 +170,8 @@ class JobRequest(BaseModel):
     # IA params
     peaks_valleys: dict[str, list[list[Number]]] | None = Field(default=None)
     timepoints: list[Number] | None = Field(default=None)  # not used for pulse3d versions < 1.0.0
+    # base64 encoded Arrow IPC stream with a single column, can be sent instead of timepoints
+    timepoints_ipc: str | None = Field(default=None)
 
     # MA params
     stim_waveform_format: str | None = Field(default=None)
@@ -215,6 +231,13 @@ class UploadDownloadRequest(BaseModel):
     upload_ids: list[uuid.UUID]
 
 
+class DownloadBundleResponse(BaseModel):
+    id: uuid.UUID
+    status: str
+    # only set once the bundle is finished
+    url: str | None = Field(default=None)
+
+
 class GenericErrorResponse(BaseModel):
     message: str | UsageQuota | dict[str, bool]
     error: str
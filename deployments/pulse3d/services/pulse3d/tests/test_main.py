@@ -1,16 +1,18 @@
+import base64
 from random import randint
 from fastapi.testclient import TestClient
+import io
 import json
 import os
 import uuid
 import pandas as pd
+import polars as pl
 import pytest
 from semver import VersionInfo
 from auth import create_token, Scopes, ScopeTags, AccountTypes
 from utils.s3 import S3Error
 from src import main
 import numpy as np
-import tempfile
 
 from pulse3D.constants import DataTypes
 from pulse3D.rendering.utils import get_metric_display_title
@@ -81,7 +83,7 @@ async def fixture_mocked_asyncpg_con(mocker):
 def test_logs__post(mocker):
     expected_params = {"key": "val"}
     mocked_gpp = mocker.patch.object(
-        main, "generate_presigned_post", autospec=True, return_value=expected_params
+        main, "generate_presigned_post_async", autospec=True, return_value=expected_params
     )
 
     test_file_name = "log_file"
@@ -150,7 +152,7 @@ def test_uploads__post_if_customer_quota_has_not_been_reached(mocked_asyncpg_con
     )
     expected_params = {"key": "val"}
     mocked_gpp = mocker.patch.object(
-        main, "generate_presigned_post", autospec=True, return_value=expected_params
+        main, "generate_presigned_post_async", autospec=True, return_value=expected_params
     )
 
     test_file_name = "recording_file"
@@ -222,6 +224,52 @@ def test_uploads__post_if_customer_quota_has_been_reached(mocked_asyncpg_con, mo
     mocked_create_upload.assert_not_called()
 
 
+def test_uploads_multipart_parts__post__signs_urls_for_requested_parts(mocked_asyncpg_con, mocker):
+    test_user_id = uuid.uuid4()
+    test_upload_id = uuid.uuid4()
+    test_md5s_parts = ["md5a", "md5b"]
+    mocked_asyncpg_con.fetchrow.return_value = {
+        "prefix": "uploads/prefix",
+        "filename": "recording.zip",
+        "multipart_upload_id": "test-mp-upload-id",
+    }
+    mocked_sign = mocker.patch.object(
+        main, "generate_upload_part_urls_async", autospec=True, return_value=["url21", "url22"]
+    )
+
+    access_token = get_token(scopes=[Scopes.MANTARRAY__BASE], userid=test_user_id)
+    response = test_client.post(
+        "/uploads/multipart/parts",
+        headers={"Authorization": f"Bearer {access_token}"},
+        json={"id": str(test_upload_id), "first_part_num": 21, "md5s_parts": test_md5s_parts},
+    )
+    assert response.status_code == 200
+    assert response.json() == {"urls": ["url21", "url22"]}
+
+    mocked_sign.assert_called_once_with(
+        "test-pulse3d-uploads",
+        "uploads/prefix/recording.zip",
+        "test-mp-upload-id",
+        test_md5s_parts,
+        first_part_num=21,
+    )
+
+
+def test_uploads_multipart_parts__post__returns_404_if_upload_is_not_in_progress(mocked_asyncpg_con, mocker):
+    mocked_asyncpg_con.fetchrow.return_value = None
+    mocked_sign = mocker.patch.object(main, "generate_upload_part_urls_async", autospec=True)
+
+    access_token = get_token(scopes=[Scopes.MANTARRAY__BASE])
+    response = test_client.post(
+        "/uploads/multipart/parts",
+        headers={"Authorization": f"Bearer {access_token}"},
+        json={"id": str(uuid.uuid4()), "first_part_num": 1, "md5s_parts": ["md5a"]},
+    )
+    assert response.status_code == 404
+
+    mocked_sign.assert_not_called()
+
+
 @pytest.mark.parametrize("test_token_scope", [[s] for s in P3D_READ_SCOPES])
 @pytest.mark.parametrize("test_upload_ids", [uuid.uuid4(), [uuid.uuid4()], [uuid.uuid4() for _ in range(3)]])
 def test_uploads__delete(test_token_scope, test_upload_ids, mocked_asyncpg_con, mocker):
@@ -337,7 +385,9 @@ def test_jobs__get__jobs_found(download, test_token_scope, test_job_ids, mocked_
     ]
 
     mocked_get_jobs = mocker.patch.object(main, "get_jobs", autospec=True, return_value=test_job_rows)
-    mocked_generate = mocker.patch.object(main, "generate_presigned_url", autospec=True, return_value="url0")
+    mocked_generate = mocker.patch.object(
+        main, "generate_presigned_url_async", autospec=True, return_value="url0"
+    )
 
     kwargs = {"headers": {"Authorization": f"Bearer {access_token}"}, "params": {}}
     # in None case, don't even pass a query param
@@ -386,7 +436,9 @@ def test_jobs__get__jobs_found(download, test_token_scope, test_job_ids, mocked_
     if download is False:
         mocked_generate.assert_not_called()
     else:
-        mocked_generate.assert_called_once_with(main.PULSE3D_UPLOADS_BUCKET, test_job_rows[0]["object_key"])
+        mocked_generate.assert_called_once_with(
+            main.PULSE3D_UPLOADS_BUCKET, test_job_rows[0]["object_key"], verify=False
+        )
 
 
 def test_jobs__get__error_with_creating_presigned_url_for_single_file(mocked_asyncpg_con, mocker):
@@ -410,7 +462,7 @@ def test_jobs__get__error_with_creating_presigned_url_for_single_file(mocked_asy
 
     mocked_get_jobs = mocker.patch.object(main, "get_jobs", autospec=True, return_value=test_job_rows)
     mocked_generate = mocker.patch.object(
-        main, "generate_presigned_url", autospec=True, side_effect=["url0", Exception(), "url2"]
+        main, "generate_presigned_url_async", autospec=True, side_effect=["url0", Exception(), "url2"]
     )
 
     access_token = get_token(scopes=[Scopes.MANTARRAY__BASE], userid=test_user_id)
@@ -438,7 +490,8 @@ def test_jobs__get__error_with_creating_presigned_url_for_single_file(mocked_asy
         con=mocked_asyncpg_con, account_type="user", account_id=str(test_user_id), job_ids=expected_job_ids
     )
     assert mocked_generate.call_args_list == [
-        mocker.call(main.PULSE3D_UPLOADS_BUCKET, test_job_rows[i]["object_key"]) for i in range(test_num_jobs)
+        mocker.call(main.PULSE3D_UPLOADS_BUCKET, test_job_rows[i]["object_key"], verify=False)
+        for i in range(test_num_jobs)
     ]
 
 
@@ -536,6 +589,7 @@ def test_jobs__post__no_params_given(mocked_asyncpg_con, mocker):
         meta={"analysis_params": expected_analysis_params, "version": test_version},
         customer_id=str(test_customer_id),
         job_type="mantarray",
+        job_id=mocker.ANY,
     )
 
 
@@ -650,14 +704,13 @@ def test_jobs__post__uploads_peaks_and_valleys_when_passed_into_request(mocker,
         customer_id=test_customer_id,
     )
     mocked_create_job = mocker.patch.object(main, "create_job", autospec=True, return_value=uuid.uuid4())
-    mocked_upload_to_s3 = mocker.patch.object(main, "upload_file_to_s3", autospec=True)
+    mocked_upload_to_s3 = mocker.patch.object(main, "upload_bytes_to_s3_async", autospec=True)
     mocked_asyncpg_con.fetchrow.return_value = {
         "user_id": test_user_id,
         "state": "external",
         "type": "mantarray",
         "end_of_life_date": None,
     }
-    spied_tempdir = mocker.spy(tempfile, "TemporaryDirectory")
     mocker.patch.object(
         main,
         "check_customer_pulse3d_usage",
@@ -680,12 +733,29 @@ def test_jobs__post__uploads_peaks_and_valleys_when_passed_into_request(mocker,
 
     mocked_create_job.assert_called_once()
 
-    expected_s3_key = f"uploads/{test_customer_id}/{test_user_id}/{test_upload_id}/{mocked_create_job.return_value}/peaks_valleys.parquet"
-    expected_parquet_path = os.path.join(spied_tempdir.spy_return.name, "peaks_valleys.parquet")
+    # the peaks and valleys are stored under the ID the job is created with
+    test_job_id = mocked_create_job.call_args.kwargs["job_id"]
+    expected_s3_key = (
+        f"uploads/{test_customer_id}/{test_user_id}/{test_upload_id}/{test_job_id}/peaks_valleys.parquet"
+    )
 
     mocked_upload_to_s3.assert_called_once_with(
-        bucket="test-pulse3d-uploads", key=expected_s3_key, file=expected_parquet_path
+        bucket="test-pulse3d-uploads", key=expected_s3_key, contents=mocker.ANY
     )
+    uploaded_df = pl.read_parquet(io.BytesIO(mocked_upload_to_s3.call_args.kwargs["contents"]))
+    assert uploaded_df["A1__peaks"].to_list() == random_list
+
+
+def test_jobs__post__reads_timepoints_from_arrow_ipc():
+    test_timepoints = [i * 1e4 for i in range(10)]
+    ipc = io.BytesIO()
+    pl.DataFrame({"time": test_timepoints}).write_ipc_stream(ipc)
+
+    details = main.JobRequest(
+        upload_id=uuid.uuid4(), version="1.0.0", timepoints_ipc=base64.b64encode(ipc.getvalue()).decode()
+    )
+
+    assert main._get_timepoints(details).to_list() == test_timepoints
 
 
 @pytest.mark.parametrize(
@@ -1177,7 +1247,7 @@ def test_uploads_download__post__correctly_handles_single_file_downloads(
     )
     mocked_yield_objs = mocker.patch.object(main, "_yield_s3_objects", autospec=True)
     mocked_presigned_url = mocker.patch.object(
-        main, "generate_presigned_url", return_value=test_presigned_url, autospec=True
+        main, "generate_presigned_url_async", return_value=test_presigned_url, autospec=True
     )
 
     test_upload_ids_strs = [str(id) for id in test_upload_ids]
@@ -1254,6 +1324,73 @@ def test_uploads_download__post__correctly_handles_multiple_file_downloads(
     )
 
 
+@pytest.mark.parametrize(
+    "test_status,test_url", [("pending", None), ("running", None), ("finished", "https://s3.test-url.com/")]
+)
+def test_uploads_download_bundle__post__returns_url_only_if_bundle_is_finished(
+    test_status, test_url, mocked_asyncpg_con, mocker
+):
+    test_customer_id = uuid.uuid4()
+    access_token = get_token(
+        scopes=[Scopes.MANTARRAY__ADMIN], account_type=AccountTypes.ADMIN, customer_id=test_customer_id
+    )
+
+    test_upload_ids = [uuid.uuid4() for _ in range(3)]
+    test_upload_rows = [
+        {"filename": f"file_{upload}.zip", "prefix": "obj/prefix"} for upload in test_upload_ids
+    ]
+    test_bundle = {
+        "id": uuid.uuid4(),
+        "status": test_status,
+        "object_key": "bundles/test.zip" if test_url else None,
+        "filename": "recordings__3.zip",
+    }
+
+    mocker.patch.object(main, "_get_uploads_download", autospec=True, return_value=test_upload_rows)
+    mocked_create_bundle = mocker.patch.object(
+        main, "create_download_bundle", autospec=True, return_value=test_bundle
+    )
+    mocked_presigned_url = mocker.patch.object(
+        main, "generate_presigned_url_async", autospec=True, return_value=test_url
+    )
+
+    response = test_client.post(
+        "/uploads/download/bundle",
+        headers={"Authorization": f"Bearer {access_token}"},
+        json={"upload_ids": [str(id) for id in test_upload_ids]},
+    )
+    assert response.status_code == 200
+    assert response.json() == {"id": str(test_bundle["id"]), "status": test_status, "url": test_url}
+
+    mocked_create_bundle.assert_called_once_with(
+        con=mocked_asyncpg_con,
+        sources=[str(id) for id in test_upload_ids],
+        keys=[f"{row['prefix']}/{row['filename']}" for row in test_upload_rows],
+        filenames=[row["filename"] for row in test_upload_rows],
+        filename="recordings__3.zip",
+        account_id=str(test_customer_id),
+        user_id=None,
+        customer_id=str(test_customer_id),
+        version=main.DOWNLOAD_BUNDLE_WORKER_VERSION,
+    )
+    if test_url:
+        mocked_presigned_url.assert_called_once_with(
+            "test-pulse3d-uploads", "bundles/test.zip", filename_override="recordings__3.zip", verify=False
+        )
+    else:
+        mocked_presigned_url.assert_not_called()
+
+
+def test_download_bundles__get__returns_404_if_account_is_not_a_recipient(mocked_asyncpg_con, mocker):
+    access_token = get_token(scopes=[Scopes.MANTARRAY__BASE])
+    mocker.patch.object(main, "get_download_bundle", autospec=True, return_value=None)
+
+    response = test_client.get(
+        f"/download-bundles/{uuid.uuid4()}", headers={"Authorization": f"Bearer {access_token}"}
+    )
+    assert response.status_code == 404
+
+
 @pytest.mark.parametrize("test_query_params", [f"upload_id={uuid.uuid4()}", f"job_id={uuid.uuid4()}"])
 def test_waveform_data__get__no_job_or_upload_id_is_found(mocker, test_query_params):
     access_token = get_token(scopes=[Scopes.MANTARRAY__BASE])
@@ -1320,7 +1457,9 @@ def test_waveform_data__get__time_force_parquet_found(mocker, pulse3d_version, d
         }
     ]
     mocker.patch.object(main, "get_jobs", autospec=True, return_value=test_jobs)
-    mocker.patch.object(main, "generate_presigned_url", autospec=True, return_value=expected_presigned_url)
+    mocker.patch.object(
+        main, "generate_presigned_url_async", autospec=True, return_value=expected_presigned_url
+    )
 
     access_token = get_token(scopes=[Scopes.MANTARRAY__BASE], userid=test_user_id)
     kwargs = {"headers": {"Authorization": f"Bearer {access_token}"}}
@@ -1374,7 +1513,7 @@ def test_waveform_data__get__no_time_force_parquet_found(mocker, pulse3d_version
     # set up mocked df returned from parquet file
     mocker.patch.object(main, "get_jobs", autospec=True, return_value=test_jobs)
     # ValueError gets raised with object isn't found
-    mocker.patch.object(main, "generate_presigned_url", side_effect=ValueError)
+    mocker.patch.object(main, "generate_presigned_url_async", side_effect=ValueError)
 
     access_token = get_token(scopes=[Scopes.MANTARRAY__BASE], userid=test_user_id)
     kwargs = {"headers": {"Authorization": f"Bearer {access_token}"}}
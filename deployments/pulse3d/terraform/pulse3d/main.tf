@@ -116,6 +116,28 @@ resource "aws_s3_bucket_cors_configuration" "pulse3d_uploads_bucket" {
   }
 }
 
+resource "aws_s3_bucket_lifecycle_configuration" "pulse3d_uploads_bucket" {
+  bucket = aws_s3_bucket.pulse3d_uploads_bucket.id
+
+  # download bundles are only reused for DOWNLOAD_BUNDLE_TTL_SECS (7 days), keep them one extra day so a URL handed out just before then still works
+  rule {
+    id     = "expire-download-bundles"
+    status = "Enabled"
+
+    filter {
+      prefix = "bundles/"
+    }
+
+    expiration {
+      days = 8
+    }
+
+    abort_incomplete_multipart_upload {
+      days_after_initiation = 1
+    }
+  }
+}
+
 
 resource "aws_s3_bucket" "private_downloads_bucket" {
   bucket = "curi-${var.cluster_name}-private-downloads"
@@ -2,7 +2,7 @@ import styled from "styled-components";
 import { useEffect, useState, useContext } from "react";
 import DropDownWidget from "@/components/basicWidgets/DropDownWidget";
 import WaveformGraph from "./InteractiveWaveformGraph";
-import { deepCopy, downloadPeakDetectionManual } from "@/utils/generic";
+import { deepCopy, downloadPeakDetectionManual, getBase64ArrowIPC } from "@/utils/generic";
 import CircularSpinner from "@/components/basicWidgets/CircularSpinner";
 import ButtonWidget from "@/components/basicWidgets/ButtonWidget";
 import ModalWidget from "@/components/basicWidgets/ModalWidget";
@@ -737,7 +737,8 @@ export default function InteractiveWaveformModal({
       if (semverGte(filteredVersions[pulse3dVersionIdx], "1.0.0")) {
         const { coordinates } = originalAnalysisData;
         // timepoints should be the same on each well, so just grab them from the first one present
-        requestBody.timepoints = coordinates[Object.keys(coordinates)[0]].map((coords) => coords[0]);
+        const timepoints = coordinates[Object.keys(coordinates)[0]].map((coords) => coords[0]);
+        requestBody.timepoints_ipc = getBase64ArrowIPC("time", timepoints);
       }
 
       const jobResponse = await fetch(`${process.env.NEXT_PUBLIC_PULSE3D_URL}/jobs`, {
@@ -124,6 +124,8 @@ const modalObj = {
 
 const MAX_WHOLE_UPLOAD_SIZE = 50 * 1024 * 1024;
 const MULTIPART_UPLOAD_CHUNK_SIZE = 30 * 1024 * 1024;
+// number of part upload URLs to request at a time
+const MULTIPART_UPLOAD_URL_WINDOW = 20;
 
 const isReanalysisPage = (router) => {
   return (
@@ -903,6 +905,7 @@ export default function UploadForm() {
           md5s_parts: chunkHashes,
           upload_type: productPage,
           auto_upload: false,
+          num_urls: MULTIPART_UPLOAD_URL_WINDOW,
         }),
       });
       let mpUploadResData = {};
@@ -925,7 +928,7 @@ export default function UploadForm() {
       }
 
       let urls = mpUploadResData.urls;
-      if (urls.length !== chunkHashes.length) {
+      if (urls.length !== Math.min(chunkHashes.length, MULTIPART_UPLOAD_URL_WINDOW)) {
         handleError("Incorrect number of parts in multipart upload details");
         return;
       }
@@ -934,7 +937,8 @@ export default function UploadForm() {
       const uploadParts = [];
       let chunkStart = 0;
       let prevRefreshTimestamp = Date.now();
-      for (const partIdx = 0; partIdx < urls.length; partIdx++) {
+      const numParts = chunkHashes.length;
+      for (let partIdx = 0; partIdx < numParts; partIdx++) {
         // Nothing else in the browser will trigger a refresh while this upload is in progress, so periodically check if the tokens need to be refreshed
         const millisSincePrevUpload = Date.now() - prevRefreshTimestamp;
         const minsSincePrevUpload = millisSincePrevUpload / (1000 * 60);
@@ -947,6 +951,25 @@ export default function UploadForm() {
           prevRefreshTimestamp = Date.now();
         }
 
+        // get the next window of URLs once the current one has been used up
+        if (partIdx >= urls.length) {
+          const partsRes = await fetch(`${process.env.NEXT_PUBLIC_PULSE3D_URL}/uploads/multipart/parts`, {
+            method: "POST",
+            body: JSON.stringify({
+              id: mpUploadResData.id,
+              first_part_num: partIdx + 1,
+              md5s_parts: chunkHashes.slice(partIdx, partIdx + MULTIPART_UPLOAD_URL_WINDOW),
+            }),
+          });
+          if (partsRes.status !== 200) {
+            handleError(
+              `ERROR (${partsRes.status}) getting upload urls for parts starting at ${partIdx + 1}`
+            );
+            return;
+          }
+          urls = urls.concat((await partsRes.json()).urls);
+        }
+
         let chunkEnd = Math.min(file.size, chunkStart + MULTIPART_UPLOAD_CHUNK_SIZE);
 
         let uploadPartRes = null;
@@ -961,7 +984,7 @@ export default function UploadForm() {
             });
           } catch (e) {
             console.log(
-              `ERROR attempt ${attemptNum} uploading file part (${partIdx + 1}/${urls.length}) to s3:  `,
+              `ERROR attempt ${attemptNum} uploading file part (${partIdx + 1}/${numParts}) to s3:  `,
               e
             );
             continue;
@@ -969,7 +992,7 @@ export default function UploadForm() {
           break;
         }
         if (uploadPartRes === null) {
-          handleError(`Max num upload attempts reached for part (${partIdx + 1}/${urls.length})`);
+          handleError(`Max num upload attempts reached for part (${partIdx + 1}/${numParts})`);
           return;
         }
 
@@ -979,7 +1002,7 @@ export default function UploadForm() {
             errMsg = parseS3XmlErrorCode(await uploadPartRes.text());
           } catch {}
           handleError(
-            `ERROR uploading file part (${partIdx + 1}/${urls.length}) to s3: ${uploadPartRes.status} ${
+            `ERROR uploading file part (${partIdx + 1}/${numParts}) to s3: ${uploadPartRes.status} ${
               parseS3XmlErrorCode(bodyText) || bodyTextErrorMsg
             }`
           );
@@ -988,7 +1011,7 @@ export default function UploadForm() {
         const etag = uploadPartRes.headers.get("ETag");
         if (etag === null) {
           handleError(
-            `etag header missing on upload file part response (${partIdx + 1}/${urls.length}) from s3`
+            `etag header missing on upload file part response (${partIdx + 1}/${numParts}) from s3`
           );
           return;
         }
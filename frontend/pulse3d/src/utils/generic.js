@@ -190,6 +190,17 @@ const getTableFromParquet = async (buffer) => {
   return apache.tableFromIPC(parquetData);
 };
 
+// encode a single column as a base64 Arrow IPC stream, which is much smaller than a JSON array of numbers
+const getBase64ArrowIPC = (colName, values) => {
+  const ipc = apache.tableToIPC(apache.tableFromArrays({ [colName]: Float64Array.from(values) }), "stream");
+  let binary = "";
+  // String.fromCharCode can't take all the bytes of a large table at once
+  for (let i = 0; i < ipc.length; i += 0x8000) {
+    binary += String.fromCharCode(...ipc.subarray(i, i + 0x8000));
+  }
+  return btoa(binary);
+};
+
 const formatDateTime = (datetime, includeSeconds) => {
   if (datetime) {
     const format = {
@@ -402,6 +413,7 @@ export {
   getPeaksValleysFromTable,
   getWaveformCoordsFromTable,
   getTableFromParquet,
+  getBase64ArrowIPC,
   formatDateTime,
   applyWindow,
   isInt,
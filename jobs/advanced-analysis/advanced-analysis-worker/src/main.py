@@ -2,8 +2,10 @@ import asyncio
 import datetime
 import json
 import os
+import signal
 import tempfile
 from typing import Any
+import uuid
 from zipfile import ZipFile
 
 from advanced_analysis import (
@@ -14,13 +16,21 @@ from advanced_analysis import (
 )
 import asyncpg
 import boto3
-from jobs import get_advanced_item, EmptyQueue
+from jobs import get_advanced_item, EmptyQueue, listen_for_new_items
 import structlog
 from structlog.contextvars import bind_contextvars, clear_contextvars, merge_contextvars
 from utils.s3 import upload_file_to_s3
 
 
 PULSE3D_UPLOADS_BUCKET = os.getenv("UPLOADS_BUCKET_ENV", "test-pulse3d-uploads")
+# pod name when running in k8s, used to mark which queue items this worker has claimed
+WORKER_ID = os.getenv("HOSTNAME", default=uuid.uuid4().hex)
+# number of jobs this worker will claim from the queue and process concurrently
+JOBS_PER_WORKER = int(os.getenv("JOBS_PER_WORKER", default=1))
+# workers in a warm pool wait for new jobs instead of exiting when the queue is empty
+IS_POOL_WORKER = os.getenv("WORKER_MODE", default="job") == "pool"
+# how often an idle pool worker checks the queue in case a notification was missed or a lease expired
+IDLE_POLL_SECS = 30
 
 
 structlog.configure(
@@ -39,6 +49,10 @@ class PlateMapNotSetError(Exception):
     pass
 
 
+class ExceptionWithErrorMsg(Exception):
+    pass
+
+
 def _create_input_file_info(
     inputs_dir: str, downloads_dir: str, upload_prefix: str, source_id: str, analysis_name: str
 ) -> dict[str, Any]:
@@ -172,8 +186,150 @@ def _well_groups_to_platemap(platemap_name, well_groups):
     }
 
 
-@get_advanced_item(queue=f"advanced-analysis-v{ADVANCED_ANALYSIS_VERSION}")
-async def process_item(con, item):
+def _run_analysis(
+    s3_client,
+    job_id,
+    customer_id,
+    user_id,
+    fetched_sources_info: dict[str, Any],
+    platemap_overrides: dict[str, Any],
+    advanced_analysis_params: dict[str, Any],
+    output_name: str,
+) -> str:
+    """Run the analysis on the given sources and upload its results to S3.
+
+    Returns the S3 key of the output file.
+    """
+    sources_info = {}
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        inputs_dir = os.path.join(tmpdir, "inputs")
+        os.mkdir(inputs_dir)
+        downloads_dir = os.path.join(tmpdir, "downloads")
+        os.mkdir(downloads_dir)
+
+        # retrieve and format info of sources, download aggregate metrics and metadata files
+        for source_id, fetched_source_info in fetched_sources_info.items():
+            logger.info(f"Processing source info for ID: {source_id}")
+            source_info = {}
+            try:
+                fetched_source_info = dict(fetched_source_info)
+                fetched_source_info_meta = json.loads(fetched_source_info["p3d_job_meta"])
+                analysis_filename = fetched_source_info["object_key"].split("/")[-1]
+                analysis_name = os.path.splitext(analysis_filename)[0]
+                source_info["p3d_analysis_metadata"] = {
+                    "filename": analysis_filename,
+                    "version": fetched_source_info_meta["version"],
+                    "data_type": fetched_source_info_meta["data_type"],
+                    "analysis_params": fetched_source_info_meta["analysis_params"],
+                    "file_creation_timestamp": fetched_source_info["finished_at"],
+                }
+                source_info |= _determine_platemap_for_source(
+                    source_id,
+                    analysis_name,
+                    platemap_overrides,
+                    fetched_source_info["p3d_job_meta"],
+                    fetched_source_info["upload_meta"],
+                )
+                source_file_info = _create_input_file_info(
+                    inputs_dir, downloads_dir, fetched_source_info["prefix"], source_id, analysis_name
+                )
+            except PlateMapNotSetError as e:
+                error_msg = f"PlateMap not set for {source_id}"
+                logger.exception(error_msg)
+                raise ExceptionWithErrorMsg(error_msg) from e
+            except:
+                logger.exception(f"Error processing source info for ID: {source_id}")
+                raise
+
+            sources_info[analysis_name] = source_info
+
+            logger.info(f"Downloading pre-analysis data for ID: {source_id}")
+            try:
+                pre_analysis_info = source_file_info["pre_analysis"]
+                s3_client.download_file(
+                    PULSE3D_UPLOADS_BUCKET, pre_analysis_info["s3_key"], pre_analysis_info["file_path"]
+                )
+            except:
+                logger.exception(f"Error downloading pre-analysis file for ID: {source_id}")
+                raise
+            logger.info(f"Moving metadata from pre-analysis zip to input dir for ID: {source_id}")
+            try:
+                with ZipFile(pre_analysis_info["file_path"]) as z:
+                    z.extract("metadata.json", path=source_file_info["input_dir"])
+            except:
+                logger.exception(
+                    f"Error moving metadata from pre-analysis zip to input dir for ID: {source_id}"
+                )
+                raise
+            logger.info(f"Downloading aggregate metrics for ID: {source_id}")
+            try:
+                aggregate_metrics_info = source_file_info["aggregate_metrics"]
+                s3_client.download_file(
+                    PULSE3D_UPLOADS_BUCKET,
+                    aggregate_metrics_info["s3_key"],
+                    aggregate_metrics_info["file_path"],
+                )
+            except:
+                logger.exception(f"Error downloading aggregate metrics file for ID: {source_id}")
+                raise
+
+        logger.info("Loading source files")
+        try:
+            input_containers = load_from_dir(inputs_dir, sources_info)
+        except Exception as e:
+            logger.exception("Failed loading source files")
+            raise ExceptionWithErrorMsg("Loading input data failed") from e
+
+        logger.info("Running longitudinal aggregation")
+        try:
+            combined_container = longitudinal_aggregator(
+                input_containers,
+                advanced_analysis_params["experiment_start_time_utc"],
+                advanced_analysis_params["local_tz_offset_hours"],
+            )
+        except Exception as e:
+            logger.exception("Failed running longitudinal aggregation")
+            raise ExceptionWithErrorMsg("Longitudinal aggregation failed") from e
+
+        output_file_info = _create_output_file_info(tmpdir, customer_id, user_id, job_id)
+
+        for output_pq_name, df in [
+            ("metadata", combined_container.combined_p3d_metadata),
+            ("ungrouped_aggs", combined_container.ungrouped_aggs),
+            ("group_aggs", combined_container.group_aggs),
+        ]:
+            logger.info(f"Writing and uploading {output_pq_name} parquet file")
+            output_items = output_file_info[output_pq_name]
+            df.write_parquet(output_items["file_path"])
+            upload_file_to_s3(
+                bucket=PULSE3D_UPLOADS_BUCKET, key=output_items["s3_key"], file=output_items["file_path"]
+            )
+
+        logger.info("Running renderer")
+        try:
+            outfile_name = render(combined_container, output_name, output_dir=output_file_info["output_dir"])
+        except Exception as e:
+            logger.exception("Failed running renderer")
+            raise ExceptionWithErrorMsg("Output file creation failed") from e
+
+        logger.info("Uploading renderer output")
+        try:
+            outfile_key = f"{output_file_info['s3_prefix']}/{outfile_name}"
+            upload_file_to_s3(
+                bucket=PULSE3D_UPLOADS_BUCKET,
+                key=outfile_key,
+                file=os.path.join(output_file_info["output_dir"], outfile_name),
+            )
+        except:
+            logger.exception("Failed uploading renderer output")
+            raise
+
+    return outfile_key
+
+
+@get_advanced_item(queue=f"advanced-analysis-v{ADVANCED_ANALYSIS_VERSION}", batch_size=JOBS_PER_WORKER)
+async def process_item(pool, item):
     # keeping initial log without bound variables
     logger.info(f"Processing item: {item}")
 
@@ -184,8 +340,6 @@ async def process_item(con, item):
 
     s3_client = boto3.client("s3")
 
-    error_msg = None
-
     job_metadata = {}
     outfile_key = None
 
@@ -207,28 +361,21 @@ async def process_item(con, item):
             logger.exception("Error processing submission metadata")
             raise
 
-        logger.info("Retrieving customer and user IDs from DB")
-        try:
-            customer_id, user_id = await con.fetchrow(
-                "SELECT customer_id, user_id FROM advanced_analysis_result WHERE id=$1", job_id
-            )
-        except:
-            logger.exception("Failed retrieving customer and user IDs from DB")
-            raise
-
-        sources_info = {}
-
-        with tempfile.TemporaryDirectory() as tmpdir:
-            inputs_dir = os.path.join(tmpdir, "inputs")
-            os.mkdir(inputs_dir)
-            downloads_dir = os.path.join(tmpdir, "downloads")
-            os.mkdir(downloads_dir)
+        async with pool.acquire() as con:
+            logger.info("Retrieving customer and user IDs from DB")
+            try:
+                customer_id, user_id = await con.fetchrow(
+                    "SELECT customer_id, user_id FROM advanced_analysis_result WHERE id=$1", job_id
+                )
+            except:
+                logger.exception("Failed retrieving customer and user IDs from DB")
+                raise
 
-            # retrieve and format info of sources, download aggregate metrics and metadata files
+            fetched_sources_info = {}
             for source_id in sources:
                 logger.info(f"Fetching source details for ID: {source_id}")
                 try:
-                    fetched_source_info = await con.fetchrow(
+                    fetched_sources_info[source_id] = await con.fetchrow(
                         "SELECT j.meta as p3d_job_meta, j.object_key, j.finished_at, up.meta as upload_meta, up.prefix "
                         "FROM jobs_result j JOIN uploads up ON j.upload_id=up.id "
                         "WHERE job_id=$1",
@@ -238,132 +385,26 @@ async def process_item(con, item):
                     logger.exception(f"Error fetching source details for ID: {source_id}")
                     raise
 
-                logger.info(f"Processing source info for ID: {source_id}")
-                source_info = {}
-                try:
-                    fetched_source_info = dict(fetched_source_info)
-                    fetched_source_info_meta = json.loads(fetched_source_info["p3d_job_meta"])
-                    analysis_filename = fetched_source_info["object_key"].split("/")[-1]
-                    analysis_name = os.path.splitext(analysis_filename)[0]
-                    source_info["p3d_analysis_metadata"] = {
-                        "filename": analysis_filename,
-                        "version": fetched_source_info_meta["version"],
-                        "data_type": fetched_source_info_meta["data_type"],
-                        "analysis_params": fetched_source_info_meta["analysis_params"],
-                        "file_creation_timestamp": fetched_source_info["finished_at"],
-                    }
-                    source_info |= _determine_platemap_for_source(
-                        source_id,
-                        analysis_name,
-                        platemap_overrides,
-                        fetched_source_info["p3d_job_meta"],
-                        fetched_source_info["upload_meta"],
-                    )
-                    source_file_info = _create_input_file_info(
-                        inputs_dir, downloads_dir, fetched_source_info["prefix"], source_id, analysis_name
-                    )
-                except PlateMapNotSetError:
-                    error_msg = f"PlateMap not set for {source_id}"
-                    logger.exception(error_msg)
-                    raise
-                except:
-                    logger.exception(f"Error processing source info for ID: {source_id}")
-                    raise
-
-                sources_info[analysis_name] = source_info
-
-                logger.info(f"Downloading pre-analysis data for ID: {source_id}")
-                try:
-                    pre_analysis_info = source_file_info["pre_analysis"]
-                    s3_client.download_file(
-                        PULSE3D_UPLOADS_BUCKET, pre_analysis_info["s3_key"], pre_analysis_info["file_path"]
-                    )
-                except:
-                    logger.exception(f"Error downloading pre-analysis file for ID: {source_id}")
-                    raise
-                logger.info(f"Moving metadata from pre-analysis zip to input dir for ID: {source_id}")
-                try:
-                    with ZipFile(pre_analysis_info["file_path"]) as z:
-                        z.extract("metadata.json", path=source_file_info["input_dir"])
-                except:
-                    logger.exception(
-                        f"Error moving metadata from pre-analysis zip to input dir for ID: {source_id}"
-                    )
-                    raise
-                logger.info(f"Downloading aggregate metrics for ID: {source_id}")
-                try:
-                    aggregate_metrics_info = source_file_info["aggregate_metrics"]
-                    s3_client.download_file(
-                        PULSE3D_UPLOADS_BUCKET,
-                        aggregate_metrics_info["s3_key"],
-                        aggregate_metrics_info["file_path"],
-                    )
-                except:
-                    logger.exception(f"Error downloading aggregate metrics file for ID: {source_id}")
-                    raise
-
-            logger.info("Loading source files")
-            try:
-                input_containers = load_from_dir(inputs_dir, sources_info)
-            except:
-                error_msg = "Loading input data failed"
-                logger.exception("Failed loading source files")
-                raise
-
-            logger.info("Running longitudinal aggregation")
-            try:
-                combined_container = longitudinal_aggregator(
-                    input_containers,
-                    advanced_analysis_params["experiment_start_time_utc"],
-                    advanced_analysis_params["local_tz_offset_hours"],
-                )
-            except:
-                error_msg = "Longitudinal aggregation failed"
-                logger.exception("Failed running longitudinal aggregation")
-                raise
-
-            output_file_info = _create_output_file_info(tmpdir, customer_id, user_id, job_id)
-
-            for output_pq_name, df in [
-                ("metadata", combined_container.combined_p3d_metadata),
-                ("ungrouped_aggs", combined_container.ungrouped_aggs),
-                ("group_aggs", combined_container.group_aggs),
-            ]:
-                logger.info(f"Writing and uploading {output_pq_name} parquet file")
-                output_items = output_file_info[output_pq_name]
-                df.write_parquet(output_items["file_path"])
-                upload_file_to_s3(
-                    bucket=PULSE3D_UPLOADS_BUCKET, key=output_items["s3_key"], file=output_items["file_path"]
-                )
-
-            logger.info("Running renderer")
-            try:
-                outfile_name = render(
-                    combined_container, output_name, output_dir=output_file_info["output_dir"]
-                )
-            except:
-                error_msg = "Output file creation failed"
-                logger.exception("Failed running renderer")
-                raise
-
-            logger.info("Uploading renderer output")
-            try:
-                outfile_key = f"{output_file_info['s3_prefix']}/{outfile_name}"
-                upload_file_to_s3(
-                    bucket=PULSE3D_UPLOADS_BUCKET,
-                    key=outfile_key,
-                    file=os.path.join(output_file_info["output_dir"], outfile_name),
-                )
-            except:
-                logger.exception("Failed uploading renderer output")
-                raise
-
+        # the analysis is blocking, so run it in a thread to keep the lease heartbeat running
+        outfile_key = await asyncio.to_thread(
+            _run_analysis,
+            s3_client,
+            job_id,
+            customer_id,
+            user_id,
+            fetched_sources_info,
+            platemap_overrides,
+            advanced_analysis_params,
+            output_name,
+        )
+
+    except ExceptionWithErrorMsg as e:
+        job_metadata["error"] = repr(e.__cause__)
+        result = "error"
+        job_metadata["error_msg"] = str(e)
     except Exception as e:
         job_metadata["error"] = repr(e)
         result = "error"
-        # some errors do not include an error message
-        if error_msg:
-            job_metadata["error_msg"] = error_msg
     else:
         logger.info("Job complete")
         result = "finished"
@@ -384,15 +425,34 @@ async def main():
 
         dsn = f"postgresql://{DB_USER}:{DB_PASS}@{DB_HOST}:5432/{DB_NAME}"
 
-        async with asyncpg.create_pool(dsn=dsn) as pool:
-            async with pool.acquire() as con, pool.acquire() as con_to_update_job_result:
-                while True:
+        # need at most one connection per concurrent job while it runs queries, one for claiming jobs and renewing
+        # their leases, and one for listening for new jobs
+        async with asyncpg.create_pool(dsn=dsn, max_size=JOBS_PER_WORKER + 2) as pool:
+            async with listen_for_new_items(pool) as new_items_event:
+                stop_event = asyncio.Event()
+                if IS_POOL_WORKER:
+                    # when the pool is scaled down, finish the current job(s) before exiting
+                    def _handle_sigterm():
+                        logger.info("Received SIGTERM, stopping after current job(s)")
+                        stop_event.set()
+                        new_items_event.set()
+
+                    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, _handle_sigterm)
+
+                while not stop_event.is_set():
+                    # clear before claiming so a job added while processing is not missed
+                    new_items_event.clear()
                     try:
-                        logger.info("Pulling job from queue")
-                        await process_item(con=con, con_to_update_job_result=con_to_update_job_result)
+                        logger.info("Pulling job(s) from queue")
+                        await process_item(pool=pool, worker_id=WORKER_ID)
                     except EmptyQueue as e:
                         logger.info(f"No jobs in queue: {e}")
-                        return
+                        if not IS_POOL_WORKER:
+                            return
+                        try:
+                            await asyncio.wait_for(new_items_event.wait(), timeout=IDLE_POLL_SECS)
+                        except asyncio.TimeoutError:
+                            pass
                     except Exception:
                         logger.exception("Processing queue item failed")
                         return
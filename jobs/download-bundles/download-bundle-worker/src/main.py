@@ -0,0 +1,130 @@
+import asyncio
+import json
+import os
+import signal
+import uuid
+
+import asyncpg
+from jobs import get_download_bundle_item, EmptyQueue, listen_for_new_items
+from stream_zip import stream_zip
+import structlog
+from structlog.contextvars import bind_contextvars, clear_contextvars, merge_contextvars
+from utils.s3 import upload_chunks_to_s3, yield_s3_objects
+
+
+VERSION = "0.1.0"
+
+PULSE3D_UPLOADS_BUCKET = os.getenv("UPLOADS_BUCKET_ENV", "test-pulse3d-uploads")
+# pod name when running in k8s, used to mark which queue items this worker has claimed
+WORKER_ID = os.getenv("HOSTNAME", default=uuid.uuid4().hex)
+# number of bundles this worker will claim from the queue and build concurrently
+JOBS_PER_WORKER = int(os.getenv("JOBS_PER_WORKER", default=1))
+# workers in a warm pool wait for new jobs instead of exiting when the queue is empty
+IS_POOL_WORKER = os.getenv("WORKER_MODE", default="job") == "pool"
+# how often an idle pool worker checks the queue in case a notification was missed or a lease expired
+IDLE_POLL_SECS = 30
+
+
+structlog.configure(
+    processors=[
+        merge_contextvars,
+        structlog.processors.TimeStamper(fmt="%Y-%m-%d %H:%M.%S"),
+        structlog.processors.format_exc_info,
+        structlog.processors.JSONRenderer(),
+    ]
+)
+
+logger = structlog.get_logger()
+
+
+def _build_bundle(keys: list[str], filenames: list[str], bundle_key: str) -> int:
+    # the ZIP is streamed straight from the source objects to the bundle object, so nothing is written to disk
+    # and only a few parts are held in memory at a time
+    return upload_chunks_to_s3(
+        PULSE3D_UPLOADS_BUCKET,
+        bundle_key,
+        stream_zip(yield_s3_objects(bucket=PULSE3D_UPLOADS_BUCKET, keys=keys, filenames=filenames)),
+    )
+
+
+@get_download_bundle_item(batch_size=JOBS_PER_WORKER)
+async def process_item(pool, item):
+    bundle_meta = json.loads(item["meta"])
+    bundle_id = item["id"]
+
+    bind_contextvars(bundle_id=str(bundle_id), num_files=len(bundle_meta["keys"]))
+    logger.info(f"Processing item: {item}")
+
+    # bundles with the same contents have the same key, so rebuilding one overwrites the previous copy
+    bundle_key = f"bundles/{bundle_meta['bundle_hash']}.zip"
+    new_meta = {}
+    object_key = None
+
+    try:
+        # this is blocking, so run it in a thread to keep the lease heartbeat running
+        bundle_size = await asyncio.to_thread(
+            _build_bundle, bundle_meta["keys"], bundle_meta["filenames"], bundle_key
+        )
+    except Exception as e:
+        logger.exception("Failed building bundle")
+        new_meta["error"] = repr(e)
+        result = "error"
+    else:
+        logger.info(f"Uploaded {bundle_size} byte bundle to {PULSE3D_UPLOADS_BUCKET}/{bundle_key}")
+        new_meta["size"] = bundle_size
+        object_key = bundle_key
+        result = "finished"
+
+    clear_contextvars()
+
+    return result, new_meta, object_key
+
+
+async def main():
+    try:
+        logger.info(f"Download Bundle Worker v{VERSION} started")
+
+        DB_PASS = os.getenv("POSTGRES_PASSWORD")
+        DB_USER = os.getenv("POSTGRES_USER", default="curibio_jobs")
+        DB_HOST = os.getenv("POSTGRES_SERVER", default="psql-rds.default")
+        DB_NAME = os.getenv("POSTGRES_DB", default="curibio")
+
+        dsn = f"postgresql://{DB_USER}:{DB_PASS}@{DB_HOST}:5432/{DB_NAME}"
+
+        # need at most one connection per concurrent job while it runs queries, one for claiming jobs and renewing
+        # their leases, and one for listening for new jobs
+        async with asyncpg.create_pool(dsn=dsn, max_size=JOBS_PER_WORKER + 2) as pool:
+            async with listen_for_new_items(pool) as new_items_event:
+                stop_event = asyncio.Event()
+                if IS_POOL_WORKER:
+                    # when the pool is scaled down, finish the current job(s) before exiting
+                    def _handle_sigterm():
+                        logger.info("Received SIGTERM, stopping after current job(s)")
+                        stop_event.set()
+                        new_items_event.set()
+
+                    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, _handle_sigterm)
+
+                while not stop_event.is_set():
+                    # clear before claiming so a job added while processing is not missed
+                    new_items_event.clear()
+                    try:
+                        logger.info("Pulling job(s) from queue")
+                        await process_item(pool=pool, worker_id=WORKER_ID)
+                    except EmptyQueue as e:
+                        logger.info(f"No jobs in queue: {e}")
+                        if not IS_POOL_WORKER:
+                            return
+                        try:
+                            await asyncio.wait_for(new_items_event.wait(), timeout=IDLE_POLL_SECS)
+                        except asyncio.TimeoutError:
+                            pass
+                    except Exception:
+                        logger.exception("Processing queue item failed")
+                        return
+    finally:
+        logger.info(f"Download Bundle Worker v{VERSION} terminating")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
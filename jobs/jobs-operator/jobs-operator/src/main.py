@@ -26,6 +26,10 @@ def create_fn(body, spec, **kwargs):
     QUEUE_VAR = kclient.V1EnvVar(name="QUEUE", value=job_queue)
     ECR_REPO = kclient.V1EnvVar(name="ECR_REPO", value=spec["ecr_repo"])
     MAX_NUM_OF_WORKERS = kclient.V1EnvVar(name="MAX_NUM_OF_WORKERS", value=f"{spec['max_num_of_workers']}")
+    WORKER_MODE = kclient.V1EnvVar(name="WORKER_MODE", value=spec.get("worker_mode", "job"))
+    MIN_NUM_OF_WORKERS = kclient.V1EnvVar(
+        name="MIN_NUM_OF_WORKERS", value=f"{spec.get('min_num_of_workers', 0)}"
+    )
 
     PRODUCT_SPECIFIC_ENV_VARS = [
         kclient.V1EnvVar(name=var, value=value) for var, value in spec.get("product_specific", {}).items()
@@ -50,10 +54,13 @@ def create_fn(body, spec, **kwargs):
             QUEUE_VAR,
             ECR_REPO,
             MAX_NUM_OF_WORKERS,
+            WORKER_MODE,
+            MIN_NUM_OF_WORKERS,
             POSTGRES_USER,
             *PRODUCT_SPECIFIC_ENV_VARS,
         ],
         image_pull_policy="Always",
+        ports=[kclient.V1ContainerPort(name="metrics", container_port=8000)],
     )
 
     # Deployment template
@@ -64,7 +71,10 @@ def create_fn(body, spec, **kwargs):
             "replicas": 1,
             "selector": {"matchLabels": {"app": f"{job_queue}_qp"}},
             "template": {
-                "metadata": {"labels": {"app": f"{job_queue}_qp"}},
+                "metadata": {
+                    "labels": {"app": f"{job_queue}_qp"},
+                    "annotations": {"prometheus.io/scrape": "true", "prometheus.io/port": "8000"},
+                },
                 "spec": {"containers": [container], "nodeSelector": {"group": "services"}},
             },
         },
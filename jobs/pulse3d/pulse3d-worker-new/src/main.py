@@ -2,15 +2,18 @@ import asyncio
 import datetime
 import json
 import os
+import signal
 import tempfile
+import threading
 from typing import Any
+import uuid
 
 import asyncpg
 import boto3
 import duckdb
 import polars as pl
 import structlog
-from jobs import EmptyQueue, get_item
+from jobs import EmptyQueue, get_item, listen_for_new_items
 from mantarray_magnet_finding.exceptions import UnableToConvergeError
 from curibio_analysis_lib import NormalizationMethods
 from pulse3D import peak_finding, twitch_labelling
@@ -39,6 +42,17 @@ logger = structlog.get_logger()
 
 s3_client = boto3.client("s3")
 
+# pod name when running in k8s, used to mark which queue items this worker has claimed
+WORKER_ID = os.getenv("HOSTNAME", default=uuid.uuid4().hex)
+# number of jobs this worker will claim from the queue and process concurrently
+JOBS_PER_WORKER = int(os.getenv("JOBS_PER_WORKER", default=1))
+# workers in a warm pool wait for new jobs instead of exiting when the queue is empty
+IS_POOL_WORKER = os.getenv("WORKER_MODE", default="job") == "pool"
+# how often an idle pool worker checks the queue in case a notification was missed or a lease expired
+IDLE_POLL_SECS = 30
+
+_duckdb_local = threading.local()
+
 
 def configure_duckdb():
     # docker container has no home directory, so these need to be set manually
@@ -135,9 +149,17 @@ def get_s3_parquet_path(
     return f"s3://{PULSE3D_UPLOADS_BUCKET}/{customer_id}/{pipeline_stage}/{file_name}.parquet"
 
 
+def get_duckdb_con() -> duckdb.DuckDBPyConnection:
+    # jobs processed at the same time each run in their own thread, and a DuckDB connection can't be shared
+    # between threads. Cursors of the default connection share the settings and secrets set in configure_duckdb
+    if (con := getattr(_duckdb_local, "con", None)) is None:
+        con = _duckdb_local.con = duckdb.cursor()
+    return con
+
+
 def query_s3_parquet(query: str, *params: Any) -> pl.DataFrame:
     try:
-        df = duckdb.sql(query, params=params)
+        df = get_duckdb_con().sql(query, params=params)
     except Exception:
         raise QueryS3ParquetError()
     df = df.pl()
@@ -147,7 +169,7 @@ def query_s3_parquet(query: str, *params: Any) -> pl.DataFrame:
 
 
 def upload_parquet_to_s3(df_upload: pl.DataFrame, s3_obj_key: str) -> None:
-    duckdb.sql("SELECT * FROM df_upload").write_parquet(s3_obj_key)
+    get_duckdb_con().sql("SELECT * FROM df_upload").write_parquet(s3_obj_key)
 
 
 def handle_upload(
@@ -358,138 +380,140 @@ def validate_product(df_analysis: pl.DataFrame, job_details: dict[str, Any]) ->
         raise Exception(error_msg)
 
 
-@get_item(queue=f"pulse3d-v{PULSE3D_VERSION}")
-async def process_item(con, item):
-    # keeping initial log without bound variables
-    logger.info(f"Processing item: {item}")
+def run_analysis(
+    job_details: dict[str, Any], upload_details: dict[str, Any], additional_col_vals: dict[str, Any]
+) -> tuple[BaseMetadata, WaveformProcessingParameters]:
+    # try to download existing waveform pre-processing data, otherwise create and upload it
+    logger.info("Checking for existing waveform-pre-processing data in S3")
+    try:
+        df_analysis = query_s3_parquet(
+            "SELECT * FROM read_parquet($1) WHERE upload_id=$2 AND p3d_version=$3",
+            get_s3_parquet_path(job_details, "waveform_pre_processing"),
+            upload_details["id"],
+            PULSE3D_VERSION,
+        )
+        logger.info(
+            "Retrieved existing waveform-pre-processing data from S3, loading existing upload metadata from DB"
+        )
+        try:
+            upload_metadata = load_existing_upload_metadata(upload_details["meta"])
+        except LoadExistingUploadMetadataError:
+            logger.info("Error loading existing upload metadata from DB, loading from recording file")
+            upload_metadata = download_and_load_recording(upload_details).metadata
+    except QueryS3ParquetError:
+        logger.info("No existing waveform-pre-processing data found in S3, creating")
+        df_analysis, upload_metadata = create_pre_processing_data(
+            job_details, upload_details, additional_col_vals
+        )
+    except Exception:
+        logger.exception("Error loading existing waveform-pre-processing data")
+        raise
 
-    job_metadata = {"processed_by": PULSE3D_VERSION}  # sanity check
+    validate_product(df_analysis, job_details)
 
-    # Tanner (3/27/24): this is specifically for human-readable error messages. The actual message in the exception is handled separately
-    error_msg = None
+    logger.info("Loading analysis params")
+    try:
+        s3_parquet_file_name = get_s3_parquet_file_name(job_details, upload_metadata)
+        waveform_processing_params, peak_finding_params, twitch_labelling_params = get_analysis_params(
+            job_details, upload_metadata
+        )
+    except Exception:
+        logger.exception("Failed loading analysis params")
+        raise
 
+    # create and upload waveform processing data
+    logger.info("Running waveform-processing")
     try:
-        job_details, upload_details, additional_col_vals = await load_details(con, item)
+        df_analysis = process(df_analysis, upload_metadata, waveform_processing_params)
+    except Exception as e:
+        logger.exception("Failed running waveform-processing")
+        raise ExceptionWithErrorMsg("Waveform processing failed") from e
 
-        # try to download existing waveform pre-processing data, otherwise create and upload it
-        logger.info("Checking for existing waveform-pre-processing data in S3")
-        try:
-            df_analysis = query_s3_parquet(
-                "SELECT * FROM read_parquet($1) WHERE upload_id=$2 AND p3d_version=$3",
-                get_s3_parquet_path(job_details, "waveform_pre_processing"),
-                upload_details["id"],
-                PULSE3D_VERSION,
-            )
-            logger.info(
-                "Retrieved existing waveform-pre-processing data from S3, loading existing upload metadata from DB"
-            )
-            try:
-                upload_metadata = load_existing_upload_metadata(upload_details["meta"])
-            except LoadExistingUploadMetadataError:
-                logger.info("Error loading existing upload metadata from DB, loading from recording file")
-                upload_metadata = download_and_load_recording(upload_details).metadata
-        except QueryS3ParquetError:
-            logger.info("No existing waveform-pre-processing data found in S3, creating")
-            df_analysis, upload_metadata = create_pre_processing_data(
-                job_details, upload_details, additional_col_vals
-            )
-        except Exception:
-            logger.exception("Error loading existing waveform-pre-processing data")
-            raise
+    logger.info("Uploading waveform-processing results")
+    try:
+        handle_upload(
+            df_analysis, s3_parquet_file_name, job_details, "waveform_processing", additional_col_vals
+        )
+    except Exception:
+        logger.exception("Failed uploading waveform-processing results")
+        raise
 
-        validate_product(df_analysis, job_details)
+    # create waveform post-processing data
+    logger.info("Running waveform-post-processing")
+    try:
+        df_analysis = post_process(df_analysis, waveform_processing_params)
+    except Exception as e:
+        logger.exception("Failed running waveform-post-processing")
+        raise ExceptionWithErrorMsg("Waveform post-processing failed") from e
 
-        logger.info("Loading analysis params")
+    # check for IA data in S3 for this job, if not found then run peak finding. In either case, upload
+    # result of peak finding module
+    logger.info("Checking for IA data in S3")
+    try:
+        # TODO figure out how we want to store IA data in S3 and then update this query
+        query_s3_parquet(
+            "SELECT * FROM read_parquet('$1') WHERE FALSE",
+            get_s3_parquet_path(job_details, "interactive_analysis"),
+        )
+        logger.info("Retrieved IA data from S3")
+        additional_col_vals["interactive_analysis"] = True
+        # TODO should the peak/valley data just be passed into peak_finding so it can handle it on its own?
+        # might also be easier to enforce schema that way
+        logger.info("Loaded data from IA")
+    except QueryS3ParquetError:
+        logger.info("No IA data found in S3")
+        additional_col_vals["interactive_analysis"] = False
+
+        logger.info("Running peak-finding")
         try:
-            s3_parquet_file_name = get_s3_parquet_file_name(job_details, upload_metadata)
-            waveform_processing_params, peak_finding_params, twitch_labelling_params = get_analysis_params(
-                job_details, upload_metadata
-            )
-        except Exception:
-            logger.exception("Failed loading analysis params")
-            raise
+            df_analysis = peak_finding.run(df_analysis, peak_finding_params)
+        except Exception as e:
+            logger.exception("Failed running peak-finding")
+            raise ExceptionWithErrorMsg("Peak detection failed") from e
+    except Exception as e:
+        logger.exception("Failed loading IA data")
+        raise ExceptionWithErrorMsg("Loading interactive analysis data failed") from e
 
-        # create and upload waveform processing data
-        logger.info("Running waveform-processing")
-        try:
-            df_analysis = process(df_analysis, upload_metadata, waveform_processing_params)
-        except Exception:
-            error_msg = "Waveform processing failed"
-            logger.exception("Failed running waveform-processing")
-            raise
+    logger.info("Uploading peak-finding results")
+    try:
+        handle_upload(df_analysis, s3_parquet_file_name, job_details, "peak_finding", additional_col_vals)
+    except Exception:
+        logger.exception("Failed uploading peak-finding results")
+        raise
 
-        logger.info("Uploading waveform-processing results")
-        try:
-            handle_upload(
-                df_analysis, s3_parquet_file_name, job_details, "waveform_processing", additional_col_vals
-            )
-        except Exception:
-            logger.exception("Failed uploading waveform-processing results")
-            raise
+    # create and upload twitch labelling data
+    logger.info("Running twitch-labelling")
+    try:
+        df_analysis = twitch_labelling.run(df_analysis, twitch_labelling_params)
+    except Exception as e:
+        logger.exception("Failed running twitch-labelling")
+        raise ExceptionWithErrorMsg("Twitch labelling failed") from e
 
-        # create waveform post-processing data
-        logger.info("Running waveform-post-processing")
-        try:
-            df_analysis = post_process(df_analysis, waveform_processing_params)
-        except Exception:
-            error_msg = "Waveform post-processing failed"
-            logger.exception("Failed running waveform-post-processing")
-            raise
+    logger.info("Uploading twitch-labelling results")
+    try:
+        handle_upload(df_analysis, s3_parquet_file_name, job_details, "twitch_labelling", additional_col_vals)
+    except Exception:
+        logger.exception("Failed uploading twitch-labelling results")
+        raise
 
-        # check for IA data in S3 for this job, if not found then run peak finding. In either case, upload
-        # result of peak finding module
-        logger.info("Checking for IA data in S3")
-        try:
-            # TODO figure out how we want to store IA data in S3 and then update this query
-            query_s3_parquet(
-                "SELECT * FROM read_parquet('$1') WHERE FALSE",
-                get_s3_parquet_path(job_details, "interactive_analysis"),
-            )
-            logger.info("Retrieved IA data from S3")
-            additional_col_vals["interactive_analysis"] = True
-            # TODO should the peak/valley data just be passed into peak_finding so it can handle it on its own?
-            # might also be easier to enforce schema that way
-            logger.info("Loaded data from IA")
-        except QueryS3ParquetError:
-            logger.info("No IA data found in S3")
-            additional_col_vals["interactive_analysis"] = False
-
-            logger.info("Running peak-finding")
-            try:
-                df_analysis = peak_finding.run(df_analysis, peak_finding_params)
-            except Exception:
-                error_msg = "Peak detection failed"
-                logger.exception("Failed running peak-finding")
-                raise
-        except Exception:
-            error_msg = "Loading interactive analysis data failed"
-            logger.exception("Failed loading IA data")
-            raise
+    return upload_metadata, waveform_processing_params
 
-        logger.info("Uploading peak-finding results")
-        try:
-            handle_upload(df_analysis, s3_parquet_file_name, job_details, "peak_finding", additional_col_vals)
-        except Exception:
-            logger.exception("Failed uploading peak-finding results")
-            raise
 
-        # create and upload twitch labelling data
-        logger.info("Running twitch-labelling")
-        try:
-            df_analysis = twitch_labelling.run(df_analysis, twitch_labelling_params)
-        except Exception:
-            error_msg = "Twitch labelling failed"
-            logger.exception("Failed running twitch-labelling")
-            raise
+@get_item(queue=f"pulse3d-v{PULSE3D_VERSION}", batch_size=JOBS_PER_WORKER)
+async def process_item(pool, item):
+    # keeping initial log without bound variables
+    logger.info(f"Processing item: {item}")
 
-        logger.info("Uploading twitch-labelling results")
-        try:
-            handle_upload(
-                df_analysis, s3_parquet_file_name, job_details, "twitch_labelling", additional_col_vals
-            )
-        except Exception:
-            logger.exception("Failed uploading twitch-labelling results")
-            raise
+    job_metadata = {"processed_by": PULSE3D_VERSION}  # sanity check
+
+    try:
+        async with pool.acquire() as con:
+            job_details, upload_details, additional_col_vals = await load_details(con, item)
+
+        # the analysis is blocking, so run it in a thread to keep the lease heartbeat running
+        upload_metadata, waveform_processing_params = await asyncio.to_thread(
+            run_analysis, job_details, upload_details, additional_col_vals
+        )
 
         # handle metadata
         logger.info("Checking for new upload metadata to add to DB")
@@ -504,11 +528,12 @@ async def process_item(con, item):
             }
             if new_meta:
                 logger.info(f"Adding new upload metadata to DB: {new_meta}")
-                await con.execute(
-                    "UPDATE uploads SET meta=meta||$1::jsonb WHERE id=$2",
-                    json.dumps(new_meta),
-                    upload_details["id"],
-                )
+                async with pool.acquire() as con:
+                    await con.execute(
+                        "UPDATE uploads SET meta=meta||$1::jsonb WHERE id=$2",
+                        json.dumps(new_meta),
+                        upload_details["id"],
+                    )
             else:
                 logger.info("No new upload metadata to add to DB")
         except Exception:
@@ -535,9 +560,6 @@ async def process_item(con, item):
     except Exception as e:
         job_metadata["error"] = repr(e)
         result = "error"
-        # some errors do not include an error message
-        if error_msg:
-            job_metadata["error_msg"] = error_msg
     else:
         logger.info("Job complete")
         result = "finished"
@@ -562,15 +584,34 @@ async def main():
 
         configure_duckdb()
 
-        async with asyncpg.create_pool(dsn=dsn) as pool:
-            async with pool.acquire() as con, pool.acquire() as con_to_update_job_result:
-                while True:
+        # need at most one connection per concurrent job while it runs queries, one for claiming jobs and renewing
+        # their leases, and one for listening for new jobs
+        async with asyncpg.create_pool(dsn=dsn, max_size=JOBS_PER_WORKER + 2) as pool:
+            async with listen_for_new_items(pool) as new_items_event:
+                stop_event = asyncio.Event()
+                if IS_POOL_WORKER:
+                    # when the pool is scaled down, finish the current job(s) before exiting
+                    def _handle_sigterm():
+                        logger.info("Received SIGTERM, stopping after current job(s)")
+                        stop_event.set()
+                        new_items_event.set()
+
+                    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, _handle_sigterm)
+
+                while not stop_event.is_set():
+                    # clear before claiming so a job added while processing is not missed
+                    new_items_event.clear()
                     try:
-                        logger.info("Pulling job from queue")
-                        await process_item(con=con, con_to_update_job_result=con_to_update_job_result)
+                        logger.info("Pulling job(s) from queue")
+                        await process_item(pool=pool, worker_id=WORKER_ID)
                     except EmptyQueue as e:
                         logger.info(f"No jobs in queue: {e}")
-                        return
+                        if not IS_POOL_WORKER:
+                            return
+                        try:
+                            await asyncio.wait_for(new_items_event.wait(), timeout=IDLE_POLL_SECS)
+                        except asyncio.TimeoutError:
+                            pass
                     except Exception:
                         logger.exception("Failed processing queue item")
                         return
@@ -1,11 +1,16 @@
 import asyncio
+from functools import cache
+import math
 import os
 import random
+import time
 
 import asyncpg
+from jobs import get_queue_stats
 import structlog
 from kubernetes import client as kclient
 from kubernetes import config
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
 from structlog.contextvars import bind_contextvars, bound_contextvars, merge_contextvars
 
 structlog.configure(
@@ -21,6 +26,15 @@ logger = structlog.getLogger()
 
 ECR_REPO = os.getenv("ECR_REPO")
 MAX_NUM_OF_WORKERS = int(os.getenv("MAX_NUM_OF_WORKERS", default=5))
+# "job" starts a k8s Job per burst of queue items, "pool" keeps a long-lived Deployment of workers per version
+WORKER_MODE = os.getenv("WORKER_MODE", default="job")
+# number of workers to keep warm per version when running in pool mode
+MIN_NUM_OF_WORKERS = int(os.getenv("MIN_NUM_OF_WORKERS", default=0))
+# add a worker to a pool if an item has been waiting to be claimed for longer than this
+SCALE_UP_WAIT_SECS = 30
+POLL_INTERVAL_SECS = int(os.getenv("POLL_INTERVAL_SECS", default=30 if WORKER_MODE == "pool" else 5 * 60))
+# number of jobs each worker will claim and process concurrently
+JOBS_PER_WORKER = int(os.getenv("JOBS_PER_WORKER", default=1))
 QUEUE = os.getenv("QUEUE")
 MIN_MEMORY_MIB = f"{os.getenv('min_memory_mib')}Mi"
 
@@ -40,22 +54,102 @@ PULSE3D_UPLOADS_BUCKET = kclient.V1EnvVar(
     name="UPLOADS_BUCKET_ENV", value=os.getenv("pulse3d_uploads_bucket")
 )
 
+# notifications received within this window of the first one are handled together
+NOTIFICATION_DEBOUNCE_SECS = 0.5
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", default=8000))
+METRICS_INTERVAL_SECS = 15
+# table that workers of each queue record their results in
+RESULT_TABLES = {
+    "pulse3d": "jobs_result",
+    "advanced-analysis": "advanced_analysis_result",
+    "download-bundles": "download_bundles",
+}
+
+QUEUE_DEPTH = Gauge(
+    "queue_processor_queue_depth", "Number of items in the queue", ["queue", "version", "state"]
+)
+QUEUE_OLDEST_ITEM_AGE = Gauge(
+    "queue_processor_oldest_item_age_seconds",
+    "Age of the oldest unclaimed item in the queue",
+    ["queue", "version"],
+)
+WORKERS_SPAWNED = Counter(
+    "queue_processor_workers_spawned_total", "Number of workers started", ["queue", "version", "mode"]
+)
+WORKER_SPAWN_SECONDS = Histogram(
+    "queue_processor_worker_spawn_seconds",
+    "Time taken to start the worker(s) needed for a version",
+    ["queue", "mode"],
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+K8S_API_SECONDS = Histogram(
+    "queue_processor_k8s_api_seconds",
+    "Latency of k8s API calls",
+    ["call"],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+JOB_RUNTIME_SECONDS = Histogram(
+    "queue_processor_job_runtime_seconds",
+    "Runtime of finished jobs as recorded by the workers",
+    ["queue", "version", "status"],
+    buckets=(5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600),
+)
+
 
 JOB_LOCK = asyncio.Lock()
 
 
-def manage_jobs(version: str, target_num_workers: int):
-    # load kube config
+def _get_worker_env(*extra_env):
+    POSTGRES_PASSWORD = kclient.V1EnvVar(
+        name="POSTGRES_PASSWORD",
+        value_from=kclient.V1EnvVarSource(
+            secret_key_ref=kclient.V1SecretKeySelector(name=WORKER_DB_CRED_NAME, key=WORKER_DB_CRED_KEY)
+        ),
+    )
+    POSTGRES_USER = kclient.V1EnvVar(name="POSTGRES_USER", value=WORKER_DB_USER)
+    JOBS_PER_WORKER_ENV = kclient.V1EnvVar(name="JOBS_PER_WORKER", value=str(JOBS_PER_WORKER))
+
+    return [
+        POSTGRES_USER,
+        POSTGRES_PASSWORD,
+        PULSE3D_UPLOADS_BUCKET,
+        MANTARRAY_LOGS_BUCKET,
+        JOBS_PER_WORKER_ENV,
+        *extra_env,
+    ]
+
+
+@cache
+def _load_k8s_config():
     config.load_incluster_config()
-    job_api = kclient.BatchV1Api()
+
+
+@cache
+def _get_qp_pod_metadata():
+    """Return the metadata of the pod this code is being executed in.
+
+    This never changes while the process is running, so only needs to be looked up once.
+    """
     pod_api = kclient.CoreV1Api()
 
-    # get pod list to get uid to use in owner_reference when spinning up new jobs
-    # the pod needed is the pod this code is being executed in
-    qp_pods_list = pod_api.list_namespaced_pod(namespace=QUEUE, label_selector=f"app={QUEUE}_qp")
+    with K8S_API_SECONDS.labels(call="list_namespaced_pod").time():
+        qp_pods_list = pod_api.list_namespaced_pod(namespace=QUEUE, label_selector=f"app={QUEUE}_qp")
+    # during a rollout there may be more than one queue processor pod, so find this one by name
+    for pod in qp_pods_list.items:
+        if pod.metadata.name == os.getenv("HOSTNAME"):
+            return pod.metadata
+    return qp_pods_list.items[0].metadata
+
+
+def manage_jobs(version: str, target_num_workers: int):
+    _load_k8s_config()
+    job_api = kclient.BatchV1Api()
+
     # get existing jobs to prevent starting a job with the same count suffix
     # make sure to only get jobs of specific version
-    running_workers_list = job_api.list_namespaced_job(QUEUE, label_selector=f"job_version={version}")
+    with K8S_API_SECONDS.labels(call="list_namespaced_job").time():
+        running_workers_list = job_api.list_namespaced_job(QUEUE, label_selector=f"job_version={version}")
     num_of_active_workers = len(running_workers_list.items)
     logger.info(f"Found {num_of_active_workers} active v{version} workers")
 
@@ -66,13 +160,8 @@ def manage_jobs(version: str, target_num_workers: int):
 
     logger.info(f"Starting {num_workers_to_create} worker(s) for {QUEUE}:{version}")
 
-    POSTGRES_PASSWORD = kclient.V1EnvVar(
-        name="POSTGRES_PASSWORD",
-        value_from=kclient.V1EnvVarSource(
-            secret_key_ref=kclient.V1SecretKeySelector(name=WORKER_DB_CRED_NAME, key=WORKER_DB_CRED_KEY)
-        ),
-    )
-    POSTGRES_USER = kclient.V1EnvVar(name="POSTGRES_USER", value=WORKER_DB_USER)
+    # used in owner_reference of the new jobs
+    qp_pod_metadata = _get_qp_pod_metadata()
 
     # adding 1 to get 1-based index for name of worker
     for count in range(num_of_active_workers + 1, target_num_workers + 1):
@@ -88,7 +177,7 @@ def manage_jobs(version: str, target_num_workers: int):
         container = kclient.V1Container(
             name=formatted_name,
             image=complete_ecr_repo,
-            env=[POSTGRES_USER, POSTGRES_PASSWORD, PULSE3D_UPLOADS_BUCKET, MANTARRAY_LOGS_BUCKET],
+            env=_get_worker_env(),
             image_pull_policy="Always",
             resources=resources,
         )
@@ -116,23 +205,155 @@ def manage_jobs(version: str, target_num_workers: int):
                         api_version="v1",
                         controller=True,
                         kind="Pod",
-                        uid=qp_pods_list.items[0].metadata.uid,
-                        name=qp_pods_list.items[0].metadata.name,
+                        uid=qp_pod_metadata.uid,
+                        name=qp_pod_metadata.name,
                     )
                 ],
             ),
             spec=spec,
         )
 
-        job_api.create_namespaced_job(namespace=QUEUE, body=job)
+        with K8S_API_SECONDS.labels(call="create_namespaced_job").time():
+            job_api.create_namespaced_job(namespace=QUEUE, body=job)
+        WORKERS_SPAWNED.labels(queue=QUEUE, version=version, mode="job").inc()
+
+
+def get_worker_pools() -> dict[str, int]:
+    """Return the number of replicas of each existing worker pool, keyed by version."""
+    _load_k8s_config()
+    apps_api = kclient.AppsV1Api()
+
+    with K8S_API_SECONDS.labels(call="list_namespaced_deployment").time():
+        pools = apps_api.list_namespaced_deployment(QUEUE, label_selector=f"worker_pool={QUEUE}")
+    return {pool.metadata.labels["pool_version"]: pool.spec.replicas for pool in pools.items}
+
+
+def get_pool_target(
+    num_replicas: int, num_items: int, num_claimed: int, oldest_unclaimed_secs: float | None
+) -> int:
+    # one worker per JOBS_PER_WORKER items in the queue, including items currently being processed
+    target = math.ceil(num_items / JOBS_PER_WORKER)
+    # items are waiting even though there should be enough workers (e.g. workers still starting up), so add another
+    if oldest_unclaimed_secs is not None and oldest_unclaimed_secs > SCALE_UP_WAIT_SECS:
+        target = max(target, num_replicas + 1)
+    # k8s picks which pods to remove when scaling down, so wait until no jobs are running to avoid interrupting one
+    if num_claimed:
+        target = max(target, num_replicas)
+
+    return min(max(target, MIN_NUM_OF_WORKERS), MAX_NUM_OF_WORKERS)
+
+
+def manage_worker_pool(version: str, num_replicas: int | None, target_num_workers: int):
+    if num_replicas == target_num_workers:
+        logger.info(f"v{version} worker pool already has target number ({target_num_workers}) of workers")
+        return
+
+    _load_k8s_config()
+    apps_api = kclient.AppsV1Api()
+
+    name = f"{QUEUE}-worker-pool-v{'-'.join(version.split('.'))}"
+
+    if num_replicas is not None:
+        logger.info(f"Scaling v{version} worker pool from {num_replicas} to {target_num_workers} worker(s)")
+        with K8S_API_SECONDS.labels(call="patch_namespaced_deployment").time():
+            apps_api.patch_namespaced_deployment(
+                name=name, namespace=QUEUE, body={"spec": {"replicas": target_num_workers}}
+            )
+        if target_num_workers > num_replicas:
+            WORKERS_SPAWNED.labels(queue=QUEUE, version=version, mode="pool").inc(
+                target_num_workers - num_replicas
+            )
+        return
+
+    logger.info(f"Creating v{version} worker pool with {target_num_workers} worker(s)")
+
+    # pools are owned by the queue processor deployment so they are cleaned up along with it, rather than being
+    # recreated each time the queue processor pod restarts
+    with K8S_API_SECONDS.labels(call="read_namespaced_deployment").time():
+        qp_deployment = apps_api.read_namespaced_deployment(name=f"{QUEUE}-queue-processor", namespace=QUEUE)
+
+    labels = {"worker_pool": QUEUE, "pool_version": version}
+    container = kclient.V1Container(
+        name=f"{QUEUE}-worker",
+        image=f"{ECR_REPO}:{version}",
+        env=_get_worker_env(kclient.V1EnvVar(name="WORKER_MODE", value="pool")),
+        # pods are long-lived, so no need to pull the image every time one starts
+        image_pull_policy="IfNotPresent",
+        resources=kclient.V1ResourceRequirements(requests={"memory": MIN_MEMORY_MIB}),
+    )
+    deployment = kclient.V1Deployment(
+        api_version="apps/v1",
+        kind="Deployment",
+        metadata=kclient.V1ObjectMeta(
+            name=name,
+            labels=labels,
+            owner_references=[
+                kclient.V1OwnerReference(
+                    api_version="apps/v1",
+                    kind="Deployment",
+                    uid=qp_deployment.metadata.uid,
+                    name=qp_deployment.metadata.name,
+                )
+            ],
+        ),
+        spec=kclient.V1DeploymentSpec(
+            replicas=target_num_workers,
+            selector=kclient.V1LabelSelector(match_labels=labels),
+            template=kclient.V1PodTemplateSpec(
+                metadata=kclient.V1ObjectMeta(labels=labels),
+                spec=kclient.V1PodSpec(
+                    containers=[container],
+                    node_selector={"group": "workers"},
+                    # give workers time to finish their current job(s) when the pool is scaled down
+                    termination_grace_period_seconds=15 * 60,
+                ),
+            ),
+        ),
+    )
+
+    with K8S_API_SECONDS.labels(call="create_namespaced_deployment").time():
+        apps_api.create_namespaced_deployment(namespace=QUEUE, body=deployment)
+    WORKERS_SPAWNED.labels(queue=QUEUE, version=version, mode="pool").inc(target_num_workers)
+
+
+def update_queue_metrics(records):
+    # clear first so that versions which no longer have any items in the queue are not reported
+    QUEUE_DEPTH.clear()
+    QUEUE_OLDEST_ITEM_AGE.clear()
+
+    for record in records:
+        version = record["version"]
+        QUEUE_DEPTH.labels(queue=QUEUE, version=version, state="claimed").set(record["num_claimed"])
+        QUEUE_DEPTH.labels(queue=QUEUE, version=version, state="unclaimed").set(
+            record["count"] - record["num_claimed"]
+        )
+        QUEUE_OLDEST_ITEM_AGE.labels(queue=QUEUE, version=version).set(record["oldest_unclaimed_secs"] or 0)
+
+
+async def record_job_runtimes(con, result_table: str, since):
+    """Observe the runtimes of jobs which finished after `since` and return the latest finish time seen."""
+    rows = await con.fetch(
+        f"SELECT meta->>'version' AS version, status, runtime, finished_at FROM {result_table} "
+        "WHERE finished_at > $1 AND runtime IS NOT NULL ORDER BY finished_at",
+        since,
+    )
+    for row in rows:
+        JOB_RUNTIME_SECONDS.labels(queue=QUEUE, version=row["version"], status=row["status"]).observe(
+            row["runtime"]
+        )
+
+    return rows[-1]["finished_at"] if rows else since
 
 
 async def process_queue(con):
     async with JOB_LOCK:
-        records = await con.fetch(
-            "SELECT meta->>'version' AS version, COUNT(*) FROM jobs_queue WHERE queue LIKE $1 GROUP BY version",
-            f"{QUEUE}%",
-        )
+        records = await get_queue_stats(con, queue_prefix=QUEUE)
+        update_queue_metrics(records)
+
+        # k8s client is blocking, so run it in a thread to avoid blocking notifications, metrics, etc.
+        if WORKER_MODE == "pool":
+            await asyncio.to_thread(process_worker_pools, records)
+            return
 
         if not records:
             logger.info("Queue is empty, nothing to process")
@@ -142,18 +363,56 @@ async def process_queue(con):
             version = record["version"]
             with bound_contextvars(version=version):
                 logger.info(f"Found {record['count']} item(s) for {version}")
-                # spin up max 5 workers, one per first five jobs in queue
-                num_of_workers = min(record["count"], MAX_NUM_OF_WORKERS)
-                manage_jobs(version, num_of_workers)
-
-
-async def handle_notification(connection, pid, channel, payload):
-    logger.info("Notification received from DB")
-    await process_queue(connection)
+                # spin up one worker per JOBS_PER_WORKER items in the queue, up to the max number of workers
+                num_of_workers = min(math.ceil(record["count"] / JOBS_PER_WORKER), MAX_NUM_OF_WORKERS)
+                with WORKER_SPAWN_SECONDS.labels(queue=QUEUE, mode="job").time():
+                    await asyncio.to_thread(manage_jobs, version, num_of_workers)
+
+
+def process_worker_pools(records):
+    worker_pools = get_worker_pools()
+    records_by_version = {record["version"]: record for record in records}
+
+    # also need to check existing pools of versions with no items in the queue so they can be scaled down
+    for version in records_by_version.keys() | worker_pools.keys():
+        with bound_contextvars(version=version):
+            num_replicas = worker_pools.get(version)
+            if record := records_by_version.get(version):
+                logger.info(
+                    f"Found {record['count']} item(s) for {version}, {record['num_claimed']} in progress"
+                )
+                target_num_workers = get_pool_target(
+                    num_replicas or 0, record["count"], record["num_claimed"], record["oldest_unclaimed_secs"]
+                )
+            else:
+                target_num_workers = get_pool_target(num_replicas, 0, 0, None)
+
+            with WORKER_SPAWN_SECONDS.labels(queue=QUEUE, mode="pool").time():
+                manage_worker_pool(version, num_replicas, target_num_workers)
+
+
+async def process_notifications(con, notification_event):
+    """Process the queue once per burst of notifications rather than once per notification."""
+    while True:
+        await notification_event.wait()
+        # wait for the rest of the burst (e.g. a bulk submission of jobs) before processing
+        await asyncio.sleep(NOTIFICATION_DEBOUNCE_SECS)
+        # clear before processing so that notifications received while processing trigger another run
+        notification_event.clear()
+        logger.info("Processing notification(s) from DB")
+        try:
+            await process_queue(con)
+        except Exception:
+            logger.exception("Error processing notification(s)")
 
 
 async def listen_to_queue(con):
     """Listen for notifications until the connection closes."""
+    notification_event = asyncio.Event()
+
+    def handle_notification(connection, pid, channel, payload):
+        notification_event.set()
+
     await con.add_listener("jobs_queue", handle_notification)
 
     db_con_termination_event = asyncio.Event()
@@ -165,7 +424,11 @@ async def listen_to_queue(con):
 
     con.add_termination_listener(cancel_listen)
 
-    await db_con_termination_event.wait()
+    notification_processor = asyncio.create_task(process_notifications(con, notification_event))
+    try:
+        await db_con_termination_event.wait()
+    finally:
+        notification_processor.cancel()
 
 
 async def run_listener(dsn):
@@ -191,15 +454,48 @@ async def run_poller(dsn):
         except Exception:
             logger.exception("Error in poller")
 
-        # wait 5 minutes before polling again
-        await asyncio.sleep(5 * 60)
+        await asyncio.sleep(POLL_INTERVAL_SECS)
+
+
+async def run_metrics_collector(dsn):
+    result_table = RESULT_TABLES.get(QUEUE)
+    since = None
+
+    while True:
+        try:
+            async with asyncpg.create_pool(dsn=dsn, max_size=1) as pool:
+                async with pool.acquire() as con:
+                    if since is None:
+                        # only report jobs that finish after the queue processor starts
+                        since = await con.fetchval("SELECT NOW()::timestamp")
+                    while True:
+                        start = time.monotonic()
+
+                        update_queue_metrics(await get_queue_stats(con, queue_prefix=QUEUE))
+                        if result_table:
+                            since = await record_job_runtimes(con, result_table, since)
+
+                        await asyncio.sleep(max(METRICS_INTERVAL_SECS - (time.monotonic() - start), 0))
+        except Exception:
+            logger.exception("Error in metrics collector")
+
+        await asyncio.sleep(METRICS_INTERVAL_SECS)
 
 
 async def main():
     dsn = f"postgresql://{QP_DB_USER}:{QP_DB_PASS}@{DB_HOST}:5432/{DB_NAME}"
 
+    # serves /metrics from a background thread
+    start_http_server(METRICS_PORT)
+
     try:
-        await asyncio.wait({asyncio.create_task(run_listener(dsn)), asyncio.create_task(run_poller(dsn))})
+        await asyncio.wait(
+            {
+                asyncio.create_task(run_listener(dsn)),
+                asyncio.create_task(run_poller(dsn)),
+                asyncio.create_task(run_metrics_collector(dsn)),
+            }
+        )
     except BaseException:
         logger.exception("ERROR IN QUEUE PROCESSOR")
 